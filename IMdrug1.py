@@ -5,9 +5,662 @@ import ttkbootstrap as bttk
 from ttkbootstrap.widgets import Notebook, DateEntry
 import mysql.connector
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import threading
 import queue
-from datetime import datetime
+import json
+import os
+import sys
+import argparse
+import hashlib
+import gzip
+import random
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, date, timedelta
+
+# โฟลเดอร์เก็บสถานะของโปรแกรมนำเข้า (เช่น ข้อมูลยาหลักที่ดาวน์โหลดไว้พร้อม ETag)
+IMPORTER_STATE_DIR = os.path.join(os.path.expanduser('~'), '.imdrug1')
+ETAG_CACHE_FILE = os.path.join(IMPORTER_STATE_DIR, 'etag_cache.json')
+# จำนวนรายการยาต่อคำขอ /api/medicines/bulk (server รับได้ไม่เกิน 5000)
+DRUG_LIST_BULK_CHUNK_SIZE = 1000
+# จำนวนผู้ใช้ต่อหน้าเมื่อโหลดรายชื่อผู้จ่ายยา (server จำกัดไม่เกิน MAX_PAGE_SIZE)
+USERS_PAGE_SIZE = 500
+# จำนวนแถวต่อชุดที่อ่านจาก HOSxP
+HOSXP_FETCH_BATCH_SIZE = 2000
+# การส่งข้อมูลตัดจ่าย: รายการต่อชุด จำนวนชุดที่อ่านรอส่งล่วงหน้า และการลองใหม่เมื่อเครือข่ายหรือ server ขัดข้อง
+# ส่งทีละชุดต่อหน่วยบริการ: ชุดของวันหลังต้องไม่ถูกบันทึกก่อนชุดของวันก่อน (FEFO ตัด Lot ตามลำดับวันที่)
+DISPENSE_UPLOAD_CHUNK_SIZE = 1000
+DISPENSE_UPLOAD_PREFETCH_CHUNKS = 2
+DISPENSE_UPLOAD_MAX_RETRIES = 5
+DISPENSE_UPLOAD_BACKOFF_SECONDS = 2
+DISPENSE_UPLOAD_TIMEOUT_SECONDS = 120
+# บีบอัด payload ตัดจ่ายด้วย gzip (JSON ชุดละ 1000 รายการเล็กลงหลายเท่า) ระดับต่ำพอที่จะไม่ทำให้การส่งช้าลง
+DISPENSE_UPLOAD_GZIP_LEVEL = 5
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+UPLOAD_JOURNAL_DIR = os.path.join(IMPORTER_STATE_DIR, 'upload_journal')
+# จำนวนวันล่าสุด (รวมวันนี้) ที่ HOSxP อาจยังบันทึกรายการเพิ่ม: อ่านและส่งซ้ำทุกรอบ และไม่เลื่อนจุดซิงค์ผ่าน
+# (hos_guid ไม่ได้เรียงตามเวลาบันทึก รายการที่เพิ่มทีหลังในวันที่เลยจุดซิงค์ไปแล้วจะไม่ถูกอ่านอีก)
+SYNC_WATERMARK_OPEN_DAYS = 2
+# รายการที่ตัดจ่ายไม่สำเร็จระหว่างซิงค์ถูกเก็บไว้ที่ระบบกลางและส่งใหม่ทุกรอบ จนผิดพลาดครบจำนวนครั้งนี้ (ค้างไว้ให้ตรวจสอบเอง)
+DISPENSE_SYNC_FAILURE_MAX_ATTEMPTS = 5
+# จำนวน connection ที่ Session เปิดค้างไว้ต่อหน่วยบริการ (ส่งตัดจ่ายหนึ่งชุดพร้อมกับคำขออื่น เช่น จุดซิงค์)
+HTTP_POOL_SIZE_PER_CLINIC = 2
+# โหมด headless: จำนวนหน่วยบริการที่ซิงค์พร้อมกัน
+HEADLESS_DEFAULT_WORKERS = 4
+STATUS_READY = "พร้อมส่ง"
+# สถานะ (tag) ของแถวในตาราง -> ข้อความในคอลัมน์สถานะ
+DRUG_LIST_TAG_LABELS = {'pending': '-', 'new': 'ยาใหม่', 'duplicate': 'ซ้ำ', 'sent': 'ส่งแล้ว'}
+DRUG_LIST_TAG_COLORS = {'new': '#d4edda', 'duplicate': '#fff3cd', 'sent': '#d1ecf1'}
+DISPENSE_TAG_LABELS = {'ready': STATUS_READY, 'error': 'ผิดพลาด: ไม่พบรหัสยานี้ในระบบกลาง'}
+DISPENSE_TAG_COLORS = {'ready': '#d4edda', 'error': '#f8d7da'}
+
+
+def iter_hosxp_dispense_batches(db_config, start_date, end_date, icodes, batch_size=HOSXP_FETCH_BATCH_SIZE, after=None):
+    """
+    อ่านรายการจ่ายยาจาก opitemrece เป็นชุดละไม่เกิน batch_size แถว เฉพาะ icode ที่มีในระบบกลาง
+    กรองและรวมจำนวนต่อ hos_guid ใน HOSxP เอง และ query ทีละวันด้วย cursor แบบ unbuffered
+    จึงได้ชุดแรกโดยไม่ต้องรออ่านทั้งเดือน และใช้หน่วยความจำไม่เกินหนึ่งชุด
+    เรียงตาม hos_guid ภายในวัน ข้อมูลชุดเดิมจึงแบ่งชุดได้เหมือนเดิมทุกครั้ง (ใช้ข้ามชุดที่ส่งแล้วใน journal)
+    after: จุดซิงค์ (vstdate, hos_guid) อ่านเฉพาะรายการที่อยู่หลังจุดนี้ (เทียบ hos_guid แบบ binary ตรงกับลำดับใน Python และ server)
+    เมื่อผู้ใช้ generator เลิกอ่านกลางทาง (ผิดพลาดหรือหยุดส่ง) แถวที่ยังไม่ได้อ่านของ query ที่ค้างอยู่ถูกทิ้งก่อนปิด connection
+    """
+    icodes = list(icodes)
+    if not icodes:
+        return
+    query = f"""
+        SELECT hos_guid, icode, vstdate, SUM(qty) AS qty
+        FROM opitemrece
+        WHERE vstdate = %s AND icode IN ({', '.join(['%s'] * len(icodes))}) {{after_filter}}
+        GROUP BY hos_guid, icode, vstdate
+        ORDER BY BINARY hos_guid, icode
+    """
+    if after:
+        start_date = max(start_date, date.fromisoformat(after[0]))
+    # consume_results: ปิด cursor/connection ได้แม้ผลของ query แบบ unbuffered ยังอ่านไม่หมด (อ่านทิ้งแทน error)
+    conn = mysql.connector.connect(**db_config, consume_results=True)
+    cursor = None
+    try:
+        cursor = conn.cursor(dictionary=True, buffered=False)
+        batch, day = [], start_date
+        while day <= end_date:
+            if after and day.isoformat() == after[0]:
+                cursor.execute(query.format(after_filter="AND BINARY hos_guid > %s"), (day, *icodes, after[1]))
+            else:
+                cursor.execute(query.format(after_filter=""), (day, *icodes))
+            while True:
+                rows = cursor.fetchmany(batch_size - len(batch))
+                if not rows:
+                    break
+                batch.extend(rows)
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+            day += timedelta(days=1)
+        if batch:
+            yield batch
+    finally:
+        if cursor is not None:
+            cursor.close()
+        conn.close()
+
+
+def fetch_hosxp_unmatched_icodes(db_config, start_date, end_date, icodes):
+    """สรุปต่อ icode ของยา (drugitems) ที่มีการจ่ายในช่วงวันที่แต่ยังไม่มีในระบบกลาง (ใช้แสดงเป็นรายการผิดพลาด)"""
+    icodes = list(icodes)
+    icode_filter = f"AND o.icode NOT IN ({', '.join(['%s'] * len(icodes))})" if icodes else ""
+    conn = mysql.connector.connect(**db_config)
+    try:
+        cursor = conn.cursor(dictionary=True)
+        cursor.execute(
+            f"""
+            SELECT o.icode, COUNT(DISTINCT o.hos_guid) AS line_count, SUM(o.qty) AS qty
+            FROM opitemrece o
+            JOIN drugitems d ON d.icode = o.icode
+            WHERE o.vstdate BETWEEN %s AND %s {icode_filter}
+            GROUP BY o.icode
+            """,
+            (start_date, end_date, *icodes)
+        )
+        return cursor.fetchall()
+    finally:
+        conn.close()
+
+
+def fetch_hosxp_drug_items(db_config):
+    """รายการยาที่ใช้งานอยู่ใน HOSxP เป็น tuple (icode, name, strength, units)"""
+    conn = mysql.connector.connect(**db_config)
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT icode, name, strength, units FROM drugitems WHERE istatus = 'y'")
+        return cursor.fetchall()
+    finally:
+        conn.close()
+
+
+def central_medicine_code_map(central_medicines):
+    """รหัสยา -> id ของยาในระบบกลาง (ใช้ทั้งแยกยาใหม่และแปลง icode ของรายการจ่ายยา)"""
+    return {str(med['medicine_code']): med['id'] for med in central_medicines}
+
+
+def iter_medicine_bulk_uploads(session, api_url, hcode, drug_rows):
+    """
+    ส่งรายการยา (icode, name, strength, units) ไปที่ /api/medicines/bulk คำขอละ DRUG_LIST_BULK_CHUNK_SIZE รายการ
+    yield ผลต่อชุด (start, จำนวนรายการในชุด, ตำแหน่งใน drug_rows ที่ส่งสำเร็จ, ข้อความผิดพลาด)
+    """
+    endpoint = f"{api_url}/api/medicines/bulk"
+    for start in range(0, len(drug_rows), DRUG_LIST_BULK_CHUNK_SIZE):
+        chunk = drug_rows[start:start + DRUG_LIST_BULK_CHUNK_SIZE]
+        medicines = [{"medicine_code": str(row[0]), "generic_name": row[1], "strength": row[2], "unit": row[3]} for row in chunk]
+        sent_positions, errors = [], []
+        try:
+            response = session.post(endpoint, json={"hcode": hcode, "medicines": medicines}, timeout=120)
+            if response.status_code == 200:
+                for result in response.json().get('results', []):
+                    if result['status'] == 'failed':
+                        errors.append(f"รหัสยา {result.get('medicine_code')}: {result.get('error')}")
+                        continue
+                    sent_positions.append(start + result['index'])
+            else:
+                errors.append(f"ส่งชุดที่ {start // DRUG_LIST_BULK_CHUNK_SIZE + 1} ผิดพลาด: {response.status_code} - {response.text[:200]}")
+        except requests.exceptions.RequestException as e:
+            errors.append(f"ส่งชุดที่ {start // DRUG_LIST_BULK_CHUNK_SIZE + 1} ผิดพลาด (เชื่อมต่อ): {e}")
+        yield start, len(chunk), sent_positions, errors
+
+
+def fetch_sync_watermark(session, api_url, hcode):
+    """จุดซิงค์ล่าสุดของหน่วยบริการจากระบบกลางเป็น key (vstdate, hos_guid) หรือ None เมื่อยังไม่เคยซิงค์"""
+    response = session.get(f"{api_url}/api/dispense/sync_watermark", params={"hcode": hcode}, timeout=15)
+    response.raise_for_status()
+    return sync_watermark_key(response.json().get('watermark'))
+
+
+def fetch_sync_failures(session, api_url, hcode):
+    """
+    รายการที่ตัดจ่ายไม่สำเร็จจากการซิงค์รอบก่อน ๆ ที่ระบบกลางเก็บไว้รอส่งใหม่ (list ของ dict จาก API)
+    None เมื่อระบบกลางรุ่นเก่ายังไม่เก็บรายการเหล่านี้ (จุดซิงค์จึงต้องไม่เลื่อนผ่านรายการที่ผิดพลาด)
+    """
+    response = session.get(f"{api_url}/api/dispense/sync_failures", params={"hcode": hcode}, timeout=30)
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+    return response.json().get('failures', [])
+
+
+def make_dispense_item(row, medicine_id):
+    """แปลงแถวที่รวมจาก HOSxP เป็นรายการที่พร้อมส่งตัดจ่าย"""
+    vstdate = row['vstdate']
+    return {
+        "icode": str(row['icode']),
+        "hos_guid": str(row['hos_guid']) if row['hos_guid'] is not None else None,
+        "qty": float(row['qty']),
+        "medicine_id": medicine_id,
+        "dispense_date_iso": vstdate.strftime('%Y-%m-%d') if hasattr(vstdate, 'strftime') else str(vstdate),
+        "status": STATUS_READY,
+    }
+
+
+def sync_watermark_key(value):
+    """แปลงจุดซิงค์จาก API ({"vstdate", "hos_guid"} หรือ null) เป็น key (vstdate, hos_guid) สำหรับเปรียบเทียบ"""
+    return (value['vstdate'], value['hos_guid']) if value else None
+
+
+def sync_watermark_value(key):
+    return {"vstdate": key[0], "hos_guid": key[1]} if key else None
+
+
+def sync_watermark_cutoff(today=None):
+    """วันที่ (ISO) แรกที่ยังเปิดอยู่: จุดซิงค์เลื่อนได้เฉพาะผ่านรายการที่วันที่ก่อนหน้านี้"""
+    return ((today or date.today()) - timedelta(days=SYNC_WATERMARK_OPEN_DAYS - 1)).isoformat()
+
+
+def create_http_session(pool_size=HTTP_POOL_SIZE_PER_CLINIC):
+    """Session แบบ keep-alive ใช้ร่วมกันทุกคำขอ คำขอ GET ลองใหม่อัตโนมัติ (POST ลองใหม่โดย DispenseUploader เอง)"""
+    session = requests.Session()
+    retry = Retry(total=3, backoff_factor=1, status_forcelist=RETRYABLE_STATUS_CODES, allowed_methods=frozenset({'GET'}))
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def dispense_chunk_key(items):
+    """รหัสของชุดจากเนื้อหา (ชุดเดิม = รหัสเดิม) ใช้อ้างอิงใน journal"""
+    content = json.dumps([(item['hos_guid'], item['medicine_id'], item['qty'], item['dispense_date_iso']) for item in items])
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+class UploadChunkError(Exception):
+    """ส่งชุดข้อมูลไม่สำเร็จ (server ปฏิเสธ หรือลองใหม่ครบจำนวนครั้งแล้ว)"""
+
+
+class UploadJournal:
+    """
+    บันทึกชุดที่ server ยืนยันแล้วลงไฟล์ JSON lines ในเครื่อง (หนึ่งไฟล์ต่องาน เช่น hcode + ช่วงวันที่)
+    เมื่องานถูกขัดจังหวะ การรันงานเดิมซ้ำจะข้ามชุดที่อยู่ใน journal และลบไฟล์เมื่อส่งครบทุกชุด
+    """
+
+    def __init__(self, job_key):
+        self.path = os.path.join(UPLOAD_JOURNAL_DIR, hashlib.sha1(job_key.encode('utf-8')).hexdigest()[:16] + '.jsonl')
+        self._lock = threading.Lock()
+        self.acked = self._load()
+
+    def _load(self):
+        acked = {}
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # บรรทัดสุดท้ายที่เขียนไม่จบตอนโปรแกรมถูกปิด
+                    acked[entry['chunk']] = entry
+        except OSError:
+            pass
+        return acked
+
+    def is_acked(self, chunk_key):
+        return chunk_key in self.acked
+
+    def record(self, chunk_key, entry):
+        # เขียนและ fsync ทันทีหลัง server ยืนยัน เพื่อไม่ให้ชุดที่ยืนยันแล้วหายเมื่อเครื่องดับ
+        entry = {"chunk": chunk_key, **entry}
+        with self._lock:
+            os.makedirs(UPLOAD_JOURNAL_DIR, exist_ok=True)
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self.acked[chunk_key] = entry
+
+    def discard(self):
+        with self._lock:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+            self.acked = {}
+
+
+class DispenseUploader:
+    """
+    ส่งรายการตัดจ่ายไปที่ /api/dispense/process_excel_dispense เป็นชุดละ chunk_size รายการผ่าน Session เดียว
+    - ส่งทีละชุดตามลำดับวันที่ (FEFO ของวันก่อนต้องได้ Lot ก่อน) ระหว่างนั้นอ่านชุดถัดไปรอไว้ได้ไม่เกิน DISPENSE_UPLOAD_PREFETCH_CHUNKS ชุด
+      เมื่อชุดใดส่งไม่สำเร็จจะไม่ส่งชุดหลังจากนั้น (รอบถัดไปส่งต่อจากชุดที่ค้าง)
+    - ชุดที่ล้มเหลวชั่วคราว (เชื่อมต่อไม่ได้, timeout, 5xx, 429) ลองใหม่แบบ exponential backoff
+      การส่งซ้ำปลอดภัย: ทุกชุดมี idempotency_key (รอบนี้ + เนื้อหาชุด) server ทำต่อจากส่วนที่ commit แล้วแทนการตัดจ่ายซ้ำ
+      และตอบ 409 (in_progress) เมื่อคำขอเดิมยังทำงานอยู่ จึงรอแล้วส่งใหม่
+    - ทุกชุดในรอบเดียวกันบันทึกต่อในเอกสารตัดจ่าย (DSPEXC) เดียวกัน: ชุดถัดไปส่ง dispense_record_id ที่ชุดก่อนได้รับ
+    - โหมดซิงค์: ระบบกลางเก็บรายการที่ผิดพลาดไว้ (จุดซิงค์เลื่อนผ่านได้) ตอนเริ่มส่งจะส่งรายการที่ค้างจากรอบก่อน ๆ ใหม่ก่อน
+      ยกเว้นรายการที่ผิดพลาดครบ DISPENSE_SYNC_FAILURE_MAX_ATTEMPTS ครั้งแล้ว (นับเป็น stuck_failures ให้ตรวจสอบเอง)
+    - ชุดที่ server ยืนยันแล้วบันทึกลง journal
+    - เมื่อระบุ watermark_cutoff (โหมดซิงค์ต่อจากจุดล่าสุด) แต่ละชุดแนบช่วงจุดซิงค์ (after, to] ให้ server เลื่อนใน transaction เดียวกับการบันทึก
+      ชุดที่ commit ไม่ตามลำดับทำให้จุดซิงค์ค้างอยู่ก่อนหน้า จึงเลื่อนจาก watermark_after ถึงชุดสุดท้ายอีกครั้งเมื่อส่งครบโดยไม่มีรายการผิดพลาด
+    """
+
+    def __init__(self, session, api_url, hcode, dispenser_id, journal, log,
+                 chunk_size=DISPENSE_UPLOAD_CHUNK_SIZE, max_retries=DISPENSE_UPLOAD_MAX_RETRIES,
+                 watermark_after=None, watermark_cutoff=None):
+        self.session = session
+        self.api_url = api_url
+        self.endpoint = f"{api_url}/api/dispense/process_excel_dispense"
+        self.hcode = hcode
+        self.dispenser_id = dispenser_id
+        self.journal = journal
+        self.log = log
+        self.chunk_size = chunk_size
+        self.max_retries = max_retries
+        self.run_id = uuid.uuid4().hex  # คำขอที่ส่งซ้ำภายในรอบเดียวกันใช้ idempotency_key เดิม
+        self.dispense_record_id = None  # เอกสารตัดจ่ายของรอบนี้ (สร้างโดยชุดแรกที่บันทึกรายการได้)
+        self.server_records_failures = False  # ระบบกลางเก็บรายการที่ผิดพลาดไว้ส่งใหม่ (ตรวจตอนเริ่ม upload ในโหมดซิงค์)
+        self.watermark_after = watermark_after
+        self.watermark_cutoff = watermark_cutoff
+        self.compress = True  # ปิดเองเมื่อ server รุ่นเก่าอ่าน body ที่บีบอัดไม่ได้
+
+    def _chunks(self, batches):
+        buffer = []
+        for batch in batches:
+            buffer.extend(batch)
+            while len(buffer) >= self.chunk_size:
+                yield buffer[:self.chunk_size]
+                buffer = buffer[self.chunk_size:]
+        if buffer:
+            yield buffer
+
+    def _chunk_watermark(self, chunk):
+        # key ของรายการสุดท้ายในชุด (เรียงตาม vstdate, hos_guid) ที่อยู่ก่อนวันที่ยังเปิดอยู่
+        for item in reversed(chunk):
+            if item['dispense_date_iso'] < self.watermark_cutoff and item['hos_guid']:
+                return item['dispense_date_iso'], item['hos_guid']
+        return None
+
+    def _load_sync_failures(self, summary):
+        # รายการที่ค้างจากรอบก่อน ๆ ในรูปแบบเดียวกับรายการจาก HOSxP (ไม่รวมรายการที่ผิดพลาดครบจำนวนครั้งแล้ว)
+        try:
+            failures = fetch_sync_failures(self.session, self.api_url, self.hcode)
+        except (requests.exceptions.RequestException, ValueError) as e:
+            self.log(f"...ดึงรายการที่รอส่งใหม่ไม่สำเร็จ: {e} (จุดซิงค์จะไม่เลื่อนผ่านรายการที่ผิดพลาดในรอบนี้)")
+            return []
+        if failures is None:
+            return []
+        self.server_records_failures = True
+        retry_items = [
+            {"icode": None, "hos_guid": failure['hos_guid'], "qty": failure['quantity_dispensed'], "medicine_id": failure['medicine_id'],
+             "dispense_date_iso": failure['dispense_date_iso'], "status": STATUS_READY}
+            for failure in failures if failure['attempts'] < DISPENSE_SYNC_FAILURE_MAX_ATTEMPTS
+        ]
+        summary['retried_failures'], summary['stuck_failures'] = len(retry_items), len(failures) - len(retry_items)
+        if failures:
+            self.log(f"...ส่งใหม่ {len(retry_items):,} รายการที่ผิดพลาดจากรอบก่อน (ผิดพลาดครบ {DISPENSE_SYNC_FAILURE_MAX_ATTEMPTS} ครั้งแล้ว {summary['stuck_failures']:,} รายการ รอตรวจสอบ)")
+        return retry_items
+
+    def _planned_chunks(self, batches, retry_items):
+        # ชุดของรายการที่รอส่งใหม่ (วันที่ก่อนจุดซิงค์) ส่งก่อนรายการใหม่จาก HOSxP คืนค่า (ชุด, เป็นชุดส่งใหม่หรือไม่)
+        for start in range(0, len(retry_items), self.chunk_size):
+            yield retry_items[start:start + self.chunk_size], True
+        for chunk in self._chunks(batches):
+            yield chunk, False
+
+    def upload(self, batches):
+        """ส่งรายการทั้งหมดจาก batches (iterable ของ list รายการ) คืนค่าสรุปผลเป็น dict"""
+        summary = {"chunks": 0, "skipped_chunks": 0, "failed_chunks": 0, "items": 0, "processed": 0, "failed_items": 0, "errors": [], "watermark": self.watermark_after,
+                   "retried_failures": 0, "stuck_failures": 0}
+        retry_items = self._load_sync_failures(summary) if self.watermark_cutoff else []
+        summary_lock = threading.Lock()
+        slots = threading.BoundedSemaphore(1 + DISPENSE_UPLOAD_PREFETCH_CHUNKS)
+        watermark_to, journal_failed_items = self.watermark_after, 0
+        stopped = threading.Event()
+
+        def upload_in_order(chunk_key, chunk, watermark_range, retry):
+            if stopped.is_set():
+                raise UploadChunkError(f"ไม่ได้ส่งชุด {chunk_key[:8]} เพราะชุดก่อนหน้าส่งไม่สำเร็จ")
+            return self._upload_chunk(chunk_key, chunk, watermark_range, retry)
+
+        def on_done(future):
+            slots.release()
+            with summary_lock:
+                try:
+                    result = future.result()
+                except Exception as e:
+                    stopped.set()
+                    summary['failed_chunks'] += 1
+                    summary['errors'].append(str(e))
+                    return
+                summary['processed'] += result['processed']
+                summary['failed_items'] += result['failed']
+                if result['watermark'] and (summary['watermark'] is None or result['watermark'] > summary['watermark']):
+                    summary['watermark'] = result['watermark']
+                self.log(f"...ส่งแล้ว {summary['processed']:,} รายการ ({result['message']})")
+
+        # worker เดียว: ชุดถูกส่งตามลำดับที่อ่านได้ (vstdate, hos_guid)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            for chunk, retry in self._planned_chunks(batches, retry_items):
+                if stopped.is_set():
+                    break
+                chunk_key = dispense_chunk_key(chunk)
+                watermark_range = None
+                if self.watermark_cutoff and not retry:
+                    chunk_to = self._chunk_watermark(chunk)
+                    if chunk_to and (watermark_to is None or chunk_to > watermark_to):
+                        watermark_range, watermark_to = (watermark_to, chunk_to), chunk_to
+                with summary_lock:
+                    summary['chunks'] += 1
+                    summary['items'] += len(chunk)
+                    if self.journal.is_acked(chunk_key):
+                        summary['skipped_chunks'] += 1
+                        journal_failed_items += self.journal.acked[chunk_key].get('failed', 0)
+                        continue
+                slots.acquire()
+                executor.submit(upload_in_order, chunk_key, chunk, watermark_range, retry).add_done_callback(on_done)
+
+        if summary['failed_chunks'] == 0:
+            self.journal.discard()
+        # รายการที่ผิดพลาดไม่ขวางจุดซิงค์เมื่อระบบกลางเก็บไว้ส่งใหม่แล้ว (ระบบกลางรุ่นเก่า: ต้องไม่มีรายการผิดพลาดเลย)
+        failures_kept = self.server_records_failures or (summary['failed_items'] == 0 and journal_failed_items == 0)
+        if self.watermark_cutoff and watermark_to and watermark_to != summary['watermark'] and summary['failed_chunks'] == 0 and failures_kept:
+            self._advance_watermark(watermark_to, summary)
+        return summary
+
+    def _advance_watermark(self, watermark_to, summary):
+        # ทุกรายการตั้งแต่ watermark_after ถึง watermark_to ถูกบันทึกแล้ว เลื่อนจุดซิงค์ที่ค้างจากชุดที่ commit ไม่ตามลำดับ
+        try:
+            response = self.session.put(f"{self.api_url}/api/dispense/sync_watermark", json={"hcode": self.hcode, "after": sync_watermark_value(self.watermark_after), "to": sync_watermark_value(watermark_to)}, timeout=30)
+            res_data = response.json()
+            if response.status_code == 200:
+                summary['watermark'] = sync_watermark_key(res_data.get('watermark'))
+            else:
+                self.log(f"...เลื่อนจุดซิงค์ไม่สำเร็จ: {response.status_code} - {res_data.get('error')} (รอบถัดไปจะส่งรายการหลังจุดซิงค์เดิมซ้ำ)")
+        except (requests.exceptions.RequestException, ValueError) as e:
+            self.log(f"...เลื่อนจุดซิงค์ไม่สำเร็จ: {e} (รอบถัดไปจะส่งรายการหลังจุดซิงค์เดิมซ้ำ)")
+
+    def _post_payload(self, payload, compressed):
+        if not compressed:
+            return self.session.post(self.endpoint, json=payload, timeout=DISPENSE_UPLOAD_TIMEOUT_SECONDS)
+        body = gzip.compress(json.dumps(payload).encode('utf-8'), compresslevel=DISPENSE_UPLOAD_GZIP_LEVEL)
+        headers = {'Content-Type': 'application/json', 'Content-Encoding': 'gzip'}
+        return self.session.post(self.endpoint, data=body, headers=headers, timeout=DISPENSE_UPLOAD_TIMEOUT_SECONDS)
+
+    def _upload_chunk(self, chunk_key, chunk, watermark_range=None, retry=False):
+        payload = {
+            "hcode": self.hcode, "dispenser_id": self.dispenser_id, "bulk_mode": True,
+            "idempotency_key": hashlib.sha1(f"{self.run_id}|{chunk_key}".encode('utf-8')).hexdigest(),
+            "dispense_items": [{"medicine_id": item['medicine_id'], "quantity_dispensed": item['qty'], "hos_guid": item['hos_guid'], "dispense_date_iso": item['dispense_date_iso']} for item in chunk],
+        }
+        if self.dispense_record_id:
+            payload["dispense_record_id"] = self.dispense_record_id
+        if retry:
+            payload["sync_failure_retry"] = True
+        if watermark_range:
+            payload["sync_watermark"] = {"after": sync_watermark_value(watermark_range[0]), "to": sync_watermark_value(watermark_range[1])}
+        processed, failed, attempt = 0, 0, 0
+        while True:
+            try:
+                compressed = self.compress
+                response = self._post_payload(payload, compressed)
+                try:
+                    res_data = response.json()
+                except ValueError:
+                    res_data = {}
+                if compressed and (response.status_code == 415 or (response.status_code == 400 and not res_data)):
+                    # server ไม่รู้จัก Content-Encoding ของ request: ส่ง JSON ปกติแทนตั้งแต่ชุดนี้
+                    self.compress = False
+                    self.log("...server ไม่รองรับ request ที่บีบอัด ส่งข้อมูลแบบไม่บีบอัดแทน")
+                    continue
+                if response.status_code == 202:
+                    # server commit ไปบางส่วนแล้ว ส่ง payload เดิมต่อด้วย next_cursor
+                    processed += res_data.get('processed_count', 0)
+                    failed += len(res_data.get('failed_details', []))
+                    payload["resume_cursor"] = res_data.get('next_cursor')
+                    if failed and not self.server_records_failures:
+                        payload.pop("sync_watermark", None)  # server รุ่นเก่าไม่เก็บรายการที่ผิดพลาด จึงต้องไม่เลื่อนจุดซิงค์ผ่านไป
+                    attempt = 0
+                    continue
+                if response.status_code in (201, 207) or (response.status_code == 400 and 'processed_count' in res_data):
+                    processed += res_data.get('processed_count', 0)
+                    failed += len(res_data.get('failed_details', []))
+                    # ยอดสะสมจาก server นับรวมรอบที่ commit ก่อน timeout ซึ่ง client ไม่ได้รับผล
+                    processed = res_data.get('total_processed_count', processed)
+                    failed = res_data.get('total_failed_count', failed)
+                    if res_data.get('dispense_record_id'):
+                        self.dispense_record_id = res_data['dispense_record_id']
+                    self.journal.record(chunk_key, {"items": len(chunk), "processed": processed, "failed": failed, "dispense_record_number": res_data.get('dispense_record_number')})
+                    return {"processed": processed, "failed": failed, "message": res_data.get('message', ''), "watermark": sync_watermark_key(res_data.get('sync_watermark'))}
+                if res_data.get('next_cursor'):
+                    payload["resume_cursor"] = res_data['next_cursor']
+                error = f"{response.status_code} - {res_data.get('error', response.text[:200])}"
+                if response.status_code not in RETRYABLE_STATUS_CODES and not (response.status_code == 409 and res_data.get('in_progress')):
+                    raise UploadChunkError(error)
+            except requests.exceptions.RequestException as e:
+                error = str(e)
+            attempt += 1
+            if attempt > self.max_retries:
+                raise UploadChunkError(f"ส่งไม่สำเร็จหลังลองใหม่ {self.max_retries} ครั้ง: {error}")
+            delay = DISPENSE_UPLOAD_BACKOFF_SECONDS * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5)
+            self.log(f"...ส่งชุด {chunk_key[:8]} ผิดพลาด ({error}) ลองใหม่ครั้งที่ {attempt} ใน {delay:.0f} วินาที")
+            time.sleep(delay)
+
+
+def format_grid_cell(value):
+    return '' if value is None else str(value)
+
+
+class VirtualGrid:
+    """
+    ตารางแสดงผลแบบ virtual: ข้อมูลทุกแถวเก็บเป็น tuple ใน list (ค่าของคอลัมน์, tag) แต่ Treeview มี item เท่าจำนวนแถวที่มองเห็นเท่านั้น
+    Thread อื่นแก้ข้อมูลผ่านเมธอดที่ล็อกไว้ได้โดยตรง ส่วนหน้าจอวาดใหม่เป็นรอบ (ทุก refresh_ms) เฉพาะเมื่อข้อมูลหรือตำแหน่งเลื่อนเปลี่ยน
+    คอลัมน์แรกคือสถานะ แสดงจาก tag ของแถว (tag_labels) จึงเปลี่ยนสถานะได้โดยไม่ต้องแก้ค่าของแถว
+    """
+
+    def __init__(self, parent, columns, tag_labels, tag_colors, formatters=None, refresh_ms=200):
+        # columns: list ของ (ชื่อคอลัมน์, หัวตาราง, ความกว้าง, anchor) โดยคอลัมน์แรกคือสถานะ
+        self.tag_labels = tag_labels
+        self.formatters = formatters or {}
+        self.refresh_ms = refresh_ms
+        self._rows = []
+        self._lock = threading.Lock()
+        self._dirty = True
+        self._offset = 0
+        self._moveto = None
+        self._visible_rows = 10
+        self._filter_tag = None
+        self._view = None  # index ของแถวที่ผ่านตัวกรอง (None = ทุกแถว)
+        self._counts = {}
+
+        self.frame = bttk.Frame(parent)
+        self.frame.rowconfigure(1, weight=1); self.frame.columnconfigure(0, weight=1)
+        summary_frame = bttk.Frame(self.frame)
+        summary_frame.grid(row=0, column=0, columnspan=2, sticky='ew', pady=(0, 5))
+        bttk.Label(summary_frame, text="แสดง:").pack(side=tk.LEFT)
+        self._filter_choices = {"ทั้งหมด": None, **{label: tag for tag, label in tag_labels.items()}}
+        self.filter_combobox = ttk.Combobox(summary_frame, state="readonly", width=30, values=list(self._filter_choices))
+        self.filter_combobox.current(0)
+        self.filter_combobox.bind("<<ComboboxSelected>>", lambda event: self.set_filter(self._filter_choices[self.filter_combobox.get()]))
+        self.filter_combobox.pack(side=tk.LEFT, padx=5)
+        self.summary_label = bttk.Label(summary_frame, text="")
+        self.summary_label.pack(side=tk.LEFT, padx=10)
+
+        self.tree = bttk.Treeview(self.frame, columns=[column[0] for column in columns], show="headings", height=self._visible_rows)
+        for name, heading, width, anchor in columns:
+            self.tree.heading(name, text=heading); self.tree.column(name, width=width, anchor=anchor)
+        for tag, color in tag_colors.items():
+            self.tree.tag_configure(tag, background=color)
+        self.scrollbar = bttk.Scrollbar(self.frame, orient=tk.VERTICAL, command=self._on_scrollbar)
+        self.tree.grid(row=1, column=0, sticky='nsew'); self.scrollbar.grid(row=1, column=1, sticky='ns')
+        self.tree.bind("<Configure>", self._on_resize)
+        self.tree.bind("<MouseWheel>", lambda event: self.scroll(-1 if event.delta > 0 else 1, 'units'))
+        self.tree.bind("<Button-4>", lambda event: self.scroll(-1, 'units'))
+        self.tree.bind("<Button-5>", lambda event: self.scroll(1, 'units'))
+        self.tree.after(self.refresh_ms, self._refresh)
+
+    # --- ข้อมูล (เรียกจาก Thread ใดก็ได้) ---
+    def clear(self):
+        with self._lock:
+            self._rows = []
+            self._offset = 0
+            self._dirty = True
+
+    def append_rows(self, rows):
+        # rows: list ของ (tuple ค่าของคอลัมน์ที่ไม่รวมสถานะ, tag)
+        with self._lock:
+            self._rows.extend(rows)
+            self._dirty = True
+
+    def set_tags(self, indices, tag):
+        with self._lock:
+            for index in indices:
+                self._rows[index] = (self._rows[index][0], tag)
+            self._dirty = True
+
+    def retag(self, tag_for_values):
+        # กำหนด tag ใหม่ให้ทุกแถวจากค่าของแถว (ครั้งเดียวใต้ล็อก แทนการแก้ Treeview ทีละแถว) คืนค่าจำนวนแถวต่อ tag
+        with self._lock:
+            self._rows = [(values, tag_for_values(values)) for values, _ in self._rows]
+            self._dirty = True
+            return self._count_tags()
+
+    def rows_with_tag(self, tag):
+        # list ของ (index, ค่าของแถว) ที่มี tag ที่ระบุ
+        with self._lock:
+            return [(index, values) for index, (values, row_tag) in enumerate(self._rows) if row_tag == tag]
+
+    def counts(self):
+        with self._lock:
+            return self._count_tags()
+
+    def _count_tags(self):
+        counts = {}
+        for _, tag in self._rows:
+            counts[tag] = counts.get(tag, 0) + 1
+        return counts
+
+    # --- การแสดงผล (Tk main thread) ---
+    def set_filter(self, tag):
+        with self._lock:
+            self._filter_tag = tag
+            self._offset = 0
+            self._dirty = True
+
+    def scroll(self, amount, what):
+        with self._lock:
+            step = self._visible_rows if what == 'pages' else 1
+            self._offset += int(amount) * step
+            self._dirty = True
+
+    def _on_scrollbar(self, action, *args):
+        if action == 'moveto':
+            # ตำแหน่งเป็นสัดส่วน แปลงเป็นแถวตอนวาด (จำนวนแถวอาจเปลี่ยนตามตัวกรองก่อนถึงรอบวาด)
+            with self._lock:
+                self._moveto = float(args[0])
+                self._dirty = True
+        elif action == 'scroll':
+            self.scroll(args[0], args[1])
+
+    def _on_resize(self, event):
+        row_height = int(ttk.Style().lookup('Treeview', 'rowheight') or 20)
+        visible_rows = max(1, (event.height - row_height) // row_height)
+        if visible_rows != self._visible_rows:
+            with self._lock:
+                self._visible_rows = visible_rows
+                self._dirty = True
+
+    def _refresh(self):
+        try:
+            if self._dirty:
+                self._render()
+        finally:
+            self.tree.after(self.refresh_ms, self._refresh)
+
+    def _render(self):
+        with self._lock:
+            self._dirty = False
+            if self._filter_tag is None:
+                self._view = None
+            else:
+                self._view = [index for index, (_, tag) in enumerate(self._rows) if tag == self._filter_tag]
+            total = len(self._view) if self._view is not None else len(self._rows)
+            if self._moveto is not None:
+                self._offset, self._moveto = int(self._moveto * total), None
+            self._offset = max(0, min(self._offset, total - self._visible_rows))
+            indices = range(self._offset, min(self._offset + self._visible_rows, total))
+            window = [self._rows[self._view[i] if self._view is not None else i] for i in indices]
+            self._counts = self._count_tags()
+            first, last = (self._offset / total, (self._offset + len(window)) / total) if total else (0.0, 1.0)
+
+        items = self.tree.get_children()
+        for i, (values, tag) in enumerate(window):
+            display_values = (self.tag_labels.get(tag, '-'), *(self.formatters.get(column, format_grid_cell)(value) for column, value in enumerate(values)))
+            if i < len(items):
+                self.tree.item(items[i], values=display_values, tags=(tag,) if tag else ())
+            else:
+                self.tree.insert("", tk.END, values=display_values, tags=(tag,) if tag else ())
+        if len(items) > len(window):
+            self.tree.delete(*items[len(window):])
+        self.scrollbar.set(first, last)
+        summary = [f"ทั้งหมด {sum(self._counts.values()):,}"] + [f"{label} {self._counts[tag]:,}" for tag, label in self.tag_labels.items() if self._counts.get(tag)]
+        self.summary_label.config(text=" | ".join(summary))
+
 
 class DrugImporterApp(bttk.Frame):
     def __init__(self, master):
@@ -17,6 +670,9 @@ class DrugImporterApp(bttk.Frame):
         self.log_queue = queue.Queue()
         self.full_user_list = [] # สำหรับเก็บข้อมูลผู้ใช้ทั้งหมดจาก API
         self.filtered_user_list = [] # สำหรับเก็บผู้ใช้ที่กรองตาม HCODE แล้ว
+        self.http = create_http_session() # Session แบบ keep-alive ใช้ร่วมกันทุกคำขอไปที่ API
+        self.etag_cache_lock = threading.Lock()
+        self.etag_cache = self.load_etag_cache() # url -> {"etag", "data"} สำหรับ conditional GET
         self.create_widgets()
         self.process_log_queue()
 
@@ -37,7 +693,6 @@ class DrugImporterApp(bttk.Frame):
 
     def create_drug_list_importer_tab(self, parent_frame):
         # UI ของ Tab 1
-        self.drug_list_data = []
         self.central_drug_codes = set()
         config_frame = bttk.Labelframe(parent_frame, text="ตั้งค่า", padding=15)
         config_frame.pack(fill=tk.X, pady=(0, 10))
@@ -85,22 +740,15 @@ class DrugImporterApp(bttk.Frame):
         tree_frame = bttk.Labelframe(parent_frame, text="รายการยา", padding=15)
         tree_frame.pack(fill=tk.BOTH, expand=True, pady=5)
         tree_frame.rowconfigure(0, weight=1); tree_frame.columnconfigure(0, weight=1)
-        columns = ("status", "icode", "name", "strength", "units")
-        self.drug_list_tree = bttk.Treeview(tree_frame, columns=columns, show="headings", height=10)
-        self.drug_list_tree.heading("status", text="สถานะ"); self.drug_list_tree.column("status", width=120, anchor=tk.W)
-        self.drug_list_tree.heading("icode", text="รหัสยา (icode)"); self.drug_list_tree.column("icode", width=120, anchor=tk.W)
-        self.drug_list_tree.heading("name", text="ชื่อยา"); self.drug_list_tree.column("name", width=300, anchor=tk.W)
-        self.drug_list_tree.heading("strength", text="ความแรง"); self.drug_list_tree.column("strength", width=150, anchor=tk.W)
-        self.drug_list_tree.heading("units", text="หน่วยนับ"); self.drug_list_tree.column("units", width=100, anchor=tk.W)
-        self.drug_list_tree.tag_configure('new', background='#d4edda'); self.drug_list_tree.tag_configure('duplicate', background='#fff3cd'); self.drug_list_tree.tag_configure('sent', background='#d1ecf1')
-        tree_scrollbar = bttk.Scrollbar(tree_frame, orient=tk.VERTICAL, command=self.drug_list_tree.yview)
-        self.drug_list_tree.configure(yscrollcommand=tree_scrollbar.set)
-        tree_scrollbar.grid(row=0, column=1, sticky='ns'); self.drug_list_tree.grid(row=0, column=0, sticky='nsew')
+        # ค่าของแถว: (icode, name, strength, units)
+        columns = [("status", "สถานะ", 120, tk.W), ("icode", "รหัสยา (icode)", 120, tk.W), ("name", "ชื่อยา", 300, tk.W), ("strength", "ความแรง", 150, tk.W), ("units", "หน่วยนับ", 100, tk.W)]
+        self.drug_list_grid = VirtualGrid(tree_frame, columns, DRUG_LIST_TAG_LABELS, DRUG_LIST_TAG_COLORS)
+        self.drug_list_grid.frame.grid(row=0, column=0, sticky='nsew')
     
     def create_dispense_importer_tab(self, parent_frame):
         # UI ของ Tab 2
-        self.dispense_data = []
         self.medicine_code_map = {}
+        self.dispense_watermark = None
         dispense_config_frame = bttk.Labelframe(parent_frame, text="ขั้นตอนที่ 1: ดึงข้อมูลการจ่ายยาจาก HOSxP", padding=15)
         dispense_config_frame.pack(fill=tk.X, pady=(0, 10))
         dispense_config_frame.columnconfigure(1, weight=1)
@@ -115,6 +763,10 @@ class DrugImporterApp(bttk.Frame):
         self.end_date_entry.grid(row=1, column=1, sticky=tk.EW, padx=5, pady=5)
         self.fetch_dispense_button = bttk.Button(dispense_config_frame, text="ดึงข้อมูลและตรวจสอบ", command=self.start_fetch_dispense_thread)
         self.fetch_dispense_button.grid(row=0, column=2, rowspan=2, padx=20, ipady=10)
+        self.stream_send_var = tk.BooleanVar(value=False)
+        bttk.Checkbutton(dispense_config_frame, text="ส่งตัดจ่ายทันทีขณะดึงข้อมูล (ไม่แสดงตัวอย่าง ใช้ผู้จ่ายยาที่เลือกในขั้นตอนที่ 2)", variable=self.stream_send_var).grid(row=2, column=0, columnspan=2, sticky=tk.W, padx=5, pady=5)
+        self.watermark_sync_var = tk.BooleanVar(value=False)
+        bttk.Checkbutton(dispense_config_frame, text="ดึงเฉพาะรายการใหม่ต่อจากจุดซิงค์ล่าสุดของระบบกลาง (ใช้วันที่เริ่มต้นเมื่อยังไม่เคยซิงค์)", variable=self.watermark_sync_var).grid(row=3, column=0, columnspan=2, sticky=tk.W, padx=5, pady=5)
         
         send_frame = bttk.Labelframe(parent_frame, text="ขั้นตอนที่ 2: ยืนยันและส่งข้อมูลเพื่อตัดจ่าย", padding=15)
         send_frame.pack(fill=tk.X, pady=10)
@@ -130,23 +782,28 @@ class DrugImporterApp(bttk.Frame):
         dispense_tree_frame = bttk.Labelframe(parent_frame, text="รายการจ่ายยาที่ดึงมา (Preview)", padding=15)
         dispense_tree_frame.pack(fill=tk.BOTH, expand=True, pady=5)
         dispense_tree_frame.rowconfigure(0, weight=1); dispense_tree_frame.columnconfigure(0, weight=1)
-        dispense_cols = ("status", "vstdate", "icode", "hos_guid", "qty")
-        self.dispense_tree = bttk.Treeview(dispense_tree_frame, columns=dispense_cols, show="headings", height=10)
-        self.dispense_tree.heading("status", text="สถานะ"); self.dispense_tree.column("status", width=150, anchor=tk.W)
-        self.dispense_tree.heading("vstdate", text="วันที่จ่าย"); self.dispense_tree.column("vstdate", width=150, anchor=tk.W)
-        self.dispense_tree.heading("icode", text="รหัสยา (icode)"); self.dispense_tree.column("icode", width=150, anchor=tk.W)
-        self.dispense_tree.heading("hos_guid", text="HOS GUID"); self.dispense_tree.column("hos_guid", width=250, anchor=tk.W)
-        self.dispense_tree.heading("qty", text="จำนวน"); self.dispense_tree.column("qty", width=100, anchor=tk.E)
-        self.dispense_tree.tag_configure('ready', background='#d4edda'); self.dispense_tree.tag_configure('error', background='#f8d7da')
-        dispense_scrollbar = bttk.Scrollbar(dispense_tree_frame, orient=tk.VERTICAL, command=self.dispense_tree.yview)
-        self.dispense_tree.configure(yscrollcommand=dispense_scrollbar.set)
-        dispense_scrollbar.grid(row=0, column=1, sticky='ns'); self.dispense_tree.grid(row=0, column=0, sticky='nsew')
+        # ค่าของแถว: (vstdate, icode, hos_guid, qty) แถว error เป็นสรุปต่อ icode (hos_guid = จำนวนรายการ)
+        dispense_cols = [("status", "สถานะ", 150, tk.W), ("vstdate", "วันที่จ่าย", 150, tk.W), ("icode", "รหัสยา (icode)", 150, tk.W), ("hos_guid", "HOS GUID", 250, tk.W), ("qty", "จำนวน", 100, tk.E)]
+        self.dispense_grid = VirtualGrid(dispense_tree_frame, dispense_cols, DISPENSE_TAG_LABELS, DISPENSE_TAG_COLORS, formatters={3: lambda qty: f"{qty:.2f}"})
+        self.dispense_grid.frame.grid(row=0, column=0, sticky='nsew')
     
     def log(self, message):
         # ฟังก์ชันสำหรับส่ง Log ไปแสดงผล
         timestamp = datetime.now().strftime("%H:%M:%S")
         self.log_queue.put(f"[{timestamp}] {message}")
 
+    def hosxp_db_config(self):
+        # ค่าการเชื่อมต่อฐานข้อมูล HOSxP จากช่องตั้งค่า
+        return {"host": self.db_host_var.get(), "database": self.db_name_var.get(), "user": self.db_user_var.get(), "password": self.db_pass_var.get(), "connect_timeout": 5}
+
+    def get_selected_dispenser_id(self):
+        # ID ของผู้จ่ายยาที่เลือกใน Dropdown (None เมื่อยังไม่เลือกหรือไม่พบ)
+        selected_user_display = self.dispenser_combobox.get()
+        for user in self.filtered_user_list: # ค้นหาในลิสต์ที่กรองแล้ว
+            if user['full_name'] == selected_user_display:
+                return user['id']
+        return None
+
     def process_log_queue(self):
         # ฟังก์ชันสำหรับวนลูปดึง Log จาก Queue มาแสดง
         try:
@@ -161,6 +818,44 @@ class DrugImporterApp(bttk.Frame):
         finally:
             self.master.after(100, self.process_log_queue)
 
+    def load_etag_cache(self):
+        # โหลดข้อมูลที่ดาวน์โหลดไว้ครั้งก่อน (ไฟล์เสียหรือไม่มีไฟล์ = เริ่มใหม่)
+        try:
+            with open(ETAG_CACHE_FILE, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save_etag_cache(self):
+        try:
+            os.makedirs(IMPORTER_STATE_DIR, exist_ok=True)
+            tmp_path = ETAG_CACHE_FILE + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.etag_cache, f, ensure_ascii=False)
+            os.replace(tmp_path, ETAG_CACHE_FILE)
+        except OSError as e:
+            self.log(f"บันทึก cache ข้อมูลยาหลักไม่สำเร็จ: {e}")
+
+    def get_json_conditional(self, url, timeout=15):
+        # GET พร้อม If-None-Match: ถ้า server ตอบ 304 ใช้ข้อมูลเดิมโดยไม่ต้องดาวน์โหลดใหม่
+        with self.etag_cache_lock:
+            cached = self.etag_cache.get(url)
+        headers = {'If-None-Match': cached['etag']} if cached else {}
+        response = self.http.get(url, headers=headers, timeout=timeout)
+        if response.status_code == 304 and cached:
+            self.log(f"...ข้อมูลไม่เปลี่ยนแปลง ใช้ข้อมูลเดิม ({len(cached['data'])} รายการ)")
+            return cached['data']
+        response.raise_for_status()
+        data = response.json()
+        etag = response.headers.get('ETag')
+        with self.etag_cache_lock:
+            if etag:
+                self.etag_cache[url] = {"etag": etag, "data": data}
+            else:
+                self.etag_cache.pop(url, None)
+            self.save_etag_cache()
+        return data
+
     def start_load_users_thread(self):
         # เริ่ม Thread โหลดรายชื่อผู้ใช้
         threading.Thread(target=self.load_users_for_combobox, daemon=True).start()
@@ -177,9 +872,19 @@ class DrugImporterApp(bttk.Frame):
         self.load_users_button.config(state=tk.DISABLED)
         try:
             api_endpoint = f"{self.api_url_var.get()}/api/users"
-            response = requests.get(api_endpoint, timeout=10)
-            response.raise_for_status()
-            self.full_user_list = response.json()
+            # ขอทีละหน้าตาม next_cursor (server เก่าที่ไม่แบ่งหน้าคืน array ของผู้ใช้ทั้งหมด)
+            self.full_user_list, params = [], {"limit": USERS_PAGE_SIZE}
+            while True:
+                response = self.http.get(api_endpoint, params=params, timeout=10)
+                response.raise_for_status()
+                page = response.json()
+                if isinstance(page, list):
+                    self.full_user_list = page
+                    break
+                self.full_user_list.extend(page.get('items', []))
+                if not page.get('next_cursor'):
+                    break
+                params = {"limit": USERS_PAGE_SIZE, "cursor": page['next_cursor']}
             
             self.filtered_user_list = [
                 user for user in self.full_user_list 
@@ -224,21 +929,14 @@ class DrugImporterApp(bttk.Frame):
         # ดึงรายการยาจาก Local DB
         self.log("[Tab 1] ดึงรายการยา: เริ่มต้น...")
         try:
-            self.master.after(0, lambda: self.drug_list_tree.delete(*self.drug_list_tree.get_children()))
-            self.drug_list_data = []
-            conn = mysql.connector.connect(host=self.db_host_var.get(), database=self.db_name_var.get(), user=self.db_user_var.get(), password=self.db_pass_var.get(), connect_timeout=5)
-            cursor = conn.cursor(dictionary=True)
-            cursor.execute("SELECT icode, name, strength, units FROM drugitems WHERE istatus = 'y'")
-            self.drug_list_data = cursor.fetchall()
-            conn.close()
-            if not self.drug_list_data:
+            self.drug_list_grid.clear()
+            drug_rows = fetch_hosxp_drug_items(self.hosxp_db_config())
+            if not drug_rows:
                 self.log("[Tab 1] ดึงรายการยา: ไม่พบข้อมูล")
                 self.master.after(0, lambda: self.set_drug_list_ui_state(fetch_state=tk.NORMAL))
                 return
-            self.log(f"[Tab 1] ดึงรายการยา: สำเร็จ {len(self.drug_list_data)} รายการ")
-            for item in self.drug_list_data:
-                values = ('-', item['icode'], item['name'], item['strength'], item['units'])
-                self.master.after(0, lambda i=item, v=values: self.drug_list_tree.insert("", tk.END, values=v, iid=f"drug_{i['icode']}"))
+            self.log(f"[Tab 1] ดึงรายการยา: สำเร็จ {len(drug_rows)} รายการ")
+            self.drug_list_grid.append_rows([(tuple(row), 'pending') for row in drug_rows])
             self.master.after(0, lambda: self.set_drug_list_ui_state(fetch_state=tk.NORMAL, compare_state=tk.NORMAL))
         except Exception as e:
             self.log(f"[Tab 1] ดึงรายการยา: ผิดพลาด - {e}")
@@ -260,20 +958,11 @@ class DrugImporterApp(bttk.Frame):
             return
         try:
             api_endpoint = f"{self.api_url_var.get()}/api/medicines?hcode={hcode}"
-            response = requests.get(api_endpoint, timeout=15)
-            response.raise_for_status()
-            central_data = response.json()
-            self.central_drug_codes = {str(med['medicine_code']) for med in central_data}
+            central_data = self.get_json_conditional(api_endpoint, timeout=15)
+            self.central_drug_codes = set(central_medicine_code_map(central_data))
             self.log(f"[Tab 1] เปรียบเทียบรายการยา: พบข้อมูลในระบบกลาง {len(self.central_drug_codes)} รายการ")
-            new_count, duplicate_count = 0, 0
-            for item_id in self.drug_list_tree.get_children():
-                item_code = self.drug_list_tree.item(item_id, 'values')[1]
-                if item_code in self.central_drug_codes:
-                    self.master.after(0, lambda iid=item_id: self.drug_list_tree.item(iid, tags=('duplicate',), values=('ซ้ำ', *self.drug_list_tree.item(iid, 'values')[1:])))
-                    duplicate_count += 1
-                else:
-                    self.master.after(0, lambda iid=item_id: self.drug_list_tree.item(iid, tags=('new',), values=('ยาใหม่', *self.drug_list_tree.item(iid, 'values')[1:])))
-                    new_count += 1
+            counts = self.drug_list_grid.retag(lambda values: 'duplicate' if str(values[0]) in self.central_drug_codes else 'new')
+            new_count, duplicate_count = counts.get('new', 0), counts.get('duplicate', 0)
             self.log(f"[Tab 1] เปรียบเทียบรายการยา: ยาใหม่ {new_count}, ยาซ้ำ {duplicate_count}")
             self.master.after(0, lambda: self.set_drug_list_ui_state(fetch_state=tk.NORMAL, compare_state=tk.NORMAL, send_state=tk.NORMAL if new_count > 0 else tk.DISABLED))
         except Exception as e:
@@ -287,105 +976,130 @@ class DrugImporterApp(bttk.Frame):
         threading.Thread(target=self.send_drug_list_to_api, daemon=True).start()
 
     def send_drug_list_to_api(self):
-        # ส่งรายการยาใหม่ไปที่ API
+        # ส่งรายการยาใหม่ไปที่ API เป็นชุดผ่าน /api/medicines/bulk (คำขอละ DRUG_LIST_BULK_CHUNK_SIZE รายการ)
         self.log("[Tab 1] ส่งรายการยาใหม่: เริ่มต้น...")
-        items_to_send = [item_id for item_id in self.drug_list_tree.get_children() if 'new' in self.drug_list_tree.item(item_id, 'tags')]
+        items_to_send = self.drug_list_grid.rows_with_tag('new')
         if not items_to_send:
             self.master.after(0, lambda: self.set_drug_list_ui_state(fetch_state=tk.NORMAL, compare_state=tk.NORMAL))
             return
         self.master.after(0, lambda: self.drug_list_progress.config(maximum=len(items_to_send), value=0))
         success_count, error_count = 0, 0
         hcode = self.hcode_var.get().strip()
-        api_endpoint = f"{self.api_url_var.get()}/api/medicines"
-        for i, item_id in enumerate(items_to_send):
-            values = self.drug_list_tree.item(item_id, 'values')
-            payload = {"hcode": hcode, "medicine_code": values[1], "generic_name": values[2], "strength": values[3], "unit": values[4]}
-            try:
-                response = requests.post(api_endpoint, json=payload, timeout=10)
-                if response.status_code == 201:
-                    success_count += 1
-                    self.master.after(0, lambda iid=item_id: self.drug_list_tree.item(iid, tags=('sent',), values=('ส่งแล้ว', *self.drug_list_tree.item(iid, 'values')[1:])))
-                else: error_count += 1
-            except requests.exceptions.RequestException: error_count += 1
-            self.master.after(0, lambda v=i+1: self.drug_list_progress.config(value=v))
+        drug_rows = [values for _, values in items_to_send]
+        for start, size, sent_positions, errors in iter_medicine_bulk_uploads(self.http, self.api_url_var.get(), hcode, drug_rows):
+            success_count += len(sent_positions)
+            error_count += size - len(sent_positions)
+            for error in errors:
+                self.log(f"[Tab 1] ...{error}")
+            self.drug_list_grid.set_tags([items_to_send[position][0] for position in sent_positions], 'sent')
+            self.master.after(0, lambda v=start + size: self.drug_list_progress.config(value=v))
         self.log(f"[Tab 1] ส่งรายการยาใหม่: สำเร็จ {success_count}, ผิดพลาด {error_count}")
         self.master.after(0, lambda: self.set_drug_list_ui_state(fetch_state=tk.NORMAL, compare_state=tk.NORMAL, send_state=tk.DISABLED))
         
     def start_fetch_dispense_thread(self):
-        # เริ่ม Thread ดึงและเตรียมข้อมูลจ่ายยา
+        # เริ่ม Thread ดึงและเตรียมข้อมูลจ่ายยา (หรือดึงและส่งตัดจ่ายทันทีเมื่อเลือกโหมดส่งทันที)
+        target = self.fetch_and_prepare_dispense_data
+        if self.stream_send_var.get():
+            if self.get_selected_dispenser_id() is None:
+                messagebox.showerror("ข้อมูลไม่ครบถ้วน", "กรุณาเลือกผู้จ่ายยาจาก Dropdown ก่อนใช้โหมดส่งทันที")
+                return
+            if not messagebox.askyesno("ยืนยันการตัดจ่ายยา", "ระบบจะดึงข้อมูลจ่ายยาตามช่วงวันที่และส่งตัดสต็อกทันทีโดยไม่แสดงตัวอย่าง\nการกระทำนี้ไม่สามารถย้อนกลับได้ ต้องการดำเนินการต่อหรือไม่?", icon='warning'):
+                return
+            target = self.stream_dispense_to_api
         self.fetch_dispense_button.config(state=tk.DISABLED)
         self.send_dispense_button.config(state=tk.DISABLED)
-        threading.Thread(target=self.fetch_and_prepare_dispense_data, daemon=True).start()
+        threading.Thread(target=target, daemon=True).start()
 
-    def fetch_and_prepare_dispense_data(self):
-        # ดึงข้อมูลจ่ายยาและตรวจสอบกับข้อมูลยาหลัก
-        self.log("[Tab 2] นำเข้าข้อมูลจ่ายยา: เริ่มกระบวนการ...")
-        self.master.after(0, lambda: self.dispense_tree.delete(*self.dispense_tree.get_children()))
-        self.dispense_data = []
-        self.medicine_code_map = {}
+    def load_dispense_sync_inputs(self):
+        # อ่าน HCODE ช่วงวันที่ และข้อมูลยาหลักจากระบบกลาง คืนค่า (hcode, start_date, end_date) หรือ None เมื่อข้อมูลไม่ครบ
+        # โหมดซิงค์ต่อจากจุดล่าสุด: self.dispense_watermark = {"after": key ของจุดซิงค์หรือ None} (ปิดโหมด = None)
         hcode = self.hcode_var.get().strip()
         if not hcode:
             messagebox.showerror("ข้อมูลไม่ครบถ้วน", "กรุณากรอก HCODE ใน Tab แรกก่อน")
-            self.master.after(0, lambda: self.fetch_dispense_button.config(state=tk.NORMAL))
-            return
-        
+            return None
+        self.log("[Tab 2] ...กำลังดึงข้อมูลยาหลัก (Master) จากระบบกลาง")
+        api_endpoint = f"{self.api_url_var.get()}/api/medicines?hcode={hcode}"
+        central_medicines = self.get_json_conditional(api_endpoint, timeout=15)
+        self.medicine_code_map = central_medicine_code_map(central_medicines)
+        self.log(f"[Tab 2] ...ดึงข้อมูลยาหลักสำเร็จ {len(self.medicine_code_map)} รายการ")
+        start_date = datetime.strptime(self.start_date_entry.entry.get(), '%d/%m/%Y').date()
+        end_date = datetime.strptime(self.end_date_entry.entry.get(), '%d/%m/%Y').date()
+        self.dispense_watermark = None
+        if self.watermark_sync_var.get():
+            after = fetch_sync_watermark(self.http, self.api_url_var.get(), hcode)
+            self.dispense_watermark = {"after": after}
+            if after:
+                start_date = date.fromisoformat(after[0])
+                self.log(f"[Tab 2] ...จุดซิงค์ล่าสุด {after[0]} (hos_guid {after[1]}) ดึงเฉพาะรายการหลังจุดนี้")
+            else:
+                self.log("[Tab 2] ...ยังไม่เคยซิงค์ ดึงตั้งแต่วันที่เริ่มต้นที่เลือก")
+        return hcode, start_date, end_date
+
+    def dispense_sync_after(self):
+        # จุดซิงค์ที่ใช้กรองรายการจาก HOSxP (None เมื่อไม่ใช้โหมดซิงค์หรือยังไม่เคยซิงค์)
+        return self.dispense_watermark['after'] if self.dispense_watermark else None
+
+    def fetch_and_prepare_dispense_data(self):
+        # ดึงข้อมูลจ่ายยา (เฉพาะยาที่มีในระบบกลาง รวมต่อ hos_guid) เป็นชุดและแสดงตัวอย่างทีละชุด
+        self.log("[Tab 2] นำเข้าข้อมูลจ่ายยา: เริ่มกระบวนการ...")
+        self.dispense_grid.clear()
+        self.medicine_code_map = {}
+        ready_count = 0
         try:
-            self.log("[Tab 2] ...กำลังดึงข้อมูลยาหลัก (Master) จากระบบกลาง")
-            api_endpoint = f"{self.api_url_var.get()}/api/medicines?hcode={hcode}"
-            response = requests.get(api_endpoint, timeout=15)
-            response.raise_for_status()
-            central_medicines = response.json()
-            self.medicine_code_map = {str(med['medicine_code']): med['id'] for med in central_medicines}
-            self.log(f"[Tab 2] ...ดึงข้อมูลยาหลักสำเร็จ {len(self.medicine_code_map)} รายการ")
+            inputs = self.load_dispense_sync_inputs()
+            if inputs is None:
+                return
+            _, start_date, end_date = inputs
+            db_config = self.hosxp_db_config()
+
             self.log("[Tab 2] ...กำลังดึงข้อมูลจ่ายยาจาก HOSxP")
-            start_date = self.start_date_entry.entry.get()
-            end_date = self.end_date_entry.entry.get()
-            formatted_start_date = datetime.strptime(start_date, '%d/%m/%Y').strftime('%Y-%m-%d')
-            formatted_end_date = datetime.strptime(end_date, '%d/%m/%Y').strftime('%Y-%m-%d')
-
-            conn = mysql.connector.connect(host=self.db_host_var.get(), database=self.db_name_var.get(), user=self.db_user_var.get(), password=self.db_pass_var.get(), connect_timeout=5)
-            cursor = conn.cursor(dictionary=True)
-            query = "SELECT icode, hos_guid, qty, vstdate FROM opitemrece WHERE vstdate BETWEEN %s AND %s"
-            cursor.execute(query, (formatted_start_date, formatted_end_date))
-            local_dispense_data = cursor.fetchall()
-            conn.close()
-
-            if not local_dispense_data:
+            for batch in iter_hosxp_dispense_batches(db_config, start_date, end_date, self.medicine_code_map.keys(), after=self.dispense_sync_after()):
+                items = [make_dispense_item(row, None) for row in batch]
+                self.dispense_grid.append_rows([((item['dispense_date_iso'], item['icode'], item['hos_guid'], item['qty']), 'ready') for item in items])
+                ready_count += len(items)
+                self.log(f"[Tab 2] ...อ่านแล้ว {ready_count} รายการ")
+
+            unmatched = fetch_hosxp_unmatched_icodes(db_config, start_date, end_date, self.medicine_code_map.keys())
+            self.dispense_grid.append_rows([(("-", str(row['icode']), f"{row['line_count']} รายการ", float(row['qty'] or 0)), 'error') for row in unmatched])
+
+            if not ready_count and not unmatched:
                 self.log("[Tab 2] ...ไม่พบข้อมูลจ่ายยาในช่วงวันที่ที่เลือก")
-                self.master.after(0, lambda: self.fetch_dispense_button.config(state=tk.NORMAL))
                 return
-            
-            self.log("[Tab 2] ...กำลังตรวจสอบและเตรียมข้อมูล")
-            ready_count = 0
-            for item in local_dispense_data:
-                icode = str(item['icode'])
-                medicine_id = self.medicine_code_map.get(icode)
-                vstdate_str = item['vstdate'].strftime('%Y-%m-%d') if isinstance(item['vstdate'], datetime) else str(item['vstdate'])
-                if medicine_id:
-                    status = "พร้อมส่ง"
-                    tag = 'ready'
-                    ready_count += 1
-                else:
-                    status = "ผิดพลาด: ไม่พบรหัสยานี้ในระบบกลาง"
-                    tag = 'error'
-                item['medicine_id'] = medicine_id
-                item['dispense_date_iso'] = vstdate_str
-                item['status'] = status
-                self.dispense_data.append(item)
-                values = (status, vstdate_str, icode, item['hos_guid'], f"{item['qty']:.2f}")
-                self.master.after(0, lambda v=values, t=tag: self.dispense_tree.insert("", tk.END, values=v, tags=(t,)))
-
-            self.log(f"[Tab 2] ดึงข้อมูลจ่ายยาสำเร็จ {len(self.dispense_data)} รายการ (พร้อมส่ง: {ready_count})")
+            self.log(f"[Tab 2] ดึงข้อมูลจ่ายยาสำเร็จ {ready_count} รายการ (ยาที่ไม่พบในระบบกลาง: {len(unmatched)} รหัส)")
+
+        except Exception as e:
+            self.log(f"[Tab 2] เกิดข้อผิดพลาดร้ายแรง: {e}")
+            messagebox.showerror("ผิดพลาด", f"เกิดข้อผิดพลาดในกระบวนการดึงข้อมูล:\n{e}")
+        finally:
             self.master.after(0, lambda: (self.fetch_dispense_button.config(state=tk.NORMAL), self.send_dispense_button.config(state=tk.NORMAL if ready_count > 0 else tk.DISABLED)))
 
+    def stream_dispense_to_api(self):
+        # โหมดส่งทันที: Thread นี้อ่าน HOSxP เป็นชุดแล้วส่งต่อให้ DispenseUploader ส่งทีละชุดตามลำดับวันที่
+        # ชุดแรกถูกส่งระหว่างที่ยังอ่านวันถัดไป และการอ่านจะรอเมื่อมีชุดค้างส่งครบจำนวน หน่วยความจำจึงไม่โตตามช่วงวันที่
+        self.log("[Tab 2] ดึงและส่งตัดจ่ายยาทันที: เริ่มกระบวนการ...")
+        self.dispense_grid.clear()
+        dispenser_id = self.get_selected_dispenser_id()
+        try:
+            inputs = self.load_dispense_sync_inputs()
+            if inputs is None:
+                return
+            hcode, start_date, end_date = inputs
+            uploader = self.create_dispense_uploader(hcode, dispenser_id, f"{hcode}|{start_date}|{end_date}")
+            batches = iter_hosxp_dispense_batches(self.hosxp_db_config(), start_date, end_date, self.medicine_code_map.keys(), after=self.dispense_sync_after())
+            try:
+                summary = uploader.upload([make_dispense_item(row, self.medicine_code_map.get(str(row['icode']))) for row in batch] for batch in batches)
+            finally:
+                batches.close()  # ปิด query ของ HOSxP ทันทีเมื่อหยุดส่งกลางทาง
+            self.report_dispense_upload(summary)
         except Exception as e:
             self.log(f"[Tab 2] เกิดข้อผิดพลาดร้ายแรง: {e}")
             messagebox.showerror("ผิดพลาด", f"เกิดข้อผิดพลาดในกระบวนการดึงข้อมูล:\n{e}")
-            self.master.after(0, lambda: self.fetch_dispense_button.config(state=tk.NORMAL))
+        finally:
+            self.master.after(0, lambda: (self.fetch_dispense_button.config(state=tk.NORMAL), self.send_dispense_button.config(state=tk.DISABLED)))
 
     def start_send_dispense_thread(self):
         # เริ่ม Thread ส่งข้อมูลจ่ายยา
-        items_ready_count = sum(1 for item in self.dispense_data if item['status'] == 'พร้อมส่ง')
+        items_ready_count = self.dispense_grid.counts().get('ready', 0)
         if items_ready_count == 0:
             messagebox.showwarning("ไม่มีข้อมูล", "ไม่มีรายการที่พร้อมสำหรับส่ง")
             return
@@ -395,54 +1109,235 @@ class DrugImporterApp(bttk.Frame):
             self.send_dispense_button.config(state=tk.DISABLED)
             threading.Thread(target=self.send_dispense_data_to_api, daemon=True).start()
 
+    def dispense_item_from_row(self, values):
+        # แปลงแถวในตารางตัวอย่าง (vstdate, icode, hos_guid, qty) กลับเป็นรายการสำหรับส่งตัดจ่าย
+        dispense_date_iso, icode, hos_guid, qty = values
+        return {"icode": icode, "hos_guid": hos_guid, "qty": qty, "medicine_id": self.medicine_code_map.get(icode), "dispense_date_iso": dispense_date_iso, "status": STATUS_READY}
+
+    def create_dispense_uploader(self, hcode, dispenser_id, job_key):
+        # ตัวส่งข้อมูลตัดจ่ายพร้อม journal ของงาน (งานเดียวกัน = API + hcode + ช่วงวันที่เดียวกัน)
+        # โหมดซิงค์: จุดเริ่มต้นของรอบเปลี่ยนตามจุดซิงค์ จึงใช้ journal เดียวต่อหน่วยบริการ และเลื่อนจุดซิงค์ไปพร้อมการบันทึก
+        api_url = self.api_url_var.get()
+        watermark_after, watermark_cutoff = None, None
+        if self.dispense_watermark is not None:
+            job_key, watermark_after, watermark_cutoff = f"{hcode}|sync", self.dispense_watermark['after'], sync_watermark_cutoff()
+        journal = UploadJournal(f"{api_url}|{job_key}")
+        if journal.acked:
+            self.log(f"[Tab 2] ...พบงานที่ส่งค้างไว้ ข้ามชุดที่ส่งสำเร็จแล้ว {len(journal.acked)} ชุด")
+        return DispenseUploader(self.http, api_url, hcode, dispenser_id, journal, lambda message: self.log(f"[Tab 2] {message}"),
+                                watermark_after=watermark_after, watermark_cutoff=watermark_cutoff)
+
+    def report_dispense_upload(self, summary):
+        # แสดงสรุปผลการส่งข้อมูลตัดจ่าย คืนค่า True เมื่อส่งครบทุกชุด
+        message = (f"ส่ง {summary['items']:,} รายการ ({summary['chunks']} ชุด, ข้ามชุดที่ส่งแล้ว {summary['skipped_chunks']} ชุด): "
+                   f"ตัดจ่ายสำเร็จ {summary['processed']:,} รายการ ไม่สำเร็จ {summary['failed_items']:,} รายการ")
+        if self.dispense_watermark is not None:
+            watermark = summary['watermark']
+            message += f"\nจุดซิงค์ล่าสุด: {watermark[0]} (hos_guid {watermark[1]})" if watermark else "\nยังไม่มีจุดซิงค์ (ไม่มีรายการก่อนวันที่ยังเปิดอยู่ที่บันทึกครบ)"
+            if summary['retried_failures'] or summary['stuck_failures']:
+                message += f"\nส่งใหม่รายการที่ผิดพลาดจากรอบก่อน {summary['retried_failures']:,} รายการ ค้างรอตรวจสอบ {summary['stuck_failures']:,} รายการ"
+        if summary['failed_chunks']:
+            self.log(f"[Tab 2] ส่งข้อมูลไม่ครบ {summary['failed_chunks']} ชุด: {message}")
+            for error in summary['errors'][:5]:
+                self.log(f"[Tab 2] ...{error}")
+            messagebox.showerror("ส่งข้อมูลไม่ครบ", f"{message}\nส่งไม่สำเร็จ {summary['failed_chunks']} ชุด กดส่งอีกครั้งเพื่อส่งเฉพาะชุดที่เหลือ\n{summary['errors'][0]}")
+            return False
+        self.log(f"[Tab 2] ส่งข้อมูลสำเร็จ: {message}")
+        messagebox.showinfo("สำเร็จ", message)
+        return True
+
     def send_dispense_data_to_api(self):
         # ส่งข้อมูลจ่ายยาไปที่ API
         self.log("[Tab 2] ส่งข้อมูลตัดจ่ายยา: เริ่มต้น...")
         hcode = self.hcode_var.get().strip()
-        selected_user_display = self.dispenser_combobox.get()
-        
-        if not selected_user_display:
+        if not self.dispenser_combobox.get():
             messagebox.showerror("ข้อมูลไม่ครบถ้วน", "กรุณาเลือกผู้จ่ายยาจาก Dropdown")
             self.master.after(0, lambda: (self.fetch_dispense_button.config(state=tk.NORMAL), self.send_dispense_button.config(state=tk.NORMAL)))
             return
 
-        dispenser_id = None
-        for user in self.filtered_user_list: # ค้นหาในลิสต์ที่กรองแล้ว
-            if user['full_name'] == selected_user_display:
-                dispenser_id = user['id']
-                break
-        
+        dispenser_id = self.get_selected_dispenser_id()
         if dispenser_id is None:
             messagebox.showerror("ผิดพลาด", "ไม่พบ ID สำหรับผู้ใช้ที่เลือก")
             self.master.after(0, lambda: (self.fetch_dispense_button.config(state=tk.NORMAL), self.send_dispense_button.config(state=tk.NORMAL)))
             return
         
-        api_endpoint = f"{self.api_url_var.get()}/api/dispense/process_excel_dispense"
-        items_to_send = [{"medicine_id": item['medicine_id'], "quantity_dispensed": float(item['qty']), "hos_guid": str(item['hos_guid']), "dispense_date_iso": item['dispense_date_iso']} for item in self.dispense_data if item['status'] == 'พร้อมส่ง']
-        payload = {"hcode": hcode, "dispenser_id": dispenser_id, "dispense_items": items_to_send}
-
-        self.log(f"[Tab 2] ...กำลังส่ง {len(items_to_send)} รายการไปที่ {api_endpoint}")
+        # เรียงตามวันที่และ hos_guid (ลำดับเดียวกับตอนอ่าน) ชุดจึงตรงกับ journal เมื่อส่งซ้ำหลังถูกขัดจังหวะ
+        items_to_send = sorted((self.dispense_item_from_row(values) for _, values in self.dispense_grid.rows_with_tag('ready')), key=lambda item: (item['dispense_date_iso'], item['hos_guid'] or '', item['icode']))
+        self.log(f"[Tab 2] ...กำลังส่ง {len(items_to_send)} รายการ")
         try:
-            response = requests.post(api_endpoint, json=payload, timeout=120)
-            if response.status_code in [201, 207]:
-                res_data = response.json()
-                self.log(f"[Tab 2] ส่งข้อมูลสำเร็จ: {res_data.get('message')}")
-                messagebox.showinfo("สำเร็จ", res_data.get('message', "ส่งข้อมูลเพื่อตัดจ่ายยาเรียบร้อยแล้ว"))
-                self.master.after(0, lambda: self.dispense_tree.delete(*self.dispense_tree.get_children()))
-                self.dispense_data = []
-            else:
-                error_detail = response.json().get('error', response.text)
-                self.log(f"[Tab 2] ส่งข้อมูลผิดพลาด: {response.status_code} - {error_detail}")
-                messagebox.showerror("API Error", f"เกิดข้อผิดพลาดจาก API:\n{error_detail}")
-        except requests.exceptions.RequestException as e:
-            self.log(f"[Tab 2] ส่งข้อมูลผิดพลาด (เชื่อมต่อ): {e}")
-            messagebox.showerror("Connection Error", f"ไม่สามารถเชื่อมต่อ API ได้:\n{e}")
+            job_key = f"{hcode}|{items_to_send[0]['dispense_date_iso']}|{items_to_send[-1]['dispense_date_iso']}"
+            summary = self.create_dispense_uploader(hcode, dispenser_id, job_key).upload([items_to_send])
+            if self.report_dispense_upload(summary):
+                self.dispense_grid.clear()
+        except Exception as e:
+            self.log(f"[Tab 2] ส่งข้อมูลผิดพลาด: {e}")
+            messagebox.showerror("ผิดพลาด", f"ไม่สามารถส่งข้อมูลได้:\n{e}")
         finally:
              self.master.after(0, lambda: (self.fetch_dispense_button.config(state=tk.NORMAL), self.send_dispense_button.config(state=tk.DISABLED)))
 
-if __name__ == "__main__":
+
+# --- โหมด headless (ซิงค์หลายหน่วยบริการตามไฟล์ตั้งค่า เช่น ตั้งเวลาทุกคืนบน server ของอำเภอ) ---
+
+def load_headless_config(path):
+    """
+    อ่านไฟล์ตั้งค่า JSON ของโหมด headless ค่าระดับบนใช้เป็นค่าเริ่มต้นของทุกหน่วยบริการ (กำหนดซ้ำในแต่ละหน่วยบริการได้)
+    {"api_url": "...", "workers": 4, "sync_drug_list": true, "initial_start_date": "YYYY-MM-DD",
+     "clinics": [{"hcode": "12345", "dispenser_id": 7, "hosxp": {"host", "database", "user", "password"}}]}
+    initial_start_date ใช้เฉพาะหน่วยบริการที่ยังไม่เคยซิงค์ (ค่าเริ่มต้น: วันล่าสุดที่ปิดแล้ว)
+    """
+    with open(path, encoding='utf-8') as f:
+        config = json.load(f)
+    defaults = {key: value for key, value in config.items() if key != 'clinics'}
+    clinics = []
+    for index, clinic in enumerate(config.get('clinics') or []):
+        clinic = {**defaults, **clinic}
+        missing = [key for key in ('api_url', 'hcode', 'dispenser_id', 'hosxp') if not clinic.get(key)]
+        if missing:
+            raise ValueError(f"clinics[{index}] ไม่มีค่า {', '.join(missing)}")
+        clinic['hcode'] = str(clinic['hcode'])
+        clinics.append(clinic)
+    if not clinics:
+        raise ValueError("ไม่มีหน่วยบริการใน clinics")
+    if len({clinic['hcode'] for clinic in clinics}) != len(clinics):
+        raise ValueError("hcode ซ้ำกันใน clinics (หน่วยบริการเดียวกันต้องซิงค์ทีละงานเพื่อไม่ให้จุดซิงค์ชนกัน)")
+    return {"workers": int(config.get('workers', HEADLESS_DEFAULT_WORKERS)), "clinics": clinics}
+
+
+def sync_clinic_headless(session, clinic, log):
+    """
+    ซิงค์หนึ่งหน่วยบริการด้วยขั้นตอนเดียวกับหน้าจอ: ส่งรายการยาใหม่จาก HOSxP แล้วดึงและส่งตัดจ่ายต่อจากจุดซิงค์ล่าสุด
+    คืนค่าสรุปผล (จำนวนรายการและเวลาที่ใช้ของแต่ละขั้นตอน) ข้อผิดพลาดร้ายแรงส่งต่อเป็น exception
+    """
+    api_url, hcode = clinic['api_url'].rstrip('/'), clinic['hcode']
+    db_config = {"connect_timeout": 5, **clinic['hosxp']}
+    result = {"hcode": hcode, "status": "ok", "drug_list": None, "dispense": None, "timings": {}}
+
+    def central_medicines():
+        response = session.get(f"{api_url}/api/medicines", params={"hcode": hcode}, timeout=30)
+        response.raise_for_status()
+        return central_medicine_code_map(response.json())
+
+    started = time.monotonic()
+    medicine_code_map = central_medicines()
+    if clinic.get('sync_drug_list', True):
+        drug_rows = fetch_hosxp_drug_items(db_config)
+        new_rows = [row for row in drug_rows if str(row[0]) not in medicine_code_map]
+        drug_list = {"hosxp_items": len(drug_rows), "new": len(new_rows), "sent": 0, "failed": 0}
+        for _, size, sent_positions, errors in iter_medicine_bulk_uploads(session, api_url, hcode, new_rows):
+            drug_list['sent'] += len(sent_positions)
+            drug_list['failed'] += size - len(sent_positions)
+            for error in errors:
+                log(f"...{error}")
+        log(f"รายการยา: ใน HOSxP {drug_list['hosxp_items']:,} ยาใหม่ {drug_list['new']:,} ส่งสำเร็จ {drug_list['sent']:,} ผิดพลาด {drug_list['failed']:,}")
+        if drug_list['sent']:
+            medicine_code_map = central_medicines()
+        result['drug_list'] = drug_list
+    result['timings']['drug_list_seconds'] = round(time.monotonic() - started, 3)
+
+    started = time.monotonic()
+    after = fetch_sync_watermark(session, api_url, hcode)
+    end_date = date.today()
+    if after:
+        start_date = date.fromisoformat(after[0])
+    else:
+        start_date = date.fromisoformat(clinic['initial_start_date']) if clinic.get('initial_start_date') else end_date - timedelta(days=SYNC_WATERMARK_OPEN_DAYS)
+    log(f"ตัดจ่าย: ดึงรายการตั้งแต่ {start_date}" + (f" หลังจุดซิงค์ {after[0]} (hos_guid {after[1]})" if after else " (ยังไม่เคยซิงค์)"))
+    uploader = DispenseUploader(session, api_url, hcode, clinic['dispenser_id'], UploadJournal(f"{api_url}|{hcode}|sync"), log,
+                                watermark_after=after, watermark_cutoff=sync_watermark_cutoff())
+    batches = iter_hosxp_dispense_batches(db_config, start_date, end_date, medicine_code_map.keys(), after=after)
+    try:
+        summary = uploader.upload([make_dispense_item(row, medicine_code_map.get(str(row['icode']))) for row in batch] for batch in batches)
+    finally:
+        batches.close()
+    unmatched = fetch_hosxp_unmatched_icodes(db_config, start_date, end_date, medicine_code_map.keys())
+    result['dispense'] = {
+        "start_date": start_date.isoformat(), "end_date": end_date.isoformat(),
+        "items": summary['items'], "processed": summary['processed'], "failed_items": summary['failed_items'],
+        "chunks": summary['chunks'], "skipped_chunks": summary['skipped_chunks'], "failed_chunks": summary['failed_chunks'],
+        "errors": summary['errors'][:20], "unmatched_icodes": len(unmatched),
+        "retried_failures": summary['retried_failures'], "stuck_failures": summary['stuck_failures'],
+        "watermark_before": sync_watermark_value(after), "watermark_after": sync_watermark_value(summary['watermark']),
+    }
+    result['timings']['dispense_seconds'] = round(time.monotonic() - started, 3)
+    log(f"ตัดจ่าย: ส่ง {summary['items']:,} รายการ สำเร็จ {summary['processed']:,} ไม่สำเร็จ {summary['failed_items']:,} (ส่งไม่ครบ {summary['failed_chunks']} ชุด)")
+
+    if summary['failed_chunks'] or summary['failed_items'] or (result['drug_list'] and result['drug_list']['failed']):
+        result['status'] = "partial"
+    return result
+
+
+def run_headless_sync(config, workers=None):
+    """ซิงค์ทุกหน่วยบริการใน config พร้อมกันไม่เกิน workers หน่วยบริการ คืนค่าสรุปผลของทั้งรอบ (พร้อมแปลงเป็น JSON)"""
+    clinics = config['clinics']
+    workers = max(1, min(workers or config['workers'], len(clinics)))
+    session = create_http_session(pool_size=workers * HTTP_POOL_SIZE_PER_CLINIC)
+    started_at, started = datetime.now(), time.monotonic()
+
+    def run_clinic(clinic):
+        hcode = clinic['hcode']
+        # เขียนทั้งบรรทัดในครั้งเดียว log ของหลายหน่วยบริการจึงไม่ปนกันกลางบรรทัด
+        log = lambda message: sys.stderr.write(f"[{datetime.now().strftime('%H:%M:%S')}] [{hcode}] {message}\n")
+        clinic_started = time.monotonic()
+        try:
+            result = sync_clinic_headless(session, clinic, log)
+        except Exception as e:
+            log(f"ผิดพลาด: {e}")
+            result = {"hcode": hcode, "status": "failed", "error": str(e), "drug_list": None, "dispense": None, "timings": {}}
+        result['timings']['total_seconds'] = round(time.monotonic() - clinic_started, 3)
+        return result
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(run_clinic, clinics))
+
+    statuses = [result['status'] for result in results]
+    dispense_results = [result['dispense'] for result in results if result['dispense']]
+    return {
+        "started_at": started_at.isoformat(timespec='seconds'),
+        "finished_at": datetime.now().isoformat(timespec='seconds'),
+        "duration_seconds": round(time.monotonic() - started, 3),
+        "workers": workers,
+        "ok": all(status == "ok" for status in statuses),
+        "totals": {
+            "clinics": len(results),
+            "ok": statuses.count("ok"), "partial": statuses.count("partial"), "failed": statuses.count("failed"),
+            "drug_list_sent": sum(result['drug_list']['sent'] for result in results if result['drug_list']),
+            "dispense_items": sum(dispense['items'] for dispense in dispense_results),
+            "dispense_processed": sum(dispense['processed'] for dispense in dispense_results),
+            "dispense_failed_items": sum(dispense['failed_items'] for dispense in dispense_results),
+        },
+        "clinics": results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="นำเข้ารายการยาและข้อมูลจ่ายยาจาก HOSxP ไปยังระบบกลาง")
+    parser.add_argument('--headless', metavar='CONFIG', help="ซิงค์ทุกหน่วยบริการตามไฟล์ตั้งค่า JSON โดยไม่เปิดหน้าจอ")
+    parser.add_argument('--workers', type=int, help=f"จำนวนหน่วยบริการที่ซิงค์พร้อมกัน (ค่าเริ่มต้นจากไฟล์ตั้งค่า หรือ {HEADLESS_DEFAULT_WORKERS})")
+    parser.add_argument('--summary', metavar='PATH', help="เขียนสรุปผล JSON ลงไฟล์ (ไม่ระบุ = stdout)")
+    args = parser.parse_args(argv)
+
+    if args.headless:
+        try:
+            config = load_headless_config(args.headless)
+        except (OSError, ValueError) as e:
+            print(f"อ่านไฟล์ตั้งค่าไม่ได้: {e}", file=sys.stderr)
+            return 2
+        summary = run_headless_sync(config, workers=args.workers)
+        output = json.dumps(summary, ensure_ascii=False, indent=2)
+        if args.summary:
+            with open(args.summary, 'w', encoding='utf-8') as f:
+                f.write(output + "\n")
+        else:
+            print(output)
+        return 0 if summary['ok'] else 1
+
     app = bttk.Window(
         title="Drug Importer to Central API (v9 - HCODE-Filtered Users)", themename="litera",
         size=(1000, 850), position=(100, 50), resizable=(True, True))
     DrugImporterApp(app)
     app.mainloop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
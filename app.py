@@ -2,27 +2,40 @@
 # หน้าที่หลัก: สร้าง Flask App, ลงทะเบียน Blueprints, และจัดการ Endpoints กลาง
 
 from flask import Flask, request, jsonify, render_template
+import click
 from flask_cors import CORS
 from werkzeug.security import generate_password_hash, check_password_hash
 from dotenv import load_dotenv
 import os
 load_dotenv()
 # --- Import Helpers & Blueprints ---
-from helpers.database import db_execute_query, get_db_connection
+from helpers.database import db_execute_query, get_db_connection, get_db_pool_stats
 from helpers.utils import iso_to_thai_date
+from helpers.pagination import parse_page_args, fetch_keyset_page, encode_page_cursor, page_response
+from helpers.stock_balance import rebuild_stock_balance, verify_stock_balance, build_balance_snapshots
+from helpers.migrations import apply_migrations, get_migration_status, explain_hot_queries
+from helpers.change_log import prune_change_log
+from helpers.dispense_uploads import prune_upload_requests
+from helpers.compression import init_compression
+from helpers.cache import cached_json_response, invalidate_cache, invalidate_clinic_stock_caches, invalidate_all_caches, get_cache_stats, CACHE_UNITSERVICES, CACHE_USERS
 from mysql.connector import Error
 
 # Import Blueprints ที่สร้างขึ้น
 from blueprints.medicines import medicine_bp
-from blueprints.inventory import inventory_bp
+from blueprints.inventory import inventory_bp, recalculate_min_max_for_hcode, get_hcodes_with_active_medicines
 from blueprints.requisitions import requisition_bp
 from blueprints.receive import receive_bp
 from blueprints.dispense import dispense_bp
+from blueprints.changes import changes_bp
 
 # --- App Initialization ---
 
 app = Flask(__name__)
+# ขนาด request body สูงสุด (หลังคลายการบีบอัด) endpoint ที่รับไฟล์หรือรายการจ่ายยาอ่านข้อมูลทั้งหมดเข้าหน่วยความจำ
+# ต้องใหญ่กว่า UPLOAD_MAX_BYTES ของไฟล์ Excel/CSV เผื่อส่วนหัวของ multipart
+app.config['MAX_CONTENT_LENGTH'] = int(os.getenv('MAX_CONTENT_LENGTH_BYTES', 32 * 1024 * 1024))
 CORS(app)
+init_compression(app)  # บีบอัด response ตาม Accept-Encoding และรับ request body แบบ gzip/deflate
 
 # --- Register Blueprints ---
 # ลงทะเบียนทุก Blueprint ที่เราสร้างขึ้นกับ Flask App
@@ -32,6 +45,13 @@ app.register_blueprint(inventory_bp)
 app.register_blueprint(requisition_bp)
 app.register_blueprint(receive_bp)
 app.register_blueprint(dispense_bp)
+app.register_blueprint(changes_bp)
+
+
+@app.errorhandler(413)
+def request_entity_too_large(e):
+    max_mb = app.config['MAX_CONTENT_LENGTH'] / 1024 / 1024
+    return jsonify({"error": f"ข้อมูลที่ส่งมามีขนาดเกินกำหนด {max_mb:.0f} MB"}), 413
 
 
 # --- HTML Rendering Routes ---
@@ -79,9 +99,15 @@ def login_api():
 # == Unit Services ==
 @app.route('/api/unitservices', methods=['GET'])
 def get_unit_services():
-    query = "SELECT hcode, name, type FROM unitservice ORDER BY name"
-    services = db_execute_query(query, fetchall=True)
-    return jsonify(services if services else [])
+    def load_unit_services():
+        query = "SELECT hcode, name, type FROM unitservice ORDER BY name"
+        services = db_execute_query(query, fetchall=True)
+        response = jsonify(services if services else [])
+        if services is None:
+            # อ่านฐานข้อมูลไม่ได้: ส่งรายการว่างตามเดิมแต่ไม่เก็บลง cache
+            response.cache_control.no_store = True
+        return response
+    return cached_json_response(CACHE_UNITSERVICES, load_unit_services)
 
 @app.route('/api/unitservices', methods=['POST'])
 def add_unit_service():
@@ -91,6 +117,7 @@ def add_unit_service():
     
     query = "INSERT INTO unitservice (hcode, name, type) VALUES (%s, %s, %s)"
     db_execute_query(query, (data['hcode'], data['name'], data.get('type', 'รพสต.')), commit=True)
+    invalidate_cache(CACHE_UNITSERVICES)
     return jsonify({"message": "เพิ่มหน่วยบริการสำเร็จ"}), 201
 
 @app.route('/api/unitservices/<string:hcode>', methods=['PUT'])
@@ -127,6 +154,8 @@ def update_unit_service(hcode):
     query = f"UPDATE unitservice SET {', '.join(update_fields)} WHERE hcode = %s"
     
     db_execute_query(query, tuple(params), commit=True)
+    invalidate_cache(CACHE_UNITSERVICES)
+    invalidate_cache(CACHE_USERS)  # รายชื่อผู้ใช้งานแสดงชื่อหน่วยบริการด้วย
     return jsonify({"message": f"แก้ไขข้อมูลหน่วยบริการสำเร็จ"})
 
 
@@ -136,15 +165,33 @@ def delete_unit_service(hcode):
         return jsonify({"error": f"ไม่พบหน่วยบริการรหัส {hcode}"}), 404
     query = "DELETE FROM unitservice WHERE hcode = %s"
     db_execute_query(query, (hcode,), commit=True)
+    invalidate_cache(CACHE_UNITSERVICES)
+    invalidate_cache(CACHE_USERS)
     return jsonify({"message": f"ลบหน่วยบริการ {hcode} สำเร็จ"})
 
 
 # == Users ==
 @app.route('/api/users', methods=['GET'])
 def get_users():
-    query = "SELECT u.id, u.username, u.full_name, u.role, u.hcode, us.name as hcode_name, u.is_active FROM users u LEFT JOIN unitservice us ON u.hcode = us.hcode ORDER BY u.full_name"
-    users = db_execute_query(query, fetchall=True)
-    return jsonify(users if users else [])
+    def load_users():
+        # keyset ต้องไม่มี NULL จึงเรียงด้วย COALESCE(full_name, '') แล้วเอาคอลัมน์ช่วยเรียงออกก่อนส่ง
+        query = "SELECT u.id, u.username, u.full_name, u.role, u.hcode, us.name as hcode_name, u.is_active, COALESCE(u.full_name, '') AS full_name_sort FROM users u LEFT JOIN unitservice us ON u.hcode = us.hcode"
+        try:
+            page = parse_page_args(request.args)
+            users, next_cursor_values, total = fetch_keyset_page(
+                query, [], [], [("COALESCE(u.full_name, '')", "full_name_sort"), ("u.id", "id")], page,
+                descending=False, count_sql="SELECT COUNT(*) AS total FROM users u"
+            )
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        for user in users or []:
+            user.pop('full_name_sort', None)
+        response = page_response(users or [], encode_page_cursor(next_cursor_values) if next_cursor_values else None, total, page)
+        if users is None:
+            response.cache_control.no_store = True
+        return response
+    # แต่ละหน้า (limit/cursor/include_total) เป็น entry แยกกัน
+    return cached_json_response(CACHE_USERS, load_users, params=request.args.to_dict())
 
 @app.route('/api/users', methods=['POST'])
 def add_user():
@@ -158,6 +205,7 @@ def add_user():
     password_hash = generate_password_hash(data['password'])
     query = "INSERT INTO users (username, password_hash, full_name, role, hcode) VALUES (%s, %s, %s, %s, %s)"
     db_execute_query(query, (data['username'], password_hash, data['full_name'], data['role'], data.get('hcode')), commit=True)
+    invalidate_cache(CACHE_USERS)
     return jsonify({"message": "เพิ่มผู้ใช้งานสำเร็จ"}), 201
 
 @app.route('/api/users/<int:user_id>', methods=['PUT'])
@@ -191,6 +239,7 @@ def update_user(user_id):
     params.append(user_id)
     query = f"UPDATE users SET {', '.join(update_parts)} WHERE id = %s"
     db_execute_query(query, tuple(params), commit=True)
+    invalidate_cache(CACHE_USERS)
     return jsonify({"message": "แก้ไขข้อมูลผู้ใช้งานสำเร็จ"})
 
 @app.route('/api/users/<int:user_id>', methods=['DELETE'])
@@ -200,12 +249,26 @@ def delete_user(user_id):
 
     try:
         db_execute_query("DELETE FROM users WHERE id = %s", (user_id,), commit=True)
+        invalidate_cache(CACHE_USERS)
         return jsonify({"message": f"ผู้ใช้งาน ID {user_id} ถูกลบแล้ว"})
     except Error as e:
         app.logger.error(f"Error deleting user {user_id}: {e}")
         return jsonify({"error": f"ไม่สามารถลบผู้ใช้งานได้เนื่องจากมีข้อมูลอ้างอิง"}), 409
 
 
+# == Health / Monitoring ==
+@app.route('/api/health/db-pool', methods=['GET'])
+def get_db_pool_health():
+    """สถิติของ connection pool ใน worker process ที่รับ request นี้ (ใช้ประกอบการปรับขนาด pool)"""
+    return jsonify(get_db_pool_stats())
+
+
+@app.route('/api/health/cache', methods=['GET'])
+def get_cache_health():
+    """สถิติ hit/miss ของ cache ต่อ endpoint ใน worker process ที่รับ request นี้ และสถานะของ backend"""
+    return jsonify(get_cache_stats())
+
+
 # == Dashboard ==
 @app.route('/api/dashboard/summary', methods=['GET'])
 def get_dashboard_summary():
@@ -224,7 +287,7 @@ def get_dashboard_summary():
     try:
         if user_hcode:
             # Query for total medicines
-            total_med_q = "SELECT COUNT(DISTINCT m.id) as count FROM medicines m JOIN inventory i ON m.id = i.medicine_id WHERE m.is_active = TRUE AND i.quantity_on_hand > 0 AND m.hcode = %s AND i.hcode = %s"
+            total_med_q = "SELECT COUNT(*) as count FROM medicines m JOIN stock_balance sb ON sb.medicine_id = m.id AND sb.hcode = m.hcode WHERE m.is_active = TRUE AND sb.total_on_hand > 0 AND m.hcode = %s AND sb.hcode = %s"
             total_med_res = db_execute_query(total_med_q, (user_hcode, user_hcode), fetchone=True, cursor_to_use=cursor)
             if total_med_res: summary['total_medicines_in_stock'] = total_med_res['count']
 
@@ -232,11 +295,10 @@ def get_dashboard_summary():
             low_stock_q = """
                 SELECT COUNT(m.id) as count
                 FROM medicines m
-                LEFT JOIN (SELECT medicine_id, hcode, SUM(quantity_on_hand) as total FROM inventory WHERE hcode = %s GROUP BY medicine_id, hcode) as i_sum
-                ON m.id = i_sum.medicine_id AND m.hcode = i_sum.hcode
-                WHERE m.is_active = TRUE AND m.hcode = %s AND COALESCE(i_sum.total, 0) <= m.reorder_point AND COALESCE(i_sum.total, 0) > 0
+                JOIN stock_balance sb ON sb.medicine_id = m.id AND sb.hcode = m.hcode
+                WHERE m.is_active = TRUE AND m.hcode = %s AND sb.total_on_hand <= m.reorder_point AND sb.total_on_hand > 0
             """
-            low_stock_res = db_execute_query(low_stock_q, (user_hcode, user_hcode), fetchone=True, cursor_to_use=cursor)
+            low_stock_res = db_execute_query(low_stock_q, (user_hcode,), fetchone=True, cursor_to_use=cursor)
             if low_stock_res: summary['low_stock_medicines'] = low_stock_res['count']
 
         # Query for pending requisitions
@@ -259,6 +321,225 @@ def get_dashboard_summary():
         if conn: conn.close()
 
 
+# --- CLI Commands ---
+# ใช้งานผ่าน: flask --app app stock-balance rebuild|verify|snapshot [--hcode XXXXX]
+
+@app.cli.group('stock-balance')
+def stock_balance_cli():
+    """จัดการตาราง stock_balance (ยอดคงเหลือรวมต่อยา)"""
+
+
+@stock_balance_cli.command('rebuild')
+@click.option('--hcode', default=None, help='สร้างใหม่เฉพาะหน่วยบริการนี้ (ไม่ระบุ = ทั้งระบบ)')
+def rebuild_stock_balance_command(hcode):
+    """สร้าง stock_balance ใหม่จาก inventory"""
+    conn = get_db_connection()
+    if not conn: raise click.ClickException("ไม่สามารถเชื่อมต่อฐานข้อมูลได้")
+    cursor = conn.cursor(dictionary=True)
+    try:
+        conn.start_transaction()
+        row_count = rebuild_stock_balance(cursor, hcode)
+        conn.commit()
+        invalidate_clinic_stock_caches(hcode) if hcode else invalidate_all_caches()
+        click.echo(f"สร้าง stock_balance ใหม่ {row_count} รายการ")
+    except Error as e:
+        conn.rollback()
+        raise click.ClickException(f"Database error: {e}")
+    finally:
+        cursor.close()
+        conn.close()
+
+
+@stock_balance_cli.command('verify')
+@click.option('--hcode', default=None, help='ตรวจสอบเฉพาะหน่วยบริการนี้ (ไม่ระบุ = ทั้งระบบ)')
+@click.option('--fix', is_flag=True, help='สร้าง stock_balance ใหม่หากพบรายการที่ไม่ตรงกัน')
+def verify_stock_balance_command(hcode, fix):
+    """ตรวจสอบว่า stock_balance ตรงกับ inventory (exit code 1 หากไม่ตรงและไม่ได้ใช้ --fix)"""
+    conn = get_db_connection()
+    if not conn: raise click.ClickException("ไม่สามารถเชื่อมต่อฐานข้อมูลได้")
+    cursor = conn.cursor(dictionary=True)
+    try:
+        mismatches = verify_stock_balance(cursor, hcode)
+        for mismatch in mismatches:
+            click.echo(
+                f"hcode={mismatch['hcode']} medicine_id={mismatch['medicine_id']} "
+                f"inventory={mismatch['expected_total']} ({mismatch['expected_nearest_expiry']}) "
+                f"stock_balance={mismatch['stored_total']} ({mismatch['stored_nearest_expiry']})"
+            )
+        if not mismatches:
+            click.echo("stock_balance ตรงกับ inventory")
+            return
+        click.echo(f"พบรายการไม่ตรงกัน {len(mismatches)} รายการ")
+        if not fix:
+            raise SystemExit(1)
+        conn.start_transaction()
+        row_count = rebuild_stock_balance(cursor, hcode)
+        conn.commit()
+        invalidate_clinic_stock_caches(hcode) if hcode else invalidate_all_caches()
+        click.echo(f"สร้าง stock_balance ใหม่ {row_count} รายการ")
+    except Error as e:
+        conn.rollback()
+        raise click.ClickException(f"Database error: {e}")
+    finally:
+        cursor.close()
+        conn.close()
+
+
+@stock_balance_cli.command('snapshot')
+@click.option('--hcode', default=None, help='สร้างเฉพาะหน่วยบริการนี้ (ไม่ระบุ = ทั้งระบบ)')
+@click.option('--months', default=1, show_default=True, help='จำนวนต้นเดือนย้อนหลังที่สร้าง (นับรวมต้นเดือนปัจจุบัน)')
+def snapshot_stock_balance_command(hcode, months):
+    """สร้าง snapshot ยอดยกมาต้นเดือนสำหรับหน้าประวัติ (ตั้งเป็นงานตามเวลาได้ เช่น cron วันที่ 1 ของเดือน)"""
+    conn = get_db_connection()
+    if not conn: raise click.ClickException("ไม่สามารถเชื่อมต่อฐานข้อมูลได้")
+    cursor = conn.cursor(dictionary=True)
+    try:
+        conn.start_transaction()
+        row_count = build_balance_snapshots(cursor, months, hcode)
+        conn.commit()
+        click.echo(f"สร้าง snapshot ยอดยกมา {row_count} รายการ")
+    except Error as e:
+        conn.rollback()
+        raise click.ClickException(f"Database error: {e}")
+    finally:
+        cursor.close()
+        conn.close()
+
+
+@app.cli.group('db')
+def db_cli():
+    """จัดการ schema ของฐานข้อมูล (migration และตรวจแผนการ query)"""
+
+
+@db_cli.command('migrate')
+def db_migrate_command():
+    """รัน migration ในโฟลเดอร์ migrations/ ที่ยังไม่เคยรัน"""
+    conn = get_db_connection()
+    if not conn: raise click.ClickException("ไม่สามารถเชื่อมต่อฐานข้อมูลได้")
+    try:
+        applied_versions = apply_migrations(conn, log=click.echo)
+        click.echo(f"รัน migration {len(applied_versions)} รายการ" if applied_versions else "ฐานข้อมูลเป็นเวอร์ชันล่าสุดแล้ว")
+    except Error as e:
+        raise click.ClickException(f"Migration ล้มเหลว: {e}")
+    finally:
+        conn.close()
+
+
+@db_cli.command('status')
+def db_status_command():
+    """แสดงสถานะ migration แต่ละไฟล์"""
+    conn = get_db_connection()
+    if not conn: raise click.ClickException("ไม่สามารถเชื่อมต่อฐานข้อมูลได้")
+    cursor = conn.cursor(dictionary=True)
+    try:
+        for migration in get_migration_status(cursor):
+            click.echo(f"{migration['version']}_{migration['name']}: {migration['state']}")
+    finally:
+        cursor.close()
+        conn.close()
+
+
+@db_cli.command('explain-check')
+@click.option('--strict', is_flag=True, help='ถือว่า full scan ที่ optimizer เลือกเอง (ทั้งที่มี index) เป็นความผิดพลาดด้วย')
+def db_explain_check_command(strict):
+    """ตรวจ EXPLAIN ของ query ที่ใช้บ่อย (exit code 1 หากพบ full scan)"""
+    conn = get_db_connection()
+    if not conn: raise click.ClickException("ไม่สามารถเชื่อมต่อฐานข้อมูลได้")
+    cursor = conn.cursor(dictionary=True)
+    try:
+        findings = explain_hot_queries(cursor)
+    except Error as e:
+        raise click.ClickException(f"Database error: {e}")
+    finally:
+        cursor.close()
+        conn.close()
+
+    failed = False
+    for finding in findings:
+        is_failure = finding['problem'] == 'full_scan' or (strict and finding['problem'])
+        failed = failed or is_failure
+        marker = "FAIL" if is_failure else ("WARN" if finding['problem'] else "ok")
+        click.echo(f"[{marker}] {finding['name']}: {finding['table']} type={finding['type']} key={finding['key']} rows={finding['rows']}")
+    if failed:
+        raise SystemExit(1)
+
+
+@app.cli.group('changes')
+def changes_cli():
+    """จัดการ change_log ของ feed /api/changes"""
+
+
+@changes_cli.command('prune')
+@click.option('--days', 'older_than_days', default=30, show_default=True, help='ลบการเปลี่ยนแปลงที่เก่ากว่าจำนวนวันนี้')
+def prune_changes_command(older_than_days):
+    """ลบ change_log เก่า (client ที่ถือ token ก่อนช่วงที่ลบจะได้ 410 และต้องโหลดข้อมูลทั้งหมดใหม่)"""
+    conn = get_db_connection()
+    if not conn: raise click.ClickException("ไม่สามารถเชื่อมต่อฐานข้อมูลได้")
+    cursor = conn.cursor(dictionary=True)
+    try:
+        conn.start_transaction()
+        row_count = prune_change_log(cursor, older_than_days)
+        conn.commit()
+        click.echo(f"ลบ change_log {row_count} รายการ")
+    except Error as e:
+        conn.rollback()
+        raise click.ClickException(f"Database error: {e}")
+    finally:
+        cursor.close()
+        conn.close()
+
+
+@app.cli.group('dispense-uploads')
+def dispense_uploads_cli():
+    """จัดการสถานะคำขอตัดจ่ายแบบ bulk (idempotency_key)"""
+
+
+@dispense_uploads_cli.command('prune')
+@click.option('--days', 'older_than_days', default=7, show_default=True, help='ลบสถานะคำขอที่เก่ากว่าจำนวนวันนี้')
+def prune_dispense_uploads_command(older_than_days):
+    """ลบสถานะคำขอตัดจ่ายเก่า (ใช้เฉพาะช่วงที่ client อาจส่งคำขอเดิมซ้ำ)"""
+    conn = get_db_connection()
+    if not conn: raise click.ClickException("ไม่สามารถเชื่อมต่อฐานข้อมูลได้")
+    cursor = conn.cursor(dictionary=True)
+    try:
+        conn.start_transaction()
+        row_count = prune_upload_requests(cursor, older_than_days)
+        conn.commit()
+        click.echo(f"ลบสถานะคำขอตัดจ่าย {row_count} รายการ")
+    except Error as e:
+        conn.rollback()
+        raise click.ClickException(f"Database error: {e}")
+    finally:
+        cursor.close()
+        conn.close()
+
+
+@app.cli.command('recalculate-min-max')
+@click.option('--hcode', default=None, help='คำนวณเฉพาะหน่วยบริการนี้ (ไม่ระบุ = ทุกหน่วยบริการ)')
+@click.option('--days', 'calculation_period_days', default=90, show_default=True, help='จำนวนวันย้อนหลังที่ใช้คำนวณ ADU')
+def recalculate_min_max_command(hcode, calculation_period_days):
+    """คำนวณ Min/Max ของยาใหม่จากยอดจ่ายย้อนหลัง (ใช้ตั้งเป็นงานตามเวลาได้ เช่น cron รายสัปดาห์)"""
+    conn = get_db_connection()
+    if not conn: raise click.ClickException("ไม่สามารถเชื่อมต่อฐานข้อมูลได้")
+    cursor = conn.cursor(dictionary=True)
+    try:
+        hcodes = [hcode] if hcode else get_hcodes_with_active_medicines(cursor)
+        conn.commit()
+        for target_hcode in hcodes:
+            conn.start_transaction()
+            details = recalculate_min_max_for_hcode(target_hcode, calculation_period_days, cursor)
+            conn.commit()
+            invalidate_clinic_stock_caches(target_hcode)
+            updated_count = sum(1 for detail in details if detail['updated_successfully'])
+            click.echo(f"{target_hcode}: ปรับ Min/Max {updated_count} จาก {len(details)} รายการ")
+    except Error as e:
+        conn.rollback()
+        raise click.ClickException(f"Database error: {e}")
+    finally:
+        cursor.close()
+        conn.close()
+
+
 # --- Main Execution ---
 if __name__ == '__main__':
     # For production, use a WSGI server like Gunicorn or Waitress
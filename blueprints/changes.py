@@ -0,0 +1,49 @@
+# /blueprints/changes.py
+
+from flask import Blueprint, request, jsonify
+from helpers.database import get_db_connection
+from helpers.change_log import read_change_feed, decode_change_token, ChangeFeedResetRequired, CHANGE_FEED_DEFAULT_LIMIT, CHANGE_FEED_MAX_LIMIT
+from mysql.connector import Error
+
+# สร้าง Blueprint สำหรับ feed การเปลี่ยนแปลง (delta sync)
+changes_bp = Blueprint('changes', __name__, url_prefix='/api/changes')
+
+
+@changes_bp.route('', methods=['GET'])
+def get_changes():
+    """
+    การเปลี่ยนแปลงของยา ยอดคงเหลือ และสถานะใบเบิกของหน่วยบริการหลัง token ที่ client ถืออยู่
+    - ไม่ส่ง since: ได้ next_token ปัจจุบัน (full_resync) ให้ client โหลดข้อมูลเต็มแล้วเก็บ token ไว้
+    - has_more = true: ขอต่อด้วย next_token ทันที
+    - 410 (reset_required): token เก่าเกินข้อมูลที่เก็บไว้ ต้องโหลดข้อมูลเต็มใหม่
+    """
+    hcode = request.args.get('hcode')
+    if not hcode:
+        return jsonify({"error": "กรุณาระบุ hcode ของหน่วยบริการ"}), 400
+
+    since_token = request.args.get('since')
+    try:
+        since_seq = decode_change_token(hcode, since_token) if since_token else None
+        limit = int(request.args.get('limit', CHANGE_FEED_DEFAULT_LIMIT))
+    except ValueError:
+        return jsonify({"error": "since หรือ limit ไม่ถูกต้อง"}), 400
+    limit = max(1, min(limit, CHANGE_FEED_MAX_LIMIT))
+
+    conn = get_db_connection()
+    if not conn: return jsonify({"error": "ไม่สามารถเชื่อมต่อฐานข้อมูลได้"}), 500
+    cursor = conn.cursor(dictionary=True)
+    try:
+        # อ่านตัวนับ change_log และค่าปัจจุบันของแถวจาก snapshot เดียวกัน
+        conn.start_transaction(readonly=True)
+        feed = read_change_feed(hcode, since_seq, limit, cursor)
+        conn.commit()
+        return jsonify(feed)
+    except ChangeFeedResetRequired:
+        conn.rollback()
+        return jsonify({"error": "token เก่าเกินไปหรือข้อมูลถูกสร้างใหม่ กรุณาโหลดข้อมูลทั้งหมดใหม่", "reset_required": True}), 410
+    except Error as e:
+        conn.rollback()
+        return jsonify({"error": f"เกิดข้อผิดพลาดในฐานข้อมูล: {getattr(e, 'msg', str(e))}"}), 500
+    finally:
+        cursor.close()
+        conn.close()
@@ -1,12 +1,22 @@
 # /blueprints/dispense.py
 
 from flask import Blueprint, request, jsonify
-from helpers.database import db_execute_query, get_db_connection
-from helpers.utils import thai_to_iso_date, iso_to_thai_date
+from helpers.database import db_execute_query, get_db_connection, build_in_placeholders, db_insert_many
+from helpers.utils import thai_to_iso_date, iso_to_thai_date, parse_date_series, normalize_code_series
+from helpers.spreadsheet import iter_spreadsheet_batches, track_upload_memory, limit_preview_items, SpreadsheetError, UPLOAD_PREVIEW_LIMIT
+from helpers.pagination import parse_page_args, fetch_keyset_page, build_keyset_query, first_page, encode_page_cursor, decode_page_cursor, page_response
+from helpers.document_numbers import next_document_number
+from helpers.medicines import fetch_active_medicines_by_code
+from helpers.stock_balance import refresh_stock_balance, refresh_stock_balance_for_movements, record_stock_changes, invalidate_balance_snapshots, invalidate_balance_snapshots_for_movements
+from helpers.cache import invalidate_clinic_stock_caches
+from helpers.sync_watermarks import parse_sync_watermark, format_sync_watermark, get_sync_watermark, advance_sync_watermark, record_sync_failures, clear_sync_failures, list_sync_failures
+from helpers.dispense_uploads import get_upload_request, claim_upload_request, save_upload_request
+from helpers.migrations import register_hot_query
 from datetime import datetime
 from mysql.connector import Error
 import pandas as pd
-from io import BytesIO
+import hashlib
+import json
 import logging
 
 # ตั้งค่า logging เพื่อช่วยในการดีบัก
@@ -34,55 +44,136 @@ def map_dispense_type_to_inventory_transaction_type(dispense_type_from_record):
         return 'จ่ายออก-ผู้ป่วย' # 'จ่ายออก-ผู้ป่วย' is a valid ENUM
     return 'อื่นๆ' # Fallback to 'อื่นๆ'
 
-def _dispense_medicine_fefo(hcode, medicine_id, quantity_to_dispense, dispense_record_id, dispenser_id, dispense_record_number, hos_guid, dispense_type_from_record, item_dispense_date_iso, cursor):
+def _fefo_lots_query(hcode, medicine_ids):
+    """SQL และพารามิเตอร์ที่ล็อก Lot ของยาที่ระบุเรียงตาม FEFO"""
+    sql = f"""
+        SELECT id as inventory_id, medicine_id, lot_number, expiry_date, quantity_on_hand
+        FROM inventory
+        WHERE hcode = %s AND medicine_id IN ({build_in_placeholders(medicine_ids)})
+        ORDER BY medicine_id, expiry_date ASC, id ASC
+        FOR UPDATE
     """
-    Logic หลักในการตัดจ่ายยาตามหลัก FEFO (First-Expired, First-Out)
-    ฟังก์ชันนี้จะจัดการการอัปเดต inventory และสร้าง transaction log
-    """
-    remaining_qty_to_dispense = quantity_to_dispense
-    available_lots_query = "SELECT id as inventory_id, lot_number, expiry_date, quantity_on_hand FROM inventory WHERE hcode = %s AND medicine_id = %s AND quantity_on_hand > 0 ORDER BY expiry_date ASC, id ASC"
-    available_lots = db_execute_query(available_lots_query, (hcode, medicine_id), fetchall=True, cursor_to_use=cursor)
+    return sql, (hcode, *medicine_ids)
 
-    total_stock_for_med = sum(lot['quantity_on_hand'] for lot in available_lots)
-    if total_stock_for_med < remaining_qty_to_dispense:
-        logger.warning(f"FEFO: Insufficient stock for medicine_id {medicine_id}. Needed {quantity_to_dispense}, available {total_stock_for_med}.")
-        return False
+register_hot_query("FEFO lots", *_fefo_lots_query('00000', [1, 2]))
 
-    dispensed_from_lots_info = []
-    inventory_transaction_type = map_dispense_type_to_inventory_transaction_type(dispense_type_from_record)
+def _lock_fefo_stock(hcode, medicine_ids, cursor):
+    """
+    ล็อก Lot ทั้งหมดของยาที่ระบุด้วย SELECT ... FOR UPDATE ในคำสั่งเดียว
+    คืนค่า dict: medicine_id -> {'lots': [lot เรียงตาม FEFO], 'total_stock': ยอดคงเหลือรวมของยา}
+    """
+    medicine_ids = list(dict.fromkeys(int(medicine_id) for medicine_id in medicine_ids))
+    if not medicine_ids:
+        return {}
+    locked_lots = db_execute_query(*_fefo_lots_query(hcode, medicine_ids), fetchall=True, cursor_to_use=cursor)
+    if locked_lots is None:
+        raise Error(msg=f"Could not lock inventory lots for hcode {hcode}")
+
+    stock_by_medicine = {medicine_id: {'lots': [], 'total_stock': 0} for medicine_id in medicine_ids}
+    for lot in locked_lots:
+        stock = stock_by_medicine.setdefault(lot['medicine_id'], {'lots': [], 'total_stock': 0})
+        stock['total_stock'] += lot['quantity_on_hand']
+        stock['lots'].append(lot)
+    return stock_by_medicine
+
+def _allocate_fefo(stock, quantity_to_dispense):
+    """
+    คำนวณการตัดจ่ายตามหลัก FEFO ในหน่วยความจำ (ไม่แตะฐานข้อมูล)
+    คืนค่า [(lot, จำนวนที่ตัดจาก lot)] และหักยอดใน stock ไว้สำหรับรายการถัดไปของยาเดียวกัน
+    หรือคืนค่า None หากสต็อกไม่เพียงพอ (stock ไม่ถูกเปลี่ยนแปลง)
+    """
+    available_stock = sum(lot['quantity_on_hand'] for lot in stock['lots'] if lot['quantity_on_hand'] > 0)
+    if available_stock < quantity_to_dispense:
+        return None
 
-    for lot in available_lots:
+    allocations = []
+    remaining_qty_to_dispense = quantity_to_dispense
+    for lot in stock['lots']:
         if remaining_qty_to_dispense <= 0: break
+        if lot['quantity_on_hand'] <= 0: continue
         qty_to_take_from_this_lot = min(remaining_qty_to_dispense, lot['quantity_on_hand'])
-        dispensed_from_lots_info.append({
-            'lot_number': lot['lot_number'],
-            'expiry_date_iso': str(lot['expiry_date']),
-            'quantity_dispensed_from_lot': qty_to_take_from_this_lot
-        })
-        
-        stock_before_txn = get_total_medicine_stock(hcode, medicine_id, cursor)
-        db_execute_query("UPDATE inventory SET quantity_on_hand = quantity_on_hand - %s WHERE id = %s", (qty_to_take_from_this_lot, lot['inventory_id']), commit=False, cursor_to_use=cursor)
-        stock_after_txn = get_total_medicine_stock(hcode, medicine_id, cursor)
-        
-        transaction_datetime = f"{item_dispense_date_iso} {datetime.now().strftime('%H:%M:%S')}"
-        db_execute_query(
-            "INSERT INTO inventory_transactions (hcode, medicine_id, lot_number, expiry_date, transaction_type, quantity_change, quantity_before_transaction, quantity_after_transaction, reference_document_id, user_id, remarks, transaction_date) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)",
-            (hcode, medicine_id, lot['lot_number'], str(lot['expiry_date']), inventory_transaction_type, -qty_to_take_from_this_lot, stock_before_txn, stock_after_txn, dispense_record_number, dispenser_id, f"FEFO Dispense (Lot: {lot['lot_number']})", transaction_datetime),
-            commit=False, cursor_to_use=cursor
-        )
+        lot['quantity_on_hand'] -= qty_to_take_from_this_lot
+        allocations.append((lot, qty_to_take_from_this_lot))
         remaining_qty_to_dispense -= qty_to_take_from_this_lot
+    return allocations
+
+def _new_fefo_write_plan():
+    """โครงสร้างสะสมรายการที่จะเขียนลงฐานข้อมูลแบบ batch หลังคำนวณ FEFO เสร็จ"""
+    return {'lot_deductions': {}, 'transactions': [], 'dispense_items': []}
 
-    for lot_info in dispensed_from_lots_info:
-        db_execute_query(
-            "INSERT INTO dispense_items (dispense_record_id, medicine_id, lot_number, expiry_date, quantity_dispensed, dispense_date, hos_guid, item_status) VALUES (%s, %s, %s, %s, %s, %s, %s, 'ปกติ')",
-            (dispense_record_id, medicine_id, lot_info['lot_number'], lot_info['expiry_date_iso'], lot_info['quantity_dispensed_from_lot'], item_dispense_date_iso, hos_guid),
-            commit=False, cursor_to_use=cursor
+def _add_fefo_allocation_to_plan(plan, stock, allocations, hcode, medicine_id, dispense_record_id, dispenser_id, dispense_record_number, hos_guid, dispense_type_from_record, item_dispense_date_iso):
+    """
+    แปลงผลการจัดสรร FEFO เป็นแถวสำหรับ UPDATE inventory, INSERT inventory_transactions และ dispense_items
+    ยอดก่อน/หลังทำรายการคำนวณจากยอดรวมที่ล็อกไว้ ไม่ต้อง query ซ้ำ
+    """
+    inventory_transaction_type = map_dispense_type_to_inventory_transaction_type(dispense_type_from_record)
+    transaction_datetime = f"{item_dispense_date_iso} {datetime.now().strftime('%H:%M:%S')}"
+
+    for lot, qty_taken in allocations:
+        plan['lot_deductions'][lot['inventory_id']] = plan['lot_deductions'].get(lot['inventory_id'], 0) + qty_taken
+        stock_before_txn = stock['total_stock']
+        stock['total_stock'] -= qty_taken
+        expiry_date_iso = str(lot['expiry_date'])
+        plan['transactions'].append((
+            hcode, medicine_id, lot['lot_number'], expiry_date_iso, inventory_transaction_type, -qty_taken,
+            stock_before_txn, stock['total_stock'], dispense_record_number, dispenser_id,
+            f"FEFO Dispense (Lot: {lot['lot_number']})", transaction_datetime
+        ))
+        plan['dispense_items'].append((
+            dispense_record_id, medicine_id, lot['lot_number'], expiry_date_iso, qty_taken,
+            item_dispense_date_iso, hos_guid, 'ปกติ'
+        ))
+
+def _write_fefo_plan(plan, cursor, stock_movements):
+    """
+    เขียนผลการตัดจ่ายทั้งหมดในแผนด้วยคำสั่งแบบ batch (UPDATE ... CASE และ INSERT หลายแถว)
+    เพิ่ม (hcode, medicine_id) ที่ยอดเปลี่ยนลงใน stock_movements ให้ผู้เรียก record_stock_changes ครั้งเดียวก่อน commit
+    """
+    lot_deductions = plan['lot_deductions']
+    if lot_deductions:
+        inventory_ids = list(lot_deductions.keys())
+        case_sql = " ".join(["WHEN %s THEN %s"] * len(inventory_ids))
+        case_params = [value for inventory_id in inventory_ids for value in (inventory_id, lot_deductions[inventory_id])]
+        cursor.execute(
+            f"UPDATE inventory SET quantity_on_hand = quantity_on_hand - (CASE id {case_sql} END) WHERE id IN ({build_in_placeholders(inventory_ids)})",
+            (*case_params, *inventory_ids)
         )
+    db_insert_many(
+        'inventory_transactions',
+        ['hcode', 'medicine_id', 'lot_number', 'expiry_date', 'transaction_type', 'quantity_change', 'quantity_before_transaction', 'quantity_after_transaction', 'reference_document_id', 'user_id', 'remarks', 'transaction_date'],
+        plan['transactions'], cursor
+    )
+    db_insert_many(
+        'dispense_items',
+        ['dispense_record_id', 'medicine_id', 'lot_number', 'expiry_date', 'quantity_dispensed', 'dispense_date', 'hos_guid', 'item_status'],
+        plan['dispense_items'], cursor
+    )
+    movements = {(txn[0], txn[1]) for txn in plan['transactions']}
+    refresh_stock_balance_for_movements(movements, cursor)
+    stock_movements.update(movements)
+    invalidate_balance_snapshots_for_movements([(txn[0], txn[1], txn[11]) for txn in plan['transactions']], cursor)
+
+def _dispense_medicine_fefo(hcode, medicine_id, quantity_to_dispense, dispense_record_id, dispenser_id, dispense_record_number, hos_guid, dispense_type_from_record, item_dispense_date_iso, cursor, stock_movements):
+    """
+    Logic หลักในการตัดจ่ายยาตามหลัก FEFO (First-Expired, First-Out)
+    ล็อก Lot ของยาครั้งเดียว คำนวณการจัดสรรในหน่วยความจำ แล้วเขียน inventory, transaction log และ dispense_items แบบ batch
+    """
+    stock = _lock_fefo_stock(hcode, [medicine_id], cursor)[int(medicine_id)]
+    allocations = _allocate_fefo(stock, quantity_to_dispense)
+    if allocations is None:
+        logger.warning(f"FEFO: Insufficient stock for medicine_id {medicine_id}. Needed {quantity_to_dispense}, available {stock['total_stock']}.")
+        return False
+
+    plan = _new_fefo_write_plan()
+    _add_fefo_allocation_to_plan(plan, stock, allocations, hcode, medicine_id, dispense_record_id, dispenser_id, dispense_record_number, hos_guid, dispense_type_from_record, item_dispense_date_iso)
+    _write_fefo_plan(plan, cursor, stock_movements)
     return True
-def _cancel_dispense_item_internal(dispense_item_id, cancelling_user_id, cursor, for_excel_update=False):
+def _cancel_dispense_item_internal(dispense_item_id, cancelling_user_id, cursor, stock_movements, for_excel_update=False):
+    """คืนสต็อกของรายการจ่ายและลบ transaction log ของรายการนั้น (ยาที่ยอดเปลี่ยนถูกเพิ่มลงใน stock_movements)"""
     try:
         item_to_cancel_query = """
             SELECT di.medicine_id, di.lot_number, di.expiry_date, di.quantity_dispensed, di.hos_guid,
+                   COALESCE(di.dispense_date, dr.dispense_date) AS movement_date,
                    dr.hcode, dr.dispense_record_number, dr.id as dispense_record_id, dr.dispense_type
             FROM dispense_items di
             JOIN dispense_records dr ON di.dispense_record_id = dr.id
@@ -122,6 +213,9 @@ def _cancel_dispense_item_internal(dispense_item_id, cancelling_user_id, cursor,
         else:
             db_execute_query("INSERT INTO inventory (hcode, medicine_id, lot_number, expiry_date, quantity_on_hand, received_date) VALUES (%s, %s, %s, %s, %s, CURDATE())",
                              (dispense_hcode, medicine_id, lot_number, expiry_date_iso, quantity_to_add_back), commit=False, cursor_to_use=cursor)
+        refresh_stock_balance(dispense_hcode, [medicine_id], cursor)
+        stock_movements.add((dispense_hcode, medicine_id))
+        invalidate_balance_snapshots(dispense_hcode, [medicine_id], cursor, item_to_cancel['movement_date'])
 
         delete_txn_conditions = [
             "hcode = %s", "medicine_id = %s", "lot_number = %s", 
@@ -172,6 +266,586 @@ def _cancel_dispense_item_internal(dispense_item_id, cancelling_user_id, cursor,
     except Exception as ex_gen:
         logger.error(f"General error in _cancel_dispense_item_internal for item {dispense_item_id}: {ex_gen}", exc_info=True)
         return False
+# --- Bulk Excel/HOSxP Dispense ---
+
+EXCEL_DISPENSE_DEFAULT_CHUNK_SIZE = 500
+EXCEL_DISPENSE_MAX_CHUNK_SIZE = 5000
+EXCEL_DISPENSE_DEFAULT_TIME_BUDGET_SECONDS = 60
+HOS_GUID_PREFETCH_BATCH_SIZE = 5000
+
+def _validate_excel_dispense_item(item_data, default_dispense_date_iso):
+    """ตรวจสอบข้อมูลรายการจ่ายจาก Excel/HOSxP คืนค่า (quantity, dispense_date_iso, error)"""
+    medicine_id = item_data.get('medicine_id')
+    quantity_requested = item_data.get('quantity_dispensed')
+    item_dispense_date_iso = item_data.get('dispense_date_iso', default_dispense_date_iso)
+
+    if not all([medicine_id, quantity_requested, item_dispense_date_iso]):
+        return None, None, "ข้อมูลไม่ครบถ้วน (ยา, จำนวน, หรือวันที่จ่าย)"
+    try:
+        int(medicine_id)
+    except (ValueError, TypeError):
+        return None, None, "รหัสยาไม่ถูกต้อง"
+    try:
+        quantity_requested = int(quantity_requested)
+    except (ValueError, TypeError):
+        return None, None, "จำนวนจ่ายไม่ถูกต้อง"
+    if quantity_requested <= 0:
+        return None, None, "จำนวนจ่ายต้องมากกว่า 0"
+    try:
+        datetime.strptime(item_dispense_date_iso, '%Y-%m-%d')
+    except (ValueError, TypeError):
+        return None, None, "รูปแบบวันที่จ่ายไม่ถูกต้อง"
+    return quantity_requested, item_dispense_date_iso, None
+
+def _existing_hos_guid_items_query(hcode, guid_batch):
+    """SQL และพารามิเตอร์ของรายการจ่ายเดิม (ที่ยังไม่ยกเลิก) ของ hos_guid ที่ระบุ"""
+    sql = f"""
+        SELECT di.id as dispense_item_id, di.hos_guid, di.quantity_dispensed
+        FROM dispense_items di
+        JOIN dispense_records dr ON di.dispense_record_id = dr.id
+        WHERE dr.hcode = %s AND di.hos_guid IN ({build_in_placeholders(guid_batch)})
+          AND dr.status != 'ยกเลิก' AND di.item_status = 'ปกติ'
+    """
+    return sql, (hcode, *guid_batch)
+
+register_hot_query("existing items by hos_guid", *_existing_hos_guid_items_query('00000', ['guid-1', 'guid-2']))
+
+def _prefetch_existing_hos_guid_items(hcode, hos_guids, cursor):
+    """ดึงรายการจ่ายเดิมของ hos_guid ทั้งหมดใน payload ด้วย query แบบ IN (...) คืนค่า dict: hos_guid -> [items]"""
+    hos_guids = list(dict.fromkeys(guid for guid in hos_guids if guid))
+    existing_by_guid = {}
+    for start in range(0, len(hos_guids), HOS_GUID_PREFETCH_BATCH_SIZE):
+        guid_batch = hos_guids[start:start + HOS_GUID_PREFETCH_BATCH_SIZE]
+        rows = db_execute_query(*_existing_hos_guid_items_query(hcode, guid_batch), fetchall=True, cursor_to_use=cursor)
+        if rows is None:
+            raise Error(msg="Could not prefetch existing hos_guid items")
+        for row in rows:
+            existing_by_guid.setdefault(row['hos_guid'], []).append(row)
+    return existing_by_guid
+
+def _bulk_payload_fingerprint(items_to_process):
+    """ลายนิ้วมือของ payload (รายการที่เรียงแล้ว) ใช้ยืนยันว่า resume_cursor มาจาก payload เดียวกัน"""
+    key_fields = [(item.get('hos_guid'), item.get('medicine_id'), item.get('quantity_dispensed'), item.get('dispense_date_iso')) for item in items_to_process]
+    return hashlib.sha256(json.dumps(key_fields, default=str).encode('utf-8')).hexdigest()[:16]
+
+def _encode_bulk_dispense_cursor(dispense_record_id, next_index, processed_total, failed_total, fingerprint):
+    """cursor ของโหมด bulk: เอกสารที่สร้าง, ตำแหน่งถัดไป, ยอดสะสมของรอบก่อน ๆ และลายนิ้วมือของ payload"""
+    return encode_page_cursor([dispense_record_id, next_index, processed_total, failed_total, fingerprint])
+
+def _decode_bulk_dispense_cursor(resume_cursor):
+    """คืนค่า dict ของ cursor หรือ None เมื่อรูปแบบไม่ถูกต้อง"""
+    try:
+        values = decode_page_cursor(str(resume_cursor))
+    except ValueError:
+        return None
+    if len(values) != 5 or not all(isinstance(value, int) and value >= 0 for value in values[:4]) or not isinstance(values[4], str):
+        return None
+    record_id, next_index, processed_total, failed_total, fingerprint = values
+    return {"dispense_record_id": record_id, "next_index": next_index, "processed_total": processed_total, "failed_total": failed_total, "fingerprint": fingerprint}
+
+def _sync_failure_entry(item_data, error):
+    """รายการที่ตัดจ่ายไม่สำเร็จสำหรับ dispense_sync_failures (ค่าที่แปลงไม่ได้เก็บเป็น NULL)"""
+    try:
+        medicine_id = int(item_data.get('medicine_id'))
+    except (ValueError, TypeError):
+        medicine_id = None
+    try:
+        quantity = float(item_data.get('quantity_dispensed'))
+    except (ValueError, TypeError):
+        quantity = None
+    try:
+        dispense_date = datetime.strptime(item_data.get('dispense_date_iso'), '%Y-%m-%d').strftime('%Y-%m-%d')
+    except (ValueError, TypeError):
+        dispense_date = None
+    return {"hos_guid": item_data.get('hos_guid'), "medicine_id": medicine_id, "quantity_dispensed": quantity, "dispense_date": dispense_date, "error": error}
+
+def _bulk_dispense_status_code(completed, total_processed, total_failed):
+    if not completed: return 202
+    if total_failed and total_processed > 0: return 207
+    if total_failed: return 400
+    return 201
+
+def _bulk_dispense_replay_response(hcode, upload_state, watermark_range, cursor):
+    """ผลของคำขอที่ส่งซ้ำหลังทำครบแล้ว (ไม่บันทึกอะไรเพิ่ม) ใช้ยอดสะสมจากสถานะของคำขอ"""
+    total_processed, total_failed = upload_state['processed_total'], upload_state['failed_total']
+    record = None
+    if upload_state['dispense_record_id']:
+        record = db_execute_query("SELECT dispense_record_number FROM dispense_records WHERE id = %s", (upload_state['dispense_record_id'],), fetchone=True, cursor_to_use=cursor)
+    response = {
+        "message": f"ข้อมูลชุดนี้ถูกบันทึกไปแล้ว: สำเร็จ {total_processed} รายการ ผิดพลาด {total_failed} รายการ",
+        "dispense_record_id": upload_state['dispense_record_id'] if record else None,
+        "dispense_record_number": record['dispense_record_number'] if record else None,
+        "processed_count": 0,
+        "total_processed_count": total_processed,
+        "failed_details": [],
+        "total_failed_count": total_failed,
+        "completed": True,
+        "duplicate_request": True,
+        "next_cursor": None,
+    }
+    if watermark_range:
+        response["sync_watermark"] = format_sync_watermark(get_sync_watermark(hcode, cursor))
+        response["sync_watermark_advanced"] = False
+    return jsonify(response), _bulk_dispense_status_code(True, total_processed, total_failed)
+
+def _process_excel_dispense_bulk(data, items_to_process, initial_failed_details=None):
+    """
+    โหมด bulk สำหรับการนำเข้าจำนวนมาก (เช่น ข้อมูลทั้งเดือนจาก IMdrug1)
+    - ดึง hos_guid ที่มีอยู่แล้วของทั้ง payload ครั้งเดียว
+    - แบ่ง commit เป็นช่วง (chunk) ในแต่ละช่วงล็อก Lot ของยาแต่ละตัวครั้งเดียวแล้วจัดสรร FEFO ในหน่วยความจำ
+    - หัวเอกสารถูกสร้างใน transaction ของ chunk แรก (ไม่เหลือเอกสารว่างเมื่อ chunk แรกล้มเหลว)
+    - หยุดเมื่อเกินเวลาที่กำหนด และคืนค่า next_cursor ให้ client ส่ง payload เดิมมาทำต่อได้
+      cursor เก็บยอดสำเร็จ/ผิดพลาดสะสมของรอบก่อน ๆ (สถานะตอนจบสะท้อนทุกรอบ) และลายนิ้วมือของ payload
+      ที่ต้องตรงกับ payload ที่ส่งมาทำต่อ พร้อมตรวจว่าเอกสารเป็นเอกสาร bulk ของหน่วยบริการ/ผู้จ่าย/ประเภทเดียวกัน
+    - sync_watermark {"after", "to"} (ไม่บังคับ): เลื่อนจุดซิงค์ใน transaction ของ chunk สุดท้าย
+      รายการที่ผิดพลาดซึ่งจุดซิงค์จะเลื่อนผ่าน (ไม่เกิน to และมี hos_guid) ถูกบันทึกลง dispense_sync_failures ใน transaction ของ chunk นั้น
+      จุดซิงค์จึงไม่ค้างอยู่ที่รายการที่ผิดพลาดถาวร (เช่น สต็อกไม่พอ) และโปรแกรมนำเข้าส่งรายการเหล่านี้ใหม่ภายหลัง
+    - sync_failure_retry (ไม่บังคับ): payload คือรายการจาก dispense_sync_failures ที่ส่งใหม่ รายการที่สำเร็จถูกลบออกจากรายการรอส่ง
+      รายการที่ยังผิดพลาดนับ attempts เพิ่ม
+    - idempotency_key (ไม่บังคับ): สถานะของคำขอถูกบันทึกพร้อมแต่ละ chunk คำขอที่ส่งซ้ำด้วยรหัสเดิม (เช่น หลัง timeout)
+      ทำต่อจากส่วนที่ commit แล้ว หรือคืนผลเดิมเมื่อทำครบแล้ว คำขอที่ซ้อนกันได้ 409 (in_progress) แทนการตัดจ่ายซ้ำ
+    - dispense_record_id (ไม่บังคับ): บันทึกต่อในเอกสาร bulk เดิมแทนการสร้างเอกสารใหม่ (ทุกชุดของการซิงค์หนึ่งรอบอยู่ในเอกสารเดียว)
+    initial_failed_details คือรายการที่ไม่ผ่านการตรวจสอบตั้งแต่ขั้นอ่านไฟล์ (รวมไว้ในผลลัพธ์ด้วย)
+    """
+    dispenser_id = data['dispenser_id']
+    hcode = data['hcode']
+    dispense_type_header = data.get('dispense_type_header', 'ผู้ป่วยนอก (Excel)')
+    remarks_header = data.get('remarks_header', 'ตัดจ่ายยาจากไฟล์ Excel (FEFO)')
+    try:
+        chunk_size = min(max(int(data.get('chunk_size', EXCEL_DISPENSE_DEFAULT_CHUNK_SIZE)), 1), EXCEL_DISPENSE_MAX_CHUNK_SIZE)
+        time_budget_seconds = float(data.get('time_budget_seconds', EXCEL_DISPENSE_DEFAULT_TIME_BUDGET_SECONDS))
+    except (ValueError, TypeError):
+        return jsonify({"error": "chunk_size หรือ time_budget_seconds ไม่ถูกต้อง"}), 400
+
+    watermark_range = None
+    if data.get('sync_watermark'):
+        try:
+            watermark_range = (parse_sync_watermark(data['sync_watermark'].get('after')), parse_sync_watermark(data['sync_watermark']['to']))
+        except (ValueError, TypeError, KeyError, AttributeError):
+            return jsonify({"error": "sync_watermark ไม่ถูกต้อง"}), 400
+
+    sync_failure_retry = bool(data.get('sync_failure_retry'))
+    idempotency_key = data.get('idempotency_key')
+    if idempotency_key is not None and (not isinstance(idempotency_key, str) or not 0 < len(idempotency_key) <= 64):
+        return jsonify({"error": "idempotency_key ต้องเป็นข้อความยาวไม่เกิน 64 ตัวอักษร"}), 400
+
+    fingerprint = _bulk_payload_fingerprint(items_to_process)
+    dispense_record_id, start_index, processed_before, failed_before = None, 0, 0, 0
+    if data.get('resume_cursor'):
+        resume = _decode_bulk_dispense_cursor(data['resume_cursor'])
+        if resume is None or not (0 <= resume['next_index'] <= len(items_to_process)):
+            return jsonify({"error": "resume_cursor ไม่ถูกต้อง"}), 400
+        if resume['fingerprint'] != fingerprint:
+            return jsonify({"error": "resume_cursor ไม่ได้มาจากข้อมูลชุดนี้ กรุณาส่งข้อมูลชุดเดิมหรือเริ่มใหม่โดยไม่ระบุ resume_cursor"}), 409
+        dispense_record_id, start_index = resume['dispense_record_id'], resume['next_index']
+        processed_before, failed_before = resume['processed_total'], resume['failed_total']
+    elif data.get('dispense_record_id') is not None:
+        try:
+            dispense_record_id = int(data['dispense_record_id'])
+        except (ValueError, TypeError):
+            return jsonify({"error": "dispense_record_id ไม่ถูกต้อง"}), 400
+
+    started_at = datetime.now()
+    conn = get_db_connection()
+    if not conn: return jsonify({"error": "ไม่สามารถเชื่อมต่อฐานข้อมูลได้"}), 500
+    cursor = conn.cursor(dictionary=True)
+
+    processed_count = 0
+    failed_items_details = list(initial_failed_details or [])
+    updated_hos_guids = []
+    skipped_hos_guids_same_qty = []
+    chunks_committed = 0
+    next_index = start_index
+    dispense_record_number = None
+    sync_watermark, sync_watermark_advanced = None, False
+    committed_totals = {}
+
+    def next_cursor_for(index):
+        return _encode_bulk_dispense_cursor(dispense_record_id, index, committed_totals["processed"], committed_totals["failed"], fingerprint)
+
+    try:
+        if idempotency_key:
+            # คำขอที่ส่งซ้ำ: สถานะที่ commit แล้วแทนที่ resume_cursor
+            upload_state = get_upload_request(hcode, idempotency_key, cursor)
+            if upload_state:
+                if upload_state['fingerprint'] != fingerprint:
+                    return jsonify({"error": "idempotency_key นี้ถูกใช้กับข้อมูลชุดอื่นแล้ว"}), 409
+                processed_before, failed_before = upload_state['processed_total'], upload_state['failed_total']
+                # failed_total ที่บันทึกไว้นับรายการที่ผิดตั้งแต่ขั้นอ่านไฟล์แล้ว (บันทึกพร้อม chunk แรก)
+                failed_items_details = []
+                if upload_state['completed']:
+                    return _bulk_dispense_replay_response(hcode, upload_state, watermark_range, cursor)
+                dispense_record_id, start_index = upload_state['dispense_record_id'], upload_state['next_index']
+                next_index = start_index
+        # ยอดสะสมเฉพาะ chunk ที่ commit แล้ว (chunk ที่ rollback จะถูกส่งมาทำใหม่และนับใหม่)
+        committed_totals.update(processed=processed_before, failed=failed_before)
+
+        if dispense_record_id:
+            # เอกสารต้องเป็นเอกสาร bulk ของหน่วยบริการ ผู้จ่าย และประเภทเดียวกัน ที่ยังไม่ถูกยกเลิก
+            record = db_execute_query(
+                "SELECT id, dispense_record_number FROM dispense_records WHERE id = %s AND hcode = %s AND dispenser_id = %s AND dispense_type = %s AND status = 'ปกติ' AND dispense_record_number LIKE 'DSPEXC-%%'",
+                (dispense_record_id, hcode, dispenser_id, dispense_type_header), fetchone=True, cursor_to_use=cursor
+            )
+            if not record:
+                return jsonify({"error": f"ไม่พบเอกสารตัดจ่ายแบบ bulk ID {dispense_record_id} ของหน่วยบริการ/ผู้จ่าย/ประเภทนี้สำหรับบันทึกต่อ"}), 404
+            dispense_record_number = record['dispense_record_number']
+
+        existing_by_guid = _prefetch_existing_hos_guid_items(hcode, [item.get('hos_guid') for item in items_to_process[start_index:]], cursor)
+        conn.rollback()  # ปิด read snapshot ก่อนเริ่ม chunk แรก
+        seen_hos_guids = set()
+
+        while next_index < len(items_to_process):
+            chunk = items_to_process[next_index:next_index + chunk_size]
+            conn.start_transaction()
+            if idempotency_key and not claim_upload_request(hcode, idempotency_key, fingerprint, next_index, cursor):
+                # คำขออื่นที่ใช้รหัสเดียวกัน (เช่น คำขอที่ client ส่งซ้ำหลัง timeout) บันทึกต่อไปแล้ว
+                conn.rollback()
+                return jsonify({"error": "ข้อมูลชุดนี้กำลังถูกบันทึกโดยคำขออื่น กรุณาส่งซ้ำภายหลัง", "in_progress": True, "chunks_committed": chunks_committed}), 409
+            stock_movements = set()
+            chunk_failures, chunk_succeeded_guids = [], []
+
+            if dispense_record_id is None:
+                # สร้างหัวเอกสารใน transaction ของ chunk แรก หาก chunk แรกล้มเหลวจะไม่เหลือเอกสารว่าง
+                overall_dispense_date_iso_str = datetime.now().strftime('%Y-%m-%d')
+                first_date = items_to_process[0].get('dispense_date_iso') if items_to_process else None
+                try:
+                    datetime.strptime(first_date, '%Y-%m-%d')
+                    overall_dispense_date_iso_str = first_date
+                except (ValueError, TypeError):
+                    pass
+                dispense_record_number = next_document_number('DSPEXC', cursor, hcode)
+                cursor.execute(
+                    "INSERT INTO dispense_records (hcode, dispense_record_number, dispense_date, dispenser_id, remarks, dispense_type, status) VALUES (%s, %s, %s, %s, %s, %s, 'ปกติ')",
+                    (hcode, dispense_record_number, overall_dispense_date_iso_str, dispenser_id, remarks_header, dispense_type_header)
+                )
+                new_record_id = cursor.lastrowid
+            else:
+                new_record_id = None
+            record_id_for_chunk = dispense_record_id or new_record_id
+
+            # ตรวจสอบข้อมูลและยกเลิกรายการเดิมของ hos_guid ที่จำนวนเปลี่ยน (คืนสต็อกก่อนล็อก Lot)
+            chunk_entries = []
+            for item_data in chunk:
+                hos_guid = item_data.get('hos_guid')
+                quantity_requested, item_dispense_date_iso, error = _validate_excel_dispense_item(item_data, datetime.now().strftime('%Y-%m-%d'))
+                if error:
+                    failed_items_details.append({"hos_guid": hos_guid, "medicine_code": item_data.get("medicine_code", "N/A"), "error": error})
+                    chunk_failures.append(_sync_failure_entry(item_data, error))
+                    continue
+                if hos_guid:
+                    if hos_guid in seen_hos_guids:
+                        failed_items_details.append({"hos_guid": hos_guid, "medicine_code": item_data.get("medicine_code", "N/A"), "error": "hos_guid ซ้ำกันภายในข้อมูลที่ส่งมา"})
+                        continue
+                    seen_hos_guids.add(hos_guid)
+                    existing_items_with_guid = existing_by_guid.get(hos_guid)
+                    if existing_items_with_guid:
+                        if sum(ex_item['quantity_dispensed'] for ex_item in existing_items_with_guid) == quantity_requested:
+                            skipped_hos_guids_same_qty.append(hos_guid)
+                            chunk_succeeded_guids.append(hos_guid)
+                            continue
+                        for ex_item_to_cancel in existing_items_with_guid:
+                            if not _cancel_dispense_item_internal(ex_item_to_cancel['dispense_item_id'], dispenser_id, cursor, stock_movements, for_excel_update=True):
+                                raise Error(msg=f"ไม่สามารถยกเลิกรายการเก่าเพื่ออัปเดตได้ (hos_guid {hos_guid})")
+                        updated_hos_guids.append(hos_guid)
+                chunk_entries.append((item_data, quantity_requested, item_dispense_date_iso))
+
+            # ล็อก Lot ของยาทุกตัวใน chunk ครั้งเดียว แล้วจัดสรร FEFO ตามลำดับวันที่
+            stock_by_medicine = _lock_fefo_stock(hcode, [item_data['medicine_id'] for item_data, _, _ in chunk_entries], cursor)
+            plan = _new_fefo_write_plan()
+            for item_data, quantity_requested, item_dispense_date_iso in chunk_entries:
+                stock = stock_by_medicine[int(item_data['medicine_id'])]
+                allocations = _allocate_fefo(stock, quantity_requested)
+                if allocations is None:
+                    error = "สต็อกไม่เพียงพอตาม FEFO หรือเกิดข้อผิดพลาดในการจ่ายยา"
+                    failed_items_details.append({"hos_guid": item_data.get('hos_guid'), "medicine_code": item_data.get("medicine_code", "N/A"), "error": error})
+                    chunk_failures.append(_sync_failure_entry(item_data, error))
+                    continue
+                _add_fefo_allocation_to_plan(
+                    plan, stock, allocations, hcode, item_data['medicine_id'],
+                    record_id_for_chunk, dispenser_id, dispense_record_number,
+                    item_data.get('hos_guid'), dispense_type_header, item_dispense_date_iso
+                )
+                chunk_succeeded_guids.append(item_data.get('hos_guid'))
+                processed_count += 1
+            _write_fefo_plan(plan, cursor, stock_movements)
+
+            # รายการที่ผิดพลาดถูกบันทึกไว้ส่งใหม่ก่อนจุดซิงค์เลื่อนผ่าน (รายการหลัง to จะถูกอ่านจาก HOSxP อีกในรอบถัดไปอยู่แล้ว)
+            if sync_failure_retry:
+                record_sync_failures(hcode, [failure for failure in chunk_failures if failure['hos_guid']], cursor)
+                clear_sync_failures(hcode, chunk_succeeded_guids, cursor)
+            elif watermark_range:
+                record_sync_failures(hcode, [failure for failure in chunk_failures
+                                             if failure['hos_guid'] and (failure['dispense_date'] or '', failure['hos_guid']) <= watermark_range[1]], cursor)
+            if watermark_range and next_index + len(chunk) >= len(items_to_process):
+                sync_watermark, sync_watermark_advanced = advance_sync_watermark(hcode, watermark_range[0], watermark_range[1], cursor)
+
+            if idempotency_key:
+                chunk_end = next_index + len(chunk)
+                save_upload_request(hcode, idempotency_key, record_id_for_chunk, chunk_end, processed_before + processed_count,
+                                    failed_before + len(failed_items_details), chunk_end >= len(items_to_process), cursor)
+            record_stock_changes(stock_movements, cursor)
+            conn.commit()
+            dispense_record_id = record_id_for_chunk
+            committed_totals.update(processed=processed_before + processed_count, failed=failed_before + len(failed_items_details))
+            invalidate_clinic_stock_caches(hcode)
+            chunks_committed += 1
+            next_index += len(chunk)
+            if (datetime.now() - started_at).total_seconds() >= time_budget_seconds:
+                break
+
+        completed = next_index >= len(items_to_process)
+        if completed and dispense_record_id:
+            remaining_items = db_execute_query("SELECT COUNT(*) as count FROM dispense_items WHERE dispense_record_id = %s", (dispense_record_id,), fetchone=True, cursor_to_use=cursor)
+            if remaining_items and remaining_items['count'] == 0:
+                db_execute_query("DELETE FROM dispense_records WHERE id = %s", (dispense_record_id,), commit=False, cursor_to_use=cursor)
+                conn.commit()
+                logger.info(f"Deleted empty dispense record {dispense_record_id} as no items were processed.")
+                dispense_record_id = None
+                dispense_record_number = None
+
+        # ผลรวมของทุกรอบ (รอบก่อน ๆ มาจาก resume_cursor) ใช้ตัดสินสถานะตอนจบ
+        total_processed = processed_before + processed_count
+        total_failed = failed_before + len(failed_items_details)
+        message = f"บันทึกการตัดจ่ายยาจาก Excel สำเร็จ {processed_count} รายการ."
+        if processed_before: message += f" รวมทุกรอบ {total_processed} รายการ."
+        if updated_hos_guids: message += f" อัปเดต (แทนที่รายการเก่า) {len(updated_hos_guids)} รายการ (hos_guid)."
+        if skipped_hos_guids_same_qty: message += f" ข้าม {len(skipped_hos_guids_same_qty)} รายการซ้ำ (hos_guid) ที่มีจำนวนเท่าเดิม."
+        if total_failed: message += f" พบข้อผิดพลาด {total_failed} รายการที่ไม่ถูกบันทึก."
+        if not completed: message += f" ประมวลผลแล้ว {next_index}/{len(items_to_process)} รายการ กรุณาส่งต่อด้วย next_cursor."
+
+        status_code = _bulk_dispense_status_code(completed, total_processed, total_failed)
+
+        response = {
+            "message": message,
+            "dispense_record_id": dispense_record_id,
+            "dispense_record_number": dispense_record_number,
+            "processed_count": processed_count,
+            "total_processed_count": total_processed,
+            "updated_hos_guids": updated_hos_guids,
+            "skipped_hos_guids_same_qty": skipped_hos_guids_same_qty,
+            "failed_details": failed_items_details,
+            "total_failed_count": total_failed,
+            "completed": completed,
+            "chunks_committed": chunks_committed,
+            "next_cursor": None if completed else next_cursor_for(next_index),
+        }
+        if watermark_range and completed:
+            if not sync_watermark_advanced:
+                sync_watermark = get_sync_watermark(hcode, cursor)
+            response["sync_watermark"] = format_sync_watermark(sync_watermark)
+            response["sync_watermark_advanced"] = sync_watermark_advanced
+        return jsonify(response), status_code
+
+    except Error as e_db:
+        if conn: conn.rollback()
+        logger.error(f"Database error during bulk Excel dispense processing: {str(e_db)}", exc_info=True)
+        response = {"error": f"Database error: {str(e_db)}", "details": failed_items_details, "chunks_committed": chunks_committed}
+        if dispense_record_id and chunks_committed:
+            response["next_cursor"] = next_cursor_for(next_index)
+        return jsonify(response), 500
+    finally:
+        if cursor: cursor.close()
+        if conn: conn.close()
+
+# --- Excel Dispense Preview ---
+
+EXCEL_DISPENSE_REQUIRED_COLUMNS = ['วันที่', 'รหัสยา', 'จำนวน']
+
+def _validate_dispense_sheet(excel_data):
+    """
+    ตรวจสอบและแปลงข้อมูลในชีตตัดจ่ายแบบ vectorized (ไม่วนทีละแถว)
+    index ของ excel_data คือเลขแถวในไฟล์ (จาก iter_spreadsheet_batches)
+    คืนค่า DataFrame ที่มีคอลัมน์ row_num, dispense_date_iso, dispense_date_str, medicine_code,
+    quantity_requested_str, quantity_requested, hos_guid และ errors (list ของข้อความผิดพลาดของแต่ละแถว)
+    """
+    rows = pd.DataFrame(index=excel_data.index)
+    rows['row_num'] = excel_data.index
+
+    dispense_date_iso, dispense_date_thai = parse_date_series(excel_data['วันที่'])
+    raw_dates = excel_data['วันที่'].astype('string').str.strip().fillna('')
+    rows['dispense_date_iso'] = dispense_date_iso
+    rows['dispense_date_str'] = dispense_date_thai.where(dispense_date_thai.notna(), raw_dates)
+
+    rows['medicine_code'] = normalize_code_series(excel_data['รหัสยา'])
+
+    quantity = pd.to_numeric(excel_data['จำนวน'], errors='coerce')
+    is_whole_number = quantity.notna() & (quantity == quantity.round())
+    rows['quantity_requested_str'] = normalize_code_series(excel_data['จำนวน'])
+    rows['quantity_requested'] = quantity.where(is_whole_number).astype('Int64')
+
+    if 'hos_guid' in excel_data.columns:
+        hos_guid = excel_data['hos_guid'].astype('string').str.strip()
+        rows['hos_guid'] = hos_guid.astype(object).where(hos_guid.notna() & (hos_guid != ''), None)
+    else:
+        rows['hos_guid'] = None
+
+    date_error = rows['dispense_date_iso'].isna()
+    quantity_not_number = ~is_whole_number
+    quantity_not_positive = is_whole_number & (quantity <= 0)
+    rows['errors'] = [
+        [message for flag, message in (
+            (bad_date, "รูปแบบวันที่จ่ายไม่ถูกต้อง (ต้องเป็น dd/mm/yyyy พ.ศ. หรือ YYYY-MM-DD ค.ศ.)"),
+            (bad_number, "จำนวนต้องเป็นตัวเลข"),
+            (not_positive, "จำนวนต้องมากกว่า 0"),
+        ) if flag]
+        for bad_date, bad_number, not_positive in zip(date_error, quantity_not_number, quantity_not_positive)
+    ]
+    return rows
+
+def _fetch_fefo_stock_for_preview(hcode, medicine_ids, cursor):
+    """ดึง Lot คงเหลือของยาหลายตัวเรียงตาม FEFO ด้วย query เดียว (ไม่ล็อก) สำหรับจำลองการตัดจ่าย"""
+    stock_by_medicine = {}
+    medicine_ids = list(dict.fromkeys(medicine_ids))
+    if not medicine_ids:
+        return stock_by_medicine
+    lots = db_execute_query(
+        f"SELECT medicine_id, lot_number, expiry_date, quantity_on_hand FROM inventory WHERE hcode = %s AND medicine_id IN ({build_in_placeholders(medicine_ids)}) AND quantity_on_hand > 0 ORDER BY medicine_id, expiry_date ASC, id ASC",
+        (hcode, *medicine_ids), fetchall=True, cursor_to_use=cursor
+    ) or []
+    for lot in lots:
+        stock = stock_by_medicine.setdefault(lot['medicine_id'], {'lots': [], 'total_stock': 0})
+        stock['lots'].append(lot)
+        stock['total_stock'] += lot['quantity_on_hand']
+    return stock_by_medicine
+
+def _fetch_existing_hos_guid_quantities(hcode, hos_guids, cursor):
+    """ยอดจ่ายรวมของ hos_guid ที่เคยบันทึกแล้ว (query แบบ GROUP BY ครั้งเดียว) คืนค่า dict: hos_guid -> จำนวน"""
+    hos_guids = list(dict.fromkeys(guid for guid in hos_guids if guid))
+    if not hos_guids:
+        return {}
+    existing_items = db_execute_query(
+        f"""
+        SELECT di.hos_guid, SUM(di.quantity_dispensed) as quantity_dispensed
+        FROM dispense_items di
+        JOIN dispense_records dr ON di.dispense_record_id = dr.id
+        WHERE dr.hcode = %s AND di.hos_guid IN ({build_in_placeholders(hos_guids)})
+          AND dr.status != 'ยกเลิก' AND di.item_status = 'ปกติ'
+        GROUP BY di.hos_guid
+        """,
+        (hcode, *hos_guids), fetchall=True, cursor_to_use=cursor
+    ) or []
+    return {row['hos_guid']: int(row['quantity_dispensed']) for row in existing_items}
+
+def _build_dispense_preview_items(sheet_batches, hcode, cursor):
+    """
+    สร้างรายการ preview จากไฟล์ที่อ่านทีละชุด (ไม่ต้องโหลดทั้งไฟล์เป็น DataFrame เดียว)
+    ต่อชุด: ตรวจสอบแบบ vectorized แล้วดึงยา (เฉพาะรหัสที่ยังไม่เคยดึง) และยอด hos_guid เดิมแบบ IN (...)
+    สุดท้ายดึง Lot ของยาทั้งหมดครั้งเดียว แล้วจำลองการตัดจ่าย FEFO ต่อเนื่องตามลำดับที่
+    process_excel_dispense จะประมวลผลจริง (วันที่, ลำดับแถว) ทำให้หลายแถวของยาเดียวกันไม่เห็นสต็อกเต็มจำนวนซ้ำกัน
+    """
+    medicines_by_code = {}
+    existing_qty_by_guid = {}
+    preview_items = []
+    for sheet_batch in sheet_batches:
+        rows = _validate_dispense_sheet(sheet_batch)
+        new_codes = [code for code in rows['medicine_code'].unique() if code not in medicines_by_code]
+        medicines_by_code.update(fetch_active_medicines_by_code(hcode, new_codes, cursor))
+        existing_qty_by_guid.update(_fetch_existing_hos_guid_quantities(hcode, rows['hos_guid'].tolist(), cursor))
+
+        for row in rows.to_dict('records'):
+            quantity_requested = row['quantity_requested']
+            item_preview = {
+                "row_num": int(row['row_num']),
+                "dispense_date_str": row['dispense_date_str'],
+                "dispense_date_iso": row['dispense_date_iso'],
+                "medicine_code": row['medicine_code'],
+                "quantity_requested_str": row['quantity_requested_str'],
+                "hos_guid": row['hos_guid'],
+                "medicine_name": "N/A",
+                "unit": "N/A",
+                "available_lots_info_for_preview": [],
+                "status": "รอตรวจสอบ",
+                "errors": row['errors'],
+            }
+            if not pd.isna(quantity_requested):
+                item_preview["quantity_requested"] = int(quantity_requested)
+            if not item_preview["errors"]:
+                medicine_info = medicines_by_code.get(item_preview["medicine_code"])
+                if medicine_info:
+                    item_preview["medicine_id"] = medicine_info['id']
+                    item_preview["medicine_name"] = f"{medicine_info['generic_name']} ({medicine_info['strength'] or 'N/A'})"
+                    item_preview["unit"] = medicine_info['unit']
+                else:
+                    item_preview["errors"].append(f"ไม่พบรหัสยา '{item_preview['medicine_code']}' หรือยาไม่ถูกเปิดใช้งาน สำหรับหน่วยบริการ {hcode}")
+            preview_items.append(item_preview)
+
+    simulation_order = sorted(
+        (item for item in preview_items if not item["errors"]),
+        key=lambda item: (item["dispense_date_iso"], item["row_num"])
+    )
+    stock_by_medicine = _fetch_fefo_stock_for_preview(hcode, [item["medicine_id"] for item in simulation_order], cursor)
+    for item_preview in simulation_order:
+        if item_preview["hos_guid"] in existing_qty_by_guid:
+            item_preview["existing_quantity"] = existing_qty_by_guid[item_preview["hos_guid"]]
+            if item_preview["quantity_requested"] == item_preview["existing_quantity"]:
+                item_preview["status"] = "รายการซ้ำ (hos_guid) และจำนวนเท่าเดิม (จะถูกข้าม)"
+                continue
+
+        stock = stock_by_medicine.setdefault(item_preview["medicine_id"], {'lots': [], 'total_stock': 0})
+        allocations = _allocate_fefo(stock, item_preview["quantity_requested"])
+        if allocations is None:
+            remaining_stock = sum(lot['quantity_on_hand'] for lot in stock['lots'])
+            item_preview["errors"].append(f"สต็อกไม่เพียงพอ (มี {remaining_stock}, ต้องการ {item_preview['quantity_requested']})")
+            item_preview["available_lots_info_for_preview"].append(f"สต็อกรวม: {remaining_stock}")
+            continue
+
+        for lot, qty_from_this_lot in allocations:
+            item_preview["available_lots_info_for_preview"].append(
+                f"Lot: {lot['lot_number']} (Exp: {iso_to_thai_date(lot['expiry_date'])}, Qty Avail: {lot['quantity_on_hand'] + qty_from_this_lot}) - จะใช้: {qty_from_this_lot}"
+            )
+        if "existing_quantity" in item_preview:
+            item_preview["status"] = "รายการซ้ำ (hos_guid) และจำนวนแตกต่าง (จะถูกอัปเดตตาม FEFO)"
+        else:
+            item_preview["status"] = "พร้อมจ่าย (FEFO)"
+
+    for item_preview in preview_items:
+        if item_preview["errors"]:
+            item_preview["status"] = "มีข้อผิดพลาด"
+    return preview_items
+
+def _summarize_dispense_preview(preview_items):
+    """สรุปจำนวนรายการตามสถานะของ preview (ready_rows = แถวที่จะถูกตัดจ่าย, skipped_rows = hos_guid ซ้ำจำนวนเท่าเดิม)"""
+    summary = {"total_rows": len(preview_items), "ready_rows": 0, "skipped_rows": 0, "error_rows": 0, "by_status": {}}
+    for item_preview in preview_items:
+        summary["by_status"][item_preview["status"]] = summary["by_status"].get(item_preview["status"], 0) + 1
+        if item_preview["errors"]:
+            summary["error_rows"] += 1
+        elif "จำนวนเท่าเดิม" in item_preview["status"]:
+            summary["skipped_rows"] += 1
+        else:
+            summary["ready_rows"] += 1
+    return summary
+
+def _collect_dispense_items_from_sheet(sheet_batches, hcode, cursor):
+    """
+    แปลงไฟล์ที่อ่านทีละชุดเป็นรายการสำหรับ _process_excel_dispense_bulk (เก็บเฉพาะฟิลด์ที่จำเป็นต่อแถว)
+    คืนค่า (items_to_process เรียงตาม (วันที่, ลำดับแถว), failed_items_details ของแถวที่ไม่ผ่านการตรวจสอบ)
+    """
+    medicines_by_code = {}
+    items_to_process = []
+    failed_items_details = []
+    for sheet_batch in sheet_batches:
+        rows = _validate_dispense_sheet(sheet_batch)
+        new_codes = [code for code in rows['medicine_code'].unique() if code not in medicines_by_code]
+        medicines_by_code.update(fetch_active_medicines_by_code(hcode, new_codes, cursor))
+        for row in rows.to_dict('records'):
+            medicine_info = medicines_by_code.get(row['medicine_code'])
+            if not row['errors'] and not medicine_info:
+                row['errors'].append(f"ไม่พบรหัสยา '{row['medicine_code']}' หรือยาไม่ถูกเปิดใช้งาน สำหรับหน่วยบริการ {hcode}")
+            if row['errors']:
+                failed_items_details.append({"row_num": int(row['row_num']), "hos_guid": row['hos_guid'], "medicine_code": row['medicine_code'], "error": ", ".join(row['errors'])})
+                continue
+            items_to_process.append({
+                "row_num": int(row['row_num']),
+                "medicine_id": medicine_info['id'],
+                "medicine_code": row['medicine_code'],
+                "quantity_dispensed": int(row['quantity_requested']),
+                "dispense_date_iso": row['dispense_date_iso'],
+                "hos_guid": row['hos_guid'],
+            })
+    items_to_process.sort(key=lambda item: (item['dispense_date_iso'], item['row_num']))
+    return items_to_process, failed_items_details
+
 # --- API Endpoints ---
 
 @dispense_bp.route('/dispense/manual', methods=['POST'])
@@ -192,34 +866,36 @@ def manual_dispense():
             conn.rollback()
             return jsonify({"error": "รูปแบบวันที่จ่ายยาไม่ถูกต้อง"}), 400
 
-        current_date_str = datetime.now().strftime('%y%m%d')
-        cursor.execute("SELECT dispense_record_number FROM dispense_records WHERE hcode = %s AND dispense_record_number LIKE %s ORDER BY id DESC LIMIT 1", (data['hcode'], f"DSP-{data['hcode']}-{current_date_str}-%"))
-        last_rec = cursor.fetchone()
-        next_seq = 1
-        if last_rec:
-            try: next_seq = int(last_rec['dispense_record_number'].split('-')[-1]) + 1
-            except (IndexError, ValueError): pass
-        dispense_record_number = f"DSP-{data['hcode']}-{current_date_str}-{next_seq:03d}"
+        dispense_record_number = next_document_number('DSP', cursor, data['hcode'])
 
         sql_disp_rec = "INSERT INTO dispense_records (hcode, dispense_record_number, dispense_date, dispenser_id, remarks, dispense_type, status) VALUES (%s, %s, %s, %s, %s, %s, 'ปกติ')"
         cursor.execute(sql_disp_rec, (data['hcode'], dispense_record_number, dispense_date_iso, data['dispenser_id'], data.get('remarks', ''), data.get('dispense_type', 'ผู้ป่วยนอก')))
         dispense_record_id = cursor.lastrowid
 
+        # ล็อก Lot ของยาทุกรายการในใบจ่ายครั้งเดียว แล้วจัดสรร FEFO ต่อเนื่องกันในหน่วยความจำ
+        stock_by_medicine = _lock_fefo_stock(data['hcode'], [item['medicine_id'] for item in data['items']], cursor)
+        plan = _new_fefo_write_plan()
         for item in data['items']:
-            success = _dispense_medicine_fefo(
-                hcode=data['hcode'], medicine_id=item['medicine_id'], quantity_to_dispense=int(item['quantity_dispensed']),
-                dispense_record_id=dispense_record_id, dispenser_id=data['dispenser_id'],
-                dispense_record_number=dispense_record_number, hos_guid=item.get('hos_guid'),
-                dispense_type_from_record=data.get('dispense_type', 'ผู้ป่วยนอก'), item_dispense_date_iso=dispense_date_iso,
-                cursor=cursor
-            )
-            if not success:
+            stock = stock_by_medicine[int(item['medicine_id'])]
+            allocations = _allocate_fefo(stock, int(item['quantity_dispensed']))
+            if allocations is None:
                 conn.rollback()
                 med_info = db_execute_query("SELECT generic_name FROM medicines WHERE id = %s", (item['medicine_id'],), fetchone=True, cursor_to_use=cursor)
                 med_name = med_info['generic_name'] if med_info else f"ID {item['medicine_id']}"
                 return jsonify({"error": f"ยา {med_name} มีไม่เพียงพอในคลังตามหลัก FEFO"}), 400
+            _add_fefo_allocation_to_plan(
+                plan, stock, allocations,
+                hcode=data['hcode'], medicine_id=item['medicine_id'],
+                dispense_record_id=dispense_record_id, dispenser_id=data['dispenser_id'],
+                dispense_record_number=dispense_record_number, hos_guid=item.get('hos_guid'),
+                dispense_type_from_record=data.get('dispense_type', 'ผู้ป่วยนอก'), item_dispense_date_iso=dispense_date_iso
+            )
+        stock_movements = set()
+        _write_fefo_plan(plan, cursor, stock_movements)
+        record_stock_changes(stock_movements, cursor)
 
         conn.commit()
+        invalidate_clinic_stock_caches(data['hcode'])
         return jsonify({"message": "บันทึกการตัดจ่ายยาสำเร็จ", "dispense_record_id": dispense_record_id, "dispense_record_number": dispense_record_number}), 201
 
     except Error as e:
@@ -231,39 +907,60 @@ def manual_dispense():
         if conn: conn.close()
 
 
-@dispense_bp.route('/dispense_records', methods=['GET'])
-def get_dispense_records():
-    """ดึงประวัติการตัดจ่ายยา"""
-    user_hcode = request.args.get('hcode')
-    start_date_thai = request.args.get('startDate')
-    end_date_thai = request.args.get('endDate')
-    
-    query = """
-        SELECT dr.id, dr.dispense_record_number, dr.dispense_date, u.full_name as dispenser_name,
-               dr.dispense_type, dr.remarks, dr.hcode, dr.status, dr.created_at,
-               (SELECT COUNT(*) FROM dispense_items di WHERE di.dispense_record_id = dr.id AND di.item_status = 'ปกติ') as item_count
-        FROM dispense_records dr JOIN users u ON dr.dispenser_id = u.id
-    """
+DISPENSE_RECORDS_SELECT = """
+    SELECT dr.id, dr.dispense_record_number, dr.dispense_date, u.full_name as dispenser_name,
+           dr.dispense_type, dr.remarks, dr.hcode, dr.status, dr.created_at,
+           (SELECT COUNT(*) FROM dispense_items di WHERE di.dispense_record_id = dr.id AND di.item_status = 'ปกติ') as item_count
+    FROM dispense_records dr JOIN users u ON dr.dispenser_id = u.id
+"""
+DISPENSE_RECORDS_ORDER_COLUMNS = [("dr.dispense_date", "dispense_date"), ("dr.id", "id")]
+
+
+def _dispense_records_filters(hcode, start_iso, end_iso):
+    """เงื่อนไขของรายการเอกสารตัดจ่าย (ค่าที่เป็น None ไม่ใช้กรอง)"""
     conditions, params = [], []
-    if user_hcode:
+    if hcode:
         conditions.append("dr.hcode = %s")
-        params.append(user_hcode)
-    if start_date_thai and (start_iso := thai_to_iso_date(start_date_thai)):
+        params.append(hcode)
+    if start_iso:
         conditions.append("dr.dispense_date >= %s")
         params.append(start_iso)
-    if end_date_thai and (end_iso := thai_to_iso_date(end_date_thai)):
+    if end_iso:
         conditions.append("dr.dispense_date <= %s")
         params.append(end_iso)
+    return conditions, params
 
-    if conditions: query += " WHERE " + " AND ".join(conditions)
-    query += " ORDER BY dr.dispense_date DESC, dr.id DESC"
-    
-    records = db_execute_query(query, tuple(params) if params else None, fetchall=True)
+
+register_hot_query("dispense records list", *build_keyset_query(
+    DISPENSE_RECORDS_SELECT, *_dispense_records_filters('00000', '2024-01-01', '2024-01-31'),
+    DISPENSE_RECORDS_ORDER_COLUMNS, first_page()
+))
+
+
+@dispense_bp.route('/dispense_records', methods=['GET'])
+def get_dispense_records():
+    """ดึงประวัติการตัดจ่ายยา"""
+    start_date_thai = request.args.get('startDate')
+    end_date_thai = request.args.get('endDate')
+    conditions, params = _dispense_records_filters(
+        request.args.get('hcode'),
+        thai_to_iso_date(start_date_thai) if start_date_thai else None,
+        thai_to_iso_date(end_date_thai) if end_date_thai else None
+    )
+
+    try:
+        page = parse_page_args(request.args)
+        records, next_cursor_values, total = fetch_keyset_page(
+            DISPENSE_RECORDS_SELECT, conditions, params, DISPENSE_RECORDS_ORDER_COLUMNS, page,
+            count_sql="SELECT COUNT(*) AS total FROM dispense_records dr"
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     if records is None: return jsonify({"error": "ไม่สามารถดึงข้อมูลได้"}), 500
     for record in records:
         record['dispense_date'] = iso_to_thai_date(record['dispense_date'])
         record['created_at'] = iso_to_thai_date(record['created_at'])
-    return jsonify(records)
+    return page_response(records, encode_page_cursor(next_cursor_values) if next_cursor_values else None, total, page)
 
 
 @dispense_bp.route('/dispense_records/<int:record_id>', methods=['GET'])
@@ -333,7 +1030,7 @@ def delete_dispense_record(record_id):
 
     try:
         conn.start_transaction()
-        dispensed_items = db_execute_query("SELECT di.*, dr.hcode FROM dispense_items di JOIN dispense_records dr ON di.dispense_record_id = dr.id WHERE di.dispense_record_id = %s", (record_id,), fetchall=True, cursor_to_use=cursor)
+        dispensed_items = db_execute_query("SELECT di.*, dr.hcode, COALESCE(di.dispense_date, dr.dispense_date) AS movement_date FROM dispense_items di JOIN dispense_records dr ON di.dispense_record_id = dr.id WHERE di.dispense_record_id = %s", (record_id,), fetchall=True, cursor_to_use=cursor)
 
         for item in dispensed_items:
             if item['item_status'] == 'ปกติ' or item['item_status'] == 'ถูกแทนที่โดย Excel':
@@ -349,9 +1046,13 @@ def delete_dispense_record(record_id):
                 db_execute_query("DELETE FROM inventory_transactions WHERE reference_document_id = (SELECT dispense_record_number FROM dispense_records WHERE id = %s) AND medicine_id = %s AND lot_number = %s AND quantity_change = %s",
                                  (record_id, item['medicine_id'], item['lot_number'], -item['quantity_dispensed']), commit=False, cursor_to_use=cursor)
 
+        refresh_stock_balance_for_movements({(item['hcode'], item['medicine_id']) for item in dispensed_items}, cursor)
+        invalidate_balance_snapshots_for_movements([(item['hcode'], item['medicine_id'], item['movement_date']) for item in dispensed_items], cursor)
         db_execute_query("DELETE FROM dispense_items WHERE dispense_record_id = %s", (record_id,), commit=False, cursor_to_use=cursor)
         db_execute_query("DELETE FROM dispense_records WHERE id = %s", (record_id,), commit=False, cursor_to_use=cursor)
+        record_stock_changes({(item['hcode'], item['medicine_id']) for item in dispensed_items}, cursor)
         conn.commit()
+        invalidate_clinic_stock_caches([item['hcode'] for item in dispensed_items])
         return jsonify({"message": f"ลบเอกสารตัดจ่าย ID {record_id} และคืนสต็อกเรียบร้อยแล้ว"})
     except Error as e:
         if conn: conn.rollback()
@@ -373,127 +1074,87 @@ def dispense_upload_excel_preview():
     hcode = request.form.get('hcode')
     if not hcode:
         return jsonify({"error": "กรุณาระบุ hcode"}), 400
-
-    preview_items = []
     try:
-        excel_data = pd.read_excel(BytesIO(file.read()), engine='openpyxl')
-        
-        required_columns = ['วันที่', 'รหัสยา', 'จำนวน'] 
-        has_hos_guid_column = 'hos_guid' in excel_data.columns 
-
-        for col in required_columns:
-            if col not in excel_data.columns:
-                return jsonify({"error": f"ไฟล์ Excel ต้องมีคอลัมน์: {', '.join(required_columns)}"}), 400
-
-        if excel_data.empty:
-            return jsonify({"error": "ไฟล์ Excel ไม่มีข้อมูล"}), 400
-
-        conn = get_db_connection()
-        if not conn: return jsonify({"error": "ไม่สามารถเชื่อมต่อฐานข้อมูลได้"}), 500
-        cursor = conn.cursor(dictionary=True)
-
-        for index, row in excel_data.iterrows():
-            row_num = index + 2
-            
-            dispense_date_from_excel = row['วันที่']
-            dispense_date_str_for_preview = ""
-            dispense_date_iso_for_logic = None
-
-            if isinstance(dispense_date_from_excel, datetime):
-                dispense_date_str_for_preview = f"{dispense_date_from_excel.day:02d}/{dispense_date_from_excel.month:02d}/{dispense_date_from_excel.year + 543}"
-                dispense_date_iso_for_logic = dispense_date_from_excel.strftime('%Y-%m-%d')
-            else:
-                dispense_date_str_for_preview = str(dispense_date_from_excel).strip()
-                dispense_date_iso_for_logic = thai_to_iso_date(dispense_date_str_for_preview)
-            
-            item_preview = {
-                "row_num": row_num,
-                "dispense_date_str": dispense_date_str_for_preview, 
-                "dispense_date_iso": dispense_date_iso_for_logic,    
-                "medicine_code": str(row['รหัสยา']).strip(),
-                "quantity_requested_str": str(row['จำนวน']).strip(),
-                "hos_guid": str(row['hos_guid']).strip() if has_hos_guid_column and pd.notna(row['hos_guid']) else None,
-                "medicine_name": "N/A",
-                "unit": "N/A",
-                "available_lots_info_for_preview": [], 
-                "status": "รอตรวจสอบ", 
-                "errors": []
-            }
-            
-            if not item_preview["dispense_date_iso"]:
-                item_preview["errors"].append("รูปแบบวันที่จ่ายไม่ถูกต้อง (ต้องเป็น dd/mm/yyyy พ.ศ. หรือ燜-MM-DD ค.ศ.)")
-
-            try:
-                item_preview["quantity_requested"] = int(item_preview["quantity_requested_str"])
-                if item_preview["quantity_requested"] <= 0:
-                    item_preview["errors"].append("จำนวนต้องมากกว่า 0")
-            except ValueError:
-                item_preview["errors"].append("จำนวนต้องเป็นตัวเลข")
-
-            if not item_preview["errors"]: 
-                medicine_info = db_execute_query(
-                    "SELECT id, generic_name, strength, unit FROM medicines WHERE medicine_code = %s AND hcode = %s AND is_active = TRUE",
-                    (item_preview["medicine_code"], hcode), fetchone=True, cursor_to_use=cursor
-                )
-                if medicine_info:
-                    item_preview["medicine_id"] = medicine_info['id']
-                    item_preview["medicine_name"] = f"{medicine_info['generic_name']} ({medicine_info['strength'] or 'N/A'})"
-                    item_preview["unit"] = medicine_info['unit']
-
-                    lots_query = "SELECT lot_number, expiry_date, quantity_on_hand FROM inventory WHERE medicine_id = %s AND hcode = %s AND quantity_on_hand > 0 ORDER BY expiry_date ASC, id ASC;"
-                    available_lots_db = db_execute_query(lots_query, (medicine_info['id'], hcode), fetchall=True, cursor_to_use=cursor)
-                    
-                    total_available_stock = sum(lot['quantity_on_hand'] for lot in available_lots_db)
-                    
-                    if total_available_stock >= item_preview["quantity_requested"]:
-                        item_preview["status"] = "พร้อมจ่าย (FEFO)"
-                        temp_qty_needed = item_preview["quantity_requested"]
-                        for lot_db in available_lots_db:
-                            if temp_qty_needed <= 0: break
-                            qty_from_this_lot = min(temp_qty_needed, lot_db["quantity_on_hand"])
-                            item_preview["available_lots_info_for_preview"].append(
-                                f"Lot: {lot_db['lot_number']} (Exp: {iso_to_thai_date(lot_db['expiry_date'])}, Qty Avail: {lot_db['quantity_on_hand']}) - จะใช้: {qty_from_this_lot}"
-                            )
-                            temp_qty_needed -= qty_from_this_lot
-                    else:
-                        item_preview["errors"].append(f"สต็อกไม่เพียงพอ (มี {total_available_stock}, ต้องการ {item_preview['quantity_requested']})")
-                        item_preview["available_lots_info_for_preview"].append(f"สต็อกรวม: {total_available_stock}")
+        preview_limit = int(request.form.get('preview_limit') or UPLOAD_PREVIEW_LIMIT)
+    except ValueError:
+        return jsonify({"error": "preview_limit ต้องเป็นตัวเลข"}), 400
 
+    conn = None
+    cursor = None
+    try:
+        with track_upload_memory() as memory_tracker:
+            conn = get_db_connection()
+            if not conn: return jsonify({"error": "ไม่สามารถเชื่อมต่อฐานข้อมูลได้"}), 500
+            cursor = conn.cursor(dictionary=True)
+
+            sheet_batches = iter_spreadsheet_batches(file, EXCEL_DISPENSE_REQUIRED_COLUMNS)
+            preview_items = _build_dispense_preview_items(sheet_batches, hcode, cursor)
+            if not preview_items:
+                return jsonify({"error": "ไฟล์ Excel ไม่มีข้อมูล"}), 400
+
+            response = {"summary": _summarize_dispense_preview(preview_items)}
+            response["preview_items"], response["preview_truncated"] = limit_preview_items(preview_items, preview_limit)
+            if memory_tracker.peak_memory_mb is not None:
+                response["peak_memory_mb"] = memory_tracker.peak_memory_mb
+            return jsonify(response), 200
+
+    except SpreadsheetError as e:
+        return jsonify({"error": str(e)}), e.status_code
+    except Exception as e:
+        logger.error(f"Error processing Excel preview: {str(e)}", exc_info=True)
+        return jsonify({"error": f"เกิดข้อผิดพลาดในการประมวลผลไฟล์ Excel: {str(e)}"}), 500
+    finally:
+        if cursor: cursor.close()
+        if conn: conn.close()
 
-                else:
-                    item_preview["errors"].append(f"ไม่พบรหัสยา '{item_preview['medicine_code']}' หรือยาไม่ถูกเปิดใช้งาน สำหรับหน่วยบริการ {hcode}")
-            
-            if item_preview["hos_guid"] and not item_preview["errors"]:
-                existing_item_check_query = """
-                    SELECT di.quantity_dispensed, dr.status as record_status, di.item_status
-                    FROM dispense_items di
-                    JOIN dispense_records dr ON di.dispense_record_id = dr.id
-                    WHERE di.hos_guid = %s AND dr.hcode = %s AND dr.status != 'ยกเลิก' AND di.item_status = 'ปกติ' 
-                    LIMIT 1 
-                """ 
-                checked_item = db_execute_query(existing_item_check_query, (item_preview["hos_guid"], hcode), fetchone=True, cursor_to_use=cursor)
-                if checked_item:
-                    item_preview["existing_quantity"] = checked_item["quantity_dispensed"]
-                    if item_preview["quantity_requested"] == checked_item["quantity_dispensed"]:
-                        item_preview["status"] = "รายการซ้ำ (hos_guid) และจำนวนเท่าเดิม (จะถูกข้าม)"
-                    else:
-                        item_preview["status"] = "รายการซ้ำ (hos_guid) และจำนวนแตกต่าง (จะถูกอัปเดตตาม FEFO)"
-            
-            if item_preview["errors"]:
-                 item_preview["status"] = "มีข้อผิดพลาด"
 
-            preview_items.append(item_preview)
+@dispense_bp.route('/dispense/upload_excel/process', methods=['POST'])
+def dispense_upload_excel_process():
+    """
+    ตัดจ่ายยาจากไฟล์ Excel/CSV โดยตรง (ไม่ต้องส่ง preview_items กลับมาเป็น JSON)
+    อ่านไฟล์ทีละชุดแล้วส่งเข้าโหมด bulk ของ process_excel_dispense
+    หากได้สถานะ 202 ให้อัปโหลดไฟล์เดิมอีกครั้งพร้อม resume_cursor
+    """
+    if 'file' not in request.files:
+        return jsonify({"error": "ไม่พบไฟล์ที่อัปโหลด"}), 400
+    file = request.files['file']
+    if file.filename == '':
+        return jsonify({"error": "ไม่ได้เลือกไฟล์"}), 400
 
-        return jsonify({"preview_items": preview_items}), 200
+    data = request.form.to_dict()
+    if not data.get('dispenser_id') or not data.get('hcode'):
+        return jsonify({"error": "ข้อมูลไม่ครบถ้วนสำหรับการยืนยันการตัดจ่าย"}), 400
 
+    conn = None
+    cursor = None
+    try:
+        with track_upload_memory() as memory_tracker:
+            conn = get_db_connection()
+            if not conn: return jsonify({"error": "ไม่สามารถเชื่อมต่อฐานข้อมูลได้"}), 500
+            cursor = conn.cursor(dictionary=True)
+            sheet_batches = iter_spreadsheet_batches(file, EXCEL_DISPENSE_REQUIRED_COLUMNS)
+            items_to_process, sheet_failed_details = _collect_dispense_items_from_sheet(sheet_batches, data['hcode'], cursor)
+            cursor.close(); cursor = None
+            conn.close(); conn = None
+
+            if not items_to_process and not sheet_failed_details:
+                return jsonify({"error": "ไฟล์ Excel ไม่มีข้อมูล"}), 400
+            # รายการที่ผิดตั้งแต่ขั้นอ่านไฟล์รายงานเฉพาะรอบแรก รอบที่ทำต่อด้วย resume_cursor จะไม่รายงานซ้ำ
+            initial_failed_details = [] if data.get('resume_cursor') else sheet_failed_details
+            response, status_code = _process_excel_dispense_bulk(data, items_to_process, initial_failed_details)
+            response_data = response.get_json()
+            if memory_tracker.peak_memory_mb is not None:
+                response_data["peak_memory_mb"] = memory_tracker.peak_memory_mb
+            return jsonify(response_data), status_code
+
+    except SpreadsheetError as e:
+        return jsonify({"error": str(e)}), e.status_code
     except Exception as e:
-        logger.error(f"Error processing Excel preview: {str(e)}", exc_info=True)
+        logger.error(f"Error processing Excel dispense upload: {str(e)}", exc_info=True)
         return jsonify({"error": f"เกิดข้อผิดพลาดในการประมวลผลไฟล์ Excel: {str(e)}"}), 500
     finally:
-        if 'conn' in locals() and conn and conn.is_connected():
-            if 'cursor' in locals() and cursor:
-                cursor.close()
-            conn.close()
+        if cursor: cursor.close()
+        if conn: conn.close()
 
 
 @dispense_bp.route('/dispense/process_excel_dispense', methods=['POST'])
@@ -517,6 +1178,8 @@ def process_excel_dispense():
         logger.error(f"Error sorting dispense items by date: {e}. Items: {items_to_process_original}")
         return jsonify({"error": "มีข้อผิดพลาดในการเรียงลำดับข้อมูลรายการยาตามวันที่"}), 400
 
+    if data.get('bulk_mode'):
+        return _process_excel_dispense_bulk(data, items_to_process)
 
     conn = get_db_connection()
     if not conn: return jsonify({"error": "ไม่สามารถเชื่อมต่อฐานข้อมูลได้"}), 500
@@ -526,6 +1189,7 @@ def process_excel_dispense():
     failed_items_details = []
     updated_hos_guids = []
     skipped_hos_guids_same_qty = []
+    stock_movements = set()
 
     try:
         conn.start_transaction()
@@ -539,14 +1203,7 @@ def process_excel_dispense():
             except (ValueError, TypeError):
                 logger.warning(f"Invalid overall_dispense_date_iso from first sorted item: {temp_date_str}, using current date.")
         
-        current_date_str_disp = datetime.now().strftime('%y%m%d')
-        cursor.execute("SELECT dispense_record_number FROM dispense_records WHERE hcode = %s AND dispense_record_number LIKE %s ORDER BY id DESC LIMIT 1", (hcode, f"DSPEXC-{hcode}-{current_date_str_disp}-%",))
-        last_disp_rec = cursor.fetchone()
-        next_disp_seq = 1
-        if last_disp_rec:
-            try: next_disp_seq = int(last_disp_rec['dispense_record_number'].split('-')[-1]) + 1
-            except (IndexError, ValueError): pass
-        dispense_record_number = f"DSPEXC-{hcode}-{current_date_str_disp}-{next_disp_seq:03d}"
+        dispense_record_number = next_document_number('DSPEXC', cursor, hcode)
 
         sql_dispense_record = "INSERT INTO dispense_records (hcode, dispense_record_number, dispense_date, dispenser_id, remarks, dispense_type, status) VALUES (%s, %s, %s, %s, %s, %s, 'ปกติ')"
         cursor.execute(sql_dispense_record, (hcode, dispense_record_number, overall_dispense_date_iso_str, dispenser_id, remarks_header, dispense_type_header))
@@ -555,24 +1212,9 @@ def process_excel_dispense():
         for item_data in items_to_process: 
             hos_guid = item_data.get('hos_guid')
             medicine_id = item_data.get('medicine_id')
-            quantity_requested = item_data.get('quantity_dispensed') 
-            item_dispense_date_iso = item_data.get('dispense_date_iso', overall_dispense_date_iso_str)
-
-            if not all([medicine_id, quantity_requested, item_dispense_date_iso]):
-                failed_items_details.append({"hos_guid": hos_guid, "medicine_code": item_data.get("medicine_code", "N/A"), "error": "ข้อมูลไม่ครบถ้วน (ยา, จำนวน, หรือวันที่จ่าย)"})
-                continue
-            try:
-                quantity_requested = int(quantity_requested)
-                if quantity_requested <= 0:
-                    failed_items_details.append({"hos_guid": hos_guid, "medicine_code": item_data.get("medicine_code"), "error": "จำนวนจ่ายต้องมากกว่า 0"})
-                    continue
-            except ValueError:
-                failed_items_details.append({"hos_guid": hos_guid, "medicine_code": item_data.get("medicine_code"), "error": "จำนวนจ่ายไม่ถูกต้อง"})
-                continue
-            try: 
-                datetime.strptime(item_dispense_date_iso, '%Y-%m-%d')
-            except (ValueError, TypeError):
-                failed_items_details.append({"hos_guid": hos_guid, "medicine_code": item_data.get("medicine_code"), "error": "รูปแบบวันที่จ่ายไม่ถูกต้อง"})
+            quantity_requested, item_dispense_date_iso, validation_error = _validate_excel_dispense_item(item_data, overall_dispense_date_iso_str)
+            if validation_error:
+                failed_items_details.append({"hos_guid": hos_guid, "medicine_code": item_data.get("medicine_code", "N/A"), "error": validation_error})
                 continue
 
             if hos_guid:
@@ -594,7 +1236,7 @@ def process_excel_dispense():
                             # For Hard Delete, _cancel_dispense_item_internal now also deletes the dispense_item.
                             # We pass for_excel_update=True to correctly mark the old dispense_record if needed,
                             # though the item itself will be gone if successfully "cancelled" this way.
-                            success_cancel_old = _cancel_dispense_item_internal(ex_item_to_cancel['dispense_item_id'], dispenser_id, cursor, for_excel_update=True)
+                            success_cancel_old = _cancel_dispense_item_internal(ex_item_to_cancel['dispense_item_id'], dispenser_id, cursor, stock_movements, for_excel_update=True)
                             if not success_cancel_old:
                                 failed_items_details.append({"hos_guid": hos_guid, "medicine_code": item_data.get("medicine_code"), "error": "ไม่สามารถยกเลิกรายการเก่าเพื่ออัปเดตได้"})
                                 conn.rollback()
@@ -605,7 +1247,7 @@ def process_excel_dispense():
                 hcode, medicine_id, quantity_requested,
                 dispense_record_id, dispenser_id, dispense_record_number,
                 hos_guid, dispense_type_header, item_dispense_date_iso,
-                cursor
+                cursor, stock_movements
             )
 
             if success_fefo_dispense:
@@ -622,8 +1264,9 @@ def process_excel_dispense():
                 dispense_record_id = None # Nullify so it's not returned
                 dispense_record_number = None
 
-
+        record_stock_changes(stock_movements, cursor)
         conn.commit()
+        invalidate_clinic_stock_caches(hcode)
         message = f"บันทึกการตัดจ่ายยาจาก Excel สำเร็จ {processed_count} รายการ."
         if updated_hos_guids: message += f" อัปเดต (แทนที่รายการเก่า) {len(updated_hos_guids)} รายการ (hos_guid)."
         if skipped_hos_guids_same_qty: message += f" ข้าม {len(skipped_hos_guids_same_qty)} รายการซ้ำ (hos_guid) ที่มีจำนวนเท่าเดิม."
@@ -655,3 +1298,75 @@ def process_excel_dispense():
         if cursor: cursor.close()
         if conn: conn.close()
 
+
+
+# --- HOSxP Sync Watermark ---
+
+@dispense_bp.route('/dispense/sync_watermark', methods=['GET'])
+def get_dispense_sync_watermark():
+    """จุดซิงค์ล่าสุดของหน่วยบริการ (watermark = null คือยังไม่เคยซิงค์ ให้ดึงตามช่วงวันที่ที่เลือก)"""
+    hcode = request.args.get('hcode')
+    if not hcode:
+        return jsonify({"error": "กรุณาระบุ hcode ของหน่วยบริการ"}), 400
+    row = db_execute_query("SELECT last_vstdate, last_hos_guid, updated_at FROM dispense_sync_watermarks WHERE hcode = %s", (hcode,), fetchone=True)
+    watermark = {"vstdate": row['last_vstdate'].strftime('%Y-%m-%d'), "hos_guid": row['last_hos_guid']} if row else None
+    return jsonify({"hcode": hcode, "watermark": watermark, "updated_at": row['updated_at'] if row else None})
+
+
+@dispense_bp.route('/dispense/sync_failures', methods=['GET'])
+def get_dispense_sync_failures():
+    """รายการจากการซิงค์ที่ตัดจ่ายไม่สำเร็จและรอส่งใหม่ (โปรแกรมนำเข้าส่งใหม่ด้วย sync_failure_retry ก่อนรายการใหม่)"""
+    hcode = request.args.get('hcode')
+    if not hcode:
+        return jsonify({"error": "กรุณาระบุ hcode ของหน่วยบริการ"}), 400
+    conn = get_db_connection()
+    if not conn: return jsonify({"error": "ไม่สามารถเชื่อมต่อฐานข้อมูลได้"}), 500
+    cursor = conn.cursor(dictionary=True)
+    try:
+        failures = list_sync_failures(hcode, cursor)
+        for failure in failures:
+            dispense_date = failure.pop('dispense_date')
+            failure['dispense_date_iso'] = dispense_date.strftime('%Y-%m-%d') if dispense_date else None
+            failure['quantity_dispensed'] = float(failure['quantity_dispensed']) if failure['quantity_dispensed'] is not None else None
+        return jsonify({"hcode": hcode, "failures": failures, "count": len(failures)})
+    except Error as e:
+        logger.error(f"Database error listing sync failures: {str(e)}", exc_info=True)
+        return jsonify({"error": f"เกิดข้อผิดพลาดในฐานข้อมูล: {getattr(e, 'msg', str(e))}"}), 500
+    finally:
+        cursor.close()
+        conn.close()
+
+
+@dispense_bp.route('/dispense/sync_watermark', methods=['PUT'])
+def advance_dispense_sync_watermark():
+    """
+    เลื่อนจุดซิงค์หลังส่งรายการครบทุกชุดแล้ว (ชุดที่ส่งพร้อมกันอาจ commit ไม่ตามลำดับ ทำให้จุดซิงค์ใน transaction ค้างอยู่ก่อนหน้า)
+    body: {"hcode", "after": จุดซิงค์ตอนเริ่มรอบ (null ได้), "to": รายการสุดท้ายที่บันทึกแล้ว}
+    จุดซิงค์เลื่อนเฉพาะเมื่อครอบคลุมถึง after แล้ว (ไม่ข้ามรายการของการซิงค์รอบอื่นที่ยังไม่ครบ)
+    """
+    data = request.get_json()
+    if not data or not data.get('hcode') or not data.get('to'):
+        return jsonify({"error": "กรุณาระบุ hcode และ to"}), 400
+    hcode = data['hcode']
+    try:
+        after, to = parse_sync_watermark(data.get('after')), parse_sync_watermark(data['to'])
+    except (ValueError, TypeError):
+        return jsonify({"error": "after หรือ to ไม่ถูกต้อง"}), 400
+
+    conn = get_db_connection()
+    if not conn: return jsonify({"error": "ไม่สามารถเชื่อมต่อฐานข้อมูลได้"}), 500
+    cursor = conn.cursor(dictionary=True)
+    try:
+        conn.start_transaction()
+        watermark, advanced = advance_sync_watermark(hcode, after, to, cursor)
+        conn.commit()
+        if not advanced and (watermark is None or watermark < to):
+            return jsonify({"error": "จุดซิงค์ปัจจุบันยังไม่ถึง after จึงไม่เลื่อนจุดซิงค์", "watermark": format_sync_watermark(watermark), "advanced": False}), 409
+        return jsonify({"hcode": hcode, "watermark": format_sync_watermark(watermark), "advanced": advanced})
+    except Error as e:
+        conn.rollback()
+        logger.error(f"Database error advancing sync watermark: {str(e)}", exc_info=True)
+        return jsonify({"error": f"เกิดข้อผิดพลาดในฐานข้อมูล: {getattr(e, 'msg', str(e))}"}), 500
+    finally:
+        cursor.close()
+        conn.close()
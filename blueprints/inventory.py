@@ -1,7 +1,14 @@
 # /blueprints/inventory.py
 
 from flask import Blueprint, request, jsonify
-from helpers.database import db_execute_query
+from helpers.database import db_execute_query, get_db_connection, build_in_placeholders, db_update_many_by_id
+from helpers.stock_balance import get_opening_balance
+from helpers.search_index import invalidate_medicine_search_index
+from helpers.cache import cached_json_response, invalidate_clinic_stock_caches, CACHE_INVENTORY_SUMMARY, CLINIC_AGGREGATE_TTL_SECONDS
+from helpers.data_versions import bump_data_version, get_clinic_data_etag, is_not_modified, not_modified_response, with_etag
+from helpers.change_log import record_changes, CHANGE_ENTITY_MEDICINE
+from helpers.pagination import parse_page_args, fetch_keyset_page, build_keyset_query, first_page, encode_page_cursor, page_response
+from helpers.migrations import register_hot_query
 from helpers.utils import thai_to_iso_date, iso_to_thai_date
 from mysql.connector import Error
 import logging
@@ -15,6 +22,74 @@ logger = logging.getLogger(__name__)
 # สร้าง Blueprint สำหรับ inventory
 inventory_bp = Blueprint('inventory', __name__, url_prefix='/api/inventory')
 
+# ข้อมูลที่สรุปคลังยาขึ้นอยู่ด้วย (ใช้สร้าง ETag)
+INVENTORY_SUMMARY_DATA_SCOPES = ('medicines', 'stock')
+
+INVENTORY_SUMMARY_SELECT = """
+    SELECT
+        m.id AS medicine_id,
+        m.medicine_code,
+        m.generic_name,
+        m.strength,
+        m.unit,
+        m.reorder_point,
+        m.min_stock, 
+        m.max_stock,
+        COALESCE(sb.total_on_hand, 0) AS total_quantity_on_hand,
+        (CASE
+            WHEN COALESCE(sb.total_on_hand, 0) <= 0 THEN 'หมด'
+            WHEN m.min_stock IS NOT NULL AND m.min_stock > 0 AND COALESCE(sb.total_on_hand, 0) <= m.min_stock THEN 'ต่ำกว่า Min'
+            WHEN m.max_stock IS NOT NULL AND m.max_stock > 0 AND COALESCE(sb.total_on_hand, 0) > m.max_stock THEN 'เกิน Max'
+            WHEN m.min_stock IS NOT NULL AND m.min_stock > 0 AND (m.max_stock IS NULL OR m.max_stock = 0 OR COALESCE(sb.total_on_hand, 0) <= m.max_stock) THEN 'ปกติ'
+            WHEN (m.min_stock IS NULL OR m.min_stock = 0) AND m.reorder_point > 0 AND COALESCE(sb.total_on_hand, 0) <= m.reorder_point THEN 'ใกล้ Reorder Point'
+            ELSE 'ปกติ'
+        END) AS status
+    FROM medicines m
+    LEFT JOIN stock_balance sb ON sb.medicine_id = m.id AND sb.hcode = m.hcode
+"""
+
+INVENTORY_HISTORY_SELECT = """
+    SELECT
+        it.id, it.transaction_date, it.transaction_type, it.lot_number, it.expiry_date,
+        it.quantity_change, it.reference_document_id,
+        it.remarks, u.full_name as user_full_name
+    FROM inventory_transactions it
+    JOIN users u ON it.user_id = u.id
+"""
+INVENTORY_HISTORY_ORDER_COLUMNS = [("it.transaction_date", "transaction_date"), ("it.id", "id")]
+
+
+def _inventory_summary_query(user_hcode):
+    """SQL และพารามิเตอร์ของสรุปคลังยา (ไม่ระบุ hcode = ทุกหน่วยบริการ)"""
+    params = []
+    where_clauses = ["m.is_active = TRUE"]
+    if user_hcode:
+        where_clauses.append("m.hcode = %s")
+        params.append(user_hcode)
+    return INVENTORY_SUMMARY_SELECT + " WHERE " + " AND ".join(where_clauses) + " ORDER BY m.generic_name", params
+
+
+def _inventory_history_filters(hcode, medicine_id, start_date, end_date_exclusive):
+    """
+    เงื่อนไขของประวัติการเคลื่อนไหว ใช้ช่วงแบบครึ่งเปิด [start, end + 1 วัน) กับคอลัมน์ตรง ๆ
+    เพื่อให้ใช้ index (hcode, medicine_id, transaction_date) ได้
+    """
+    conditions, params = ["it.hcode = %s", "it.medicine_id = %s"], [hcode, medicine_id]
+    if start_date:
+        conditions.append("it.transaction_date >= %s")
+        params.append(start_date)
+    if end_date_exclusive:
+        conditions.append("it.transaction_date < %s")
+        params.append(end_date_exclusive)
+    return conditions, params
+
+
+register_hot_query("stock balance by clinic", *_inventory_summary_query('00000'))
+register_hot_query("inventory history", *build_keyset_query(
+    INVENTORY_HISTORY_SELECT, *_inventory_history_filters('00000', 1, '2024-01-01', '2024-02-01'),
+    INVENTORY_HISTORY_ORDER_COLUMNS, first_page(), descending=False
+))
+
 
 @inventory_bp.route('/', methods=['GET'])
 def get_inventory_summary():
@@ -28,49 +103,26 @@ def get_inventory_summary():
     if not user_hcode and user_role != 'ผู้ดูแลระบบ':
         return jsonify({"error": "กรุณาระบุ hcode ของหน่วยบริการ"}), 400
 
-    base_query = """
-        SELECT
-            m.id AS medicine_id,
-            m.medicine_code,
-            m.generic_name,
-            m.strength,
-            m.unit,
-            m.reorder_point,
-            m.min_stock, 
-            m.max_stock,
-            COALESCE(i_sum.total_quantity, 0) AS total_quantity_on_hand,
-            (CASE
-                WHEN COALESCE(i_sum.total_quantity, 0) <= 0 THEN 'หมด'
-                WHEN m.min_stock IS NOT NULL AND m.min_stock > 0 AND COALESCE(i_sum.total_quantity, 0) <= m.min_stock THEN 'ต่ำกว่า Min'
-                WHEN m.max_stock IS NOT NULL AND m.max_stock > 0 AND COALESCE(i_sum.total_quantity, 0) > m.max_stock THEN 'เกิน Max'
-                WHEN m.min_stock IS NOT NULL AND m.min_stock > 0 AND (m.max_stock IS NULL OR m.max_stock = 0 OR COALESCE(i_sum.total_quantity, 0) <= m.max_stock) THEN 'ปกติ'
-                WHEN (m.min_stock IS NULL OR m.min_stock = 0) AND m.reorder_point > 0 AND COALESCE(i_sum.total_quantity, 0) <= m.reorder_point THEN 'ใกล้ Reorder Point'
-                ELSE 'ปกติ'
-            END) AS status
-        FROM medicines m
-        LEFT JOIN (
-            SELECT medicine_id, hcode, SUM(quantity_on_hand) as total_quantity
-            FROM inventory
-            GROUP BY medicine_id, hcode
-        ) AS i_sum ON m.id = i_sum.medicine_id AND m.hcode = i_sum.hcode
-    """
-    params = []
-    where_clauses = ["m.is_active = TRUE"]
-    
-    if user_hcode:
-        where_clauses.append("m.hcode = %s")
-        params.append(user_hcode)
+    # conditional GET: ตัวนับของหน่วยบริการยังไม่เปลี่ยน = client มีข้อมูลล่าสุดแล้ว ไม่ต้องรัน query ข้างล่าง
+    etag = get_clinic_data_etag(user_hcode, INVENTORY_SUMMARY_DATA_SCOPES)
+    if is_not_modified(etag):
+        return not_modified_response(etag)
 
-    if where_clauses:
-        base_query += " WHERE " + " AND ".join(where_clauses)
+    base_query, params = _inventory_summary_query(user_hcode)
 
-    base_query += " ORDER BY m.generic_name;"
+    def load_inventory_summary():
+        inventory_summary = db_execute_query(base_query, tuple(params) if params else None, fetchall=True)
+        if inventory_summary is None:
+            return jsonify({"error": "ไม่สามารถดึงข้อมูลคลังยาได้"}), 500
+        return jsonify(inventory_summary)
 
-    inventory_summary = db_execute_query(base_query, tuple(params) if params else None, fetchall=True)
-    if inventory_summary is None:
-        return jsonify({"error": "ไม่สามารถดึงข้อมูลคลังยาได้"}), 500
-    
-    return jsonify(inventory_summary)
+    # ผลลัพธ์ขึ้นกับ hcode เท่านั้น (role ใช้ตรวจสิทธิ์ข้างบน) / ไม่ระบุ hcode = มุมมองรวมทุกหน่วยบริการ
+    # ใส่ ETag ใน key ด้วย เพื่อไม่ให้ส่งข้อมูลเก่าจาก cache ไปพร้อม ETag ใหม่ในช่วงก่อน invalidate
+    response = cached_json_response(
+        CACHE_INVENTORY_SUMMARY, load_inventory_summary, hcode=user_hcode,
+        params={"etag": etag} if etag else None, ttl=CLINIC_AGGREGATE_TTL_SECONDS
+    )
+    return with_etag(response, etag)
 
 
 @inventory_bp.route('/history/<int:medicine_id>', methods=['GET'])
@@ -90,39 +142,37 @@ def get_inventory_history(medicine_id):
     end_date_iso = thai_to_iso_date(end_date_thai) if end_date_thai else None
     
     try:
-        # --- ขั้นตอนที่ 1: คำนวณยอดคงเหลือเริ่มต้น (ก่อนช่วงวันที่ที่เลือก) ---
-        initial_balance_q = "SELECT COALESCE(SUM(quantity_change), 0) as balance FROM inventory_transactions WHERE hcode = %s AND medicine_id = %s"
-        initial_balance_params = [user_hcode, medicine_id]
-        
-        if start_date_iso:
-            initial_balance_q += " AND DATE(transaction_date) < %s"
-            initial_balance_params.append(start_date_iso)
-            
-        initial_balance_res = db_execute_query(initial_balance_q, tuple(initial_balance_params), fetchone=True)
-        running_balance = initial_balance_res['balance'] if initial_balance_res else 0
+        start_date = datetime.strptime(start_date_iso, '%Y-%m-%d').date() if start_date_iso else None
+        end_date_exclusive = datetime.strptime(end_date_iso, '%Y-%m-%d').date() + timedelta(days=1) if end_date_iso else None
+    except ValueError:
+        return jsonify({"error": "รูปแบบวันที่ไม่ถูกต้อง"}), 400
+    try:
+        # cursor ของหน้าประวัติเก็บ [transaction_date, id, ยอดคงเหลือหลังแถวสุดท้าย] เพื่อให้หน้าถัดไปคำนวณยอดต่อได้
+        page = parse_page_args(request.args)
+        if page['cursor'] and len(page['cursor']) != 3:
+            raise ValueError("cursor ไม่ถูกต้อง")
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    conn = None
+    cursor = None
+    try:
+        conn = get_db_connection()
+        if not conn: return jsonify({"error": "ไม่สามารถเชื่อมต่อฐานข้อมูลได้"}), 500
+        cursor = conn.cursor(dictionary=True)
+
+        # --- ขั้นตอนที่ 1: คำนวณยอดคงเหลือเริ่มต้น (ก่อนช่วงวันที่ที่เลือก) จาก snapshot รายเดือน + ช่วงต่อท้าย ---
+        if page['cursor']:
+            running_balance = int(page['cursor'][2])
+        else:
+            running_balance = get_opening_balance(user_hcode, medicine_id, start_date, cursor) if start_date else 0
 
         # --- ขั้นตอนที่ 2: ดึงรายการเคลื่อนไหวทั้งหมดในช่วงวันที่ที่เลือก ---
-        query_conditions = ["it.hcode = %s", "it.medicine_id = %s"]
-        params = [user_hcode, medicine_id]
-        
-        if start_date_iso:
-            query_conditions.append("DATE(it.transaction_date) >= %s")
-            params.append(start_date_iso)
-        if end_date_iso:
-            query_conditions.append("DATE(it.transaction_date) <= %s")
-            params.append(end_date_iso)
-            
-        query = f"""
-            SELECT
-                it.id, it.transaction_date, it.transaction_type, it.lot_number, it.expiry_date,
-                it.quantity_change, it.reference_document_id,
-                it.remarks, u.full_name as user_full_name
-            FROM inventory_transactions it
-            JOIN users u ON it.user_id = u.id
-            WHERE {" AND ".join(query_conditions)}
-            ORDER BY it.transaction_date ASC, it.id ASC;
-        """
-        history_raw = db_execute_query(query, tuple(params), fetchall=True)
+        query_conditions, params = _inventory_history_filters(user_hcode, medicine_id, start_date, end_date_exclusive)
+        history_raw, next_cursor_values, total = fetch_keyset_page(
+            INVENTORY_HISTORY_SELECT, query_conditions, params, INVENTORY_HISTORY_ORDER_COLUMNS, page,
+            descending=False, count_sql="SELECT COUNT(*) AS total FROM inventory_transactions it", cursor_to_use=cursor
+        )
 
         if history_raw is None: 
             return jsonify({"error": "ไม่สามารถดึงประวัติยาได้ (DB Error)"}), 500
@@ -138,8 +188,9 @@ def get_inventory_history(medicine_id):
             item['expiry_date'] = iso_to_thai_date(item.get('expiry_date'))
             
             processed_history.append(item)
-            
-        return jsonify(processed_history)
+
+        next_cursor = encode_page_cursor(next_cursor_values + [running_balance]) if next_cursor_values else None
+        return page_response(processed_history, next_cursor, total, page)
 
     except Error as e: 
         logger.error(f"Error getting inventory history: {e}", exc_info=True)
@@ -147,6 +198,9 @@ def get_inventory_history(medicine_id):
     except Exception as ex:
         logger.error(f"General error getting inventory history: {ex}", exc_info=True)
         return jsonify({"error": f"เกิดข้อผิดพลาดทั่วไป: {ex}"}), 500
+    finally:
+        if cursor: cursor.close()
+        if conn: conn.close()
 
 
 @inventory_bp.route('/lots', methods=['GET'])
@@ -181,17 +235,124 @@ def get_medicine_lots_in_inventory():
         
     return jsonify(lots)
 
+# --- Min/Max Calculation ---
+
+DISPENSE_TRANSACTION_TYPES = ('จ่ายออก-ผู้ป่วย', 'ตัดจ่ายยา', 'จ่ายออก', 'Dispense')
+MIN_MAX_UPDATE_BATCH_SIZE = 500
+
+def _dispensed_quantity_query(hcode, start_date, end_date_exclusive, medicine_id=None):
+    """ยอดจ่ายรวมต่อยาในช่วง [start_date, end_date_exclusive) ของยาที่ใช้งานอยู่ (GROUP BY ครั้งเดียวทั้งหน่วยบริการ)"""
+    medicine_filter_sql, medicine_params = "", []
+    if medicine_id is not None:
+        medicine_filter_sql, medicine_params = " AND m.id = %s", [medicine_id]
+    sql = f"""
+        SELECT m.id, m.generic_name, m.lead_time_days, m.review_period_days,
+               COALESCE(dispensed.total_dispensed, 0) AS total_dispensed
+        FROM medicines m
+        LEFT JOIN (
+            SELECT medicine_id, SUM(ABS(quantity_change)) AS total_dispensed
+            FROM inventory_transactions
+            WHERE hcode = %s
+              AND transaction_type IN ({build_in_placeholders(DISPENSE_TRANSACTION_TYPES)})
+              AND transaction_date >= %s AND transaction_date < %s
+            GROUP BY medicine_id
+        ) AS dispensed ON dispensed.medicine_id = m.id
+        WHERE m.hcode = %s AND m.is_active = TRUE{medicine_filter_sql}
+        ORDER BY m.id
+    """
+    return sql, (hcode, *DISPENSE_TRANSACTION_TYPES, start_date, end_date_exclusive, hcode, *medicine_params)
+
+
+register_hot_query("dispensed quantity for min/max", *_dispensed_quantity_query('00000', '2024-01-01', '2024-04-01'))
+
+
+def _read_min_max(hcode, medicine_ids, cursor):
+    """ค่า min_stock/max_stock ปัจจุบันของยาที่ระบุ คืนค่า dict: medicine_id -> (min_stock, max_stock)"""
+    stored = {}
+    for start in range(0, len(medicine_ids), MIN_MAX_UPDATE_BATCH_SIZE):
+        batch = medicine_ids[start:start + MIN_MAX_UPDATE_BATCH_SIZE]
+        cursor.execute(
+            f"SELECT id, min_stock, max_stock FROM medicines WHERE hcode = %s AND id IN ({build_in_placeholders(batch)})",
+            (hcode, *batch)
+        )
+        stored.update({row['id']: (row['min_stock'], row['max_stock']) for row in cursor.fetchall()})
+    return stored
+
+
+def recalculate_min_max_for_hcode(hcode, calculation_period_days, cursor, medicine_id=None):
+    """
+    คำนวณ Min/Max ของยาทุกตัว (หรือเฉพาะ medicine_id) ในหน่วยบริการ ด้วย query แบบ GROUP BY ครั้งเดียว
+    แล้วเขียนกลับด้วย UPDATE ... CASE แบบ batch (db_update_many_by_id) ผู้เรียกเป็นผู้ start_transaction/commit
+    Min = ADU * lead time, Max = Min + ADU * review period (ADU = ยอดจ่ายในช่วง / จำนวนวัน)
+    คืนค่า list ของรายละเอียดผลการคำนวณรายยา (updated_successfully = ค่าที่อ่านกลับหลัง UPDATE ตรงกับค่าที่คำนวณ)
+    """
+    today = datetime.now().date()
+    start_date_adu = today - timedelta(days=calculation_period_days)
+    # ช่วงแบบครึ่งเปิด [start, วันนี้ + 1 วัน) เทียบเท่า DATE(transaction_date) BETWEEN start AND วันนี้ แต่ใช้ index ได้
+    cursor.execute(*_dispensed_quantity_query(hcode, start_date_adu.isoformat(), (today + timedelta(days=1)).isoformat(), medicine_id))
+    medicines = cursor.fetchall()
+
+    results_details = []
+    for med in medicines:
+        lead_time_days = med['lead_time_days'] if med.get('lead_time_days') is not None else 0
+        review_period_days = med['review_period_days'] if med.get('review_period_days') is not None else 0
+        total_dispensed = float(med['total_dispensed'])
+        adu = total_dispensed / calculation_period_days if total_dispensed > 0 else 0.0
+
+        calculated_min_stock = adu * float(lead_time_days)
+        calculated_max_stock = calculated_min_stock + (adu * float(review_period_days))
+        final_min_stock = int(math.ceil(calculated_min_stock))
+        final_max_stock = max(int(math.ceil(calculated_max_stock)), final_min_stock)
+
+        results_details.append({
+            "medicine_id": med['id'],
+            "generic_name": med['generic_name'],
+            "adu": round(adu, 3),
+            "lead_time_days": lead_time_days,
+            "review_period_days": review_period_days,
+            "calculated_min_stock_raw": round(calculated_min_stock, 3),
+            "calculated_max_stock_raw": round(calculated_max_stock, 3),
+            "final_min_stock": final_min_stock,
+            "final_max_stock": final_max_stock,
+            "updated_successfully": False
+        })
+
+    db_update_many_by_id(
+        'medicines', ['min_stock', 'max_stock'],
+        [(detail['medicine_id'], detail['final_min_stock'], detail['final_max_stock']) for detail in results_details],
+        cursor, batch_size=MIN_MAX_UPDATE_BATCH_SIZE
+    )
+    # rowcount ของ UPDATE นับเฉพาะแถวที่ค่าเปลี่ยน จึงอ่านค่าที่บันทึกกลับมาเทียบแทน
+    stored = _read_min_max(hcode, [detail['medicine_id'] for detail in results_details], cursor)
+    for detail in results_details:
+        detail['updated_successfully'] = stored.get(detail['medicine_id']) == (detail['final_min_stock'], detail['final_max_stock'])
+    if results_details:
+        bump_data_version(hcode, 'medicines', cursor)
+        record_changes(hcode, CHANGE_ENTITY_MEDICINE, [detail['medicine_id'] for detail in results_details], cursor)
+    return results_details
+
+def get_hcodes_with_active_medicines(cursor):
+    """รายการหน่วยบริการที่มียาเปิดใช้งาน (สำหรับคำนวณ Min/Max ทั้งเครือข่าย)"""
+    cursor.execute("SELECT DISTINCT hcode FROM medicines WHERE is_active = TRUE ORDER BY hcode")
+    return [row['hcode'] for row in cursor.fetchall()]
+
 @inventory_bp.route('/calculate-min-max', methods=['POST'])
 def calculate_min_max_stock():
+    """
+    คำนวณ Min/Max ใหม่จากยอดจ่ายย้อนหลัง
+    Body: hcode (required เว้นแต่ all_hcodes), medicine_id (optional), calculation_period_days (default 90),
+          all_hcodes (optional, true = คำนวณทุกหน่วยบริการ แยก transaction ต่อหน่วยบริการ)
+    """
     data = request.get_json()
     if not data:
         return jsonify({"error": "No data provided"}), 400
 
     hcode = data.get('hcode')
+    all_hcodes = bool(data.get('all_hcodes'))
     medicine_id_filter = data.get('medicine_id') # Optional
     calculation_period_days = data.get('calculation_period_days', 90)
 
-    if not hcode:
+    if not hcode and not all_hcodes:
         return jsonify({"error": "hcode is required"}), 400
     
     try: # Ensure calculation_period_days is an int
@@ -202,120 +363,54 @@ def calculate_min_max_stock():
     if calculation_period_days <= 0:
         calculation_period_days = 90
 
-    try:
-        medicines_query_base = """
-            SELECT id, generic_name, lead_time_days, review_period_days
-            FROM medicines 
-            WHERE hcode = %s AND is_active = TRUE
-        """
-        # Note: safety_stock_days is not included here as it's not confirmed to be in DB schema yet.
-        # If it were, it would be: SELECT id, generic_name, lead_time_days, review_period_days, safety_stock_days
-        
-        medicines_params = [hcode]
-
-        if medicine_id_filter:
-            try:
-                medicine_id_val = int(medicine_id_filter)
-                medicines_query_base += " AND id = %s"
-                medicines_params.append(medicine_id_val)
-            except ValueError:
-                return jsonify({"error": "Invalid medicine_id format."}), 400
-        
-        medicines_to_process = db_execute_query(medicines_query_base, tuple(medicines_params), fetchall=True)
+    medicine_id_val = None
+    if medicine_id_filter:
+        try:
+            medicine_id_val = int(medicine_id_filter)
+        except ValueError:
+            return jsonify({"error": "Invalid medicine_id format."}), 400
 
-        if medicines_to_process is None: # Indicates a DB query execution error in db_execute_query
-            logger.error(f"Failed to fetch medicines for hcode {hcode}, medicine_id_filter {medicine_id_filter}")
-            return jsonify({"error": "Could not fetch medicines for calculation due to a database error."}), 500
-        
-        if not medicines_to_process:
+    conn = get_db_connection()
+    if not conn: return jsonify({"error": "ไม่สามารถเชื่อมต่อฐานข้อมูลได้"}), 500
+    cursor = conn.cursor(dictionary=True)
+    try:
+        hcodes = get_hcodes_with_active_medicines(cursor) if all_hcodes else [hcode]
+        conn.commit()
+
+        results_details = []
+        for target_hcode in hcodes:
+            conn.start_transaction()
+            hcode_details = recalculate_min_max_for_hcode(target_hcode, calculation_period_days, cursor, medicine_id_val)
+            conn.commit()
+            invalidate_medicine_search_index(target_hcode)
+            invalidate_clinic_stock_caches(target_hcode)
+            if all_hcodes:
+                for detail in hcode_details:
+                    detail['hcode'] = target_hcode
+            results_details.extend(hcode_details)
+
+        if not results_details:
             return jsonify({"message": "No active medicines found matching the criteria for this hcode."}), 200
 
-        updated_count = 0
-        results_details = [] 
-
-        today = datetime.now().date()
-        start_date_adu = today - timedelta(days=calculation_period_days)
-
-        for med in medicines_to_process:
-            lead_time_days = med.get('lead_time_days', 0) if med.get('lead_time_days') is not None else 0
-            review_period_days = med.get('review_period_days', 0) if med.get('review_period_days') is not None else 0
-            # safety_stock_days = med.get('safety_stock_days', 0) # Omitted for now
-
-            adu_query = """
-                SELECT SUM(ABS(quantity_change)) as total_dispensed
-                FROM inventory_transactions
-                WHERE medicine_id = %s
-                  AND hcode = %s
-                  AND transaction_type IN ('จ่ายออก-ผู้ป่วย', 'ตัดจ่ายยา', 'จ่ายออก', 'Dispense') 
-                  AND DATE(transaction_date) BETWEEN %s AND %s
-            """
-            # Added 'Dispense' as another possible transaction_type string
-            adu_params = (med['id'], hcode, start_date_adu.isoformat(), today.isoformat())
-            dispensing_data = db_execute_query(adu_query, adu_params, fetchone=True)
-
-            total_dispensed = 0
-            if dispensing_data and dispensing_data['total_dispensed'] is not None:
-                total_dispensed = float(dispensing_data['total_dispensed']) # Ensure float for division
-
-            adu = 0.0
-            if calculation_period_days > 0 and total_dispensed > 0:
-                adu = total_dispensed / calculation_period_days
-            
-            # Min Stock: (ADU * Lead Time)
-            calculated_min_stock = adu * float(lead_time_days) 
-            
-            # Max Stock: Min Stock + (ADU * Review Period)
-            calculated_max_stock = calculated_min_stock + (adu * float(review_period_days))
-
-            final_min_stock = int(math.ceil(calculated_min_stock))
-            final_max_stock = int(math.ceil(calculated_max_stock))
-
-            if final_max_stock < final_min_stock:
-                final_max_stock = final_min_stock 
-
-            update_med_query = """
-                UPDATE medicines 
-                SET min_stock = %s, max_stock = %s 
-                WHERE id = %s AND hcode = %s
-            """
-            update_params = (final_min_stock, final_max_stock, med['id'], hcode)
-            
-            # Execute the update. db_execute_query with commit=True (and no get_last_id) returns None.
-            # Errors during execution should be caught by the broader try-except blocks.
-            db_execute_query(update_med_query, update_params, commit=True)
-            
-            # If we reach here, the query was executed and committed without raising an
-            # exception that propagated to the main try-except blocks.
-            # We consider this item processed for update.
-            current_update_success = True 
-            updated_count += 1
-            # Note: The specific information about whether 0 rows or N rows were affected by the UPDATE
-            # is not available here without modifying db_execute_query to return cursor.rowcount.
-            # The current logic assumes an attempt was made and no critical error stopped it.
-
-            results_details.append({
-                "medicine_id": med['id'],
-                "generic_name": med['generic_name'],
-                "adu": round(adu, 3),
-                "lead_time_days": lead_time_days,
-                "review_period_days": review_period_days,
-                "calculated_min_stock_raw": round(calculated_min_stock,3),
-                "calculated_max_stock_raw": round(calculated_max_stock,3),
-                "final_min_stock": final_min_stock,
-                "final_max_stock": final_max_stock,
-                "updated_successfully": current_update_success
-            })
-
+        updated_count = sum(1 for detail in results_details if detail['updated_successfully'])
         return jsonify({
-            "message": f"{updated_count} of {len(medicines_to_process)} medicines had their Min/Max stock levels updated/processed.",
+            "message": f"{updated_count} of {len(results_details)} medicines had their Min/Max stock levels updated.",
+            "updated_count": updated_count,
+            "processed_count": len(results_details),
+            "hcodes_processed": len(hcodes),
             "details": results_details
         }), 200
 
     except Error as e:
+        conn.rollback()
         logger.error(f"Database error during Min/Max calculation for hcode {hcode}: {e}", exc_info=True)
         # It's good to check e.msg as not all Error instances might have it clearly.
         error_message = getattr(e, 'msg', str(e))
         return jsonify({"error": f"Database error: {error_message}"}), 500
     except Exception as ex:
+        conn.rollback()
         logger.error(f"General error during Min/Max calculation for hcode {hcode}: {ex}", exc_info=True)
         return jsonify({"error": f"An unexpected error occurred: {str(ex)}"}), 500
+    finally:
+        cursor.close()
+        conn.close()
@@ -1,13 +1,33 @@
 # /blueprints/medicines.py
 
 from flask import Blueprint, request, jsonify
-from helpers.database import db_execute_query
+from helpers.database import db_execute_query, get_db_connection, build_in_placeholders, db_insert_many
+from helpers.search_index import get_medicine_search_index, invalidate_medicine_search_index
+from helpers.cache import cached_json_response, invalidate_clinic_stock_caches, CACHE_MEDICINES, CLINIC_AGGREGATE_TTL_SECONDS
+from helpers.data_versions import bump_data_version, get_clinic_data_etag, is_not_modified, not_modified_response, with_etag
+from helpers.change_log import record_changes, CHANGE_ENTITY_MEDICINE
 from mysql.connector import Error
 
 # สร้าง Blueprint สำหรับ medicines
 # ทุก endpoint ในไฟล์นี้จะขึ้นต้นด้วย /api/medicines
 medicine_bp = Blueprint('medicines', __name__, url_prefix='/api/medicines')
 
+# รายการยามียอดคงเหลือรวมอยู่ด้วย ETag จึงขึ้นกับทั้งข้อมูลหลักของยาและยอดคงเหลือ
+MEDICINE_LIST_DATA_SCOPES = ('medicines', 'stock')
+
+
+def _record_medicine_changes(hcode, medicine_ids, cursor):
+    """เพิ่มตัวนับ ETag และบันทึก change_log ของยาที่เปลี่ยน (เรียกใน transaction เดียวกับการเขียน)"""
+    bump_data_version(hcode, 'medicines', cursor)
+    record_changes(hcode, CHANGE_ENTITY_MEDICINE, medicine_ids, cursor)
+
+
+def _invalidate_medicine_read_models(hcode):
+    """ล้างดัชนีค้นหาและ cache ของหน่วยบริการหลัง commit การแก้ไขข้อมูลยา"""
+    invalidate_medicine_search_index(hcode)
+    invalidate_clinic_stock_caches(hcode)
+
+
 @medicine_bp.route('/', methods=['GET'])
 def get_medicines_endpoint(): 
     """
@@ -18,31 +38,41 @@ def get_medicines_endpoint():
     
     if not user_hcode: 
         return jsonify({"error": "กรุณาระบุ hcode ของหน่วยบริการ"}), 400
+
+    etag = get_clinic_data_etag(user_hcode, MEDICINE_LIST_DATA_SCOPES)
+    if is_not_modified(etag):
+        return not_modified_response(etag)
         
     query = """
         SELECT
             m.id, m.hcode, m.medicine_code, m.generic_name, m.strength, m.unit,
             m.reorder_point, m.min_stock, m.max_stock, m.lead_time_days, m.review_period_days,
             m.is_active,
-            COALESCE(inv_sum.current_stock, 0) AS total_quantity_on_hand
+            COALESCE(sb.total_on_hand, 0) AS total_quantity_on_hand
         FROM medicines m
-        LEFT JOIN (
-            SELECT medicine_id, hcode, SUM(quantity_on_hand) AS current_stock
-            FROM inventory
-            GROUP BY medicine_id, hcode
-        ) AS inv_sum ON m.id = inv_sum.medicine_id AND m.hcode = inv_sum.hcode
+        LEFT JOIN stock_balance sb ON sb.medicine_id = m.id AND sb.hcode = m.hcode
         WHERE m.hcode = %s AND m.is_active = TRUE
         ORDER BY m.generic_name
     """ 
-    medicines_data = db_execute_query(query, (user_hcode,), fetchall=True) 
-    if medicines_data is None:
-        return jsonify({"error": "ไม่สามารถดึงข้อมูลยาได้"}), 500
-    return jsonify(medicines_data)
+
+    def load_medicines():
+        medicines_data = db_execute_query(query, (user_hcode,), fetchall=True)
+        if medicines_data is None:
+            return jsonify({"error": "ไม่สามารถดึงข้อมูลยาได้"}), 500
+        return jsonify(medicines_data)
+
+    # มียอดคงเหลือรวมอยู่ในผลลัพธ์ จึงใช้ TTL ของข้อมูลสรุปและถูก invalidate เมื่อมีการรับ/จ่ายยาด้วย
+    response = cached_json_response(
+        CACHE_MEDICINES, load_medicines, hcode=user_hcode,
+        params={"etag": etag} if etag else None, ttl=CLINIC_AGGREGATE_TTL_SECONDS
+    )
+    return with_etag(response, etag)
 
 @medicine_bp.route('/search', methods=['GET'])
 def search_medicines():
     """
-    ค้นหายาด้วย medicine_code หรือ generic_name
+    ค้นหายาด้วย medicine_code หรือ generic_name จากดัชนีในหน่วยความจำ (helpers/search_index.py)
+    เรียงตามความตรงของคำค้น (รหัสตรงกัน > ขึ้นต้นรหัส > ขึ้นต้นชื่อ > ขึ้นต้นคำในชื่อ > มีคำค้นอยู่ในข้อความ)
     Query Params: term (required), hcode (required)
     """
     search_term = request.args.get('term', '')
@@ -53,27 +83,24 @@ def search_medicines():
     if not search_term or len(search_term) < 1:
         return jsonify([]) 
 
-    query = """
-        SELECT
-            m.id, m.medicine_code, m.generic_name, m.strength, m.unit,
-            m.min_stock, m.max_stock,
-            COALESCE(inv_sum.current_stock, 0) AS total_quantity_on_hand
-        FROM medicines m
-        LEFT JOIN (
-            SELECT medicine_id, hcode, SUM(quantity_on_hand) AS current_stock
-            FROM inventory
-            GROUP BY medicine_id, hcode
-        ) AS inv_sum ON m.id = inv_sum.medicine_id AND m.hcode = inv_sum.hcode
-        WHERE m.is_active = TRUE AND m.hcode = %s AND (m.medicine_code LIKE %s OR m.generic_name LIKE %s)
-        ORDER BY m.generic_name
-        LIMIT 10
-    """
-    like_term = f"%{search_term}%"
-    params = (user_hcode, like_term, like_term)
-    
-    medicines_data = db_execute_query(query, params, fetchall=True)
-    if medicines_data is None:
+    search_index = get_medicine_search_index(user_hcode)
+    if search_index is None:
+        return jsonify({"error": "เกิดข้อผิดพลาดระหว่างค้นหายา"}), 500
+    medicines_data = [dict(med) for med in search_index.search(search_term, limit=10)]
+    if not medicines_data:
+        return jsonify([])
+
+    # ยอดคงเหลืออ่านจากตาราง stock_balance (ยอดรวมที่คำนวณไว้แล้ว) ด้วย primary key เฉพาะยาที่แสดง
+    medicine_ids = [med['id'] for med in medicines_data]
+    balances = db_execute_query(
+        f"SELECT medicine_id, total_on_hand FROM stock_balance WHERE hcode = %s AND medicine_id IN ({build_in_placeholders(medicine_ids)})",
+        (user_hcode, *medicine_ids), fetchall=True
+    )
+    if balances is None:
         return jsonify({"error": "เกิดข้อผิดพลาดระหว่างค้นหายา"}), 500
+    total_by_medicine = {row['medicine_id']: row['total_on_hand'] for row in balances}
+    for med in medicines_data:
+        med['total_quantity_on_hand'] = total_by_medicine.get(med['id'], 0)
     return jsonify(medicines_data)
 
 
@@ -108,24 +135,150 @@ def add_medicine():
         data.get('lead_time_days', 0),
         data.get('review_period_days', 0)
     )
+    conn = get_db_connection()
+    if not conn: return jsonify({"error": "ไม่สามารถเชื่อมต่อฐานข้อมูลได้"}), 500
+    cursor = conn.cursor(dictionary=True)
     try:
-        new_medicine_id = db_execute_query(sql, params, commit=True, get_last_id=True)
-        if new_medicine_id:
-            created_medicine_query = """
-                SELECT id, hcode, medicine_code, generic_name, strength, unit, 
-                       reorder_point, min_stock, max_stock, lead_time_days, review_period_days, 
-                       is_active 
-                FROM medicines WHERE id = %s
-            """
-            created_medicine = db_execute_query(created_medicine_query, (new_medicine_id,), fetchone=True)
-            return jsonify({"message": "เพิ่มยาใหม่สำเร็จ", "medicine": created_medicine}), 201
-        else:
-            return jsonify({"error": "ไม่สามารถเพิ่มยาได้"}), 500
+        conn.start_transaction()
+        cursor.execute(sql, params)
+        new_medicine_id = cursor.lastrowid
+        _record_medicine_changes(hcode, [new_medicine_id], cursor)
+        conn.commit()
+        _invalidate_medicine_read_models(hcode)
+
+        created_medicine_query = """
+            SELECT id, hcode, medicine_code, generic_name, strength, unit, 
+                   reorder_point, min_stock, max_stock, lead_time_days, review_period_days, 
+                   is_active 
+            FROM medicines WHERE id = %s
+        """
+        created_medicine = db_execute_query(created_medicine_query, (new_medicine_id,), fetchone=True, cursor_to_use=cursor)
+        return jsonify({"message": "เพิ่มยาใหม่สำเร็จ", "medicine": created_medicine}), 201
     except Error as e:
+        conn.rollback()
         error_msg = getattr(e, 'msg', str(e))
         if getattr(e, 'errno', 0) == 1062:
             return jsonify({"error": f"ไม่สามารถเพิ่มยาได้: รหัสยา {data['medicine_code']} อาจมีอยู่แล้วสำหรับหน่วยบริการนี้. ({error_msg})"}), 409
         return jsonify({"error": f"เกิดข้อผิดพลาดในฐานข้อมูล: {error_msg}"}), 500
+    finally:
+        cursor.close()
+        conn.close()
+
+# จำนวนแถวสูงสุดต่อคำขอ /bulk (client แบ่งส่งเป็นชุด) และจำนวนแถวต่อคำสั่ง SQL
+MEDICINE_BULK_MAX_ROWS = 5000
+MEDICINE_BULK_BATCH_SIZE = 500
+# คอลัมน์ข้อมูลหลักที่ /bulk เขียนทับเมื่อรหัสยามีอยู่แล้ว (ไม่แตะ Min/Max และสถานะที่หน่วยบริการตั้งเอง)
+MEDICINE_BULK_UPDATE_COLUMNS = ('generic_name', 'strength', 'unit')
+
+
+def _normalize_bulk_medicine_row(row):
+    """ตรวจและแปลงแถวของ /bulk เป็น dict ของคอลัมน์ (ValueError เมื่อข้อมูลไม่ครบ)"""
+    if not isinstance(row, dict):
+        raise ValueError("รูปแบบข้อมูลไม่ถูกต้อง")
+    values = {column: (str(row[column]).strip() if row.get(column) is not None else None) for column in ('medicine_code', *MEDICINE_BULK_UPDATE_COLUMNS)}
+    missing = [column for column in ('medicine_code', 'generic_name', 'unit') if not values[column]]
+    if missing:
+        raise ValueError(f"ข้อมูลไม่ครบถ้วน, ต้องมี: {', '.join(missing)}")
+    values['strength'] = values['strength'] or None
+    return values
+
+
+def _select_medicines_by_code(hcode, medicine_codes, cursor, for_update=False):
+    """ยาของหน่วยบริการตามรหัสยา คืนค่า dict: รหัสยา (casefold ตาม collation ของตาราง) -> แถว"""
+    medicines = {}
+    for start in range(0, len(medicine_codes), MEDICINE_BULK_BATCH_SIZE):
+        batch = medicine_codes[start:start + MEDICINE_BULK_BATCH_SIZE]
+        rows = db_execute_query(
+            f"SELECT id, medicine_code, generic_name, strength, unit FROM medicines "
+            f"WHERE hcode = %s AND medicine_code IN ({build_in_placeholders(batch)}){' FOR UPDATE' if for_update else ''}",
+            (hcode, *batch), fetchall=True, cursor_to_use=cursor
+        )
+        if rows is None:
+            raise Error(msg="ไม่สามารถอ่านข้อมูลยาเดิมได้")
+        medicines.update({row['medicine_code'].casefold(): row for row in rows})
+    return medicines
+
+
+@medicine_bp.route('/bulk', methods=['POST'])
+def bulk_upsert_medicines():
+    """
+    เพิ่ม/แก้ไขข้อมูลยาหลักหลายรายการในครั้งเดียว (เช่น โหลดรายการยาจาก HOSxP ครั้งแรกด้วย IMdrug1)
+    Body: hcode, medicines: [{medicine_code, generic_name, strength, unit}]
+    รหัสยาที่มีอยู่แล้วจะถูกแก้ไขเฉพาะชื่อ/ความแรง/หน่วยนับ ทุกแถวบันทึกใน transaction เดียวด้วย INSERT ... ON DUPLICATE KEY UPDATE เป็นชุด
+    คืนค่าผลรายแถวตามลำดับที่ส่งมา: status = created | updated | unchanged | failed
+    """
+    data = request.get_json()
+    if not data or not data.get('hcode') or not isinstance(data.get('medicines'), list):
+        return jsonify({"error": "ข้อมูลไม่ครบถ้วน (ต้องการ hcode และ medicines)"}), 400
+    if len(data['medicines']) > MEDICINE_BULK_MAX_ROWS:
+        return jsonify({"error": f"ส่งได้ไม่เกิน {MEDICINE_BULK_MAX_ROWS} รายการต่อครั้ง"}), 400
+
+    hcode = data['hcode']
+    results = [None] * len(data['medicines'])
+    rows_by_code = {}
+    for index, row in enumerate(data['medicines']):
+        try:
+            values = _normalize_bulk_medicine_row(row)
+        except ValueError as e:
+            results[index] = {"index": index, "medicine_code": row.get('medicine_code') if isinstance(row, dict) else None, "status": "failed", "error": str(e)}
+            continue
+        code_key = values['medicine_code'].casefold()
+        if code_key in rows_by_code:
+            results[index] = {"index": index, "medicine_code": values['medicine_code'], "status": "failed", "error": "รหัสยาซ้ำในคำขอเดียวกัน"}
+            continue
+        rows_by_code[code_key] = (index, values)
+
+    conn = get_db_connection()
+    if not conn: return jsonify({"error": "ไม่สามารถเชื่อมต่อฐานข้อมูลได้"}), 500
+    cursor = conn.cursor(dictionary=True)
+    try:
+        conn.start_transaction()
+        existing = _select_medicines_by_code(hcode, [values['medicine_code'] for _, values in rows_by_code.values()], cursor, for_update=True)
+
+        rows_to_write, changed_ids = [], []
+        for code_key, (index, values) in rows_by_code.items():
+            current = existing.get(code_key)
+            if current and all(current[column] == values[column] for column in MEDICINE_BULK_UPDATE_COLUMNS):
+                results[index] = {"index": index, "medicine_code": values['medicine_code'], "status": "unchanged", "id": current['id']}
+                continue
+            rows_to_write.append((hcode, values['medicine_code'], values['generic_name'], values['strength'], values['unit']))
+            if current:
+                changed_ids.append(current['id'])
+                results[index] = {"index": index, "medicine_code": values['medicine_code'], "status": "updated", "id": current['id']}
+
+        db_insert_many(
+            'medicines', ['hcode', 'medicine_code', *MEDICINE_BULK_UPDATE_COLUMNS], rows_to_write, cursor,
+            batch_size=MEDICINE_BULK_BATCH_SIZE,
+            on_duplicate_sql=", ".join(f"`{column}` = VALUES(`{column}`)" for column in MEDICINE_BULK_UPDATE_COLUMNS)
+        )
+
+        created_codes = [values['medicine_code'] for code_key, (index, values) in rows_by_code.items() if code_key not in existing and results[index] is None]
+        created = _select_medicines_by_code(hcode, created_codes, cursor)
+        for code_key, (index, values) in rows_by_code.items():
+            if results[index] is None:
+                medicine_id = created.get(code_key, {}).get('id')
+                changed_ids.append(medicine_id)
+                results[index] = {"index": index, "medicine_code": values['medicine_code'], "status": "created", "id": medicine_id}
+
+        changed_ids = [medicine_id for medicine_id in changed_ids if medicine_id]
+        if changed_ids:
+            _record_medicine_changes(hcode, changed_ids, cursor)
+        conn.commit()
+        if changed_ids:
+            _invalidate_medicine_read_models(hcode)
+
+        summary = {status: sum(1 for result in results if result['status'] == status) for status in ('created', 'updated', 'unchanged', 'failed')}
+        return jsonify({
+            "message": f"เพิ่มยา {summary['created']} รายการ, แก้ไข {summary['updated']} รายการ, ไม่เปลี่ยนแปลง {summary['unchanged']} รายการ, ไม่สำเร็จ {summary['failed']} รายการ",
+            "summary": summary,
+            "results": results
+        }), 200
+    except Error as e:
+        conn.rollback()
+        return jsonify({"error": f"เกิดข้อผิดพลาดในฐานข้อมูล: {getattr(e, 'msg', str(e))}"}), 500
+    finally:
+        cursor.close()
+        conn.close()
 
 @medicine_bp.route('/<int:medicine_id>', methods=['PUT'])
 def update_medicine(medicine_id):
@@ -177,11 +330,16 @@ def update_medicine(medicine_id):
 
     query = f"UPDATE medicines SET {', '.join(update_query_parts)} WHERE id = %s AND hcode = %s"
 
+    conn = get_db_connection()
+    if not conn: return jsonify({"error": "ไม่สามารถเชื่อมต่อฐานข้อมูลได้"}), 500
+    cursor = conn.cursor(dictionary=True)
     try:
-        # Execute the update. For commit=True, db_execute_query returns None if not get_last_id.
-        # The concept of 'rows_affected' needs to come from the cursor directly if db_execute_query is not modified.
-        # For now, just execute and then re-fetch to confirm.
-        db_execute_query(query, tuple(query_params), commit=True) 
+        # แก้ไขยา บันทึก change_log และเพิ่มตัวนับ ETag ใน transaction เดียวกัน แล้วจึงอ่านค่าล่าสุดกลับไป
+        conn.start_transaction()
+        cursor.execute(query, tuple(query_params))
+        _record_medicine_changes(current_hcode, [medicine_id], cursor)
+        conn.commit()
+        _invalidate_medicine_read_models(current_hcode)
         
         # Fetch the updated medicine data to return
         updated_medicine_query = """
@@ -190,7 +348,7 @@ def update_medicine(medicine_id):
                    is_active 
             FROM medicines WHERE id = %s
         """
-        updated_medicine = db_execute_query(updated_medicine_query, (medicine_id,), fetchone=True)
+        updated_medicine = db_execute_query(updated_medicine_query, (medicine_id,), fetchone=True, cursor_to_use=cursor)
         
         if not updated_medicine: 
             # This implies the medicine_id became invalid after update, which is highly unlikely
@@ -204,10 +362,14 @@ def update_medicine(medicine_id):
         # We assume success if no exception and updated_medicine is found.
         return jsonify({"message": f"แก้ไขข้อมูลยา ID {medicine_id} สำเร็จ", "medicine": updated_medicine})
     except Error as e:
+        conn.rollback()
         error_msg = getattr(e, 'msg', str(e))
         if getattr(e, 'errno', 0) == 1062: # Duplicate entry
             return jsonify({"error": f"ไม่สามารถอัปเดตยาได้: รหัสยา '{fields_to_set['medicine_code']}' อาจมีอยู่แล้ว. ({error_msg})"}), 409
         return jsonify({"error": f"เกิดข้อผิดพลาดในฐานข้อมูลขณะอัปเดต: {error_msg}"}), 500
+    finally:
+        cursor.close()
+        conn.close()
 
 @medicine_bp.route('/<int:medicine_id>/toggle_active', methods=['PUT'])
 def toggle_medicine_active_status(medicine_id):
@@ -223,16 +385,21 @@ def toggle_medicine_active_status(medicine_id):
     is_active_bool = bool(is_active_from_request)
 
     query = "UPDATE medicines SET is_active = %s WHERE id = %s"
+    conn = get_db_connection()
+    if not conn: return jsonify({"error": "ไม่สามารถเชื่อมต่อฐานข้อมูลได้"}), 500
+    cursor = conn.cursor(dictionary=True)
     try:
-        # Execute the update. db_execute_query returns None for commit=True.
-        db_execute_query(query, (is_active_bool, medicine_id), commit=True)
+        conn.start_transaction()
+        medicine = db_execute_query("SELECT id, hcode FROM medicines WHERE id = %s FOR UPDATE", (medicine_id,), fetchone=True, cursor_to_use=cursor)
+        if not medicine:
+            conn.rollback()
+            return jsonify({"error": f"ไม่พบรายการยา ID {medicine_id}"}), 404
+        cursor.execute(query, (is_active_bool, medicine_id))
+        _record_medicine_changes(medicine['hcode'], [medicine_id], cursor)
+        conn.commit()
+        _invalidate_medicine_read_models(medicine['hcode'])
 
-        # To confirm the change or if it was already in that state, we should re-fetch or check.
-        # However, the original logic tried to use rows_affected.
-        # For now, fixing the TypeError and assuming success if no exception.
-        # A more robust check would re-fetch the status or have db_execute_query return rowcount.
-        
-        check_exists = db_execute_query("SELECT id, is_active FROM medicines WHERE id = %s", (medicine_id,), fetchone=True)
+        check_exists = db_execute_query("SELECT id, hcode, is_active FROM medicines WHERE id = %s", (medicine_id,), fetchone=True, cursor_to_use=cursor)
         if not check_exists:
             return jsonify({"error": f"ไม่พบรายการยา ID {medicine_id} หลังพยายามอัปเดตสถานะ"}), 404
 
@@ -248,5 +415,9 @@ def toggle_medicine_active_status(medicine_id):
              return jsonify({"error": f"สถานะยา ID {medicine_id} ไม่ตรงกับที่ร้องขอหลังจากการอัปเดต"}), 500
 
     except Error as e:
+        conn.rollback()
         error_msg = getattr(e, 'msg', str(e))
-        return jsonify({"error": f"เกิดข้อผิดพลาดในฐานข้อมูล: {error_msg}"}), 500
\ No newline at end of file
+        return jsonify({"error": f"เกิดข้อผิดพลาดในฐานข้อมูล: {error_msg}"}), 500
+    finally:
+        cursor.close()
+        conn.close()
\ No newline at end of file
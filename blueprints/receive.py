@@ -1,10 +1,19 @@
 # /blueprints/receive.py
 
 from flask import Blueprint, request, jsonify
-from helpers.database import db_execute_query, get_db_connection
-from helpers.utils import thai_to_iso_date, iso_to_thai_date
+from helpers.database import db_execute_query, get_db_connection, build_in_placeholders, db_insert_many
+from helpers.utils import thai_to_iso_date, iso_to_thai_date, parse_date_series, normalize_code_series
+from helpers.spreadsheet import iter_spreadsheet_batches, track_upload_memory, limit_preview_items, SpreadsheetError, UPLOAD_PREVIEW_LIMIT
+from helpers.pagination import parse_page_args, fetch_keyset_page, encode_page_cursor, page_response
+from helpers.document_numbers import next_document_number
+from helpers.medicines import fetch_active_medicines_by_code
+from helpers.stock_balance import refresh_stock_balance, record_stock_changes, invalidate_balance_snapshots
+from helpers.cache import invalidate_clinic_stock_caches
+from helpers.change_log import CHANGE_ENTITY_REQUISITION
+from helpers.migrations import register_hot_query
 from datetime import datetime
 from mysql.connector import Error
+import pandas as pd
 import logging
 
 # ตั้งค่า logging
@@ -14,11 +23,216 @@ logger = logging.getLogger(__name__)
 # สร้าง Blueprint สำหรับ goods_received
 receive_bp = Blueprint('receive', __name__, url_prefix='/api')
 
-def get_total_medicine_stock(hcode, medicine_id, cursor):
-    """ดึงยอดคงเหลือรวมของยาที่ระบุจาก inventory"""
-    stock_query = "SELECT COALESCE(SUM(quantity_on_hand), 0) as total_stock FROM inventory WHERE hcode = %s AND medicine_id = %s"
-    stock_data = db_execute_query(stock_query, (hcode, medicine_id), fetchone=True, cursor_to_use=cursor)
-    return stock_data['total_stock'] if stock_data else 0
+RECEIVE_UPLOAD_REQUIRED_COLUMNS = ['รหัสยา', 'เลขที่ล็อต', 'วันหมดอายุ', 'จำนวน']
+
+# ลบ transaction log ของการรับยาตาม lot เมื่อลบเอกสารรับยา (ค้นด้วย reference_document_id)
+DELETE_RECEIVED_TRANSACTIONS_SQL = "DELETE FROM inventory_transactions WHERE reference_document_id = %s AND medicine_id = %s AND lot_number = %s AND quantity_change > 0"
+register_hot_query("transaction log by reference document", DELETE_RECEIVED_TRANSACTIONS_SQL, ('GRV-00000-240101-001', 1, 'LOT1'))
+
+def _write_goods_received(hcode, receiver_id, header, receive_lines, cursor):
+    """
+    บันทึกเอกสารรับยาและรายการทั้งหมดแบบ batch (ผู้เรียกเป็นผู้ start_transaction/commit)
+    header: received_date_iso, voucher_number, requisition_id, supplier_name, invoice_number, remarks
+    receive_lines: list ของ dict ที่มี medicine_id, lot_number, expiry_date_iso, quantity_received, unit_price, notes
+    ยาทุกตัวต้องผ่านการตรวจสอบว่าเป็นของหน่วยบริการนี้มาแล้ว คืนค่า (voucher_id, voucher_number)
+    """
+    received_date_iso = header['received_date_iso']
+    voucher_number = header.get('voucher_number')
+    requisition_id = header.get('requisition_id')
+    medicine_ids = list(dict.fromkeys(line['medicine_id'] for line in receive_lines))
+
+    # สร้างเลขที่เอกสารอัตโนมัติหากไม่ได้รับมา
+    if not voucher_number:
+        if requisition_id:
+            req_info = db_execute_query("SELECT requisition_number FROM requisitions WHERE id = %s", (requisition_id,), fetchone=True, cursor_to_use=cursor)
+            voucher_number = f"GRN-{req_info['requisition_number']}" if req_info else f"GRN-{hcode}-{datetime.now().strftime('%y%m%d%H%M%S')}"
+        else:
+            voucher_number = next_document_number('GRN', cursor, hcode)
+
+    # เพิ่มข้อมูลลงใน goods_received_vouchers
+    sql_voucher = "INSERT INTO goods_received_vouchers (hcode, voucher_number, requisition_id, received_date, receiver_id, supplier_name, invoice_number, remarks) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)"
+    cursor.execute(sql_voucher, (hcode, voucher_number, requisition_id, received_date_iso, receiver_id, header.get('supplier_name'), header.get('invoice_number'), header.get('remarks')))
+    voucher_id = cursor.lastrowid
+
+    # ยอดคงเหลือรวมก่อนรับของยาทุกตัว แล้วไล่ยอดก่อน/หลังของแต่ละรายการในหน่วยความจำ
+    cursor.execute(
+        f"SELECT medicine_id, COALESCE(SUM(quantity_on_hand), 0) AS total_stock FROM inventory WHERE hcode = %s AND medicine_id IN ({build_in_placeholders(medicine_ids)}) GROUP BY medicine_id FOR UPDATE",
+        (hcode, *medicine_ids)
+    )
+    running_stock = {row['medicine_id']: int(row['total_stock']) for row in cursor.fetchall()}
+
+    transaction_type = 'รับเข้า-ใบเบิก' if requisition_id else 'รับเข้า-ตรง'
+    transaction_datetime_for_db = f"{received_date_iso} {datetime.now().strftime('%H:%M:%S')}"
+    item_rows, inventory_rows, transaction_rows = [], [], []
+    for line in receive_lines:
+        medicine_id, lot_number, expiry_date_iso, quantity_received = line['medicine_id'], line['lot_number'], line['expiry_date_iso'], line['quantity_received']
+        total_stock_before = running_stock.get(medicine_id, 0)
+        total_stock_after = total_stock_before + quantity_received
+        running_stock[medicine_id] = total_stock_after
+
+        item_rows.append((voucher_id, medicine_id, lot_number, expiry_date_iso, quantity_received, line.get('unit_price') or 0.00, line.get('notes')))
+        inventory_rows.append((hcode, medicine_id, lot_number, expiry_date_iso, quantity_received, received_date_iso))
+        transaction_rows.append((
+            hcode, medicine_id, lot_number, expiry_date_iso, transaction_type, quantity_received,
+            total_stock_before, total_stock_after, voucher_number or f"RECV{voucher_id}", receiver_id,
+            line.get('notes') or "รับยาเข้าคลัง", transaction_datetime_for_db
+        ))
+
+    db_insert_many(
+        'goods_received_items',
+        ['goods_received_voucher_id', 'medicine_id', 'lot_number', 'expiry_date', 'quantity_received', 'unit_price', 'notes'],
+        item_rows, cursor
+    )
+    # รวมยอดเข้ากับ Lot เดิมด้วย unique key hcode_medicine_lot_expiry_unique (Lot ใหม่จะถูกสร้างพร้อม received_date)
+    db_insert_many(
+        'inventory',
+        ['hcode', 'medicine_id', 'lot_number', 'expiry_date', 'quantity_on_hand', 'received_date'],
+        inventory_rows, cursor,
+        on_duplicate_sql="quantity_on_hand = quantity_on_hand + VALUES(quantity_on_hand)"
+    )
+    db_insert_many(
+        'inventory_transactions',
+        ['hcode', 'medicine_id', 'lot_number', 'expiry_date', 'transaction_type', 'quantity_change', 'quantity_before_transaction', 'quantity_after_transaction', 'reference_document_id', 'user_id', 'remarks', 'transaction_date'],
+        transaction_rows, cursor
+    )
+    refresh_stock_balance(hcode, medicine_ids, cursor)
+    invalidate_balance_snapshots(hcode, medicine_ids, cursor, received_date_iso)
+    # อัปเดตสถานะใบเบิกหากเป็นการรับจากใบเบิก
+    if requisition_id:
+        db_execute_query("UPDATE requisitions SET status = 'รับยาแล้ว', updated_at = NOW() WHERE id = %s AND (status = 'อนุมัติแล้ว' OR status = 'อนุมัติบางส่วน')", (requisition_id,), commit=False, cursor_to_use=cursor)
+    requisition_changes = [(hcode, CHANGE_ENTITY_REQUISITION, requisition_id)] if requisition_id and cursor.rowcount else []
+    record_stock_changes([(hcode, medicine_id) for medicine_id in medicine_ids], cursor, requisition_changes)
+    return voucher_id, voucher_number
+
+def _validate_receive_sheet(sheet_batch):
+    """
+    ตรวจสอบและแปลงข้อมูลในชีตรับยาแบบ vectorized
+    คืนค่า DataFrame ที่มีคอลัมน์ row_num, medicine_code, lot_number, expiry_date_iso, expiry_date_str,
+    quantity_received_str, quantity_received, unit_price, notes และ errors (list ของข้อความผิดพลาดของแต่ละแถว)
+    """
+    rows = pd.DataFrame(index=sheet_batch.index)
+    rows['row_num'] = sheet_batch.index
+    rows['medicine_code'] = normalize_code_series(sheet_batch['รหัสยา'])
+    rows['lot_number'] = normalize_code_series(sheet_batch['เลขที่ล็อต'])
+
+    expiry_date_iso, expiry_date_thai = parse_date_series(sheet_batch['วันหมดอายุ'])
+    raw_dates = sheet_batch['วันหมดอายุ'].astype('string').str.strip().fillna('')
+    rows['expiry_date_iso'] = expiry_date_iso
+    rows['expiry_date_str'] = expiry_date_thai.where(expiry_date_thai.notna(), raw_dates)
+
+    quantity = pd.to_numeric(sheet_batch['จำนวน'], errors='coerce')
+    is_whole_number = quantity.notna() & (quantity == quantity.round())
+    rows['quantity_received_str'] = normalize_code_series(sheet_batch['จำนวน'])
+    rows['quantity_received'] = quantity.where(is_whole_number).astype('Int64')
+
+    unit_price = pd.to_numeric(sheet_batch['ราคาต่อหน่วย'], errors='coerce') if 'ราคาต่อหน่วย' in sheet_batch.columns else pd.Series(0.0, index=sheet_batch.index)
+    rows['unit_price'] = unit_price.fillna(0.0).astype(float)
+    if 'หมายเหตุ' in sheet_batch.columns:
+        notes = sheet_batch['หมายเหตุ'].astype('string').str.strip()
+        rows['notes'] = notes.astype(object).where(notes.notna() & (notes != ''), None)
+    else:
+        rows['notes'] = None
+
+    code_missing = rows['medicine_code'] == ''
+    lot_missing = rows['lot_number'] == ''
+    date_error = rows['expiry_date_iso'].isna()
+    quantity_not_number = ~is_whole_number
+    quantity_not_positive = is_whole_number & (quantity <= 0)
+    rows['errors'] = [
+        [message for flag, message in (
+            (no_code, "ไม่ได้ระบุรหัสยา"),
+            (no_lot, "ไม่ได้ระบุเลขที่ล็อต"),
+            (bad_date, "รูปแบบวันหมดอายุไม่ถูกต้อง (ต้องเป็น dd/mm/yyyy พ.ศ. หรือ YYYY-MM-DD ค.ศ.)"),
+            (bad_number, "จำนวนต้องเป็นตัวเลข"),
+            (not_positive, "จำนวนต้องมากกว่า 0"),
+        ) if flag]
+        for no_code, no_lot, bad_date, bad_number, not_positive in zip(code_missing, lot_missing, date_error, quantity_not_number, quantity_not_positive)
+    ]
+    return rows
+
+def _fetch_existing_lots(hcode, medicine_ids, cursor):
+    """Lot ที่มีอยู่แล้วในคลังของยาที่ระบุ (query เดียว) คืนค่า dict: (medicine_id, lot_number, expiry_date ISO) -> quantity_on_hand"""
+    medicine_ids = list(dict.fromkeys(medicine_ids))
+    if not medicine_ids:
+        return {}
+    cursor.execute(
+        f"SELECT medicine_id, lot_number, expiry_date, quantity_on_hand FROM inventory WHERE hcode = %s AND medicine_id IN ({build_in_placeholders(medicine_ids)})",
+        (hcode, *medicine_ids)
+    )
+    return {(lot['medicine_id'], lot['lot_number'], str(lot['expiry_date'])): lot['quantity_on_hand'] for lot in cursor.fetchall()}
+
+def _build_receive_upload_items(sheet_batches, hcode, cursor):
+    """
+    แปลงไฟล์รับยาที่อ่านทีละชุดเป็นรายการ preview/บันทึก
+    ต่อชุด: ตรวจสอบแบบ vectorized แล้วดึงยาเฉพาะรหัสที่ยังไม่เคยดึงด้วย IN (...)
+    สุดท้ายดึง Lot เดิมของยาทั้งหมดครั้งเดียว เพื่อบอกว่าแต่ละแถวจะรวมเข้ากับ Lot เดิมหรือสร้าง Lot ใหม่
+    """
+    medicines_by_code = {}
+    upload_items = []
+    for sheet_batch in sheet_batches:
+        rows = _validate_receive_sheet(sheet_batch)
+        new_codes = [code for code in rows['medicine_code'].unique() if code not in medicines_by_code]
+        medicines_by_code.update(fetch_active_medicines_by_code(hcode, new_codes, cursor))
+
+        for row in rows.to_dict('records'):
+            upload_item = {
+                "row_num": int(row['row_num']),
+                "medicine_code": row['medicine_code'],
+                "lot_number": row['lot_number'],
+                "expiry_date_iso": row['expiry_date_iso'],
+                "expiry_date_str": row['expiry_date_str'],
+                "quantity_received_str": row['quantity_received_str'],
+                "unit_price": row['unit_price'],
+                "notes": row['notes'],
+                "medicine_name": "N/A",
+                "unit": "N/A",
+                "status": "รอตรวจสอบ",
+                "errors": row['errors'],
+            }
+            if not pd.isna(row['quantity_received']):
+                upload_item["quantity_received"] = int(row['quantity_received'])
+            if not upload_item["errors"]:
+                medicine_info = medicines_by_code.get(upload_item["medicine_code"])
+                if medicine_info:
+                    upload_item["medicine_id"] = medicine_info['id']
+                    upload_item["medicine_name"] = f"{medicine_info['generic_name']} ({medicine_info['strength'] or 'N/A'})"
+                    upload_item["unit"] = medicine_info['unit']
+                else:
+                    upload_item["errors"].append(f"ไม่พบรหัสยา '{upload_item['medicine_code']}' หรือยาไม่ถูกเปิดใช้งาน สำหรับหน่วยบริการ {hcode}")
+            upload_items.append(upload_item)
+
+    valid_items = [item for item in upload_items if not item["errors"]]
+    existing_lots = _fetch_existing_lots(hcode, [item["medicine_id"] for item in valid_items], cursor)
+    seen_in_file = set()
+    for upload_item in valid_items:
+        lot_key = (upload_item["medicine_id"], upload_item["lot_number"], upload_item["expiry_date_iso"])
+        if lot_key in existing_lots:
+            upload_item["existing_quantity"] = existing_lots[lot_key]
+            upload_item["status"] = f"รวมกับ Lot เดิม (คงเหลือ {existing_lots[lot_key]})"
+        elif lot_key in seen_in_file:
+            upload_item["status"] = "รวมกับแถวก่อนหน้าในไฟล์ (Lot ใหม่)"
+        else:
+            upload_item["status"] = "Lot ใหม่"
+        seen_in_file.add(lot_key)
+
+    for upload_item in upload_items:
+        if upload_item["errors"]:
+            upload_item["status"] = "มีข้อผิดพลาด"
+    return upload_items
+
+def _summarize_receive_upload(upload_items):
+    """สรุปจำนวนรายการของไฟล์รับยา แยก Lot ใหม่/Lot เดิม/มีข้อผิดพลาด"""
+    summary = {"total_rows": len(upload_items), "new_lots": 0, "merged_lots": 0, "error_rows": 0, "total_quantity": 0}
+    for upload_item in upload_items:
+        if upload_item["errors"]:
+            summary["error_rows"] += 1
+            continue
+        summary["total_quantity"] += upload_item["quantity_received"]
+        if "existing_quantity" in upload_item:
+            summary["merged_lots"] += 1
+        else:
+            summary["new_lots"] += 1
+    return summary
 
 @receive_bp.route('/goods_received', methods=['POST'])
 def add_goods_received():
@@ -43,42 +257,17 @@ def add_goods_received():
             conn.rollback()
             return jsonify({"error": "รูปแบบวันที่รับยาไม่ถูกต้อง"}), 400
 
-        voucher_number = data.get('voucher_number')
-        requisition_id = data.get('requisition_id')
-
-        # สร้างเลขที่เอกสารอัตโนมัติหากไม่ได้รับมา
-        if not voucher_number:
-            if requisition_id:
-                req_info = db_execute_query("SELECT requisition_number FROM requisitions WHERE id = %s", (requisition_id,), fetchone=True, cursor_to_use=cursor)
-                voucher_number = f"GRN-{req_info['requisition_number']}" if req_info else f"GRN-{hcode}-{datetime.now().strftime('%y%m%d%H%M%S')}"
-            else:
-                current_date_str = datetime.now().strftime('%y%m%d')
-                cursor.execute("SELECT voucher_number FROM goods_received_vouchers WHERE hcode = %s AND voucher_number LIKE %s ORDER BY id DESC LIMIT 1", (hcode, f"GRN-{hcode}-{current_date_str}-%",))
-                last_voucher = cursor.fetchone()
-                next_seq = 1
-                if last_voucher:
-                    try:
-                        next_seq = int(last_voucher['voucher_number'].split('-')[-1]) + 1
-                    except (IndexError, ValueError):
-                        pass
-                voucher_number = f"GRN-{hcode}-{current_date_str}-{next_seq:03d}"
-
-        # เพิ่มข้อมูลลงใน goods_received_vouchers
-        sql_voucher = "INSERT INTO goods_received_vouchers (hcode, voucher_number, requisition_id, received_date, receiver_id, supplier_name, invoice_number, remarks) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)"
-        cursor.execute(sql_voucher, (hcode, voucher_number, requisition_id, received_date_iso, receiver_id, data.get('supplier_name'), data.get('invoice_number'), data.get('remarks')))
-        voucher_id = cursor.lastrowid
-
         if not data.get('items') or not isinstance(data['items'], list) or len(data['items']) == 0:
             conn.rollback()
             return jsonify({"error": "ต้องมีรายการยาอย่างน้อย 1 รายการสำหรับการรับยา"}), 400
 
-        # วนลูปเพื่อจัดการแต่ละรายการยา
+        # ตรวจสอบทุกรายการก่อนเขียนข้อมูล
+        receive_lines = []
         for item in data['items']:
             if not all(k in item for k in ['medicine_id', 'lot_number', 'expiry_date', 'quantity_received']):
                 conn.rollback()
                 return jsonify({"error": f"ข้อมูลรายการยาที่รับไม่ครบถ้วน: {item}"}), 400
 
-            medicine_id, lot_number = item['medicine_id'], item['lot_number']
             expiry_date_iso = thai_to_iso_date(item['expiry_date'])
             if not expiry_date_iso:
                 conn.rollback()
@@ -88,48 +277,36 @@ def add_goods_received():
             if quantity_received <= 0:
                 conn.rollback()
                 return jsonify({"error": "จำนวนที่รับต้องมากกว่า 0"}), 400
-
-            # ตรวจสอบว่ายาที่รับมีอยู่ใน master data ของหน่วยบริการนั้นหรือไม่
-            if not db_execute_query("SELECT id FROM medicines WHERE id = %s AND hcode = %s", (medicine_id, hcode), fetchone=True, cursor_to_use=cursor):
-                conn.rollback()
-                return jsonify({"error": f"ไม่พบรหัสยา {medicine_id} สำหรับหน่วยบริการ {hcode}"}), 400
-
-            # เพิ่มรายการยาที่รับ
-            cursor.execute("INSERT INTO goods_received_items (goods_received_voucher_id, medicine_id, lot_number, expiry_date, quantity_received, unit_price, notes) VALUES (%s, %s, %s, %s, %s, %s, %s)",
-                           (voucher_id, medicine_id, lot_number, expiry_date_iso, quantity_received, item.get('unit_price', 0.00), item.get('notes')))
-
-            # อัปเดตคลัง (Inventory) และสร้าง Transaction Log
-            total_stock_before = get_total_medicine_stock(hcode, medicine_id, cursor)
-
-            inv_item = db_execute_query("SELECT id FROM inventory WHERE hcode = %s AND medicine_id = %s AND lot_number = %s AND expiry_date = %s", (hcode, medicine_id, lot_number, expiry_date_iso), fetchone=True, cursor_to_use=cursor)
-            if inv_item:
-                cursor.execute("UPDATE inventory SET quantity_on_hand = quantity_on_hand + %s WHERE id = %s", (quantity_received, inv_item['id']))
-            else:
-                cursor.execute("INSERT INTO inventory (hcode, medicine_id, lot_number, expiry_date, quantity_on_hand, received_date) VALUES (%s, %s, %s, %s, %s, %s)", (hcode, medicine_id, lot_number, expiry_date_iso, quantity_received, received_date_iso))
-
-            total_stock_after = get_total_medicine_stock(hcode, medicine_id, cursor)
-            
-            transaction_type = 'รับเข้า-ใบเบิก' if requisition_id else 'รับเข้า-ตรง'            
-            transaction_datetime_for_db = f"{received_date_iso} {datetime.now().strftime('%H:%M:%S')}"
-            
-            # เปลี่ยนการใช้ NOW() มาเป็นตัวแปรที่เราสร้างขึ้น
-            sql_transaction = """
-                INSERT INTO inventory_transactions 
-                (hcode, medicine_id, lot_number, expiry_date, transaction_type, quantity_change, 
-                quantity_before_transaction, quantity_after_transaction, reference_document_id, user_id, remarks, transaction_date) 
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            """
-            params_transaction = (
-                hcode, medicine_id, lot_number, expiry_date_iso, transaction_type, quantity_received, 
-                total_stock_before, total_stock_after, voucher_number or f"RECV{voucher_id}", receiver_id, 
-                item.get('notes', "รับยาเข้าคลัง"), transaction_datetime_for_db
-            )
-            cursor.execute(sql_transaction, params_transaction)
-        # อัปเดตสถานะใบเบิกหากเป็นการรับจากใบเบิก
-        if requisition_id:
-            db_execute_query("UPDATE requisitions SET status = 'รับยาแล้ว', updated_at = NOW() WHERE id = %s AND (status = 'อนุมัติแล้ว' OR status = 'อนุมัติบางส่วน')", (requisition_id,), commit=False, cursor_to_use=cursor)
+            receive_lines.append({
+                "medicine_id": int(item['medicine_id']),
+                "lot_number": item['lot_number'],
+                "expiry_date_iso": expiry_date_iso,
+                "quantity_received": quantity_received,
+                "unit_price": item.get('unit_price', 0.00),
+                "notes": item.get('notes'),
+            })
+
+        # ตรวจสอบว่ายาที่รับมีอยู่ใน master data ของหน่วยบริการนั้นหรือไม่ (คำสั่งเดียวสำหรับทุกรายการ)
+        medicine_ids = list(dict.fromkeys(line['medicine_id'] for line in receive_lines))
+        cursor.execute(f"SELECT id FROM medicines WHERE hcode = %s AND id IN ({build_in_placeholders(medicine_ids)})", (hcode, *medicine_ids))
+        known_medicine_ids = {row['id'] for row in cursor.fetchall()}
+        unknown_medicine_ids = [medicine_id for medicine_id in medicine_ids if medicine_id not in known_medicine_ids]
+        if unknown_medicine_ids:
+            conn.rollback()
+            return jsonify({"error": f"ไม่พบรหัสยา {unknown_medicine_ids[0]} สำหรับหน่วยบริการ {hcode}"}), 400
+
+        header = {
+            "received_date_iso": received_date_iso,
+            "voucher_number": data.get('voucher_number'),
+            "requisition_id": data.get('requisition_id'),
+            "supplier_name": data.get('supplier_name'),
+            "invoice_number": data.get('invoice_number'),
+            "remarks": data.get('remarks'),
+        }
+        voucher_id, voucher_number = _write_goods_received(hcode, receiver_id, header, receive_lines, cursor)
 
         conn.commit()
+        invalidate_clinic_stock_caches(hcode)
         return jsonify({"message": "บันทึกการรับยาเข้าคลังสำเร็จ", "voucher_id": voucher_id, "voucher_number": voucher_number}), 201
 
     except Error as e:
@@ -145,6 +322,134 @@ def add_goods_received():
         if conn: conn.close()
 
 
+@receive_bp.route('/goods_received/upload/preview', methods=['POST'])
+def goods_received_upload_preview():
+    """
+    ตรวจสอบไฟล์รับยาจากผู้ขาย (Excel/CSV) ก่อนบันทึก
+    คอลัมน์ที่ต้องมี: รหัสยา, เลขที่ล็อต, วันหมดอายุ, จำนวน / คอลัมน์เพิ่มเติม: ราคาต่อหน่วย, หมายเหตุ
+    Form: file, hcode, preview_limit (optional, ค่าเริ่มต้น UPLOAD_PREVIEW_LIMIT)
+    """
+    if 'file' not in request.files:
+        return jsonify({"error": "ไม่พบไฟล์ที่อัปโหลด"}), 400
+    file = request.files['file']
+    if file.filename == '':
+        return jsonify({"error": "ไม่ได้เลือกไฟล์"}), 400
+
+    hcode = request.form.get('hcode')
+    if not hcode:
+        return jsonify({"error": "กรุณาระบุ hcode"}), 400
+    try:
+        preview_limit = int(request.form.get('preview_limit') or UPLOAD_PREVIEW_LIMIT)
+    except ValueError:
+        return jsonify({"error": "preview_limit ต้องเป็นตัวเลข"}), 400
+
+    conn = None
+    cursor = None
+    try:
+        with track_upload_memory() as memory_tracker:
+            conn = get_db_connection()
+            if not conn: return jsonify({"error": "ไม่สามารถเชื่อมต่อฐานข้อมูลได้"}), 500
+            cursor = conn.cursor(dictionary=True)
+
+            sheet_batches = iter_spreadsheet_batches(file, RECEIVE_UPLOAD_REQUIRED_COLUMNS)
+            upload_items = _build_receive_upload_items(sheet_batches, hcode, cursor)
+            if not upload_items:
+                return jsonify({"error": "ไฟล์ไม่มีข้อมูล"}), 400
+
+            response = {"summary": _summarize_receive_upload(upload_items)}
+            response["preview_items"], response["preview_truncated"] = limit_preview_items(upload_items, preview_limit)
+            if memory_tracker.peak_memory_mb is not None:
+                response["peak_memory_mb"] = memory_tracker.peak_memory_mb
+            return jsonify(response), 200
+
+    except SpreadsheetError as e:
+        return jsonify({"error": str(e)}), e.status_code
+    except Exception as e:
+        logger.error(f"Error processing goods received upload preview: {str(e)}", exc_info=True)
+        return jsonify({"error": f"เกิดข้อผิดพลาดในการประมวลผลไฟล์: {str(e)}"}), 500
+    finally:
+        if cursor: cursor.close()
+        if conn: conn.close()
+
+
+@receive_bp.route('/goods_received/upload/process', methods=['POST'])
+def goods_received_upload_process():
+    """
+    บันทึกการรับยาจากไฟล์ของผู้ขายเป็นเอกสารรับยาหนึ่งใบ ใน transaction เดียว
+    Form: file, hcode, receiver_id, received_date, supplier_name, invoice_number, remarks, voucher_number (optional)
+    หากมีแถวใดผิดพลาดจะไม่บันทึกเลย และคืนรายการแถวที่ผิดพลาดใน failed_rows
+    """
+    if 'file' not in request.files:
+        return jsonify({"error": "ไม่พบไฟล์ที่อัปโหลด"}), 400
+    file = request.files['file']
+    if file.filename == '':
+        return jsonify({"error": "ไม่ได้เลือกไฟล์"}), 400
+
+    data = request.form.to_dict()
+    if not all(data.get(k) for k in ['received_date', 'receiver_id', 'hcode']):
+        return jsonify({"error": "ข้อมูลไม่ครบถ้วน (ต้องการ received_date, receiver_id, hcode)"}), 400
+    received_date_iso = thai_to_iso_date(data['received_date'])
+    if not received_date_iso:
+        return jsonify({"error": "รูปแบบวันที่รับยาไม่ถูกต้อง"}), 400
+    hcode = data['hcode']
+
+    conn = None
+    cursor = None
+    try:
+        with track_upload_memory() as memory_tracker:
+            conn = get_db_connection()
+            if not conn: return jsonify({"error": "ไม่สามารถเชื่อมต่อฐานข้อมูลได้"}), 500
+            cursor = conn.cursor(dictionary=True)
+
+            sheet_batches = iter_spreadsheet_batches(file, RECEIVE_UPLOAD_REQUIRED_COLUMNS)
+            upload_items = _build_receive_upload_items(sheet_batches, hcode, cursor)
+            if not upload_items:
+                return jsonify({"error": "ไฟล์ไม่มีข้อมูล"}), 400
+            failed_rows = [
+                {"row_num": item["row_num"], "medicine_code": item["medicine_code"], "lot_number": item["lot_number"], "error": ", ".join(item["errors"])}
+                for item in upload_items if item["errors"]
+            ]
+            if failed_rows:
+                return jsonify({"error": f"ไฟล์มีข้อผิดพลาด {len(failed_rows)} แถว กรุณาแก้ไขแล้วอัปโหลดใหม่", "failed_rows": failed_rows}), 400
+
+            header = {
+                "received_date_iso": received_date_iso,
+                "voucher_number": data.get('voucher_number'),
+                "requisition_id": None,
+                "supplier_name": data.get('supplier_name'),
+                "invoice_number": data.get('invoice_number'),
+                "remarks": data.get('remarks'),
+            }
+            conn.rollback()  # ปิด read snapshot ของการตรวจสอบไฟล์ก่อนเริ่ม transaction ที่เขียน
+            conn.start_transaction()
+            voucher_id, voucher_number = _write_goods_received(hcode, data['receiver_id'], header, upload_items, cursor)
+            conn.commit()
+            invalidate_clinic_stock_caches(hcode)
+            response = {
+                "message": f"บันทึกการรับยาจากไฟล์สำเร็จ {len(upload_items)} รายการ",
+                "voucher_id": voucher_id,
+                "voucher_number": voucher_number,
+                "summary": _summarize_receive_upload(upload_items),
+            }
+            if memory_tracker.peak_memory_mb is not None:
+                response["peak_memory_mb"] = memory_tracker.peak_memory_mb
+            return jsonify(response), 201
+
+    except SpreadsheetError as e:
+        return jsonify({"error": str(e)}), e.status_code
+    except Error as e:
+        if conn: conn.rollback()
+        logger.error(f"Database error in goods_received_upload_process: {e}", exc_info=True)
+        return jsonify({"error": f"Database error: {e}"}), 500
+    except Exception as e:
+        if conn: conn.rollback()
+        logger.error(f"Error processing goods received upload: {str(e)}", exc_info=True)
+        return jsonify({"error": f"เกิดข้อผิดพลาดในการประมวลผลไฟล์: {str(e)}"}), 500
+    finally:
+        if cursor: cursor.close()
+        if conn: conn.close()
+
+
 @receive_bp.route('/goods_received_vouchers', methods=['GET'])
 def get_goods_received_vouchers():
     """
@@ -183,18 +488,21 @@ def get_goods_received_vouchers():
         conditions.append("grv.received_date <= %s")
         params.append(end_date_iso)
 
-    if conditions:
-        query += " WHERE " + " AND ".join(conditions)
-
-    query += " ORDER BY grv.received_date DESC, grv.id DESC"
-    vouchers = db_execute_query(query, tuple(params) if params else None, fetchall=True)
+    try:
+        page = parse_page_args(request.args)
+        vouchers, next_cursor_values, total = fetch_keyset_page(
+            query, conditions, params, [("grv.received_date", "received_date"), ("grv.id", "id")], page,
+            count_sql="SELECT COUNT(*) AS total FROM goods_received_vouchers grv"
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
     if vouchers is None:
         return jsonify({"error": "ไม่สามารถดึงข้อมูลการรับยาได้"}), 500
 
     for voucher in vouchers:
         voucher['received_date'] = iso_to_thai_date(voucher['received_date'])
-    return jsonify(vouchers)
+    return page_response(vouchers, encode_page_cursor(next_cursor_values) if next_cursor_values else None, total, page)
 
 
 @receive_bp.route('/goods_received_vouchers/<int:voucher_id>', methods=['GET'])
@@ -288,13 +596,18 @@ def delete_manual_goods_received_voucher(voucher_id):
             db_execute_query("UPDATE inventory SET quantity_on_hand = quantity_on_hand - %s WHERE hcode = %s AND medicine_id = %s AND lot_number = %s AND expiry_date = %s",
                              (item['quantity_received'], voucher['hcode'], item['medicine_id'], item['lot_number'], item['expiry_date']), commit=False, cursor_to_use=cursor)
             # ลบ transaction log เดิม
-            db_execute_query("DELETE FROM inventory_transactions WHERE reference_document_id = %s AND medicine_id = %s AND lot_number = %s AND quantity_change > 0",
+            db_execute_query(DELETE_RECEIVED_TRANSACTIONS_SQL,
                              (voucher['voucher_number'], item['medicine_id'], item['lot_number']), commit=False, cursor_to_use=cursor)
 
+        refresh_stock_balance(voucher['hcode'], [item['medicine_id'] for item in received_items], cursor)
+        invalidate_balance_snapshots(voucher['hcode'], [item['medicine_id'] for item in received_items], cursor, voucher['received_date'])
+
         # ลบข้อมูล
         db_execute_query("DELETE FROM goods_received_items WHERE goods_received_voucher_id = %s", (voucher_id,), commit=False, cursor_to_use=cursor)
         db_execute_query("DELETE FROM goods_received_vouchers WHERE id = %s", (voucher_id,), commit=False, cursor_to_use=cursor)
+        record_stock_changes([(voucher['hcode'], item['medicine_id']) for item in received_items], cursor)
         conn.commit()
+        invalidate_clinic_stock_caches(voucher['hcode'])
         return jsonify({"message": f"ลบเอกสารรับยา (กรอกเอง) ID {voucher_id} และคืนสต็อกเรียบร้อยแล้ว"})
     except Error as e:
         if conn: conn.rollback()
@@ -1,9 +1,12 @@
 # /blueprints/requisitions.py
 
 from flask import Blueprint, request, jsonify
-from helpers.database import db_execute_query, get_db_connection
+from helpers.database import db_execute_query, get_db_connection, build_in_placeholders, db_insert_many, db_update_many_by_id
 from helpers.utils import thai_to_iso_date, iso_to_thai_date
-from datetime import datetime
+from helpers.pagination import parse_page_args, fetch_keyset_page, build_keyset_query, first_page, encode_page_cursor, page_response
+from helpers.document_numbers import next_document_number
+from helpers.change_log import record_changes, record_changes_by_hcode, CHANGE_ENTITY_REQUISITION
+from helpers.migrations import register_hot_query
 from mysql.connector import Error
 import math # Added for math.ceil
 
@@ -11,31 +14,73 @@ import math # Added for math.ceil
 requisition_bp = Blueprint('requisitions', __name__, url_prefix='/api/requisitions')
 
 
-@requisition_bp.route('/', methods=['GET'])
-def get_requisitions():
-    """
-    ดึงข้อมูลใบเบิกทั้งหมดตามเงื่อนไข
-    Query Params: startDate, endDate, hcode, role
-    """
-    start_date_thai = request.args.get('startDate')
-    end_date_thai = request.args.get('endDate')
-    user_hcode = request.args.get('hcode')
-    user_role = request.args.get('role')
+REQUISITIONS_SELECT = """
+    SELECT
+        r.id, r.requisition_number, r.requisition_date,
+        u_requester.full_name as requester_name,
+        us.name as requester_hospital_name,
+        r.requester_hcode, r.status, r.approval_date,
+        u_approver.full_name as approved_by_name
+    FROM requisitions r
+    JOIN users u_requester ON r.requester_id = u_requester.id
+    LEFT JOIN unitservice us ON r.requester_hcode = us.hcode
+    LEFT JOIN users u_approver ON r.approved_by_id = u_approver.id
+"""
+REQUISITIONS_ORDER_COLUMNS = [("r.requisition_date", "requisition_date"), ("r.id", "id")]
+
+
+def _requisition_date_filters(start_date_thai, end_date_thai):
+    """เงื่อนไขช่วงวันที่เบิก (วันที่ที่แปลงไม่ได้ไม่ใช้กรอง)"""
+    conditions, params = [], []
+    if start_date_thai:
+        start_date_iso = thai_to_iso_date(start_date_thai)
+        if start_date_iso:
+            conditions.append("r.requisition_date >= %s")
+            params.append(start_date_iso)
+    if end_date_thai:
+        end_date_iso = thai_to_iso_date(end_date_thai)
+        if end_date_iso:
+            conditions.append("r.requisition_date <= %s")
+            params.append(end_date_iso)
+    return conditions, params
+
 
+def _pending_requisitions_query(conditions, params):
+    """SQL และพารามิเตอร์ของใบเบิกที่รออนุมัติ เรียงจากเก่าไปใหม่"""
     query = """
         SELECT
             r.id, r.requisition_number, r.requisition_date,
-            u_requester.full_name as requester_name,
+            u.full_name as requester_name,
             us.name as requester_hospital_name,
-            r.requester_hcode, r.status, r.approval_date,
-            u_approver.full_name as approved_by_name
+            r.requester_hcode,
+            (SELECT COUNT(*) FROM requisition_items ri WHERE ri.requisition_id = r.id) as item_count,
+            r.status
         FROM requisitions r
-        JOIN users u_requester ON r.requester_id = u_requester.id
+        JOIN users u ON r.requester_id = u.id
         LEFT JOIN unitservice us ON r.requester_hcode = us.hcode
-        LEFT JOIN users u_approver ON r.approved_by_id = u_approver.id
+        WHERE r.status = 'รออนุมัติ'
+    """
+    if conditions:
+        query += " AND " + " AND ".join(conditions)
+    query += " ORDER BY r.requisition_date ASC, r.id ASC"
+    return query, params
+
+
+register_hot_query("requisitions list", *build_keyset_query(
+    REQUISITIONS_SELECT, ["r.requester_hcode = %s"], ['00000'], REQUISITIONS_ORDER_COLUMNS, first_page()
+))
+register_hot_query("pending requisitions", *_pending_requisitions_query(*_requisition_date_filters('01/01/2567', '31/01/2567')))
+
+
+@requisition_bp.route('/', methods=['GET'])
+def get_requisitions():
+    """
+    ดึงข้อมูลใบเบิกทั้งหมดตามเงื่อนไข
+    Query Params: startDate, endDate, hcode, role
     """
-    params = []
-    conditions = []
+    user_hcode = request.args.get('hcode')
+    user_role = request.args.get('role')
+    conditions, params = [], []
 
     if user_role == 'เจ้าหน้าที่ รพสต.' and user_hcode:
         conditions.append("r.requester_hcode = %s")
@@ -44,23 +89,18 @@ def get_requisitions():
         conditions.append("r.requester_hcode = %s")
         params.append(user_hcode)
 
-    if start_date_thai:
-        start_date_iso = thai_to_iso_date(start_date_thai)
-        if start_date_iso:
-            conditions.append("r.requisition_date >= %s")
-            params.append(start_date_iso)
-    if end_date_thai:
-        end_date_iso = thai_to_iso_date(end_date_thai)
-        if end_date_iso:
-            conditions.append("r.requisition_date <= %s")
-            params.append(end_date_iso)
-
-    if conditions:
-        query += " WHERE " + " AND ".join(conditions)
-
-    query += " ORDER BY r.requisition_date DESC, r.id DESC"
+    date_conditions, date_params = _requisition_date_filters(request.args.get('startDate'), request.args.get('endDate'))
+    conditions.extend(date_conditions)
+    params.extend(date_params)
 
-    requisitions_data = db_execute_query(query, tuple(params) if params else None, fetchall=True)
+    try:
+        page = parse_page_args(request.args)
+        requisitions_data, next_cursor_values, total = fetch_keyset_page(
+            REQUISITIONS_SELECT, conditions, params, REQUISITIONS_ORDER_COLUMNS, page,
+            count_sql="SELECT COUNT(*) AS total FROM requisitions r"
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
     if requisitions_data is None:
         return jsonify({"error": "ไม่สามารถดึงข้อมูลใบเบิกได้"}), 500
@@ -68,7 +108,7 @@ def get_requisitions():
     for req_item in requisitions_data:
         req_item['requisition_date'] = iso_to_thai_date(req_item.get('requisition_date'))
         req_item['approval_date'] = iso_to_thai_date(req_item.get('approval_date'))
-    return jsonify(requisitions_data)
+    return page_response(requisitions_data, encode_page_cursor(next_cursor_values) if next_cursor_values else None, total, page)
 
 
 @requisition_bp.route('/', methods=['POST'])
@@ -96,34 +136,37 @@ def create_requisition():
 
     try:
         conn.start_transaction()
-        current_date_str = datetime.now().strftime('%Y%m%d')
-        cursor.execute("SELECT requisition_number FROM requisitions WHERE requisition_number LIKE %s ORDER BY id DESC LIMIT 1", (f"REQ-{current_date_str}-%",))
-        last_req = cursor.fetchone()
-        next_seq = 1
-        if last_req:
-            try:
-                next_seq = int(last_req['requisition_number'].split('-')[-1]) + 1
-            except (IndexError, ValueError):
-                pass
-
-        requisition_number = f"REQ-{current_date_str}-{next_seq:04d}"
-
-        sql_requisition = "INSERT INTO requisitions (requisition_number, requisition_date, requester_id, requester_hcode, status, remarks) VALUES (%s, %s, %s, %s, %s, %s)"
-        cursor.execute(sql_requisition, (requisition_number, requisition_date_iso, requester_id, requester_hcode, 'รออนุมัติ', data.get('remarks', '')))
-        requisition_id = cursor.lastrowid
-
-        sql_requisition_item = "INSERT INTO requisition_items (requisition_id, medicine_id, quantity_requested) VALUES (%s, %s, %s)"
         for item in data['items']:
             if not item.get('medicine_id') or not item.get('quantity_requested'):
                 conn.rollback()
                 return jsonify({"error": "ข้อมูลรายการยาในใบเบิกไม่ครบถ้วน"}), 400
 
-            med_check = db_execute_query("SELECT id FROM medicines WHERE id = %s AND hcode = %s", (item['medicine_id'], requester_hcode), fetchone=True, cursor_to_use=cursor)
-            if not med_check:
-                conn.rollback()
-                return jsonify({"error": f"ไม่พบรหัสยา {item['medicine_id']} สำหรับหน่วยบริการ {requester_hcode} ของผู้ขอเบิก"}), 400
+        try:
+            medicine_ids = list(dict.fromkeys(int(item['medicine_id']) for item in data['items']))
+        except (TypeError, ValueError):
+            conn.rollback()
+            return jsonify({"error": "รหัสยาในใบเบิกต้องเป็นตัวเลข"}), 400
+
+        # ตรวจสอบยาทุกรายการว่าเป็นของหน่วยบริการผู้ขอเบิกด้วย query เดียว
+        cursor.execute(f"SELECT id FROM medicines WHERE hcode = %s AND id IN ({build_in_placeholders(medicine_ids)})", (requester_hcode, *medicine_ids))
+        known_medicine_ids = {row['id'] for row in cursor.fetchall()}
+        unknown_medicine_ids = [medicine_id for medicine_id in medicine_ids if medicine_id not in known_medicine_ids]
+        if unknown_medicine_ids:
+            conn.rollback()
+            return jsonify({"error": f"ไม่พบรหัสยา {unknown_medicine_ids[0]} สำหรับหน่วยบริการ {requester_hcode} ของผู้ขอเบิก"}), 400
+
+        requisition_number = next_document_number('REQ', cursor)
+
+        sql_requisition = "INSERT INTO requisitions (requisition_number, requisition_date, requester_id, requester_hcode, status, remarks) VALUES (%s, %s, %s, %s, %s, %s)"
+        cursor.execute(sql_requisition, (requisition_number, requisition_date_iso, requester_id, requester_hcode, 'รออนุมัติ', data.get('remarks', '')))
+        requisition_id = cursor.lastrowid
 
-            cursor.execute(sql_requisition_item, (requisition_id, item['medicine_id'], item['quantity_requested']))
+        db_insert_many(
+            'requisition_items', ['requisition_id', 'medicine_id', 'quantity_requested'],
+            [(requisition_id, int(item['medicine_id']), item['quantity_requested']) for item in data['items']],
+            cursor
+        )
+        record_changes(requester_hcode, CHANGE_ENTITY_REQUISITION, [requisition_id], cursor)
 
         conn.commit()
         return jsonify({"message": "สร้างใบเบิกยาสำเร็จ", "requisition_id": requisition_id, "requisition_number": requisition_number}), 201
@@ -173,40 +216,7 @@ def get_pending_approval_requisitions():
     """
     ดึงข้อมูลใบเบิกที่รอการอนุมัติทั้งหมด
     """
-    start_date_thai = request.args.get('startDate')
-    end_date_thai = request.args.get('endDate')
-
-    query = """
-        SELECT
-            r.id, r.requisition_number, r.requisition_date,
-            u.full_name as requester_name,
-            us.name as requester_hospital_name,
-            r.requester_hcode,
-            (SELECT COUNT(*) FROM requisition_items ri WHERE ri.requisition_id = r.id) as item_count,
-            r.status
-        FROM requisitions r
-        JOIN users u ON r.requester_id = u.id
-        LEFT JOIN unitservice us ON r.requester_hcode = us.hcode
-        WHERE r.status = 'รออนุมัติ'
-    """
-    params = []
-    conditions_sql = []
-
-    if start_date_thai:
-        start_date_iso = thai_to_iso_date(start_date_thai)
-        if start_date_iso:
-            conditions_sql.append("r.requisition_date >= %s")
-            params.append(start_date_iso)
-    if end_date_thai:
-        end_date_iso = thai_to_iso_date(end_date_thai)
-        if end_date_iso:
-            conditions_sql.append("r.requisition_date <= %s")
-            params.append(end_date_iso)
-
-    if conditions_sql:
-        query += " AND " + " AND ".join(conditions_sql)
-
-    query += " ORDER BY r.requisition_date ASC, r.id ASC"
+    query, params = _pending_requisitions_query(*_requisition_date_filters(request.args.get('startDate'), request.args.get('endDate')))
 
     pending_requisitions = db_execute_query(query, tuple(params) if params else None, fetchall=True)
 
@@ -239,7 +249,7 @@ def get_requisition_items(requisition_id):
             m.unit, 
             m.min_stock,
             m.max_stock,
-            COALESCE(inv_sum.current_stock, 0) AS total_quantity_on_hand,
+            COALESCE(sb.total_on_hand, 0) AS total_quantity_on_hand,
             ri.quantity_requested,
             ri.quantity_approved, 
             ri.approved_lot_number, 
@@ -248,14 +258,7 @@ def get_requisition_items(requisition_id):
             ri.reason_for_change_or_rejection
         FROM requisition_items ri
         JOIN medicines m ON ri.medicine_id = m.id
-        LEFT JOIN (
-            SELECT 
-                inv.medicine_id, 
-                inv.hcode, 
-                SUM(inv.quantity_on_hand) AS current_stock
-            FROM inventory inv
-            GROUP BY inv.medicine_id, inv.hcode
-        ) AS inv_sum ON m.id = inv_sum.medicine_id AND m.hcode = inv_sum.hcode
+        LEFT JOIN stock_balance sb ON sb.medicine_id = m.id AND sb.hcode = m.hcode
         WHERE ri.requisition_id = %s AND m.hcode = %s
         ORDER BY m.generic_name;
     """
@@ -287,7 +290,7 @@ def cancel_requisition_endpoint(requisition_id):
 
     try:
         conn.start_transaction()
-        requisition = db_execute_query("SELECT id, status FROM requisitions WHERE id = %s", (requisition_id,), fetchone=True, cursor_to_use=cursor)
+        requisition = db_execute_query("SELECT id, status, requester_hcode FROM requisitions WHERE id = %s", (requisition_id,), fetchone=True, cursor_to_use=cursor)
         if not requisition:
             conn.rollback()
             return jsonify({"error": "ไม่พบใบเบิกที่ต้องการยกเลิก"}), 404
@@ -298,6 +301,7 @@ def cancel_requisition_endpoint(requisition_id):
 
         db_execute_query("DELETE FROM requisition_items WHERE requisition_id = %s", (requisition_id,), commit=False, cursor_to_use=cursor)
         db_execute_query("DELETE FROM requisitions WHERE id = %s", (requisition_id,), commit=False, cursor_to_use=cursor)
+        record_changes(requisition['requester_hcode'], CHANGE_ENTITY_REQUISITION, [requisition_id], cursor)
         conn.commit()
         return jsonify({"message": f"ใบเบิกเลขที่ ID {requisition_id} และรายการยาที่เกี่ยวข้อง ถูกลบออกจากระบบแล้ว (Hard Delete)"}), 200
 
@@ -309,6 +313,105 @@ def cancel_requisition_endpoint(requisition_id):
         if conn: conn.close()
 
 
+class RequisitionApprovalError(ValueError):
+    """ข้อมูลการอนุมัติใบเบิกไม่ถูกต้อง (ส่งกลับเป็น error พร้อม status_code)"""
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
+
+def _lock_requisitions_for_approval(requisition_ids, cursor):
+    """
+    ล็อกหัวใบเบิกและอ่านรายการยาของใบเบิกทั้งหมดด้วย 2 query
+    คืนค่า dict: requisition_id -> {'status': ..., 'requester_hcode': ..., 'items': {requisition_item_id: quantity_requested}}
+    """
+    requisition_ids = list(dict.fromkeys(int(requisition_id) for requisition_id in requisition_ids))
+    if not requisition_ids:
+        return {}
+    cursor.execute(f"SELECT id, status, requester_hcode FROM requisitions WHERE id IN ({build_in_placeholders(requisition_ids)}) FOR UPDATE", tuple(requisition_ids))
+    requisitions = {row['id']: {'status': row['status'], 'requester_hcode': row['requester_hcode'], 'items': {}} for row in cursor.fetchall()}
+    cursor.execute(f"SELECT id, requisition_id, quantity_requested FROM requisition_items WHERE requisition_id IN ({build_in_placeholders(requisition_ids)})", tuple(requisition_ids))
+    for row in cursor.fetchall():
+        requisitions[row['requisition_id']]['items'][row['id']] = row['quantity_requested']
+    return requisitions
+
+def _plan_requisition_approval(requisition_id, requisition, approval_items_data):
+    """
+    ตรวจสอบข้อมูลการอนุมัติของใบเบิกหนึ่งใบ (ไม่เขียนฐานข้อมูล)
+    approval_items_data เป็น None = อนุมัติทุกรายการตามจำนวนที่ขอ
+    คืนค่า (item_updates สำหรับ db_update_many_by_id, สถานะใหม่ของใบเบิก) หรือ raise RequisitionApprovalError
+    """
+    if not requisition:
+        raise RequisitionApprovalError("ไม่พบใบเบิก", 404)
+    if requisition['status'] != 'รออนุมัติ':
+        raise RequisitionApprovalError(f"ใบเบิกนี้ไม่อยู่ในสถานะ 'รออนุมัติ' (สถานะปัจจุบัน: {requisition['status']})")
+    if approval_items_data is None:
+        approval_items_data = [
+            {"requisition_item_id": item_id, "quantity_approved": quantity_requested, "item_approval_status": 'อนุมัติ'}
+            for item_id, quantity_requested in requisition['items'].items()
+        ]
+
+    all_items_approved_as_requested = True
+    any_item_approved = False
+    item_updates = []
+    for item_data in approval_items_data:
+        req_item_id = item_data.get('requisition_item_id')
+        qty_approved = item_data.get('quantity_approved')
+        item_status = item_data.get('item_approval_status')
+
+        if req_item_id is None or qty_approved is None or item_status is None:
+            raise RequisitionApprovalError(f"ข้อมูลรายการยาไม่ครบถ้วน: {item_data}")
+        try:
+            req_item_id, qty_approved = int(req_item_id), int(qty_approved)
+        except (TypeError, ValueError):
+            raise RequisitionApprovalError(f"รหัสรายการหรือจำนวนที่อนุมัติต้องเป็นตัวเลข: {item_data}")
+
+        quantity_requested = requisition['items'].get(req_item_id)
+        if quantity_requested is None:
+            raise RequisitionApprovalError(f"ไม่พบรายการยา ID {req_item_id} ในใบเบิกนี้", 404)
+
+        if item_status in ['อนุมัติ', 'แก้ไขจำนวน']:
+            any_item_approved = True
+            if qty_approved != quantity_requested:
+                all_items_approved_as_requested = False
+        elif item_status == 'ปฏิเสธ':
+            all_items_approved_as_requested = False
+        else:
+            raise RequisitionApprovalError(f"สถานะการอนุมัติรายการยาไม่ถูกต้อง: {item_status}")
+
+        approved_exp_date_iso = thai_to_iso_date(item_data.get('approved_expiry_date'))
+        item_updates.append((req_item_id, qty_approved, item_data.get('approved_lot_number'), approved_exp_date_iso, item_status, item_data.get('reason_for_change_or_rejection')))
+
+    final_status = 'ปฏิเสธ'
+    if any_item_approved:
+        final_status = 'อนุมัติบางส่วน'
+        if all_items_approved_as_requested:
+            final_status = 'อนุมัติแล้ว'
+    return item_updates, final_status
+
+def _write_requisition_approvals(item_updates, header_updates, approved_by_id, approver_hcode, requisitions, cursor):
+    """
+    เขียนผลการอนุมัติของทุกรายการและทุกใบเบิกด้วย UPDATE ... CASE แบบ batch (ผู้เรียกเป็นผู้ commit)
+    requisitions คือผลจาก _lock_requisitions_for_approval (ใช้หา hcode ของผู้ขอเบิกสำหรับ change_log)
+    """
+    db_update_many_by_id(
+        'requisition_items',
+        ['quantity_approved', 'approved_lot_number', 'approved_expiry_date', 'item_approval_status', 'reason_for_change_or_rejection'],
+        item_updates, cursor
+    )
+    if not header_updates:
+        return
+    requisition_ids = [requisition_id for requisition_id, _ in header_updates]
+    cursor.execute(
+        f"UPDATE requisitions SET status = (CASE id {' '.join(['WHEN %s THEN %s'] * len(header_updates))} END), "
+        f"approved_by_id = %s, approver_hcode = %s, approval_date = CURDATE(), updated_at = NOW() WHERE id IN ({build_in_placeholders(requisition_ids)})",
+        (*[value for update in header_updates for value in update], approved_by_id, approver_hcode, *requisition_ids)
+    )
+    record_changes_by_hcode(
+        CHANGE_ENTITY_REQUISITION,
+        [(requisitions[requisition_id]['requester_hcode'], requisition_id) for requisition_id in requisition_ids],
+        cursor
+    )
+
 @requisition_bp.route('/<int:requisition_id>/process_approval', methods=['PUT'])
 def process_requisition_approval(requisition_id):
     """
@@ -328,58 +431,75 @@ def process_requisition_approval(requisition_id):
 
     try:
         conn.start_transaction()
-        requisition_header = db_execute_query("SELECT status FROM requisitions WHERE id = %s", (requisition_id,), fetchone=True, cursor_to_use=cursor)
-        if not requisition_header:
-            conn.rollback()
-            return jsonify({"error": "ไม่พบใบเบิก"}), 404
-        if requisition_header['status'] != 'รออนุมัติ':
-            conn.rollback()
-            return jsonify({"error": f"ใบเบิกนี้ไม่อยู่ในสถานะ 'รออนุมัติ' (สถานะปัจจุบัน: {requisition_header['status']})"}), 400
-
-        all_items_approved_as_requested = True
-        any_item_approved = False
-        all_items_rejected = True
+        requisitions = _lock_requisitions_for_approval([requisition_id], cursor)
+        item_updates, final_status = _plan_requisition_approval(requisition_id, requisitions.get(requisition_id), approval_items_data)
+        _write_requisition_approvals(item_updates, [(requisition_id, final_status)], approved_by_id, approver_hcode, requisitions, cursor)
 
-        for item_data in approval_items_data:
-            req_item_id = item_data.get('requisition_item_id')
-            qty_approved = item_data.get('quantity_approved')
-            item_status = item_data.get('item_approval_status')
-
-            if req_item_id is None or qty_approved is None or item_status is None:
-                conn.rollback()
-                return jsonify({"error": f"ข้อมูลรายการยาไม่ครบถ้วน: {item_data}"}), 400
+        conn.commit()
+        return jsonify({"message": f"ดำเนินการใบเบิก ID {requisition_id} สำเร็จ สถานะใหม่คือ {final_status}"}), 200
 
-            original_req_item = db_execute_query("SELECT quantity_requested FROM requisition_items WHERE id = %s", (req_item_id,), fetchone=True, cursor_to_use=cursor)
-            if not original_req_item:
-                conn.rollback()
-                return jsonify({"error": f"ไม่พบรายการยา ID {req_item_id} ในใบเบิกนี้"}), 404
-
-            if item_status in ['อนุมัติ', 'แก้ไขจำนวน']:
-                any_item_approved = True
-                all_items_rejected = False
-                if int(qty_approved) != original_req_item['quantity_requested']:
-                    all_items_approved_as_requested = False
-            elif item_status == 'ปฏิเสธ':
-                all_items_approved_as_requested = False
-            else:
-                conn.rollback()
-                return jsonify({"error": f"สถานะการอนุมัติรายการยาไม่ถูกต้อง: {item_status}"}), 400
+    except RequisitionApprovalError as e:
+        conn.rollback()
+        return jsonify({"error": str(e)}), e.status_code
+    except Error as e:
+        if conn: conn.rollback()
+        return jsonify({"error": f"เกิดข้อผิดพลาดในการดำเนินการใบเบิก: {e}"}), 500
+    finally:
+        if cursor: cursor.close()
+        if conn: conn.close()
 
-            sql_update_item = "UPDATE requisition_items SET quantity_approved = %s, approved_lot_number = %s, approved_expiry_date = %s, item_approval_status = %s, reason_for_change_or_rejection = %s WHERE id = %s"
-            approved_exp_date_iso = thai_to_iso_date(item_data.get('approved_expiry_date'))
-            cursor.execute(sql_update_item, (int(qty_approved), item_data.get('approved_lot_number'), approved_exp_date_iso, item_status, item_data.get('reason_for_change_or_rejection'), req_item_id))
+@requisition_bp.route('/batch_approval', methods=['PUT'])
+def process_batch_requisition_approval():
+    """
+    อนุมัติใบเบิกหลายใบในครั้งเดียว (เช่น รอบอนุมัติสิ้นเดือนของ รพ.แม่ข่าย)
+    Body: approved_by_id, approver_hcode,
+          requisitions: [{requisition_id, items (optional, รูปแบบเดียวกับ process_approval)}]
+          หรือ requisition_ids: [...] เพื่ออนุมัติทุกรายการตามจำนวนที่ขอ
+    ใบเบิกที่ข้อมูลไม่ถูกต้องหรือไม่อยู่ในสถานะ 'รออนุมัติ' จะถูกข้ามและรายงานใน failed ส่วนที่เหลือบันทึกใน transaction เดียว
+    """
+    data = request.get_json()
+    if not data or not data.get('approved_by_id') or not (data.get('requisitions') or data.get('requisition_ids')):
+        return jsonify({"error": "ข้อมูลไม่ครบถ้วน (ต้องการ approved_by_id และ requisitions หรือ requisition_ids)"}), 400
 
-        final_status = 'ปฏิเสธ'
-        if any_item_approved:
-            final_status = 'อนุมัติบางส่วน'
-            if all_items_approved_as_requested:
-                final_status = 'อนุมัติแล้ว'
+    approved_by_id = data['approved_by_id']
+    approver_hcode = data.get('approver_hcode')
+    try:
+        approval_requests = [(int(entry['requisition_id']), entry.get('items')) for entry in data.get('requisitions') or []]
+        approval_requests += [(int(requisition_id), None) for requisition_id in data.get('requisition_ids') or []]
+    except (KeyError, TypeError, ValueError):
+        return jsonify({"error": "requisition_id ไม่ถูกต้อง"}), 400
 
-        sql_update_header = "UPDATE requisitions SET status = %s, approved_by_id = %s, approver_hcode = %s, approval_date = CURDATE(), updated_at = NOW() WHERE id = %s"
-        cursor.execute(sql_update_header, (final_status, approved_by_id, approver_hcode, requisition_id))
+    conn = get_db_connection()
+    if not conn: return jsonify({"error": "ไม่สามารถเชื่อมต่อฐานข้อมูลได้"}), 500
+    cursor = conn.cursor(dictionary=True)
 
+    try:
+        conn.start_transaction()
+        requisitions = _lock_requisitions_for_approval([requisition_id for requisition_id, _ in approval_requests], cursor)
+
+        item_updates, header_updates, processed, failed = [], [], [], []
+        seen_requisition_ids = set()
+        for requisition_id, approval_items_data in approval_requests:
+            if requisition_id in seen_requisition_ids:
+                failed.append({"requisition_id": requisition_id, "error": "ระบุใบเบิกซ้ำในคำขอเดียวกัน"})
+                continue
+            seen_requisition_ids.add(requisition_id)
+            try:
+                requisition_item_updates, final_status = _plan_requisition_approval(requisition_id, requisitions.get(requisition_id), approval_items_data)
+            except RequisitionApprovalError as e:
+                failed.append({"requisition_id": requisition_id, "error": str(e)})
+                continue
+            item_updates.extend(requisition_item_updates)
+            header_updates.append((requisition_id, final_status))
+            processed.append({"requisition_id": requisition_id, "status": final_status})
+
+        _write_requisition_approvals(item_updates, header_updates, approved_by_id, approver_hcode, requisitions, cursor)
         conn.commit()
-        return jsonify({"message": f"ดำเนินการใบเบิก ID {requisition_id} สำเร็จ สถานะใหม่คือ {final_status}"}), 200
+        return jsonify({
+            "message": f"ดำเนินการใบเบิกสำเร็จ {len(processed)} ใบ, ไม่สำเร็จ {len(failed)} ใบ",
+            "processed": processed,
+            "failed": failed
+        }), 200
 
     except Error as e:
         if conn: conn.rollback()
@@ -398,23 +518,13 @@ def suggest_auto_requisition_items():
         SELECT
             m.id AS medicine_id, m.medicine_code, m.generic_name, m.strength, m.unit,
             m.min_stock, m.max_stock,
-            COALESCE(inv_sum.current_stock, 0) AS total_quantity_on_hand
+            COALESCE(sb.total_on_hand, 0) AS total_quantity_on_hand
         FROM medicines m
-        LEFT JOIN (
-            SELECT medicine_id, hcode, SUM(quantity_on_hand) AS current_stock
-            FROM inventory
-            WHERE hcode = %s  -- Filter inventory by hcode here as well
-            GROUP BY medicine_id, hcode
-        ) AS inv_sum ON m.id = inv_sum.medicine_id AND m.hcode = inv_sum.hcode -- Ensure join uses m.hcode
+        LEFT JOIN stock_balance sb ON sb.medicine_id = m.id AND sb.hcode = m.hcode
         WHERE m.hcode = %s AND m.is_active = TRUE AND m.min_stock > 0
         ORDER BY m.generic_name;
     """
-    # Note: The subquery for inv_sum also needs to be filtered by hcode for accuracy,
-    # or ensure the outer m.hcode = inv_sum.hcode join is sufficient.
-    # The provided query structure is generally okay if inv_sum.hcode is correctly matched.
-    # For clarity and safety, adding hcode filter in subquery is better.
-    
-    medicines = db_execute_query(query, (hcode, hcode), fetchall=True) # Pass hcode twice
+    medicines = db_execute_query(query, (hcode,), fetchall=True)
 
     if medicines is None:
         return jsonify({"error": "Could not fetch medicine data for suggestions."}), 500
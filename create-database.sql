@@ -80,11 +80,30 @@ CREATE TABLE IF NOT EXISTS `inventory` (
   `last_updated` TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
   FOREIGN KEY (`hcode`) REFERENCES `unitservice`(`hcode`) ON DELETE CASCADE ON UPDATE CASCADE,
   FOREIGN KEY (`medicine_id`) REFERENCES `medicines`(`id`) ON DELETE RESTRICT ON UPDATE CASCADE,
-  UNIQUE KEY `hcode_medicine_lot_expiry_unique` (`hcode`, `medicine_id`, `lot_number`, `expiry_date`)
+  UNIQUE KEY `hcode_medicine_lot_expiry_unique` (`hcode`, `medicine_id`, `lot_number`, `expiry_date`),
+  KEY `idx_inventory_fefo` (`hcode`, `medicine_id`, `expiry_date`, `quantity_on_hand`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='ข้อมูลยาคงคลังแยกตามล็อตและหน่วยบริการ';
 
 -- --------------------------------------------------------
 
+--
+-- Table structure for table `stock_balance`
+-- ตารางยอดคงเหลือรวมต่อยา (ปรับปรุงพร้อมทุกการเคลื่อนไหวของ inventory ใน transaction เดียวกัน)
+-- ฐานข้อมูลเดิมให้รัน flask db migrate แล้วสร้างข้อมูลเริ่มต้นด้วยคำสั่ง: flask stock-balance rebuild
+--
+CREATE TABLE IF NOT EXISTS `stock_balance` (
+  `hcode` VARCHAR(5) NOT NULL COMMENT 'รหัสหน่วยบริการเจ้าของคลัง (อ้างอิง unitservice.hcode)',
+  `medicine_id` INT NOT NULL COMMENT 'รหัสยา (อ้างอิง medicines.id)',
+  `total_on_hand` INT NOT NULL DEFAULT 0 COMMENT 'ยอดคงเหลือรวมทุกล็อต',
+  `nearest_expiry` DATE NULL COMMENT 'วันหมดอายุที่ใกล้ที่สุดของล็อตที่ยังมียาคงเหลือ',
+  `updated_at` TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  PRIMARY KEY (`hcode`, `medicine_id`),
+  FOREIGN KEY (`hcode`) REFERENCES `unitservice`(`hcode`) ON DELETE CASCADE ON UPDATE CASCADE,
+  FOREIGN KEY (`medicine_id`) REFERENCES `medicines`(`id`) ON DELETE CASCADE ON UPDATE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='ยอดคงเหลือรวมต่อยาและหน่วยบริการ (materialized จาก inventory)';
+
+-- --------------------------------------------------------
+
 --
 -- Table structure for table `requisitions`
 -- ตารางใบเบิกยา
@@ -105,7 +124,9 @@ CREATE TABLE IF NOT EXISTS `requisitions` (
   FOREIGN KEY (`requester_id`) REFERENCES `users`(`id`),
   FOREIGN KEY (`requester_hcode`) REFERENCES `unitservice`(`hcode`),
   FOREIGN KEY (`approved_by_id`) REFERENCES `users`(`id`),
-  FOREIGN KEY (`approver_hcode`) REFERENCES `unitservice`(`hcode`)
+  FOREIGN KEY (`approver_hcode`) REFERENCES `unitservice`(`hcode`),
+  KEY `idx_requisitions_status_hcode_date` (`status`, `requester_hcode`, `requisition_date`),
+  KEY `idx_requisitions_hcode_date` (`requester_hcode`, `requisition_date`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='ข้อมูลใบเบิกยา';
 
 -- --------------------------------------------------------
@@ -148,7 +169,8 @@ CREATE TABLE IF NOT EXISTS `goods_received_vouchers` (
   `updated_at` TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
   FOREIGN KEY (`hcode`) REFERENCES `unitservice`(`hcode`) ON DELETE CASCADE ON UPDATE CASCADE,
   FOREIGN KEY (`requisition_id`) REFERENCES `requisitions`(`id`),
-  FOREIGN KEY (`receiver_id`) REFERENCES `users`(`id`)
+  FOREIGN KEY (`receiver_id`) REFERENCES `users`(`id`),
+  KEY `idx_grv_hcode_received_date` (`hcode`, `received_date`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='เอกสารการรับยาเข้าคลัง';
 
 -- --------------------------------------------------------
@@ -188,7 +210,8 @@ CREATE TABLE IF NOT EXISTS `dispense_records` (
   `created_at` TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
   `updated_at` TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
   FOREIGN KEY (`hcode`) REFERENCES `unitservice`(`hcode`) ON DELETE CASCADE ON UPDATE CASCADE,
-  FOREIGN KEY (`dispenser_id`) REFERENCES `users`(`id`)
+  FOREIGN KEY (`dispenser_id`) REFERENCES `users`(`id`),
+  KEY `idx_dispense_records_hcode_date` (`hcode`, `dispense_date`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='ข้อมูลการตัดจ่ายยา';
 
 -- --------------------------------------------------------
@@ -206,9 +229,10 @@ CREATE TABLE IF NOT EXISTS `dispense_items` (
   `quantity_dispensed` INT NOT NULL COMMENT 'จำนวนที่จ่าย',
   `dispense_date` DATE COMMENT 'วันที่จ่ายยาจริงของรายการนี้',
 	`item_status` TEXT COMMENT 'สถานะของรายการยานี้',
-  `hos_guid` TEXT COMMENT 'รหัสอ้างอิงของรายการยา',
+  `hos_guid` VARCHAR(100) NULL COMMENT 'รหัสอ้างอิงของรายการยา',
   FOREIGN KEY (`dispense_record_id`) REFERENCES `dispense_records`(`id`) ON DELETE CASCADE ON UPDATE CASCADE,
-  FOREIGN KEY (`medicine_id`) REFERENCES `medicines`(`id`) ON DELETE RESTRICT ON UPDATE CASCADE
+  FOREIGN KEY (`medicine_id`) REFERENCES `medicines`(`id`) ON DELETE RESTRICT ON UPDATE CASCADE,
+  KEY `idx_dispense_items_hos_guid` (`hos_guid`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='รายการยาที่ตัดจ่ายในแต่ละครั้ง';
 
 -- --------------------------------------------------------
@@ -233,11 +257,133 @@ CREATE TABLE IF NOT EXISTS `inventory_transactions` (
   `remarks` TEXT COMMENT 'หมายเหตุ',
   FOREIGN KEY (`hcode`) REFERENCES `unitservice`(`hcode`) ON DELETE CASCADE ON UPDATE CASCADE,
   FOREIGN KEY (`medicine_id`) REFERENCES `medicines`(`id`),
-  FOREIGN KEY (`user_id`) REFERENCES `users`(`id`)
+  FOREIGN KEY (`user_id`) REFERENCES `users`(`id`),
+  KEY `idx_inv_txn_hcode_medicine_date` (`hcode`, `medicine_id`, `transaction_date`),
+  KEY `idx_inv_txn_hcode_type_date` (`hcode`, `transaction_type`, `transaction_date`, `medicine_id`, `quantity_change`),
+  KEY `idx_inv_txn_reference_document` (`reference_document_id`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='ประวัติการเคลื่อนไหวของยาในคลัง';
 
 -- --------------------------------------------------------
 
+--
+-- Table structure for table `inventory_balance_snapshots`
+-- ตารางยอดยกมารายเดือนของยาแต่ละรายการ (ใช้คำนวณยอดยกมาในหน้าประวัติการเคลื่อนไหว)
+--
+CREATE TABLE IF NOT EXISTS `inventory_balance_snapshots` (
+  `hcode` VARCHAR(5) NOT NULL COMMENT 'รหัสหน่วยบริการ (อ้างอิง unitservice.hcode)',
+  `medicine_id` INT NOT NULL COMMENT 'รหัสยา (อ้างอิง medicines.id)',
+  `snapshot_date` DATE NOT NULL COMMENT 'ยอดคงเหลือ ณ ต้นวันนี้ (ต้นเดือน)',
+  `balance` INT NOT NULL COMMENT 'ผลรวม quantity_change ของ transaction ก่อน snapshot_date',
+  `created_at` TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`hcode`, `medicine_id`, `snapshot_date`),
+  FOREIGN KEY (`hcode`) REFERENCES `unitservice`(`hcode`) ON DELETE CASCADE ON UPDATE CASCADE,
+  FOREIGN KEY (`medicine_id`) REFERENCES `medicines`(`id`) ON DELETE CASCADE ON UPDATE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='ยอดยกมารายเดือนของยาแต่ละรายการ';
+
+-- --------------------------------------------------------
+
+--
+-- Table structure for table `document_sequences`
+-- ตารางตัวนับเลขที่เอกสารรายวัน (DSP, DSPEXC, GRN, REQ) ต่อหน่วยบริการ
+--
+CREATE TABLE IF NOT EXISTS `document_sequences` (
+  `prefix` VARCHAR(10) NOT NULL COMMENT 'ประเภทเลขที่เอกสาร เช่น DSP, DSPEXC, GRN, REQ',
+  `scope` VARCHAR(10) NOT NULL DEFAULT '' COMMENT 'รหัสหน่วยบริการ (ว่าง = ใช้ร่วมกันทั้งระบบ เช่น REQ)',
+  `period` VARCHAR(8) NOT NULL COMMENT 'วันที่ในเลขที่เอกสาร (YYMMDD หรือ YYYYMMDD)',
+  `last_value` INT NOT NULL DEFAULT 0 COMMENT 'ลำดับล่าสุดที่ออกไปแล้ว',
+  `updated_at` TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  PRIMARY KEY (`prefix`, `scope`, `period`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='ตัวนับเลขที่เอกสารรายวัน';
+
+-- --------------------------------------------------------
+
+--
+-- Table structure for table `clinic_data_versions`
+-- ตัวนับการเปลี่ยนแปลงข้อมูลหลักของยาและยอดคงเหลือต่อหน่วยบริการ (ใช้สร้าง ETag)
+--
+CREATE TABLE IF NOT EXISTS `clinic_data_versions` (
+  `hcode` VARCHAR(5) NOT NULL COMMENT 'รหัสหน่วยบริการ (อ้างอิง unitservice.hcode)',
+  `medicines_version` BIGINT UNSIGNED NOT NULL DEFAULT 0 COMMENT 'ตัวนับการเปลี่ยนแปลงข้อมูลหลักของยา',
+  `stock_version` BIGINT UNSIGNED NOT NULL DEFAULT 0 COMMENT 'ตัวนับการเปลี่ยนแปลงยอดคงเหลือ',
+  `change_seq` BIGINT UNSIGNED NOT NULL DEFAULT 0 COMMENT 'ลำดับการเปลี่ยนแปลงล่าสุดใน change_log',
+  `pruned_seq` BIGINT UNSIGNED NOT NULL DEFAULT 0 COMMENT 'token ที่เก่ากว่าค่านี้ต้องโหลดข้อมูลใหม่ทั้งหมด',
+  `updated_at` TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  PRIMARY KEY (`hcode`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='ตัวนับการเปลี่ยนแปลงข้อมูลต่อหน่วยบริการ (ETag และ change feed)';
+
+-- --------------------------------------------------------
+
+--
+-- Table structure for table `change_log`
+-- บันทึกการเปลี่ยนแปลงของยา ยอดคงเหลือรายยา และสถานะใบเบิก สำหรับ feed /api/changes
+--
+CREATE TABLE IF NOT EXISTS `change_log` (
+  `id` BIGINT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY,
+  `hcode` VARCHAR(5) NOT NULL COMMENT 'รหัสหน่วยบริการ (อ้างอิง unitservice.hcode)',
+  `seq` BIGINT UNSIGNED NOT NULL COMMENT 'ลำดับการเปลี่ยนแปลงของหน่วยบริการ (clinic_data_versions.change_seq)',
+  `entity` VARCHAR(20) NOT NULL COMMENT 'medicine, stock (entity_id = medicine_id) หรือ requisition',
+  `entity_id` INT NOT NULL,
+  `created_at` TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  INDEX `idx_change_log_hcode_seq` (`hcode`, `seq`),
+  INDEX `idx_change_log_created_at` (`created_at`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='บันทึกการเปลี่ยนแปลงสำหรับ feed /api/changes';
+
+-- --------------------------------------------------------
+
+--
+-- Table structure for table `dispense_sync_watermarks`
+-- จุดซิงค์ล่าสุดของข้อมูลการจ่ายยาจาก HOSxP ต่อหน่วยบริการ (โปรแกรมนำเข้าดึงเฉพาะรายการหลังจุดนี้)
+--
+CREATE TABLE IF NOT EXISTS `dispense_sync_watermarks` (
+  `hcode` VARCHAR(5) NOT NULL COMMENT 'รหัสหน่วยบริการ (อ้างอิง unitservice.hcode)',
+  `last_vstdate` DATE NOT NULL COMMENT 'วันที่รับบริการของรายการล่าสุดที่บันทึกแล้ว',
+  `last_hos_guid` VARCHAR(100) NOT NULL COMMENT 'hos_guid ของรายการล่าสุดที่บันทึกแล้ว (เรียงตาม vstdate, hos_guid)',
+  `updated_at` TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  PRIMARY KEY (`hcode`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='จุดซิงค์ล่าสุดของข้อมูลการจ่ายยาจาก HOSxP';
+
+-- --------------------------------------------------------
+
+--
+-- Table structure for table `dispense_upload_requests`
+-- สถานะของคำขอตัดจ่ายแบบ bulk ต่อ idempotency_key (คำขอที่ส่งซ้ำทำต่อจากสถานะเดิมแทนการตัดจ่ายซ้ำ)
+--
+CREATE TABLE IF NOT EXISTS `dispense_upload_requests` (
+  `hcode` VARCHAR(5) NOT NULL COMMENT 'รหัสหน่วยบริการ (อ้างอิง unitservice.hcode)',
+  `idempotency_key` VARCHAR(64) NOT NULL COMMENT 'รหัสของคำขอจาก client (คำขอที่ส่งซ้ำใช้รหัสเดิม)',
+  `fingerprint` CHAR(16) NOT NULL COMMENT 'ลายนิ้วมือของรายการในคำขอ',
+  `dispense_record_id` INT NULL COMMENT 'เอกสารตัดจ่ายที่คำขอนี้บันทึกรายการลง',
+  `next_index` INT NOT NULL DEFAULT 0 COMMENT 'ตำแหน่งรายการถัดไปที่ยังไม่ได้บันทึก',
+  `processed_total` INT NOT NULL DEFAULT 0 COMMENT 'จำนวนรายการที่บันทึกสำเร็จแล้ว',
+  `failed_total` INT NOT NULL DEFAULT 0 COMMENT 'จำนวนรายการที่ผิดพลาด',
+  `completed` TINYINT(1) NOT NULL DEFAULT 0 COMMENT 'ประมวลผลครบทุกรายการแล้ว',
+  `created_at` TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  `updated_at` TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  PRIMARY KEY (`hcode`, `idempotency_key`),
+  INDEX `idx_dispense_upload_requests_created_at` (`created_at`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='สถานะคำขอตัดจ่ายแบบ bulk ต่อ idempotency key';
+
+-- --------------------------------------------------------
+
+--
+-- Table structure for table `dispense_sync_failures`
+-- รายการจาก HOSxP ที่ตัดจ่ายไม่สำเร็จระหว่างการซิงค์ (จุดซิงค์เลื่อนผ่านได้ โปรแกรมนำเข้าส่งใหม่จากตารางนี้)
+--
+CREATE TABLE IF NOT EXISTS `dispense_sync_failures` (
+  `hcode` VARCHAR(5) NOT NULL COMMENT 'รหัสหน่วยบริการ (อ้างอิง unitservice.hcode)',
+  `hos_guid` VARCHAR(100) NOT NULL COMMENT 'รหัสอ้างอิงของรายการยาใน HOSxP',
+  `medicine_id` INT NULL COMMENT 'รหัสยา (อ้างอิง medicines.id)',
+  `quantity_dispensed` DECIMAL(12,2) NULL COMMENT 'จำนวนที่จ่ายตาม HOSxP',
+  `dispense_date` DATE NULL COMMENT 'วันที่รับบริการ',
+  `error` TEXT COMMENT 'สาเหตุที่ตัดจ่ายไม่สำเร็จครั้งล่าสุด',
+  `attempts` INT NOT NULL DEFAULT 1 COMMENT 'จำนวนครั้งที่ตัดจ่ายไม่สำเร็จ',
+  `created_at` TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  `updated_at` TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  PRIMARY KEY (`hcode`, `hos_guid`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='รายการซิงค์จาก HOSxP ที่ตัดจ่ายไม่สำเร็จ รอส่งใหม่';
+
+-- --------------------------------------------------------
+
 --
 -- Insert default admin user
 --
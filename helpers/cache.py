@@ -0,0 +1,296 @@
+# /helpers/cache.py
+# Cache แบบ read-through ของ response JSON ที่ถูกเรียกบ่อย (หน่วยบริการ, ผู้ใช้งาน, รายการยา, สรุปคลังยา)
+# - key ประกอบจากชื่อ endpoint + hcode + query string และเวอร์ชันของ namespace (endpoint, hcode)
+# - การ invalidate คือการเพิ่มเวอร์ชันของ namespace: key เก่าจะไม่ถูกอ่านอีกและหมดอายุไปเองตาม TTL
+# - backend ใช้ Redis เมื่อตั้ง CACHE_REDIS_URL (ใช้ร่วมกันทุก gunicorn worker) หากไม่ตั้งใช้ LocalCacheBackend ใน process
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlencode
+from flask import current_app
+
+logger = logging.getLogger(__name__)
+
+CACHE_CONFIG = {
+    'enabled': os.getenv('CACHE_ENABLED', '1').lower() not in ('0', 'false', 'no'),
+    'redis_url': os.getenv('CACHE_REDIS_URL'),                             # เช่น redis://localhost:6379/0
+    'key_prefix': os.getenv('CACHE_KEY_PREFIX', 'drug:'),
+    'max_entries': int(os.getenv('CACHE_MAX_ENTRIES', 2000)),              # เฉพาะ LocalCacheBackend
+    'max_bytes': int(os.getenv('CACHE_MAX_BYTES', 64 * 1024 * 1024)),      # เฉพาะ LocalCacheBackend
+}
+
+# TTL (วินาที) ต่อประเภทข้อมูล: ข้อมูลอ้างอิงเปลี่ยนน้อย ส่วนยอดคงเหลือเปลี่ยนตามการรับ/จ่ายยา
+REFERENCE_DATA_TTL_SECONDS = int(os.getenv('CACHE_REFERENCE_TTL_SECONDS', 300))
+CLINIC_AGGREGATE_TTL_SECONDS = int(os.getenv('CACHE_AGGREGATE_TTL_SECONDS', 60))
+
+# ชื่อ namespace ของ endpoint ที่ cache (ใช้ทั้งตอนอ่านและตอน invalidate)
+CACHE_UNITSERVICES = 'unitservices'
+CACHE_USERS = 'users'
+CACHE_MEDICINES = 'medicines'
+CACHE_INVENTORY_SUMMARY = 'inventory_summary'
+
+ALL_HCODES = '*'
+GLOBAL_NAMESPACE = 'global'
+
+
+class LocalCacheBackend:
+    """
+    Cache ในหน่วยความจำของ process (ใช้แทน Redis ตอนพัฒนา หรือเมื่อรันแบบ worker เดียว)
+    LRU ด้วย OrderedDict, TTL ต่อ key และจำกัดทั้งจำนวน entry และขนาดรวมของค่า (bytes)
+    """
+
+    name = 'local'
+
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._versions = {}
+        self._size_bytes = 0
+        self._evictions = 0
+        self._lock = threading.Lock()
+
+    def _remove(self, key):
+        _, value = self._entries.pop(key)
+        self._size_bytes -= len(value)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, ttl):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._size_bytes += len(value)
+            while len(self._entries) > self.max_entries or self._size_bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self._evictions += 1
+
+    def get_versions(self, namespaces):
+        with self._lock:
+            return [self._versions.get(namespace, 0) for namespace in namespaces]
+
+    def bump_version(self, namespace):
+        with self._lock:
+            self._versions[namespace] = self._versions.get(namespace, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "size_bytes": self._size_bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "evictions": self._evictions,
+            }
+
+
+class RedisCacheBackend:
+    """
+    Cache ใน Redis ที่ทุก worker ใช้ร่วมกัน (การ invalidate จาก worker หนึ่งมีผลกับทุก worker ทันที)
+    TTL ต่อ key ใช้ EX ของ Redis ส่วน LRU และเพดานหน่วยความจำให้ตั้งที่ Redis (maxmemory + allkeys-lru)
+    """
+
+    name = 'redis'
+
+    def __init__(self, url, key_prefix):
+        import redis  # optional dependency: ติดตั้งเฉพาะเมื่อใช้ CACHE_REDIS_URL
+        self._client = redis.Redis.from_url(url, socket_timeout=0.5, socket_connect_timeout=0.5)
+        self._prefix = key_prefix
+
+    def get(self, key):
+        return self._client.get(self._prefix + key)
+
+    def set(self, key, value, ttl):
+        self._client.set(self._prefix + key, value, ex=ttl)
+
+    def get_versions(self, namespaces):
+        versions = self._client.mget([f"{self._prefix}version:{namespace}" for namespace in namespaces])
+        return [int(version) if version is not None else 0 for version in versions]
+
+    def bump_version(self, namespace):
+        self._client.incr(f"{self._prefix}version:{namespace}")
+
+    def clear(self):
+        for key in self._client.scan_iter(match=f"{self._prefix}*", count=500):
+            self._client.delete(key)
+
+    def stats(self):
+        info = self._client.info('memory')
+        return {"used_memory_bytes": info.get('used_memory'), "maxmemory_policy": info.get('maxmemory_policy')}
+
+
+def _create_backend():
+    if CACHE_CONFIG['redis_url']:
+        try:
+            return RedisCacheBackend(CACHE_CONFIG['redis_url'], CACHE_CONFIG['key_prefix'])
+        except ImportError:
+            logger.warning("CACHE_REDIS_URL ถูกตั้งไว้แต่ไม่ได้ติดตั้งแพ็กเกจ redis จึงใช้ cache ใน process แทน")
+    return LocalCacheBackend(CACHE_CONFIG['max_entries'], CACHE_CONFIG['max_bytes'])
+
+
+_backend = None
+_backend_lock = threading.Lock()
+_metrics = {}
+_metrics_lock = threading.Lock()
+
+
+def get_cache_backend():
+    """backend ของ process ปัจจุบัน (สร้างครั้งแรกที่เรียกใช้)"""
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = _create_backend()
+    return _backend
+
+
+def set_cache_backend(backend):
+    """เปลี่ยน backend (เช่น ใช้ LocalCacheBackend แทน Redis ตอนทดสอบ) คืนค่า backend เดิม"""
+    global _backend
+    with _backend_lock:
+        previous, _backend = _backend, backend
+    return previous
+
+
+def _reset_cache_after_fork():
+    # gunicorn pre-fork: ให้ worker แต่ละตัวสร้าง backend/connection ของตัวเอง
+    global _backend, _backend_lock, _metrics_lock
+    _backend = None
+    _backend_lock = threading.Lock()
+    _metrics_lock = threading.Lock()
+    _metrics.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_cache_after_fork)
+
+
+def _count(endpoint, metric):
+    with _metrics_lock:
+        counters = _metrics.setdefault(endpoint, {"hits": 0, "misses": 0, "stores": 0, "invalidations": 0, "errors": 0})
+        counters[metric] += 1
+
+
+def _namespace(endpoint, hcode):
+    return f"{endpoint}:{hcode or ALL_HCODES}"
+
+
+def build_cache_key(endpoint, hcode=None, params=None, versions=(0, 0)):
+    """key ของ entry: namespace, เวอร์ชัน (ของทั้งระบบ, ของ namespace) และ query string ที่เรียงแล้ว"""
+    query = urlencode(sorted((params or {}).items()))
+    return f"{_namespace(endpoint, hcode)}:v{versions[0]}.{versions[1]}:{query}"
+
+
+def cached_json_response(endpoint, loader, hcode=None, params=None, ttl=REFERENCE_DATA_TTL_SECONDS):
+    """
+    คืนค่า response จาก cache หรือเรียก loader() (ค่าที่ endpoint คืนตามปกติ) แล้วเก็บผลไว้
+    เก็บเฉพาะ response 200 แบบ JSON ที่ไม่มี Cache-Control: no-store พร้อม header X-*
+    เวอร์ชันของ namespace อ่านก่อนเรียก loader: หากมีการ invalidate ระหว่างโหลด ผลที่เก็บจะอยู่ใต้เวอร์ชันเก่าและไม่ถูกอ่าน
+    หาก backend ใช้งานไม่ได้ จะอ่านจากฐานข้อมูลตามปกติ
+    """
+    if not CACHE_CONFIG['enabled']:
+        return loader()
+    backend = get_cache_backend()
+    try:
+        versions = backend.get_versions([GLOBAL_NAMESPACE, _namespace(endpoint, hcode)])
+        key = build_cache_key(endpoint, hcode, params, versions)
+        cached = backend.get(key)
+    except Exception as e:
+        logger.warning(f"Cache read failed for {endpoint}: {e}")
+        _count(endpoint, 'errors')
+        return loader()
+
+    if cached is not None:
+        _count(endpoint, 'hits')
+        entry = json.loads(cached)
+        response = current_app.response_class(entry['body'], status=200, mimetype='application/json')
+        response.headers.extend(entry['headers'])
+        response.headers['X-Cache'] = 'HIT'
+        return response
+
+    _count(endpoint, 'misses')
+    response = current_app.make_response(loader())
+    if response.status_code == 200 and response.is_json and 'no-store' not in response.cache_control:
+        entry = {
+            "body": response.get_data(as_text=True),
+            "headers": [(name, value) for name, value in response.headers if name.startswith('X-')],
+        }
+        try:
+            backend.set(key, json.dumps(entry).encode('utf-8'), ttl)
+            _count(endpoint, 'stores')
+        except Exception as e:
+            logger.warning(f"Cache write failed for {endpoint}: {e}")
+            _count(endpoint, 'errors')
+    response.headers['X-Cache'] = 'MISS'
+    return response
+
+
+def _bump_versions(endpoint, namespaces):
+    backend = get_cache_backend()
+    for namespace in namespaces:
+        try:
+            backend.bump_version(namespace)
+            _count(endpoint, 'invalidations')
+        except Exception as e:
+            logger.error(f"Cache invalidation failed for {namespace}: {e}")
+            _count(endpoint, 'errors')
+
+
+def invalidate_cache(endpoint, hcode=None):
+    """
+    ทำให้ entry ของ endpoint (เฉพาะหน่วยบริการ hcode) ใช้ไม่ได้ เรียกหลัง commit การเขียนที่เกี่ยวข้อง
+    ระบุ hcode จะ invalidate มุมมองรวมทุกหน่วยบริการ (ของผู้ดูแลระบบ) ไปด้วย
+    """
+    namespaces = [_namespace(endpoint, None)]
+    if hcode:
+        namespaces.append(_namespace(endpoint, hcode))
+    _bump_versions(endpoint, namespaces)
+
+
+def invalidate_all_caches():
+    """ทำให้ทุก entry ใช้ไม่ได้ (เช่น หลังสร้าง stock_balance ใหม่ทั้งระบบ)"""
+    _bump_versions(GLOBAL_NAMESPACE, [GLOBAL_NAMESPACE])
+
+
+def invalidate_clinic_stock_caches(hcodes):
+    """invalidate รายการยาและสรุปคลังยาของหน่วยบริการที่ยอดคงเหลือหรือข้อมูลยาเปลี่ยน"""
+    if isinstance(hcodes, str):
+        hcodes = [hcodes]
+    for hcode in dict.fromkeys(hcodes):
+        invalidate_cache(CACHE_MEDICINES, hcode)
+        invalidate_cache(CACHE_INVENTORY_SUMMARY, hcode)
+
+
+def get_cache_stats():
+    """สถิติ hit/miss ต่อ endpoint ของ process นี้ และสถานะของ backend"""
+    with _metrics_lock:
+        endpoints = {endpoint: dict(counters) for endpoint, counters in _metrics.items()}
+    for counters in endpoints.values():
+        lookups = counters['hits'] + counters['misses']
+        counters['hit_ratio'] = round(counters['hits'] / lookups, 3) if lookups else None
+    backend = get_cache_backend()
+    try:
+        backend_stats = backend.stats()
+    except Exception as e:
+        backend_stats = {"error": str(e)}
+    return {"enabled": CACHE_CONFIG['enabled'], "backend": backend.name, "backend_stats": backend_stats, "endpoints": endpoints}
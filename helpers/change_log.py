@@ -0,0 +1,186 @@
+# /helpers/change_log.py
+# บันทึกการเปลี่ยนแปลง (change_log) สำหรับ feed /api/changes: client ขอเฉพาะสิ่งที่เปลี่ยนหลัง token ล่าสุดของตน
+# ลำดับ (seq) นับแยกต่อหน่วยบริการจาก clinic_data_versions.change_seq ซึ่งถูกล็อกจนจบ transaction ที่เขียน
+# จึง commit ตามลำดับ seq เสมอ: เมื่ออ่านเห็น seq N แล้ว ทุก seq ที่น้อยกว่า N ของหน่วยบริการนั้น commit แล้วทั้งหมด
+import os
+from helpers.database import build_in_placeholders, db_insert_many
+from helpers.pagination import encode_page_cursor, decode_page_cursor
+
+CHANGE_ENTITY_MEDICINE = 'medicine'
+CHANGE_ENTITY_STOCK = 'stock'              # entity_id = medicine_id (ยอดคงเหลือรวมใน stock_balance)
+CHANGE_ENTITY_REQUISITION = 'requisition'
+
+CHANGE_FEED_DEFAULT_LIMIT = int(os.getenv('CHANGE_FEED_DEFAULT_LIMIT', 1000))
+CHANGE_FEED_MAX_LIMIT = int(os.getenv('CHANGE_FEED_MAX_LIMIT', 5000))
+
+MEDICINE_CHANGE_COLUMNS = "id, hcode, medicine_code, generic_name, strength, unit, reorder_point, min_stock, max_stock, lead_time_days, review_period_days, is_active"
+
+
+class ChangeFeedResetRequired(Exception):
+    """token เก่ากว่าข้อมูลที่ยังเก็บไว้ (หรือไม่ตรงกับฐานข้อมูล) client ต้องโหลดข้อมูลทั้งหมดใหม่"""
+
+
+def record_changes(hcode, entity, entity_ids, cursor):
+    """
+    บันทึกว่า entity_ids ของหน่วยบริการเปลี่ยน ต้องเรียกด้วย cursor ของ transaction ที่เขียนข้อมูลนั้น
+    ไม่ได้เก็บค่าของแถว: feed อ่านค่าปัจจุบันตอนขอ (แถวที่ไม่มีแล้วจะถูกรายงานเป็น delete)
+    """
+    record_change_set(hcode, {entity: entity_ids}, cursor)
+
+
+def record_change_set(hcode, changes, cursor):
+    """
+    บันทึกการเปลี่ยนแปลงหลายชนิดของ transaction เดียวด้วย seq เดียว (changes: dict entity -> entity_ids)
+    แถวตัวนับ change_seq ถูกล็อกจนจบ transaction จึงควรเรียกครั้งเดียวช่วงท้าย transaction
+    """
+    rows = [
+        (entity, entity_id)
+        for entity, entity_ids in changes.items()
+        for entity_id in dict.fromkeys(int(entity_id) for entity_id in entity_ids)
+    ]
+    if not hcode or not rows:
+        return
+    cursor.execute(
+        "INSERT INTO clinic_data_versions (hcode, change_seq) VALUES (%s, LAST_INSERT_ID(1)) "
+        "ON DUPLICATE KEY UPDATE change_seq = LAST_INSERT_ID(change_seq + 1)",
+        (hcode,)
+    )
+    cursor.execute("SELECT LAST_INSERT_ID() AS seq")
+    seq = int(cursor.fetchone()['seq'])
+    db_insert_many('change_log', ['hcode', 'seq', 'entity', 'entity_id'], [(hcode, seq, entity, entity_id) for entity, entity_id in rows], cursor)
+
+
+def record_changes_by_hcode(entity, hcode_entity_pairs, cursor):
+    """record_changes จากรายการ (hcode, entity_id) หลายหน่วยบริการ (ล็อกแถวตัวนับตามลำดับ hcode เพื่อไม่ให้ deadlock)"""
+    entity_ids_by_hcode = {}
+    for hcode, entity_id in hcode_entity_pairs:
+        entity_ids_by_hcode.setdefault(hcode, []).append(entity_id)
+    for hcode in sorted(entity_ids_by_hcode):
+        record_changes(hcode, entity, entity_ids_by_hcode[hcode], cursor)
+
+
+def require_change_feed_resync(cursor, hcode=None):
+    """บังคับให้ client ของหน่วยบริการ (หรือทุกหน่วยบริการ) โหลดข้อมูลใหม่ทั้งหมด เช่น หลังสร้าง stock_balance ใหม่"""
+    where_sql, params = ("WHERE hcode = %s", (hcode,)) if hcode else ("", ())
+    cursor.execute(f"UPDATE clinic_data_versions SET change_seq = change_seq + 1, pruned_seq = change_seq {where_sql}", params)
+
+
+def prune_change_log(cursor, older_than_days):
+    """
+    ลบ change_log ที่เก่ากว่า older_than_days วัน และจำ seq สูงสุดที่ลบไว้ใน pruned_seq
+    client ที่ถือ token เก่ากว่านั้นจะได้ reset_required แทนการพลาดการเปลี่ยนแปลงโดยไม่รู้ตัว คืนค่าจำนวนแถวที่ลบ
+    """
+    cursor.execute(
+        """
+        UPDATE clinic_data_versions cdv
+        JOIN (SELECT hcode, MAX(seq) AS max_seq FROM change_log WHERE created_at < NOW() - INTERVAL %s DAY GROUP BY hcode) pruned
+          ON pruned.hcode = cdv.hcode
+        SET cdv.pruned_seq = GREATEST(cdv.pruned_seq, pruned.max_seq)
+        """,
+        (older_than_days,)
+    )
+    cursor.execute(
+        "DELETE cl FROM change_log cl JOIN clinic_data_versions cdv ON cdv.hcode = cl.hcode WHERE cl.seq <= cdv.pruned_seq"
+    )
+    return cursor.rowcount
+
+
+def encode_change_token(hcode, seq):
+    return encode_page_cursor([hcode, seq])
+
+
+def decode_change_token(hcode, token):
+    """คืนค่า seq จาก token (ValueError เมื่อ token ไม่ถูกต้องหรือเป็นของหน่วยบริการอื่น)"""
+    values = decode_page_cursor(token)
+    if len(values) != 2 or values[0] != hcode or not isinstance(values[1], int) or values[1] < 0:
+        raise ValueError("token ไม่ถูกต้องสำหรับหน่วยบริการนี้")
+    return values[1]
+
+
+def _read_change_rows(hcode, since_seq, limit, cursor):
+    """
+    แถวของ change_log หลัง since_seq ไม่เกิน limit แถว โดยไม่ตัดกลาง seq (การเปลี่ยนแปลงของ transaction เดียวกันมาด้วยกันเสมอ)
+    คืนค่า (rows, has_more)
+    """
+    cursor.execute(
+        "SELECT seq, entity, entity_id FROM change_log WHERE hcode = %s AND seq > %s ORDER BY seq, id LIMIT %s",
+        (hcode, since_seq, limit + 1)
+    )
+    rows = cursor.fetchall()
+    if len(rows) <= limit:
+        return rows, False
+    rows = rows[:limit]
+    last_seq = rows[-1]['seq']
+    if rows[0]['seq'] != last_seq:
+        return [row for row in rows if row['seq'] != last_seq], True
+    # transaction เดียวมีการเปลี่ยนแปลงมากกว่า limit: ส่งทั้ง seq
+    cursor.execute("SELECT seq, entity, entity_id FROM change_log WHERE hcode = %s AND seq = %s ORDER BY id", (hcode, last_seq))
+    return cursor.fetchall(), True
+
+
+def _fetch_current_rows(query, hcode, ids, cursor):
+    if not ids:
+        return []
+    cursor.execute(query.format(placeholders=build_in_placeholders(ids)), (hcode, *ids))
+    return cursor.fetchall()
+
+
+def read_change_feed(hcode, since_seq, limit, cursor):
+    """
+    การเปลี่ยนแปลงของหน่วยบริการหลัง since_seq: upserts (ค่าปัจจุบันของแถว) และ deletes (id ที่ไม่มีแล้ว/ปิดใช้งาน)
+    ควรเรียกใน transaction แบบอ่านอย่างเดียวเพื่อให้ตัวนับและ change_log มาจาก snapshot เดียวกัน
+    since_seq = None คือเริ่มต้นใหม่: คืนเฉพาะ token ปัจจุบัน (client โหลดข้อมูลเต็มหลังได้ token แล้วจึงขอ feed ต่อ)
+    """
+    cursor.execute("SELECT change_seq, pruned_seq FROM clinic_data_versions WHERE hcode = %s", (hcode,))
+    version_row = cursor.fetchone()
+    current_seq = int(version_row['change_seq']) if version_row else 0
+    pruned_seq = int(version_row['pruned_seq']) if version_row else 0
+
+    feed = {
+        "hcode": hcode,
+        "medicines": {"upserts": [], "deletes": []},
+        "stock": {"upserts": [], "deletes": []},
+        "requisitions": {"upserts": [], "deletes": []},
+        "has_more": False,
+    }
+    if since_seq is None:
+        feed["next_token"] = encode_change_token(hcode, current_seq)
+        feed["full_resync"] = True
+        return feed
+    if since_seq < pruned_seq or since_seq > current_seq:
+        raise ChangeFeedResetRequired()
+
+    rows, has_more = _read_change_rows(hcode, since_seq, limit, cursor)
+    next_seq = rows[-1]['seq'] if has_more else current_seq
+    changed_ids = {CHANGE_ENTITY_MEDICINE: [], CHANGE_ENTITY_STOCK: [], CHANGE_ENTITY_REQUISITION: []}
+    for row in rows:
+        changed_ids.setdefault(row['entity'], []).append(int(row['entity_id']))
+    changed_ids = {entity: list(dict.fromkeys(ids)) for entity, ids in changed_ids.items()}
+
+    medicines = _fetch_current_rows(
+        f"SELECT {MEDICINE_CHANGE_COLUMNS} FROM medicines WHERE hcode = %s AND id IN ({{placeholders}})",
+        hcode, changed_ids[CHANGE_ENTITY_MEDICINE], cursor
+    )
+    feed["medicines"]["upserts"] = [medicine for medicine in medicines if medicine['is_active']]
+    active_medicine_ids = {medicine['id'] for medicine in feed["medicines"]["upserts"]}
+    feed["medicines"]["deletes"] = [medicine_id for medicine_id in changed_ids[CHANGE_ENTITY_MEDICINE] if medicine_id not in active_medicine_ids]
+
+    stock = _fetch_current_rows(
+        "SELECT medicine_id, total_on_hand, nearest_expiry, updated_at FROM stock_balance WHERE hcode = %s AND medicine_id IN ({placeholders})",
+        hcode, changed_ids[CHANGE_ENTITY_STOCK], cursor
+    )
+    feed["stock"]["upserts"] = stock
+    stock_medicine_ids = {row['medicine_id'] for row in stock}
+    feed["stock"]["deletes"] = [medicine_id for medicine_id in changed_ids[CHANGE_ENTITY_STOCK] if medicine_id not in stock_medicine_ids]
+
+    requisitions = _fetch_current_rows(
+        "SELECT id, requisition_number, requisition_date, status, approval_date, updated_at FROM requisitions WHERE requester_hcode = %s AND id IN ({placeholders})",
+        hcode, changed_ids[CHANGE_ENTITY_REQUISITION], cursor
+    )
+    feed["requisitions"]["upserts"] = requisitions
+    requisition_ids = {row['id'] for row in requisitions}
+    feed["requisitions"]["deletes"] = [requisition_id for requisition_id in changed_ids[CHANGE_ENTITY_REQUISITION] if requisition_id not in requisition_ids]
+
+    feed["next_token"] = encode_change_token(hcode, next_seq)
+    feed["has_more"] = has_more
+    return feed
@@ -0,0 +1,141 @@
+# /helpers/compression.py
+# บีบอัด response (gzip/deflate ตาม Accept-Encoding ของ client) และรับ request body ที่ client บีบอัดมาด้วย gzip หรือ deflate (ระบุใน header Content-Encoding)
+# หน่วยบริการเชื่อมต่อผ่านอินเทอร์เน็ตที่ช้า: JSON ขนาดใหญ่ (รายการยา, สรุปคลังยา, preview_items) มักเล็กลงหลายเท่าเมื่อบีบอัด
+import gzip
+import json
+import logging
+import os
+import zlib
+from io import BytesIO
+from flask import request
+
+logger = logging.getLogger(__name__)
+
+COMPRESSION_CONFIG = {
+    'enabled': os.getenv('COMPRESSION_ENABLED', '1').lower() not in ('0', 'false', 'no'),
+    'min_bytes': int(os.getenv('COMPRESSION_MIN_BYTES', 1024)),                        # response ที่เล็กกว่านี้ส่งตามเดิม
+    'level': int(os.getenv('COMPRESSION_LEVEL', 6)),                                   # 1 (เร็ว) - 9 (เล็กที่สุด)
+    'max_request_bytes': int(os.getenv('REQUEST_MAX_DECOMPRESSED_BYTES', 100 * 1024 * 1024)),  # ขนาดสูงสุดของ request หลังคลายการบีบอัด
+}
+
+# ชนิดของ response ที่บีบอัด (ไฟล์ Excel, รูปภาพ ฯลฯ ถูกบีบอัดมาแล้ว)
+COMPRESSIBLE_MIMETYPES = {
+    'application/json', 'application/javascript', 'text/html', 'text/css', 'text/plain', 'text/csv', 'text/javascript',
+}
+SUPPORTED_ENCODINGS = ('gzip', 'deflate')
+
+
+class RequestBodyTooLarge(ValueError):
+    """request body หลังคลายการบีบอัดใหญ่เกินกำหนด"""
+
+
+def compress_body(data, encoding, level):
+    """บีบอัด bytes ด้วย gzip หรือ deflate (รูปแบบ zlib ตาม HTTP) mtime=0 ทำให้ข้อมูลเดิมได้ผลลัพธ์เดิมเสมอ"""
+    if encoding == 'gzip':
+        return gzip.compress(data, compresslevel=level, mtime=0)
+    return zlib.compress(data, level)
+
+
+def decompress_body(data, encoding, max_bytes):
+    """คลายการบีบอัด request body ไม่เกิน max_bytes (ValueError เมื่อข้อมูลเสีย, RequestBodyTooLarge เมื่อใหญ่เกินกำหนด)"""
+    # wbits 16+MAX_WBITS = gzip, 32+MAX_WBITS = ตรวจหัว zlib/gzip เอง (client บางตัวส่ง deflate เป็น gzip)
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS if encoding == 'gzip' else 32 + zlib.MAX_WBITS)
+    try:
+        output = decompressor.decompress(data, max_bytes + 1)
+        if len(output) > max_bytes or decompressor.unconsumed_tail:
+            raise RequestBodyTooLarge(f"ข้อมูลหลังคลายการบีบอัดใหญ่เกิน {max_bytes} bytes")
+        output += decompressor.flush()
+    except zlib.error as e:
+        raise ValueError(f"ข้อมูลที่บีบอัดเสียหาย: {e}") from e
+    if not decompressor.eof:
+        raise ValueError("ข้อมูลที่บีบอัดไม่ครบ")
+    return output
+
+
+class RequestDecompressionMiddleware:
+    """
+    WSGI middleware: คลายการบีบอัด request body ก่อนถึง Flask (get_json, form และไฟล์อัปโหลดอ่านได้ตามปกติ)
+    Content-Encoding ที่ไม่รองรับตอบ 415 ข้อมูลเสียตอบ 400 และใหญ่เกินกำหนดตอบ 413
+    """
+
+    def __init__(self, wsgi_app, max_bytes):
+        self.wsgi_app = wsgi_app
+        self.max_bytes = max_bytes
+
+    def __call__(self, environ, start_response):
+        encoding = environ.get('HTTP_CONTENT_ENCODING', '').strip().lower()
+        if not encoding or encoding == 'identity':
+            return self.wsgi_app(environ, start_response)
+        if encoding not in SUPPORTED_ENCODINGS:
+            return self._error(start_response, '415 Unsupported Media Type', f"ไม่รองรับ Content-Encoding: {encoding} (รองรับ gzip, deflate)")
+        try:
+            content_length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            content_length = 0
+        # ข้อมูลที่บีบอัดแล้วใหญ่เกินกำหนดตอบ 413 โดยไม่อ่าน body เข้าหน่วยความจำ
+        if content_length > self.max_bytes:
+            return self._error(start_response, '413 Request Entity Too Large', f"ข้อมูลที่ส่งมามีขนาดเกิน {self.max_bytes} bytes")
+        if content_length:
+            data = environ['wsgi.input'].read(content_length)
+        else:
+            # chunked transfer: อ่านได้จนจบเฉพาะเมื่อ server ระบุว่า input มีจุดสิ้นสุด (อ่านไม่เกิน max_bytes + 1 เพื่อรู้ว่าเกินหรือไม่)
+            data = environ['wsgi.input'].read(self.max_bytes + 1) if environ.get('wsgi.input_terminated') else b''
+            if len(data) > self.max_bytes:
+                return self._error(start_response, '413 Request Entity Too Large', f"ข้อมูลที่ส่งมามีขนาดเกิน {self.max_bytes} bytes")
+        try:
+            body = decompress_body(data, encoding, self.max_bytes)
+        except RequestBodyTooLarge as e:
+            return self._error(start_response, '413 Request Entity Too Large', str(e))
+        except ValueError as e:
+            return self._error(start_response, '400 Bad Request', str(e))
+        environ['wsgi.input'] = BytesIO(body)
+        environ['CONTENT_LENGTH'] = str(len(body))
+        environ.pop('HTTP_CONTENT_ENCODING', None)
+        return self.wsgi_app(environ, start_response)
+
+    @staticmethod
+    def _error(start_response, status, message):
+        body = json.dumps({"error": message}, ensure_ascii=False).encode('utf-8')
+        start_response(status, [('Content-Type', 'application/json'), ('Content-Length', str(len(body)))])
+        return [body]
+
+
+def compress_response(response):
+    """after_request: บีบอัด response ที่ใหญ่กว่า min_bytes ตาม Accept-Encoding (gzip ก่อน deflate เมื่อ client รับทั้งคู่)"""
+    if response.mimetype not in COMPRESSIBLE_MIMETYPES:
+        return response
+    response.vary.add('Accept-Encoding')
+    if (response.status_code < 200 or response.status_code in (204, 206, 304) or response.direct_passthrough
+            or response.is_streamed or 'Content-Encoding' in response.headers or response.cache_control.no_transform):
+        return response
+    encoding = request.accept_encodings.best_match(SUPPORTED_ENCODINGS)
+    if not encoding:
+        return response
+    data = response.get_data()
+    if len(data) < COMPRESSION_CONFIG['min_bytes']:
+        return response
+    compressed = compress_body(data, encoding, COMPRESSION_CONFIG['level'])
+    if len(compressed) >= len(data):
+        return response
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    # ETag แบบ strong ต้องต่างกันตาม encoding (ETag ของระบบเป็นแบบ weak จึงใช้ค่าเดิมได้)
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(f"{etag}-{encoding}")
+    return response
+
+
+def init_compression(app):
+    """
+    ติดตั้งการบีบอัดให้ Flask app ตาม COMPRESSION_CONFIG (ปิดได้ด้วย COMPRESSION_ENABLED=0 เช่น เมื่อ nginx บีบอัดให้แล้ว)
+    คลายการบีบอัด request ไม่เกิน MAX_CONTENT_LENGTH ของ app (ถ้ากำหนดไว้) เพื่อไม่ให้คลายข้อมูลที่ Flask จะปฏิเสธอยู่แล้ว
+    """
+    max_request_bytes = COMPRESSION_CONFIG['max_request_bytes']
+    if app.config.get('MAX_CONTENT_LENGTH'):
+        max_request_bytes = min(max_request_bytes, app.config['MAX_CONTENT_LENGTH'])
+    app.wsgi_app = RequestDecompressionMiddleware(app.wsgi_app, max_request_bytes)
+    if COMPRESSION_CONFIG['enabled']:
+        app.after_request(compress_response)
+    else:
+        logger.info("ปิดการบีบอัด response (COMPRESSION_ENABLED=0)")
@@ -0,0 +1,69 @@
+# /helpers/data_versions.py
+# ตัวนับการเปลี่ยนแปลงข้อมูลต่อหน่วยบริการ (clinic_data_versions) ใช้สร้าง ETag ของรายการยาและยอดคงเหลือ
+# client ส่ง If-None-Match มา หากตัวนับยังไม่เปลี่ยนจะตอบ 304 โดยไม่ต้องรัน query รวมยอด
+from flask import current_app, request
+from helpers.database import db_execute_query
+
+# ขอบเขตข้อมูลที่มีตัวนับ -> คอลัมน์ในตาราง clinic_data_versions
+DATA_VERSION_COLUMNS = {
+    'medicines': 'medicines_version',  # ข้อมูลหลักของยา (เพิ่ม/แก้ไข/เปิด-ปิด, Min/Max)
+    'stock': 'stock_version',          # ยอดคงเหลือใน stock_balance
+}
+
+
+def bump_data_version(hcode, scope, cursor):
+    """
+    เพิ่มตัวนับของหน่วยบริการ ต้องเรียกด้วย cursor ของ transaction ที่แก้ไขข้อมูล (ตัวนับ commit พร้อมข้อมูล)
+    แถวของหน่วยบริการถูกล็อกจนจบ transaction จึงควรเรียกช่วงท้ายของ transaction
+    """
+    column = DATA_VERSION_COLUMNS[scope]
+    cursor.execute(
+        f"INSERT INTO clinic_data_versions (hcode, {column}) VALUES (%s, 1) ON DUPLICATE KEY UPDATE {column} = {column} + 1",
+        (hcode,)
+    )
+
+
+def bump_all_data_versions(scope, cursor):
+    """เพิ่มตัวนับของทุกหน่วยบริการ (เช่น สร้าง stock_balance ใหม่ทั้งระบบ)"""
+    column = DATA_VERSION_COLUMNS[scope]
+    cursor.execute(f"UPDATE clinic_data_versions SET {column} = {column} + 1")
+
+
+def get_clinic_data_etag(hcode, scopes):
+    """
+    ETag (แบบ weak) ของข้อมูลหน่วยบริการจากตัวนับของขอบเขตที่ระบุ เช่น W/"12345-m3-s17"
+    คืนค่า None เมื่อไม่ระบุ hcode หรืออ่านตัวนับไม่ได้ (จะไม่ใช้ conditional GET)
+    """
+    if not hcode:
+        return None
+    # aggregate คืนค่าหนึ่งแถวเสมอ (0 เมื่อหน่วยบริการยังไม่มีแถวตัวนับ) จึงได้ None เฉพาะเมื่อ query ผิดพลาด
+    row = db_execute_query(
+        "SELECT COALESCE(MAX(medicines_version), 0) AS medicines_version, COALESCE(MAX(stock_version), 0) AS stock_version "
+        "FROM clinic_data_versions WHERE hcode = %s",
+        (hcode,), fetchone=True
+    )
+    if row is None:
+        return None
+    parts = [f"{scope[0]}{row[DATA_VERSION_COLUMNS[scope]]}" for scope in scopes]
+    return f'W/"{hcode}-{"-".join(parts)}"'
+
+
+def is_not_modified(etag):
+    """client มีข้อมูลเวอร์ชันเดียวกันอยู่แล้วหรือไม่ (ตรวจ If-None-Match แบบ weak comparison)"""
+    return bool(etag) and request.if_none_match.contains_weak(etag.removeprefix('W/').strip('"'))
+
+
+def not_modified_response(etag):
+    """response 304 ที่ไม่มี body พร้อม ETag เดิม"""
+    response = current_app.response_class(status=304)
+    response.headers['ETag'] = etag
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+def with_etag(response, etag):
+    """ใส่ ETag ให้ response 200 และบังคับให้ client ตรวจกับ server ทุกครั้ง (no-cache) ก่อนใช้ข้อมูลเดิม"""
+    if etag and response.status_code == 200:
+        response.headers['ETag'] = etag
+        response.headers['Cache-Control'] = 'no-cache'
+    return response
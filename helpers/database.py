@@ -1,7 +1,13 @@
 # /helpers/database.py
 import mysql.connector
 from mysql.connector import Error
+from collections import deque
+import logging
 import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
 
 
 # โหลดการตั้งค่าฐานข้อมูลจาก environment variables
@@ -14,13 +20,239 @@ DB_CONFIG = {
     'database': os.getenv('DB_NAME'),
 }
 
+# การตั้งค่า Connection Pool (ต่อ 1 process ของ gunicorn worker)
+DB_POOL_CONFIG = {
+    'pool_size': int(os.getenv('DB_POOL_SIZE', 10)),            # จำนวน connection ที่เก็บไว้ใช้ซ้ำ
+    'max_overflow': int(os.getenv('DB_POOL_MAX_OVERFLOW', 5)),  # จำนวน connection ชั่วคราวที่เปิดเพิ่มได้เมื่อ pool เต็ม
+    'timeout': float(os.getenv('DB_POOL_TIMEOUT', 10)),         # วินาทีที่รอ connection ว่างก่อนยอมแพ้
+    'recycle': int(os.getenv('DB_POOL_RECYCLE', 1800)),         # อายุสูงสุดของ connection (วินาที) ก่อนเปิดใหม่
+}
+
+
+# connection ของ process แม่ที่ process ลูกได้มาตอน fork: เก็บ reference ไว้ตลอดอายุ process
+# เพื่อไม่ให้ถูกปิดตอน garbage collect (การปิดส่ง COM_QUIT ผ่าน socket ที่ใช้ร่วมกับ process แม่)
+_inherited_connections = []
+
+
+class PooledConnection:
+    """
+    ตัวห่อ connection ที่ยืมมาจาก pool
+    ทำงานเหมือน mysql.connector connection ทุกประการ ยกเว้น close() จะคืน connection กลับเข้า pool แทนการปิดจริง
+    """
+
+    def __init__(self, pool, raw_conn, created_at):
+        self._pool = pool
+        self._raw_conn = raw_conn
+        self._created_at = created_at
+
+    def close(self):
+        if self._raw_conn is not None:
+            raw_conn, self._raw_conn = self._raw_conn, None
+            self._pool.release(raw_conn, self._created_at)
+
+    def __getattr__(self, name):
+        if self._raw_conn is None:
+            raise Error(msg="Connection has already been returned to the pool")
+        return getattr(self._raw_conn, name)
+
+
+class ConnectionPool:
+    """
+    Connection pool แบบจำกัดขนาดสำหรับ MySQL
+    - เก็บ connection ว่างไว้ใช้ซ้ำไม่เกิน pool_size และเปิดเพิ่มชั่วคราวได้ไม่เกิน max_overflow
+    - ตรวจสุขภาพ connection ทุกครั้งที่ยืม (ping + อายุ connection)
+    - ผูกกับ process ที่สร้าง เพื่อไม่ให้ worker ที่ fork มาใช้ socket ร่วมกับ process แม่
+    """
+
+    def __init__(self, db_config, pool_size, max_overflow, timeout, recycle):
+        self._db_config = db_config
+        self.pool_size = max(1, pool_size)
+        self.max_overflow = max(0, max_overflow)
+        self.timeout = timeout
+        self.recycle = recycle
+        self.pid = os.getpid()
+        self._idle = deque()
+        self._cond = threading.Condition()
+        self._open_count = 0
+        self._in_use = 0
+        self._stats = {
+            'checkouts': 0,
+            'connections_created': 0,
+            'connections_discarded': 0,
+            'waits': 0,
+            'wait_time_total_ms': 0.0,
+            'wait_time_max_ms': 0.0,
+            'timeouts': 0,
+            'peak_in_use': 0,
+        }
+
+    def _open_raw_connection(self):
+        conn = mysql.connector.connect(**self._db_config)
+        with self._cond:
+            self._stats['connections_created'] += 1
+        return conn, time.monotonic()
+
+    def _is_healthy(self, raw_conn, created_at):
+        if self.recycle > 0 and time.monotonic() - created_at > self.recycle:
+            return False
+        try:
+            return raw_conn.is_connected()
+        except Error:
+            return False
+
+    def abandon_inherited(self):
+        """ทิ้ง connection ว่างของ pool ที่สืบทอดมาจาก process แม่โดยไม่ปิด (เรียกใน process ลูกเท่านั้น ไม่ใช้ lock ของ pool)"""
+        _inherited_connections.extend(raw_conn for raw_conn, _ in self._idle)
+        self._idle.clear()
+
+    def _discard(self, raw_conn):
+        try:
+            raw_conn.close()
+        except Error:
+            pass
+
+    def acquire(self):
+        """ยืม connection จาก pool (รอได้ไม่เกิน timeout วินาที)"""
+        if os.getpid() != self.pid:
+            raise Error(msg="Connection pool belongs to another process; use get_connection_pool()")
+        deadline = time.monotonic() + self.timeout
+        waited_since = None
+        while True:
+            raw_conn, created_at, must_open = None, None, False
+            with self._cond:
+                if self._idle:
+                    raw_conn, created_at = self._idle.pop()
+                elif self._open_count < self.pool_size + self.max_overflow:
+                    self._open_count += 1
+                    must_open = True
+                else:
+                    if waited_since is None:
+                        waited_since = time.monotonic()
+                        self._stats['waits'] += 1
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats['timeouts'] += 1
+                        self._record_wait(waited_since)
+                        raise Error(msg=f"Timed out after {self.timeout}s waiting for a pooled database connection")
+                    self._cond.wait(remaining)
+                    continue
+
+            if must_open:
+                try:
+                    raw_conn, created_at = self._open_raw_connection()
+                except Exception:
+                    with self._cond:
+                        self._open_count -= 1
+                        self._cond.notify()
+                    raise
+            elif not self._is_healthy(raw_conn, created_at):
+                self._discard(raw_conn)
+                with self._cond:
+                    self._stats['connections_discarded'] += 1
+                    self._open_count -= 1
+                continue
+
+            with self._cond:
+                self._in_use += 1
+                self._stats['checkouts'] += 1
+                self._stats['peak_in_use'] = max(self._stats['peak_in_use'], self._in_use)
+                if waited_since is not None:
+                    self._record_wait(waited_since)
+            return PooledConnection(self, raw_conn, created_at)
+
+    def _record_wait(self, waited_since):
+        waited_ms = (time.monotonic() - waited_since) * 1000
+        self._stats['wait_time_total_ms'] += waited_ms
+        self._stats['wait_time_max_ms'] = max(self._stats['wait_time_max_ms'], waited_ms)
+
+    def release(self, raw_conn, created_at):
+        """คืน connection เข้า pool (rollback transaction ที่ค้างอยู่ก่อนเสมอ)"""
+        if os.getpid() != self.pid:
+            # connection ของ process แม่ ห้ามใช้หรือปิดใน process ลูก
+            _inherited_connections.append(raw_conn)
+            return
+
+        reusable = True
+        try:
+            raw_conn.rollback()
+        except Error:
+            reusable = False
+
+        with self._cond:
+            self._in_use -= 1
+            if reusable and len(self._idle) < self.pool_size:
+                self._idle.append((raw_conn, created_at))
+                raw_conn = None
+            else:
+                self._open_count -= 1
+                self._stats['connections_discarded'] += 1
+            self._cond.notify()
+
+        if raw_conn is not None:
+            self._discard(raw_conn)
+
+    def stats(self):
+        """สถิติการใช้งาน pool สำหรับใช้ปรับขนาด pool"""
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update({
+                'pid': self.pid,
+                'pool_size': self.pool_size,
+                'max_overflow': self.max_overflow,
+                'timeout': self.timeout,
+                'open': self._open_count,
+                'idle': len(self._idle),
+                'in_use': self._in_use,
+            })
+        stats['wait_time_avg_ms'] = round(stats['wait_time_total_ms'] / stats['waits'], 3) if stats['waits'] else 0.0
+        stats['wait_time_total_ms'] = round(stats['wait_time_total_ms'], 3)
+        stats['wait_time_max_ms'] = round(stats['wait_time_max_ms'], 3)
+        return stats
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_connection_pool():
+    """คืนค่า pool ของ process ปัจจุบัน (สร้างใหม่อัตโนมัติหลัง fork)"""
+    global _pool
+    pool = _pool
+    if pool is None or pool.pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool.pid != os.getpid():
+                if _pool is not None:
+                    # fork โดยไม่ผ่าน register_at_fork (เช่น แพลตฟอร์มที่ไม่รองรับ)
+                    _pool.abandon_inherited()
+                _pool = ConnectionPool(DB_CONFIG, **DB_POOL_CONFIG)
+            pool = _pool
+    return pool
+
+
+def _reset_pool_after_fork():
+    # gunicorn pre-fork: ให้ worker แต่ละตัวสร้าง pool ของตัวเอง
+    global _pool, _pool_lock
+    if _pool is not None:
+        _pool.abandon_inherited()
+    _pool = None
+    _pool_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_pool_after_fork)
+
+
+def get_db_pool_stats():
+    """สถิติของ connection pool ใน process นี้"""
+    return get_connection_pool().stats()
+
+
 def get_db_connection():
-    """สร้างการเชื่อมต่อกับฐานข้อมูล MySQL"""
+    """ยืมการเชื่อมต่อกับฐานข้อมูล MySQL จาก connection pool (เรียก close() เพื่อคืน connection)"""
     try:
-        conn = mysql.connector.connect(**DB_CONFIG)
-        return conn
+        return get_connection_pool().acquire()
     except Error as e:
-        print(f"Error connecting to MySQL database: {e}")
+        logger.error(f"Error connecting to MySQL database: {e}")
         return None
 
 def db_execute_query(query, params=None, fetchone=False, fetchall=False, commit=False, get_last_id=False, cursor_to_use=None):
@@ -36,7 +268,7 @@ def db_execute_query(query, params=None, fetchone=False, fetchall=False, commit=
         if not is_external_cursor:
             conn = get_db_connection()
             if conn is None:
-                print("Failed to get database connection.")
+                logger.error("Failed to get database connection.")
                 return None
             cursor = conn.cursor(dictionary=True)  # คืนค่าผลลัพธ์เป็น dictionary
 
@@ -54,9 +286,9 @@ def db_execute_query(query, params=None, fetchone=False, fetchall=False, commit=
 
         return result
     except Error as e:
-        print(f"Database Error: {e} for query: {query} with params: {params}")
+        logger.error(f"Database Error: {e} for query: {query} with params: {params}")
         if conn and commit and not is_external_cursor:
-            print("Rolling back transaction due to error.")
+            logger.warning("Rolling back transaction due to error.")
             conn.rollback()
         return None  # คืนค่า None หากเกิดข้อผิดพลาด
     finally:
@@ -65,3 +297,50 @@ def db_execute_query(query, params=None, fetchone=False, fetchall=False, commit=
                 cursor.close()
             if conn:
                 conn.close()
+
+
+def build_in_placeholders(values):
+    """สร้าง placeholder '%s, %s, ...' สำหรับเงื่อนไข IN (...) ตามจำนวนค่าที่ส่งมา"""
+    return ', '.join(['%s'] * len(values))
+
+
+def db_insert_many(table, columns, rows, cursor_to_use, batch_size=500, on_duplicate_sql=None):
+    """
+    INSERT หลายแถวด้วยคำสั่งเดียว (multi-row VALUES) แบ่งเป็นชุดละไม่เกิน batch_size แถว
+    on_duplicate_sql: ส่วนหลัง ON DUPLICATE KEY UPDATE (เช่น "qty = qty + VALUES(qty)") สำหรับ upsert
+    ต้องส่ง cursor ที่อยู่ใน transaction มาเสมอ ฟังก์ชันนี้ไม่ commit เอง
+    คืนค่าจำนวนแถวที่ได้รับผลกระทบ
+    """
+    if not rows:
+        return 0
+    column_sql = ', '.join(f"`{column}`" for column in columns)
+    row_placeholder = '(' + ', '.join(['%s'] * len(columns)) + ')'
+    affected = 0
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start:start + batch_size]
+        query = f"INSERT INTO {table} ({column_sql}) VALUES {', '.join([row_placeholder] * len(batch))}"
+        if on_duplicate_sql:
+            query += f" ON DUPLICATE KEY UPDATE {on_duplicate_sql}"
+        cursor_to_use.execute(query, [value for row in batch for value in row])
+        affected += cursor_to_use.rowcount
+    return affected
+
+
+def db_update_many_by_id(table, columns, rows, cursor_to_use, batch_size=500):
+    """
+    UPDATE หลายแถวที่มีค่าต่างกันด้วยคำสั่งเดียว: SET col = CASE id WHEN ... THEN ... END WHERE id IN (...)
+    rows: list ของ tuple (id, ค่าของ columns ตามลำดับ) แบ่งเป็นชุดละไม่เกิน batch_size แถว
+    ต้องส่ง cursor ที่อยู่ใน transaction มาเสมอ ฟังก์ชันนี้ไม่ commit เอง
+    """
+    if not rows:
+        return 0
+    affected = 0
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start:start + batch_size]
+        ids = [row[0] for row in batch]
+        case_sql = " ".join(["WHEN %s THEN %s"] * len(batch))
+        set_sql = ", ".join(f"`{column}` = (CASE id {case_sql} END)" for column in columns)
+        params = [value for i in range(len(columns)) for row in batch for value in (row[0], row[i + 1])]
+        cursor_to_use.execute(f"UPDATE {table} SET {set_sql} WHERE id IN ({build_in_placeholders(ids)})", params + ids)
+        affected += cursor_to_use.rowcount
+    return affected
@@ -0,0 +1,44 @@
+# /helpers/dispense_uploads.py
+# สถานะของคำขอตัดจ่ายแบบ bulk ต่อ idempotency_key: เอกสารที่บันทึกลง ตำแหน่งรายการถัดไป และยอดสะสม
+# สถานะเลื่อนใน transaction เดียวกับการบันทึกแต่ละ chunk คำขอที่ส่งซ้ำหลัง timeout จึงทำต่อจากส่วนที่ commit แล้ว
+# และคำขอที่ซ้อนกัน (คำขอเดิมยังทำงานอยู่ขณะ client ส่งซ้ำ) ทำ chunk เดียวกันซ้ำไม่ได้
+
+
+def get_upload_request(hcode, idempotency_key, cursor, for_update=False):
+    """สถานะของคำขอ (dict) หรือ None เมื่อยังไม่เคยบันทึก chunk ใดของคำขอนี้"""
+    cursor.execute(
+        "SELECT fingerprint, dispense_record_id, next_index, processed_total, failed_total, completed "
+        f"FROM dispense_upload_requests WHERE hcode = %s AND idempotency_key = %s{' FOR UPDATE' if for_update else ''}",
+        (hcode, idempotency_key)
+    )
+    return cursor.fetchone()
+
+
+def claim_upload_request(hcode, idempotency_key, fingerprint, next_index, cursor):
+    """
+    ล็อกสถานะของคำขอก่อนบันทึก chunk ที่เริ่มที่ next_index (สร้างแถวเมื่อยังไม่มี) เรียกเป็นคำสั่งแรกของ transaction ของ chunk
+    คืนค่า True เมื่อสถานะยังอยู่ที่ next_index, False เมื่อคำขออื่นที่ใช้รหัสเดียวกันบันทึกต่อไปแล้วหรือรายการไม่ตรงกัน
+    """
+    # แถวที่กำลังถูกสร้างโดยคำขออื่นทำให้คำสั่งนี้รอจนคำขอนั้น commit แล้วจึงเห็นสถานะล่าสุด
+    cursor.execute(
+        "INSERT INTO dispense_upload_requests (hcode, idempotency_key, fingerprint, next_index) VALUES (%s, %s, %s, %s) "
+        "ON DUPLICATE KEY UPDATE hcode = hcode",
+        (hcode, idempotency_key, fingerprint, next_index)
+    )
+    state = get_upload_request(hcode, idempotency_key, cursor, for_update=True)
+    return state['fingerprint'] == fingerprint and state['next_index'] == next_index and not state['completed']
+
+
+def save_upload_request(hcode, idempotency_key, dispense_record_id, next_index, processed_total, failed_total, completed, cursor):
+    """บันทึกสถานะหลังบันทึก chunk (ใน transaction เดียวกับ chunk ที่ claim ไว้)"""
+    cursor.execute(
+        "UPDATE dispense_upload_requests SET dispense_record_id = %s, next_index = %s, processed_total = %s, failed_total = %s, completed = %s "
+        "WHERE hcode = %s AND idempotency_key = %s",
+        (dispense_record_id, next_index, processed_total, failed_total, int(completed), hcode, idempotency_key)
+    )
+
+
+def prune_upload_requests(cursor, older_than_days):
+    """ลบสถานะคำขอที่เก่ากว่า older_than_days วัน (ใช้เฉพาะช่วงที่ client อาจส่งซ้ำ) คืนค่าจำนวนแถวที่ลบ"""
+    cursor.execute("DELETE FROM dispense_upload_requests WHERE created_at < NOW() - INTERVAL %s DAY", (older_than_days,))
+    return cursor.rowcount
@@ -0,0 +1,74 @@
+# /helpers/document_numbers.py
+# ออกเลขที่เอกสาร (DSP, DSPEXC, GRN, REQ) จากตารางตัวนับ document_sequences แทนการค้นเลขล่าสุดด้วย LIKE
+from datetime import datetime
+
+# รูปแบบเลขที่เอกสารแต่ละประเภท และตาราง/คอลัมน์ของเลขเดิม (ใช้ตั้งค่าเริ่มต้นของตัวนับครั้งแรกของวัน)
+DOCUMENT_NUMBER_FORMATS = {
+    'DSP': {"table": "dispense_records", "column": "dispense_record_number", "hcode_column": "hcode", "date_format": "%y%m%d", "width": 3},
+    'DSPEXC': {"table": "dispense_records", "column": "dispense_record_number", "hcode_column": "hcode", "date_format": "%y%m%d", "width": 3},
+    'GRN': {"table": "goods_received_vouchers", "column": "voucher_number", "hcode_column": "hcode", "date_format": "%y%m%d", "width": 3},
+    # เลขใบเบิกไม่แยกตามหน่วยบริการ (REQ-YYYYMMDD-NNNN) จึงใช้ scope ว่าง
+    'REQ': {"table": "requisitions", "column": "requisition_number", "hcode_column": None, "date_format": "%Y%m%d", "width": 4},
+}
+
+
+def _number_prefix(prefix, scope, period):
+    return f"{prefix}-{scope}-{period}-" if scope else f"{prefix}-{period}-"
+
+
+def format_document_number(prefix, scope, period, sequence):
+    """ประกอบเลขที่เอกสาร เช่น DSP-12345-240131-007 หรือ REQ-20240131-0007"""
+    width = DOCUMENT_NUMBER_FORMATS[prefix]['width']
+    return f"{_number_prefix(prefix, scope, period)}{sequence:0{width}d}"
+
+
+def _legacy_last_sequence(prefix, scope, period, cursor):
+    """
+    ลำดับล่าสุดของเลขที่ออกไปแล้วก่อนมีตัวนับ (หรือที่ถูกกรอกเอง) ของวันนั้น
+    เรียกเฉพาะตอนสร้างแถวตัวนับครั้งแรกของ (prefix, scope, period) จึงไม่อยู่ในเส้นทางปกติ
+    """
+    fmt = DOCUMENT_NUMBER_FORMATS[prefix]
+    conditions, params = [f"{fmt['column']} LIKE %s"], [_number_prefix(prefix, scope, period) + '%']
+    if fmt['hcode_column']:
+        conditions.append(f"{fmt['hcode_column']} = %s")
+        params.append(scope)
+    cursor.execute(f"SELECT {fmt['column']} AS number FROM {fmt['table']} WHERE {' AND '.join(conditions)}", tuple(params))
+    last_sequence = 0
+    for row in cursor.fetchall():
+        try:
+            last_sequence = max(last_sequence, int(row['number'].split('-')[-1]))
+        except (IndexError, ValueError):
+            pass
+    return last_sequence
+
+
+def reserve_document_numbers(prefix, cursor, scope='', count=1, on_date=None):
+    """
+    จองเลขที่เอกสารต่อเนื่องกัน count เลขของ (prefix, scope, วัน) ด้วย cursor ของ transaction ที่บันทึกเอกสาร คืนค่า list ของเลขที่เอกสาร
+    ใช้ INSERT ... ON DUPLICATE KEY UPDATE last_value = LAST_INSERT_ID(last_value + count) คำสั่งเดียว:
+    แถวที่มีอยู่แล้วถูกล็อกเฉพาะ record ของ primary key (ไม่มี gap lock แบบ UPDATE แถวที่ยังไม่มี แล้วค่อย INSERT ซึ่งทำให้ deadlock 1213)
+    แถวตัวนับถูกล็อกจนจบ transaction ของผู้เรียก และหาก transaction rollback เลขที่ออกไปจะถูกคืนด้วย จึงไม่มีเลขข้าม
+    """
+    if prefix not in DOCUMENT_NUMBER_FORMATS:
+        raise ValueError(f"ไม่รู้จักประเภทเลขที่เอกสาร {prefix}")
+    if count <= 0:
+        return []
+    scope = scope or ''
+    period = (on_date or datetime.now()).strftime(DOCUMENT_NUMBER_FORMATS[prefix]['date_format'])
+
+    # อ่านแบบไม่ล็อกว่ามีแถวของวันแล้วหรือยัง ค้นเลขเดิมด้วย LIKE เฉพาะแถวแรกของวัน (ค่า seed ใช้เมื่อ INSERT ได้แถวใหม่เท่านั้น)
+    cursor.execute("SELECT 1 AS found FROM document_sequences WHERE prefix = %s AND scope = %s AND period = %s", (prefix, scope, period))
+    seed = 0 if cursor.fetchone() else _legacy_last_sequence(prefix, scope, period, cursor)
+    cursor.execute(
+        "INSERT INTO document_sequences (prefix, scope, period, last_value) VALUES (%s, %s, %s, LAST_INSERT_ID(%s)) "
+        "ON DUPLICATE KEY UPDATE last_value = LAST_INSERT_ID(last_value + %s)",
+        (prefix, scope, period, seed + count, count)
+    )
+    cursor.execute("SELECT LAST_INSERT_ID() AS last_value")
+    last_value = int(cursor.fetchone()['last_value'])
+    return [format_document_number(prefix, scope, period, sequence) for sequence in range(last_value - count + 1, last_value + 1)]
+
+
+def next_document_number(prefix, cursor, scope='', on_date=None):
+    """ออกเลขที่เอกสารถัดไปหนึ่งเลข"""
+    return reserve_document_numbers(prefix, cursor, scope, 1, on_date)[0]
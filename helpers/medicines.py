@@ -0,0 +1,18 @@
+# /helpers/medicines.py
+# ค้นข้อมูลยาของหน่วยบริการที่ใช้ร่วมกันระหว่างการนำเข้าไฟล์รับยาและตัดจ่ายยา
+from helpers.database import build_in_placeholders
+
+
+def fetch_active_medicines_by_code(hcode, medicine_codes, cursor):
+    """
+    ดึงข้อมูลยาที่เปิดใช้งานตามรหัสยาด้วย query IN (...) ครั้งเดียว คืนค่า dict: medicine_code -> medicine
+    ข้อผิดพลาดของฐานข้อมูลส่งต่อเป็น Error (ไม่ถือว่าไม่พบยา)
+    """
+    medicine_codes = list(dict.fromkeys(code for code in medicine_codes if code))
+    if not medicine_codes:
+        return {}
+    cursor.execute(
+        f"SELECT id, medicine_code, generic_name, strength, unit FROM medicines WHERE hcode = %s AND is_active = TRUE AND medicine_code IN ({build_in_placeholders(medicine_codes)})",
+        (hcode, *medicine_codes)
+    )
+    return {str(med['medicine_code']): med for med in cursor.fetchall()}
@@ -0,0 +1,150 @@
+# /helpers/migrations.py
+# ตัวรัน schema migration แบบมีเวอร์ชัน (ไฟล์ migrations/NNNN_ชื่อ.sql) และตัวตรวจ EXPLAIN ของ query ที่ใช้บ่อย
+import hashlib
+import os
+import re
+from mysql.connector import Error
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'migrations')
+MIGRATION_FILE_PATTERN = re.compile(r'^(\d{4})_([\w\-]+)\.sql$')
+
+# error ที่หมายถึง "ทำไปแล้ว" (เช่น ฐานข้อมูลที่สร้างจาก create-database.sql เวอร์ชันใหม่) จึงถือว่าสำเร็จ
+IDEMPOTENT_ERRNOS = {
+    1050: 'table already exists',
+    1060: 'duplicate column name',
+    1061: 'duplicate key name',
+    1091: "can't drop; check that column/key exists",
+    1826: 'duplicate foreign key constraint name',
+}
+
+SCHEMA_MIGRATIONS_DDL = """
+    CREATE TABLE IF NOT EXISTS `schema_migrations` (
+      `version` VARCHAR(20) NOT NULL PRIMARY KEY,
+      `name` VARCHAR(255) NOT NULL,
+      `checksum` CHAR(64) NOT NULL,
+      `applied_at` TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='ประวัติการรัน schema migration'
+"""
+
+
+def list_migrations(migrations_dir=MIGRATIONS_DIR):
+    """รายการไฟล์ migration เรียงตามเวอร์ชัน คืนค่า list ของ dict: version, name, path, checksum"""
+    migrations = []
+    for filename in sorted(os.listdir(migrations_dir)):
+        match = MIGRATION_FILE_PATTERN.match(filename)
+        if not match:
+            continue
+        path = os.path.join(migrations_dir, filename)
+        with open(path, 'rb') as f:
+            checksum = hashlib.sha256(f.read()).hexdigest()
+        migrations.append({"version": match.group(1), "name": match.group(2), "path": path, "checksum": checksum})
+    return migrations
+
+
+def split_sql_statements(sql_text):
+    """แยกไฟล์ SQL เป็นคำสั่งทีละคำสั่ง (ตัดบรรทัด comment '--' และแยกด้วย ';' ท้ายบรรทัด)"""
+    statements, current = [], []
+    for line in sql_text.splitlines():
+        if line.strip().startswith('--'):
+            continue
+        current.append(line)
+        if line.rstrip().endswith(';'):
+            statement = '\n'.join(current).strip().rstrip(';').strip()
+            if statement:
+                statements.append(statement)
+            current = []
+    trailing = '\n'.join(current).strip()
+    if trailing:
+        statements.append(trailing)
+    return statements
+
+
+def get_applied_migrations(cursor):
+    cursor.execute(SCHEMA_MIGRATIONS_DDL)
+    cursor.execute("SELECT version, name, checksum, applied_at FROM schema_migrations ORDER BY version")
+    return {row['version']: row for row in cursor.fetchall()}
+
+
+def get_migration_status(cursor, migrations_dir=MIGRATIONS_DIR):
+    """สถานะของ migration แต่ละไฟล์: applied / pending / changed (ไฟล์ถูกแก้หลังรันแล้ว)"""
+    applied = get_applied_migrations(cursor)
+    status = []
+    for migration in list_migrations(migrations_dir):
+        applied_row = applied.get(migration['version'])
+        if not applied_row:
+            state = 'pending'
+        elif applied_row['checksum'] != migration['checksum']:
+            state = 'changed'
+        else:
+            state = 'applied'
+        status.append({**migration, "state": state, "applied_at": applied_row['applied_at'] if applied_row else None})
+    return status
+
+
+def apply_migrations(conn, migrations_dir=MIGRATIONS_DIR, log=print):
+    """
+    รัน migration ที่ยังไม่เคยรันตามลำดับเวอร์ชัน แล้วบันทึกลง schema_migrations
+    คำสั่ง DDL ของ MySQL commit เองทีละคำสั่ง จึงรันได้ซ้ำอย่างปลอดภัยโดยข้าม error ใน IDEMPOTENT_ERRNOS
+    คืนค่า list ของเวอร์ชันที่รันในครั้งนี้
+    """
+    cursor = conn.cursor(dictionary=True)
+    applied_versions = []
+    try:
+        applied = get_applied_migrations(cursor)
+        for migration in list_migrations(migrations_dir):
+            if migration['version'] in applied:
+                continue
+            log(f"Applying {migration['version']}_{migration['name']}")
+            with open(migration['path'], encoding='utf-8') as f:
+                statements = split_sql_statements(f.read())
+            for statement in statements:
+                try:
+                    cursor.execute(statement)
+                except Error as e:
+                    if e.errno not in IDEMPOTENT_ERRNOS:
+                        raise
+                    log(f"  skipped ({IDEMPOTENT_ERRNOS[e.errno]}): {statement.splitlines()[0]}")
+            cursor.execute(
+                "INSERT INTO schema_migrations (version, name, checksum) VALUES (%s, %s, %s)",
+                (migration['version'], migration['name'], migration['checksum'])
+            )
+            conn.commit()
+            applied_versions.append(migration['version'])
+        return applied_versions
+    finally:
+        cursor.close()
+
+
+# --- EXPLAIN check ---
+# query ที่ใช้บ่อย: โมดูลที่รัน query ลงทะเบียนจากค่าคงที่/ฟังก์ชันเดียวกับที่ใช้จริงตอน import (ค่าพารามิเตอร์เป็นค่าตัวอย่าง เพราะดูเฉพาะแผนการ query)
+HOT_QUERIES = []
+
+
+def register_hot_query(name, sql, params):
+    """เพิ่ม query ในรายการที่ flask db explain-check ตรวจ"""
+    HOT_QUERIES.append((name, sql, tuple(params)))
+
+
+def explain_hot_queries(cursor, queries=HOT_QUERIES):
+    """
+    รัน EXPLAIN กับ query ที่ใช้บ่อย คืนค่า list ของ dict: name, table, type, key, possible_keys, rows, problem
+    problem = 'full_scan' เมื่อ table ถูกอ่านแบบ ALL โดยไม่มี index ที่ใช้ได้เลย (ถือว่า regress)
+    problem = 'full_scan_by_choice' เมื่อมี index ให้ใช้แต่ optimizer เลือก full scan (มักเกิดกับตารางที่มีข้อมูลน้อย)
+    """
+    findings = []
+    for name, sql, params in queries:
+        cursor.execute(f"EXPLAIN {sql}", params)
+        for row in cursor.fetchall():
+            problem = None
+            if row.get('type') == 'ALL':
+                problem = 'full_scan' if not row.get('possible_keys') else 'full_scan_by_choice'
+            findings.append({
+                "name": name,
+                "table": row.get('table'),
+                "type": row.get('type'),
+                "key": row.get('key'),
+                "possible_keys": row.get('possible_keys'),
+                "rows": row.get('rows'),
+                "problem": problem,
+            })
+    return findings
@@ -0,0 +1,138 @@
+# /helpers/pagination.py
+# Keyset pagination (แบ่งหน้าด้วยค่าของแถวสุดท้าย แทน OFFSET) สำหรับ endpoint ที่คืนรายการยาว ๆ
+import base64
+import json
+import os
+from datetime import date, datetime
+from flask import jsonify
+from helpers.database import db_execute_query
+
+DEFAULT_PAGE_SIZE = int(os.getenv('DEFAULT_PAGE_SIZE', 50))
+MAX_PAGE_SIZE = int(os.getenv('MAX_PAGE_SIZE', 500))
+
+
+def encode_page_cursor(values):
+    """เข้ารหัสค่าของแถวสุดท้าย (เช่น [วันที่, id]) เป็น cursor แบบ URL-safe"""
+    serializable = [str(value) if isinstance(value, (date, datetime)) else value for value in values]
+    return base64.urlsafe_b64encode(json.dumps(serializable).encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_page_cursor(cursor):
+    padded = cursor + '=' * (-len(cursor) % 4)
+    try:
+        values = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8'))
+    except (ValueError, UnicodeError):
+        raise ValueError("cursor ไม่ถูกต้อง")
+    if not isinstance(values, list) or not values:
+        raise ValueError("cursor ไม่ถูกต้อง")
+    return values
+
+
+def parse_page_args(args):
+    """
+    อ่านพารามิเตอร์การแบ่งหน้าจาก query string: limit, cursor, include_total
+    paginated เป็น True เมื่อ client ส่ง limit หรือ cursor มา (จะได้ผลลัพธ์แบบ envelope)
+    client เดิมที่ไม่ได้ขอแบ่งหน้าได้รายการทั้งหมดเป็น array เหมือนเดิม (limit = None ไม่ตัดรายการ)
+    """
+    limit_arg, cursor_arg = args.get('limit'), args.get('cursor')
+    paginated = bool(limit_arg or cursor_arg)
+    if limit_arg:
+        try:
+            limit = int(limit_arg)
+        except ValueError:
+            raise ValueError("limit ต้องเป็นตัวเลข")
+        if limit <= 0:
+            raise ValueError("limit ต้องมากกว่า 0")
+        limit = min(limit, MAX_PAGE_SIZE)
+    else:
+        limit = DEFAULT_PAGE_SIZE if paginated else None
+    return {
+        "paginated": paginated,
+        "limit": limit,
+        "cursor": decode_page_cursor(cursor_arg) if cursor_arg else None,
+        "include_total": args.get('include_total') in ('1', 'true', 'yes'),
+    }
+
+
+def first_page(limit=DEFAULT_PAGE_SIZE):
+    """หน้าแรกของการแบ่งหน้า (ใช้กับ build_keyset_query ตอนลงทะเบียน query ที่ตรวจ EXPLAIN)"""
+    return {"paginated": True, "limit": limit, "cursor": None, "include_total": False}
+
+
+def _keyset_condition(order_columns, cursor_values, descending):
+    """
+    เงื่อนไข keyset สำหรับลำดับ (c1, c2, ...) เช่น c1 < v1 OR (c1 = v1 AND c2 < v2)
+    ใส่ c1 <= v1 นำหน้าเพื่อให้ optimizer ใช้ช่วงของ index ได้
+    """
+    operator = '<' if descending else '>'
+    columns = [column for column, _ in order_columns]
+    values = list(cursor_values[:len(columns)])
+    disjuncts, params = [], []
+    for i, column in enumerate(columns):
+        parts = [f"{prior} = %s" for prior in columns[:i]] + [f"{column} {operator} %s"]
+        disjuncts.append("(" + " AND ".join(parts) + ")")
+        params.extend(values[:i] + [values[i]])
+    condition = f"{columns[0]} {operator}= %s AND (" + " OR ".join(disjuncts) + ")"
+    return condition, [values[0], *params]
+
+
+def build_keyset_query(select_sql, conditions, params, order_columns, page, descending=True):
+    """SQL และพารามิเตอร์ของหน้าตาม page (อ่านเกิน limit หนึ่งแถวเพื่อรู้ว่ามีหน้าถัดไป) ใช้ทั้งตอนดึงข้อมูลและตอนตรวจ EXPLAIN"""
+    page_conditions, page_params = list(conditions), list(params)
+    if page['cursor']:
+        if len(page['cursor']) < len(order_columns):
+            raise ValueError("cursor ไม่ถูกต้อง")
+        keyset_sql, keyset_params = _keyset_condition(order_columns, page['cursor'], descending)
+        page_conditions.append(keyset_sql)
+        page_params.extend(keyset_params)
+
+    direction = "DESC" if descending else "ASC"
+    query = select_sql
+    if page_conditions:
+        query += " WHERE " + " AND ".join(page_conditions)
+    query += " ORDER BY " + ", ".join(f"{column} {direction}" for column, _ in order_columns)
+    if page['limit'] is not None:
+        query += " LIMIT %s"
+        page_params.append(page['limit'] + 1)
+    return query, page_params
+
+
+def fetch_keyset_page(select_sql, conditions, params, order_columns, page, descending=True, count_sql=None, cursor_to_use=None):
+    """
+    รัน select_sql พร้อมเงื่อนไข, keyset และ LIMIT (ไม่มี LIMIT เมื่อ page['limit'] เป็น None)
+    order_columns: list ของ (คอลัมน์ใน SQL, ชื่อ field ในผลลัพธ์) ต้องจบด้วยคอลัมน์ที่ไม่ซ้ำ (เช่น id)
+    และห้ามมีค่า NULL (NULL เปรียบเทียบกับ cursor ไม่ได้ ให้ใช้ COALESCE ทั้งใน SQL และ field ในผลลัพธ์)
+    count_sql: SELECT COUNT(*) AS total FROM ... (ไม่มี WHERE) ที่เบากว่า select_sql สำหรับนับจำนวนทั้งหมด
+    คืนค่า (rows, next_cursor_values หรือ None, total หรือ None) / rows เป็น None เมื่อ query ผิดพลาด
+    """
+    query, page_params = build_keyset_query(select_sql, conditions, params, order_columns, page, descending)
+    rows = db_execute_query(query, tuple(page_params) if page_params else None, fetchall=True, cursor_to_use=cursor_to_use)
+    if rows is None:
+        return None, None, None
+
+    next_cursor_values = None
+    if page['limit'] is not None and len(rows) > page['limit']:
+        rows = rows[:page['limit']]
+        next_cursor_values = [rows[-1][field] for _, field in order_columns]
+
+    total = None
+    if page['include_total'] and not page['cursor']:
+        # นับเฉพาะเมื่อขอและเฉพาะหน้าแรก เพราะ COUNT ต้องอ่านทุกแถวที่ตรงเงื่อนไข
+        where_sql = " WHERE " + " AND ".join(conditions) if conditions else ""
+        count_query = f"{count_sql}{where_sql}" if count_sql else f"SELECT COUNT(*) AS total FROM ({select_sql}{where_sql}) AS page_source"
+        count_row = db_execute_query(count_query, tuple(params) if params else None, fetchone=True, cursor_to_use=cursor_to_use)
+        total = count_row['total'] if count_row else None
+    return rows, next_cursor_values, total
+
+
+def page_response(items, next_cursor, total, page):
+    """
+    สร้าง response ของรายการ: แบบ envelope {items, next_cursor, limit, total} เมื่อ client ขอแบ่งหน้า
+    หรือ array ของรายการทั้งหมดแบบเดิม
+    """
+    if page['paginated']:
+        body = {"items": items, "next_cursor": next_cursor, "limit": page['limit']}
+        if page['include_total']:
+            body["total"] = total
+        return jsonify(body)
+    return jsonify(items)
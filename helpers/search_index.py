@@ -0,0 +1,142 @@
+# /helpers/search_index.py
+# ดัชนีค้นหายาในหน่วยความจำ (ต่อ hcode ต่อ process) สำหรับช่องค้นหายาแบบพิมพ์แล้วแสดงผลทันที
+import bisect
+import os
+import re
+import threading
+import time
+import unicodedata
+from helpers.database import db_execute_query
+
+# อายุของดัชนี (วินาที) ก่อนโหลดใหม่ เพื่อให้ worker อื่นที่ไม่ได้รับการ invalidate เห็นข้อมูลยาที่แก้ไข
+SEARCH_INDEX_TTL_SECONDS = int(os.getenv('SEARCH_INDEX_TTL_SECONDS', 60))
+NGRAM_SIZE = 3
+
+# วรรณยุกต์และเครื่องหมายกำกับเสียงของไทย (ไม้ไต่คู้ ่ ้ ๊ ๋ การันต์ และยามักการ) ตัดทิ้งเพื่อให้พิมพ์ผิด/ไม่ใส่วรรณยุกต์ก็ค้นเจอ
+_THAI_MARKS = re.compile('[\u0e47-\u0e4c\u0e4e]')
+_WHITESPACE = re.compile(r'\s+')
+
+# ลำดับคุณภาพของการจับคู่ (ค่าน้อย = ตรงกว่า)
+MATCH_CODE_EXACT, MATCH_CODE_PREFIX, MATCH_NAME_PREFIX, MATCH_WORD_PREFIX, MATCH_CODE_CONTAINS, MATCH_NAME_CONTAINS = range(6)
+
+
+def normalize_search_text(text):
+    """แปลงข้อความสำหรับค้นหา: NFC, ตัวพิมพ์เล็ก, ตัดวรรณยุกต์ไทย, รวมสระอำที่แยกเขียน (ํ + า) และรวมช่องว่าง"""
+    if text is None:
+        return ''
+    text = unicodedata.normalize('NFC', str(text)).casefold()
+    text = _THAI_MARKS.sub('', text)
+    text = text.replace('\u0e4d\u0e32', '\u0e33')
+    return _WHITESPACE.sub(' ', text).strip()
+
+
+def _ngrams(text):
+    return {text[i:i + NGRAM_SIZE] for i in range(len(text) - NGRAM_SIZE + 1)}
+
+
+class MedicineSearchIndex:
+    """
+    ดัชนีของยาที่เปิดใช้งานในหน่วยบริการหนึ่ง
+    - prefix: list ของ (คำ, ลำดับยา) ที่เรียงไว้ ค้นด้วย bisect
+    - n-gram: trigram -> ชุดลำดับยา สำหรับค้นคำที่อยู่กลางข้อความ
+    """
+
+    def __init__(self, medicines):
+        self.medicines = medicines
+        self.built_at = time.monotonic()
+        self._codes = [normalize_search_text(med['medicine_code']) for med in medicines]
+        self._names = [normalize_search_text(med['generic_name']) for med in medicines]
+        self._sort_keys = [(name, code) for name, code in zip(self._names, self._codes)]
+
+        prefix_entries = []
+        self._ngram_postings = {}
+        for i, (code, name) in enumerate(zip(self._codes, self._names)):
+            for token in {code, name, *name.split(' ')}:
+                if token:
+                    prefix_entries.append((token, i))
+            for gram in _ngrams(code) | _ngrams(name):
+                self._ngram_postings.setdefault(gram, set()).add(i)
+        prefix_entries.sort()
+        self._prefix_tokens = [token for token, _ in prefix_entries]
+        self._prefix_ids = [i for _, i in prefix_entries]
+
+    def _prefix_candidates(self, term):
+        start = bisect.bisect_left(self._prefix_tokens, term)
+        end = bisect.bisect_left(self._prefix_tokens, term + '\U0010ffff', lo=start)
+        return set(self._prefix_ids[start:end])
+
+    def _substring_candidates(self, term):
+        if len(term) < NGRAM_SIZE:
+            # คำค้นสั้นกว่า n-gram ใช้การไล่ตรวจทั้งดัชนี (ข้อความสั้นและอยู่ในหน่วยความจำแล้ว)
+            return range(len(self.medicines))
+        postings = sorted((self._ngram_postings.get(gram, set()) for gram in _ngrams(term)), key=len)
+        return set.intersection(*postings) if postings and postings[0] else set()
+
+    def _match_rank(self, i, term):
+        code, name = self._codes[i], self._names[i]
+        if code == term:
+            return MATCH_CODE_EXACT
+        if code.startswith(term):
+            return MATCH_CODE_PREFIX
+        if name.startswith(term):
+            return MATCH_NAME_PREFIX
+        if any(word.startswith(term) for word in name.split(' ')):
+            return MATCH_WORD_PREFIX
+        if term in code:
+            return MATCH_CODE_CONTAINS
+        if term in name:
+            return MATCH_NAME_CONTAINS
+        return None
+
+    def search(self, term, limit=10):
+        """คืนค่ารายการยาที่ตรงกับคำค้น เรียงตามคุณภาพการจับคู่ แล้วตามชื่อยา"""
+        term = normalize_search_text(term)
+        if not term:
+            return []
+        ranked = []
+        candidates = self._prefix_candidates(term)
+        if len(candidates) < limit:
+            candidates = candidates | set(self._substring_candidates(term))
+        for i in candidates:
+            rank = self._match_rank(i, term)
+            if rank is not None:
+                ranked.append((rank, self._sort_keys[i], i))
+        ranked.sort()
+        return [self.medicines[i] for _, _, i in ranked[:limit]]
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def _load_medicine_search_index(hcode):
+    medicines = db_execute_query(
+        "SELECT id, medicine_code, generic_name, strength, unit, min_stock, max_stock FROM medicines WHERE hcode = %s AND is_active = TRUE",
+        (hcode,), fetchall=True
+    )
+    if medicines is None:
+        return None
+    return MedicineSearchIndex(medicines)
+
+
+def get_medicine_search_index(hcode):
+    """ดัชนีของหน่วยบริการ (สร้างใหม่เมื่อยังไม่มี หมดอายุ หรือถูก invalidate) คืนค่า None เมื่ออ่านฐานข้อมูลไม่ได้"""
+    index = _indexes.get(hcode)
+    if index is not None and time.monotonic() - index.built_at < SEARCH_INDEX_TTL_SECONDS:
+        return index
+    with _indexes_lock:
+        index = _indexes.get(hcode)
+        if index is None or time.monotonic() - index.built_at >= SEARCH_INDEX_TTL_SECONDS:
+            index = _load_medicine_search_index(hcode)
+            if index is not None:
+                _indexes[hcode] = index
+        return index
+
+
+def invalidate_medicine_search_index(hcode=None):
+    """ล้างดัชนีของหน่วยบริการ (หรือทั้งหมดเมื่อไม่ระบุ) ใน process นี้ เรียกหลังเพิ่ม/แก้ไข/เปิด-ปิดยา"""
+    with _indexes_lock:
+        if hcode is None:
+            _indexes.clear()
+        else:
+            _indexes.pop(hcode, None)
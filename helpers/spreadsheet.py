@@ -0,0 +1,206 @@
+# /helpers/spreadsheet.py
+import io
+import os
+import sys
+import tracemalloc
+import pandas as pd
+from openpyxl import load_workbook
+
+try:
+    import resource
+except ImportError:  # Windows ไม่มีโมดูล resource
+    resource = None
+
+# ขนาดไฟล์อัปโหลดสูงสุด (byte) และจำนวนแถวต่อชุดที่อ่านออกมาประมวลผล
+UPLOAD_MAX_BYTES = int(os.getenv('UPLOAD_MAX_BYTES', 20 * 1024 * 1024))
+SPREADSHEET_BATCH_SIZE = int(os.getenv('SPREADSHEET_BATCH_SIZE', 2000))
+# จำนวนรายการ preview สูงสุดที่ส่งกลับเป็นค่าเริ่มต้น (ยอดรวมทั้งไฟล์อยู่ใน summary)
+UPLOAD_PREVIEW_LIMIT = int(os.getenv('UPLOAD_PREVIEW_LIMIT', 200))
+# วัดหน่วยความจำสูงสุดของการประมวลผลไฟล์ด้วย tracemalloc เฉพาะเมื่อเปิด (ใช้วัดผลในเครื่องทดสอบ)
+# tracemalloc ทำให้การจองหน่วยความจำทุกครั้งของทั้ง process ช้าลง ค่าเริ่มต้นจึงใช้ ru_maxrss แทน
+UPLOAD_MEMORY_PROFILING = os.getenv('UPLOAD_MEMORY_PROFILING', '0').lower() in ('1', 'true', 'yes')
+
+CSV_EXTENSIONS = ('.csv', '.txt')
+
+
+class SpreadsheetError(ValueError):
+    """ไฟล์ที่อัปโหลดไม่สามารถอ่านได้ หรือมีโครงสร้างไม่ถูกต้อง"""
+    status_code = 400
+
+
+class UploadTooLargeError(SpreadsheetError):
+    """ไฟล์ที่อัปโหลดมีขนาดเกิน UPLOAD_MAX_BYTES"""
+    status_code = 413
+
+
+def get_upload_size(file_storage):
+    """ขนาดไฟล์ที่อัปโหลด (byte) โดยไม่อ่านเนื้อหาทั้งไฟล์เข้าหน่วยความจำ"""
+    stream = file_storage.stream
+    position = stream.tell()
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell()
+    stream.seek(position)
+    return size
+
+
+def is_csv_upload(file_storage):
+    filename = (file_storage.filename or '').lower()
+    return filename.endswith(CSV_EXTENSIONS) or file_storage.mimetype == 'text/csv'
+
+
+def iter_spreadsheet_batches(file_storage, required_columns, batch_size=SPREADSHEET_BATCH_SIZE, max_bytes=UPLOAD_MAX_BYTES):
+    """
+    อ่านไฟล์ Excel (.xlsx) หรือ CSV ที่อัปโหลดทีละชุด (DataFrame ละไม่เกิน batch_size แถว)
+    - Excel เปิดแบบ read-only ของ openpyxl จึงไม่โหลดทั้ง workbook เข้าหน่วยความจำ
+    - CSV อ่านด้วย pandas แบบ chunksize (เร็วกว่า Excel มาก)
+    index ของแต่ละ DataFrame คือเลขแถวในไฟล์ (แถวหัวตาราง = 1) และข้ามแถวที่ว่างทั้งแถว
+    """
+    size = get_upload_size(file_storage)
+    if size > max_bytes:
+        raise UploadTooLargeError(f"ไฟล์มีขนาด {size / 1024 / 1024:.1f} MB เกินกำหนด {max_bytes / 1024 / 1024:.1f} MB")
+    file_storage.stream.seek(0)
+
+    if is_csv_upload(file_storage):
+        batches = _iter_csv_batches(file_storage.stream, batch_size)
+    else:
+        batches = _iter_xlsx_batches(file_storage.stream, batch_size)
+
+    header_checked = False
+    for batch in batches:
+        if not header_checked:
+            missing_columns = [col for col in required_columns if col not in batch.columns]
+            if missing_columns:
+                raise SpreadsheetError(f"ไฟล์ต้องมีคอลัมน์: {', '.join(required_columns)}")
+            header_checked = True
+        batch = batch.dropna(how='all')
+        if not batch.empty:
+            yield batch
+
+
+def _iter_csv_batches(stream, batch_size):
+    text_stream = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    try:
+        reader = pd.read_csv(text_stream, dtype=str, chunksize=batch_size, skip_blank_lines=False)
+        next_row_num = 2
+        for chunk in reader:
+            chunk.columns = [str(col).strip() for col in chunk.columns]
+            chunk.index = pd.RangeIndex(next_row_num, next_row_num + len(chunk))
+            next_row_num += len(chunk)
+            yield chunk.replace(r'^\s*$', None, regex=True)
+    except (pd.errors.ParserError, UnicodeDecodeError) as e:
+        raise SpreadsheetError(f"ไม่สามารถอ่านไฟล์ CSV ได้: {e}")
+    finally:
+        text_stream.detach()
+
+
+def _iter_xlsx_batches(stream, batch_size):
+    try:
+        workbook = load_workbook(stream, read_only=True, data_only=True)
+    except Exception as e:
+        raise SpreadsheetError(f"ไม่สามารถอ่านไฟล์ Excel ได้: {e}")
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        columns = [str(col).strip() if col is not None else f"Unnamed: {i}" for i, col in enumerate(header)]
+
+        batch, batch_start_row_num = [], 2
+        for row_num, values in enumerate(rows, start=2):
+            if not batch:
+                batch_start_row_num = row_num
+            batch.append(values[:len(columns)] + (None,) * (len(columns) - len(values)))
+            if len(batch) >= batch_size:
+                yield _rows_to_frame(batch, columns, batch_start_row_num)
+                batch = []
+        if batch:
+            yield _rows_to_frame(batch, columns, batch_start_row_num)
+    finally:
+        workbook.close()
+
+
+def _rows_to_frame(rows, columns, first_row_num):
+    frame = pd.DataFrame.from_records(rows, columns=columns)
+    frame.index = pd.RangeIndex(first_row_num, first_row_num + len(rows))
+    return frame
+
+
+class PeakMemoryTracker:
+    """
+    วัดหน่วยความจำสูงสุดที่ถูกจองระหว่างประมวลผลไฟล์ด้วย tracemalloc (หน่วย MB)
+    tracemalloc ทำงานระดับ process ค่าที่ได้จึงรวม request อื่นที่ทำงานพร้อมกันใน worker เดียวกันด้วย
+    """
+
+    def __enter__(self):
+        self._owns_tracing = not tracemalloc.is_tracing()
+        if self._owns_tracing:
+            tracemalloc.start()
+        else:
+            tracemalloc.reset_peak()
+        self._baseline, _ = tracemalloc.get_traced_memory()
+        self._final_peak = None
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._final_peak = self._peak_bytes()
+        if self._owns_tracing:
+            tracemalloc.stop()
+        return False
+
+    def _peak_bytes(self):
+        _, peak = tracemalloc.get_traced_memory()
+        return max(peak - self._baseline, 0)
+
+    @property
+    def peak_memory_mb(self):
+        peak = self._final_peak if self._final_peak is not None else self._peak_bytes()
+        return round(peak / 1024 / 1024, 2)
+
+
+class MaxRssMemoryTracker:
+    """
+    วัดส่วนที่ ru_maxrss (RSS สูงสุดของ process) เพิ่มขึ้นระหว่างประมวลผลไฟล์ (หน่วย MB) ต้นทุนแค่ getrusage สองครั้ง
+    ได้ 0 ถ้า process เคยใช้หน่วยความจำสูงกว่านี้มาก่อน ส่วนระบบที่ไม่มีโมดูล resource ได้ peak_memory_mb = None
+    """
+
+    def __enter__(self):
+        self._baseline = _max_rss_bytes()
+        self._final_peak = None
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._final_peak = self._peak_bytes()
+        return False
+
+    def _peak_bytes(self):
+        if self._baseline is None:
+            return None
+        return max(_max_rss_bytes() - self._baseline, 0)
+
+    @property
+    def peak_memory_mb(self):
+        peak = self._final_peak if self._final_peak is not None else self._peak_bytes()
+        return None if peak is None else round(peak / 1024 / 1024, 2)
+
+
+def _max_rss_bytes():
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS รายงานเป็น byte ส่วน Linux รายงานเป็น KB
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+def track_upload_memory():
+    """context manager สำหรับ handler: PeakMemoryTracker เมื่อเปิด UPLOAD_MEMORY_PROFILING ไม่เช่นนั้นใช้ MaxRssMemoryTracker"""
+    return PeakMemoryTracker() if UPLOAD_MEMORY_PROFILING else MaxRssMemoryTracker()
+
+
+def limit_preview_items(preview_items, preview_limit):
+    """
+    ตัดรายการ preview ให้ไม่เกิน preview_limit โดยส่งรายการที่มีข้อผิดพลาดก่อน
+    เพื่อให้ผู้ใช้เห็นสิ่งที่ต้องแก้ไขแม้จะตัดรายการบางส่วนออก คืนค่า (รายการที่ส่งกลับ, ถูกตัดหรือไม่)
+    """
+    if len(preview_items) <= preview_limit:
+        return preview_items, False
+    return sorted(preview_items, key=lambda item: not item["errors"])[:max(preview_limit, 0)], True
@@ -0,0 +1,242 @@
+# /helpers/stock_balance.py
+# ดูแลตาราง stock_balance (ยอดคงเหลือรวมต่อยาต่อหน่วยบริการ) ให้ตรงกับตาราง inventory
+from datetime import date, timedelta
+from helpers.database import build_in_placeholders
+from helpers.migrations import register_hot_query
+from helpers.data_versions import bump_data_version, bump_all_data_versions
+from helpers.change_log import record_change_set, require_change_feed_resync, CHANGE_ENTITY_STOCK
+
+STOCK_BALANCE_SELECT_FROM_INVENTORY = """
+    SELECT hcode, medicine_id,
+           COALESCE(SUM(quantity_on_hand), 0) AS total_on_hand,
+           MIN(CASE WHEN quantity_on_hand > 0 THEN expiry_date END) AS nearest_expiry
+    FROM inventory
+"""
+
+
+def refresh_stock_balance(hcode, medicine_ids, cursor):
+    """
+    คำนวณยอดคงเหลือรวมและวันหมดอายุที่ใกล้ที่สุดของยาที่ระบุใหม่จาก inventory แล้วบันทึกลง stock_balance
+    ต้องเรียกด้วย cursor เดียวกับที่แก้ไข inventory (ก่อน commit) เพื่อให้อยู่ใน transaction เดียวกัน
+    ใช้ cursor.execute ตรง ๆ เพื่อให้ error ถูกส่งต่อและ transaction ถูก rollback ทั้งก้อน
+    ตัวนับ stock_version (ETag) และ change_log ไม่ได้บันทึกที่นี่: ผู้เรียกสะสม (hcode, medicine_id) ไว้แล้วเรียก record_stock_changes ครั้งเดียวก่อน commit
+    """
+    medicine_ids = list(dict.fromkeys(int(medicine_id) for medicine_id in medicine_ids))
+    if not medicine_ids:
+        return
+    cursor.execute(
+        f"""
+        INSERT INTO stock_balance (hcode, medicine_id, total_on_hand, nearest_expiry)
+        {STOCK_BALANCE_SELECT_FROM_INVENTORY}
+        WHERE hcode = %s AND medicine_id IN ({build_in_placeholders(medicine_ids)})
+        GROUP BY hcode, medicine_id
+        ON DUPLICATE KEY UPDATE
+            total_on_hand = VALUES(total_on_hand),
+            nearest_expiry = VALUES(nearest_expiry),
+            updated_at = CURRENT_TIMESTAMP
+        """,
+        (hcode, *medicine_ids)
+    )
+
+
+def _group_movements_by_hcode(movements):
+    medicine_ids_by_hcode = {}
+    for hcode, medicine_id in movements:
+        medicine_ids_by_hcode.setdefault(hcode, []).append(medicine_id)
+    return medicine_ids_by_hcode
+
+
+def refresh_stock_balance_for_movements(movements, cursor):
+    """เรียก refresh_stock_balance จากรายการ (hcode, medicine_id) ที่มีการเคลื่อนไหว โดยรวมกลุ่มตาม hcode"""
+    medicine_ids_by_hcode = _group_movements_by_hcode(movements)
+    for hcode in sorted(medicine_ids_by_hcode):
+        refresh_stock_balance(hcode, medicine_ids_by_hcode[hcode], cursor)
+
+
+def record_stock_changes(movements, cursor, other_changes=()):
+    """
+    เพิ่มตัวนับ stock_version และบันทึก change_log (seq เดียว) ครั้งเดียวต่อหน่วยบริการ
+    สำหรับ (hcode, medicine_id) ทั้งหมดที่ transaction เปลี่ยนยอดคงเหลือ
+    other_changes: (hcode, entity, entity_id) อื่นของ transaction เดียวกัน (เช่น สถานะใบเบิก) ให้อยู่ใน seq เดียวกัน
+    แถวตัวนับใช้ร่วมกันทั้งหน่วยบริการ จึงต้องเรียกครั้งเดียวหลังล็อกและแก้ไข inventory ครบแล้ว (ก่อน commit)
+    เพื่อไม่ให้ถือล็อกแถวตัวนับไว้ระหว่างรอล็อก Lot อื่น (ล็อกตามลำดับ hcode เสมอเพื่อไม่ให้ deadlock)
+    """
+    changes_by_hcode = {}
+    for hcode, medicine_id in movements:
+        changes_by_hcode.setdefault(hcode, {}).setdefault(CHANGE_ENTITY_STOCK, []).append(medicine_id)
+    for hcode, entity, entity_id in other_changes:
+        changes_by_hcode.setdefault(hcode, {}).setdefault(entity, []).append(entity_id)
+    for hcode in sorted(changes_by_hcode):
+        if CHANGE_ENTITY_STOCK in changes_by_hcode[hcode]:
+            bump_data_version(hcode, 'stock', cursor)
+        record_change_set(hcode, changes_by_hcode[hcode], cursor)
+
+
+def rebuild_stock_balance(cursor, hcode=None):
+    """สร้าง stock_balance ใหม่ทั้งหมดจาก inventory (ทั้งระบบ หรือเฉพาะหน่วยบริการ) คืนค่าจำนวนแถวที่สร้าง"""
+    where_sql, params = ("WHERE hcode = %s", (hcode,)) if hcode else ("", ())
+    cursor.execute(f"DELETE FROM stock_balance {where_sql}", params)
+    cursor.execute(
+        f"""
+        INSERT INTO stock_balance (hcode, medicine_id, total_on_hand, nearest_expiry)
+        {STOCK_BALANCE_SELECT_FROM_INVENTORY}
+        {where_sql}
+        GROUP BY hcode, medicine_id
+        """,
+        params
+    )
+    row_count = cursor.rowcount
+    if hcode:
+        bump_data_version(hcode, 'stock', cursor)
+    else:
+        bump_all_data_versions('stock', cursor)
+    # สร้างใหม่ทั้งก้อนไม่ได้บันทึกรายยา client ของ change feed จึงต้องโหลดยอดคงเหลือใหม่ทั้งหมด
+    require_change_feed_resync(cursor, hcode)
+    return row_count
+
+
+def verify_stock_balance(cursor, hcode=None):
+    """
+    เปรียบเทียบ stock_balance กับยอดที่คำนวณจาก inventory
+    คืนค่า list ของรายการที่ไม่ตรงกัน (รวมรายการที่ขาดหายไปจากฝั่งใดฝั่งหนึ่ง)
+    """
+    inventory_where, balance_where, params = "", "", ()
+    if hcode:
+        inventory_where, balance_where, params = "WHERE hcode = %s", "WHERE hcode = %s", (hcode, hcode)
+    cursor.execute(
+        f"""
+        SELECT hcode, medicine_id,
+               SUM(expected_total) AS expected_total, MAX(expected_nearest_expiry) AS expected_nearest_expiry,
+               SUM(stored_total) AS stored_total, MAX(stored_nearest_expiry) AS stored_nearest_expiry,
+               SUM(in_inventory) AS in_inventory, SUM(in_balance) AS in_balance
+        FROM (
+            SELECT hcode, medicine_id, total_on_hand AS expected_total, nearest_expiry AS expected_nearest_expiry,
+                   NULL AS stored_total, NULL AS stored_nearest_expiry, 1 AS in_inventory, 0 AS in_balance
+            FROM ({STOCK_BALANCE_SELECT_FROM_INVENTORY} {inventory_where} GROUP BY hcode, medicine_id) AS expected
+            UNION ALL
+            SELECT hcode, medicine_id, NULL, NULL, total_on_hand, nearest_expiry, 0, 1
+            FROM stock_balance {balance_where}
+        ) AS combined
+        GROUP BY hcode, medicine_id
+        HAVING in_inventory = 0 OR in_balance = 0
+            OR NOT (expected_total <=> stored_total)
+            OR NOT (expected_nearest_expiry <=> stored_nearest_expiry)
+        ORDER BY hcode, medicine_id
+        """,
+        params
+    )
+    mismatches = []
+    for row in cursor.fetchall():
+        mismatches.append({
+            "hcode": row['hcode'],
+            "medicine_id": row['medicine_id'],
+            "expected_total": int(row['expected_total']) if row['expected_total'] is not None else None,
+            "stored_total": int(row['stored_total']) if row['stored_total'] is not None else None,
+            "expected_nearest_expiry": str(row['expected_nearest_expiry']) if row['expected_nearest_expiry'] else None,
+            "stored_nearest_expiry": str(row['stored_nearest_expiry']) if row['stored_nearest_expiry'] else None,
+        })
+    return mismatches
+
+
+# --- Balance snapshots ---
+# ยอดยกมารายเดือนของแต่ละยา (SUM(quantity_change) ของ transaction ก่อนวันที่ snapshot_date)
+# ใช้คำนวณยอดยกมาของหน้าประวัติ: snapshot ล่าสุด + ผลรวมช่วงสั้น ๆ ต่อท้าย แทนการ SUM ทั้งประวัติ
+# snapshot สร้างโดยงานเบื้องหลัง (flask stock-balance snapshot) หน้าประวัติอ่านอย่างเดียวโดยไม่ล็อก
+# การเขียน transaction ย้อนหลังลบเฉพาะ snapshot ที่อยู่หลังวันที่ของ transaction นั้น
+
+
+def _month_start(day):
+    return day.replace(day=1)
+
+
+def _previous_month_start(day):
+    return _month_start(_month_start(day) - timedelta(days=1))
+
+
+def _sum_quantity_change_query(hcode, medicine_id, from_date=None, before_date=None):
+    conditions, params = ["hcode = %s", "medicine_id = %s"], [hcode, medicine_id]
+    if from_date:
+        conditions.append("transaction_date >= %s")
+        params.append(from_date)
+    if before_date:
+        conditions.append("transaction_date < %s")
+        params.append(before_date)
+    return f"SELECT COALESCE(SUM(quantity_change), 0) AS balance FROM inventory_transactions WHERE {' AND '.join(conditions)}", tuple(params)
+
+
+def _sum_quantity_change(hcode, medicine_id, cursor, from_date=None, before_date=None):
+    cursor.execute(*_sum_quantity_change_query(hcode, medicine_id, from_date, before_date))
+    return int(cursor.fetchone()['balance'])
+
+
+# ยอดยกมา: ช่วงต่อท้ายหลัง snapshot (from_date ถึง before_date)
+register_hot_query("opening balance", *_sum_quantity_change_query('00000', 1, '2024-01-01', '2024-01-15'))
+
+
+def get_opening_balance(hcode, medicine_id, before_date, cursor):
+    """
+    ยอดคงเหลือของยา ณ ต้นวันที่ before_date (ผลรวม quantity_change ที่ transaction_date < before_date)
+    อ่านจาก snapshot ล่าสุดที่ไม่เกิน before_date แล้วบวกเฉพาะช่วงต่อท้าย (ใช้ index hcode, medicine_id, transaction_date)
+    อ่านอย่างเดียวและไม่ล็อก หากยังไม่มี snapshot จะรวมตั้งแต่ต้นประวัติ
+    """
+    cursor.execute(
+        "SELECT snapshot_date, balance FROM inventory_balance_snapshots WHERE hcode = %s AND medicine_id = %s AND snapshot_date <= %s ORDER BY snapshot_date DESC LIMIT 1",
+        (hcode, medicine_id, before_date)
+    )
+    snapshot = cursor.fetchone()
+    snapshot_date = snapshot['snapshot_date'] if snapshot else None
+    balance = int(snapshot['balance']) if snapshot else 0
+    if snapshot_date is None or snapshot_date < before_date:
+        balance += _sum_quantity_change(hcode, medicine_id, cursor, snapshot_date, before_date)
+    return balance
+
+
+def build_balance_snapshots(cursor, months=1, hcode=None, today=None):
+    """
+    สร้าง (หรือสร้างใหม่) snapshot ต้นเดือนของยาทุกตัวย้อนหลัง months เดือน นับรวมต้นเดือนปัจจุบัน
+    ใช้เป็นงานเบื้องหลังตามเวลา (เช่น cron วันที่ 1 ของเดือน) ผู้เรียกเป็นผู้ start_transaction/commit
+    INSERT ... SELECT อ่านแบบล็อก (shared) ในตัว จึงไม่พลาด transaction ย้อนหลังที่ commit ระหว่างสร้าง คืนค่า rowcount รวม
+    """
+    where_sql, params = ("AND hcode = %s", (hcode,)) if hcode else ("", ())
+    snapshot_date = _month_start(today or date.today())
+    row_count = 0
+    for _ in range(max(months, 1)):
+        cursor.execute(
+            f"""
+            INSERT INTO inventory_balance_snapshots (hcode, medicine_id, snapshot_date, balance)
+            SELECT hcode, medicine_id, %s, COALESCE(SUM(quantity_change), 0)
+            FROM inventory_transactions
+            WHERE transaction_date < %s {where_sql}
+            GROUP BY hcode, medicine_id
+            ON DUPLICATE KEY UPDATE balance = VALUES(balance)
+            """,
+            (snapshot_date, snapshot_date, *params)
+        )
+        row_count += cursor.rowcount
+        snapshot_date = _previous_month_start(snapshot_date)
+    return row_count
+
+
+def invalidate_balance_snapshots(hcode, medicine_ids, cursor, movement_date):
+    """
+    ลบ snapshot ที่ไม่ถูกต้องแล้วเพราะมี transaction ย้อนหลัง (เพิ่มหรือลบ) ณ วันที่ movement_date
+    snapshot รวมเฉพาะ transaction ก่อน snapshot_date จึงลบเฉพาะ snapshot ที่ snapshot_date หลังวันนั้น
+    """
+    medicine_ids = list(dict.fromkeys(int(medicine_id) for medicine_id in medicine_ids))
+    if not medicine_ids:
+        return
+    cursor.execute(
+        f"DELETE FROM inventory_balance_snapshots WHERE hcode = %s AND medicine_id IN ({build_in_placeholders(medicine_ids)}) AND snapshot_date > %s",
+        (hcode, *medicine_ids, str(movement_date)[:10])
+    )
+
+
+def invalidate_balance_snapshots_for_movements(dated_movements, cursor):
+    """invalidate_balance_snapshots จากรายการ (hcode, medicine_id, วันที่) โดยใช้วันที่เก่าสุดของแต่ละยา"""
+    earliest_dates = {}
+    for hcode, medicine_id, movement_date in dated_movements:
+        movement_date = str(movement_date)[:10]
+        if movement_date < earliest_dates.get((hcode, medicine_id), '9999-12-31'):
+            earliest_dates[(hcode, medicine_id)] = movement_date
+    for (hcode, medicine_id), movement_date in sorted(earliest_dates.items()):
+        invalidate_balance_snapshots(hcode, [medicine_id], cursor, movement_date)
@@ -0,0 +1,90 @@
+# /helpers/sync_watermarks.py
+# จุดซิงค์ล่าสุด (watermark) ของข้อมูลการจ่ายยาจาก HOSxP ต่อหน่วยบริการ: (vstdate, hos_guid) ของรายการสุดท้ายที่บันทึกแล้ว
+# โปรแกรมนำเข้าเรียงรายการตาม (vstdate, hos_guid) และดึงเฉพาะรายการหลังจุดนี้
+# จุดซิงค์เลื่อนใน transaction เดียวกับการบันทึกรายการ และเลื่อนได้เฉพาะเมื่อรายการก่อนหน้าช่วงนั้นถูกบันทึกครบแล้ว
+# รายการที่ตัดจ่ายไม่สำเร็จถูกบันทึกไว้ใน dispense_sync_failures (transaction เดียวกัน) จึงไม่ทำให้จุดซิงค์ค้าง
+from datetime import datetime
+from helpers.database import build_in_placeholders
+
+
+def parse_sync_watermark(value):
+    """
+    แปลง {"vstdate": "YYYY-MM-DD", "hos_guid": "..."} เป็น key (vstdate, hos_guid) สำหรับเปรียบเทียบ
+    None คือยังไม่มีจุดซิงค์ (ก่อนรายการแรก) ValueError เมื่อรูปแบบไม่ถูกต้อง
+    """
+    if value is None:
+        return None
+    if not isinstance(value, dict) or not value.get('vstdate') or not value.get('hos_guid'):
+        raise ValueError("จุดซิงค์ต้องมี vstdate และ hos_guid")
+    vstdate = datetime.strptime(str(value['vstdate']), '%Y-%m-%d').strftime('%Y-%m-%d')
+    return vstdate, str(value['hos_guid'])
+
+
+def format_sync_watermark(key):
+    return {"vstdate": key[0], "hos_guid": key[1]} if key else None
+
+
+def get_sync_watermark(hcode, cursor, for_update=False):
+    """key ของจุดซิงค์ปัจจุบันของหน่วยบริการ (None เมื่อยังไม่เคยซิงค์)"""
+    cursor.execute(
+        f"SELECT last_vstdate, last_hos_guid FROM dispense_sync_watermarks WHERE hcode = %s{' FOR UPDATE' if for_update else ''}",
+        (hcode,)
+    )
+    row = cursor.fetchone()
+    if not row:
+        return None
+    return row['last_vstdate'].strftime('%Y-%m-%d'), row['last_hos_guid']
+
+
+def advance_sync_watermark(hcode, after, to, cursor):
+    """
+    เลื่อนจุดซิงค์ไปที่ to เมื่อ client ยืนยันว่ารายการในช่วง (after, to] ถูกบันทึกแล้ว (after = None คือตั้งแต่ต้น)
+    เลื่อนเฉพาะเมื่อจุดซิงค์ปัจจุบันครอบคลุมถึง after แล้ว (รายการก่อนช่วงนี้บันทึกครบ) และ to อยู่หลังจุดปัจจุบัน
+    ต้องเรียกด้วย cursor ของ transaction ที่บันทึกรายการ (แถวถูกล็อกจนจบ transaction) คืนค่า (key ปัจจุบัน, เลื่อนหรือไม่)
+    """
+    current = get_sync_watermark(hcode, cursor, for_update=True)
+    covered = after is None or (current is not None and current >= after)
+    if not covered or (current is not None and to <= current):
+        return current, False
+    cursor.execute(
+        "INSERT INTO dispense_sync_watermarks (hcode, last_vstdate, last_hos_guid) VALUES (%s, %s, %s) "
+        "ON DUPLICATE KEY UPDATE last_vstdate = VALUES(last_vstdate), last_hos_guid = VALUES(last_hos_guid)",
+        (hcode, to[0], to[1])
+    )
+    return to, True
+
+
+def record_sync_failures(hcode, failures, cursor):
+    """
+    บันทึกรายการที่ตัดจ่ายไม่สำเร็จ (dict: hos_guid, medicine_id, quantity_dispensed, dispense_date, error) ต้องเรียกใน transaction ของ chunk
+    รายการเดิมที่ผิดพลาดซ้ำจะนับ attempts เพิ่ม (โปรแกรมนำเข้าหยุดส่งซ้ำอัตโนมัติเมื่อเกินจำนวนครั้งที่กำหนด)
+    """
+    if not failures:
+        return
+    cursor.executemany(
+        "INSERT INTO dispense_sync_failures (hcode, hos_guid, medicine_id, quantity_dispensed, dispense_date, error) VALUES (%s, %s, %s, %s, %s, %s) "
+        "ON DUPLICATE KEY UPDATE medicine_id = VALUES(medicine_id), quantity_dispensed = VALUES(quantity_dispensed), "
+        "dispense_date = VALUES(dispense_date), error = VALUES(error), attempts = attempts + 1",
+        [(hcode, failure['hos_guid'], failure['medicine_id'], failure['quantity_dispensed'], failure['dispense_date'], failure['error']) for failure in failures]
+    )
+
+
+def clear_sync_failures(hcode, hos_guids, cursor):
+    """ลบรายการที่ส่งใหม่แล้วบันทึกสำเร็จ (หรือมีอยู่แล้วด้วยจำนวนเท่าเดิม) ออกจากรายการที่รอส่งใหม่"""
+    hos_guids = list(dict.fromkeys(guid for guid in hos_guids if guid))
+    if not hos_guids:
+        return
+    cursor.execute(
+        f"DELETE FROM dispense_sync_failures WHERE hcode = %s AND hos_guid IN ({build_in_placeholders(hos_guids)})",
+        (hcode, *hos_guids)
+    )
+
+
+def list_sync_failures(hcode, cursor):
+    """รายการที่รอส่งใหม่ของหน่วยบริการ เรียงตาม (วันที่, hos_guid) เหมือนลำดับการซิงค์"""
+    cursor.execute(
+        "SELECT hos_guid, medicine_id, quantity_dispensed, dispense_date, error, attempts, updated_at "
+        "FROM dispense_sync_failures WHERE hcode = %s ORDER BY dispense_date, hos_guid",
+        (hcode,)
+    )
+    return cursor.fetchall()
@@ -1,5 +1,6 @@
 # /helpers/utils.py
-from datetime import datetime
+from datetime import datetime, date
+import pandas as pd
 
 def thai_to_iso_date(thai_date_str):
     """แปลงวันที่รูปแบบไทย (วว/ดด/ปปปป พ.ศ.) เป็นรูปแบบ ISO (YYYY-MM-DD)"""
@@ -35,3 +36,38 @@ def iso_to_thai_date(iso_date_obj):
         return f"{day}/{month}/{buddhist_year}"
     except (ValueError, TypeError):
         return None
+
+def parse_date_series(values):
+    """
+    แปลงคอลัมน์วันที่จาก Excel/CSV แบบ vectorized
+    รองรับ datetime จาก Excel, ข้อความ วว/ดด/ปปปป (พ.ศ.) และ YYYY-MM-DD (ค.ศ.)
+    คืนค่า (iso_series, thai_series) ค่าที่แปลงไม่ได้จะเป็น None
+    """
+    if pd.api.types.is_datetime64_any_dtype(values):
+        parsed = pd.to_datetime(values, errors='coerce')
+    else:
+        is_datetime_cell = values.map(lambda v: isinstance(v, (datetime, date)))
+        parsed = pd.to_datetime(values.where(is_datetime_cell), errors='coerce')
+
+        text = values.where(~is_datetime_cell).astype('string').str.strip()
+        thai_parts = text.str.extract(r'^(\d{1,2})/(\d{1,2})/(\d{4})$')
+        buddhist_year = pd.to_numeric(thai_parts[2], errors='coerce')
+        christian_year = (buddhist_year - 543).where(buddhist_year >= 2500).astype('Int64').astype('string')
+        from_thai = pd.to_datetime(
+            christian_year + '-' + thai_parts[1].str.zfill(2) + '-' + thai_parts[0].str.zfill(2),
+            format='%Y-%m-%d', errors='coerce'
+        )
+        from_iso = pd.to_datetime(text.where(text.str.match(r'^\d{4}-\d{2}-\d{2}$', na=False)), format='%Y-%m-%d', errors='coerce')
+        parsed = parsed.fillna(from_thai).fillna(from_iso)
+
+    parsed = parsed.dt.normalize()
+    iso_series = parsed.dt.strftime('%Y-%m-%d')
+    thai_series = parsed.dt.strftime('%d/%m/') + (parsed.dt.year + 543).astype('Int64').astype('string')
+    return iso_series.astype(object).where(parsed.notna(), None), thai_series.astype(object).where(parsed.notna(), None)
+
+def normalize_code_series(values):
+    """แปลงคอลัมน์รหัส (เช่น รหัสยา) เป็นข้อความ ตัดช่องว่าง และตัด .0 ที่เกิดจาก Excel อ่านตัวเลขเป็นทศนิยม"""
+    text = values.astype('string').str.strip()
+    if pd.api.types.is_numeric_dtype(values):
+        text = text.str.replace(r'\.0$', '', regex=True)
+    return text.fillna('')
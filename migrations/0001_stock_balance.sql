@@ -0,0 +1,13 @@
+-- 0001: ตาราง stock_balance (ยอดคงเหลือรวมต่อยา) สำหรับฐานข้อมูลที่สร้างก่อนมีตารางนี้
+-- หลัง migrate ให้สร้างข้อมูลเริ่มต้นด้วยคำสั่ง: flask stock-balance rebuild
+
+CREATE TABLE IF NOT EXISTS `stock_balance` (
+  `hcode` VARCHAR(5) NOT NULL COMMENT 'รหัสหน่วยบริการเจ้าของคลัง (อ้างอิง unitservice.hcode)',
+  `medicine_id` INT NOT NULL COMMENT 'รหัสยา (อ้างอิง medicines.id)',
+  `total_on_hand` INT NOT NULL DEFAULT 0 COMMENT 'ยอดคงเหลือรวมทุกล็อต',
+  `nearest_expiry` DATE NULL COMMENT 'วันหมดอายุที่ใกล้ที่สุดของล็อตที่ยังมียาคงเหลือ',
+  `updated_at` TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  PRIMARY KEY (`hcode`, `medicine_id`),
+  FOREIGN KEY (`hcode`) REFERENCES `unitservice`(`hcode`) ON DELETE CASCADE ON UPDATE CASCADE,
+  FOREIGN KEY (`medicine_id`) REFERENCES `medicines`(`id`) ON DELETE CASCADE ON UPDATE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='ยอดคงเหลือรวมต่อยาและหน่วยบริการ (materialized จาก inventory)';
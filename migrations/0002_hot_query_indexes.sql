@@ -0,0 +1,40 @@
+-- 0002: index สำหรับรูปแบบ query ที่ใช้บ่อย
+-- ตรวจสอบผลด้วยคำสั่ง: flask db explain-check
+
+-- ประวัติการเคลื่อนไหว / ยอดยกมา / คำนวณ Min-Max: WHERE hcode, medicine_id [, transaction_type] AND ช่วง transaction_date
+ALTER TABLE `inventory_transactions`
+  ADD INDEX `idx_inv_txn_hcode_medicine_date` (`hcode`, `medicine_id`, `transaction_date`);
+
+ALTER TABLE `inventory_transactions`
+  ADD INDEX `idx_inv_txn_hcode_type_date` (`hcode`, `transaction_type`, `transaction_date`, `medicine_id`, `quantity_change`);
+
+-- ลบ transaction log ตอนยกเลิก/ลบเอกสาร: WHERE reference_document_id = ...
+ALTER TABLE `inventory_transactions`
+  ADD INDEX `idx_inv_txn_reference_document` (`reference_document_id`);
+
+-- Lot คงเหลือเรียงตาม FEFO: WHERE hcode, medicine_id AND quantity_on_hand > 0 ORDER BY expiry_date, id
+ALTER TABLE `inventory`
+  ADD INDEX `idx_inventory_fefo` (`hcode`, `medicine_id`, `expiry_date`, `quantity_on_hand`);
+
+-- hos_guid เดิมเป็น TEXT ซึ่งทำ index ไม่ได้ (HOSxP GUID ยาวไม่เกิน 38 ตัวอักษร)
+ALTER TABLE `dispense_items`
+  MODIFY `hos_guid` VARCHAR(100) NULL COMMENT 'รหัสอ้างอิงของรายการยา';
+
+ALTER TABLE `dispense_items`
+  ADD INDEX `idx_dispense_items_hos_guid` (`hos_guid`);
+
+-- รายการเอกสารตัดจ่ายของหน่วยบริการตามช่วงวันที่
+-- (dispense_record_number LIKE 'DSP-...%' ใช้ UNIQUE index ของคอลัมน์นั้นอยู่แล้ว)
+ALTER TABLE `dispense_records`
+  ADD INDEX `idx_dispense_records_hcode_date` (`hcode`, `dispense_date`);
+
+-- รายการใบเบิก: WHERE status [, requester_hcode] ORDER BY requisition_date
+ALTER TABLE `requisitions`
+  ADD INDEX `idx_requisitions_status_hcode_date` (`status`, `requester_hcode`, `requisition_date`);
+
+ALTER TABLE `requisitions`
+  ADD INDEX `idx_requisitions_hcode_date` (`requester_hcode`, `requisition_date`);
+
+-- เอกสารรับยาของหน่วยบริการตามวันที่รับ
+ALTER TABLE `goods_received_vouchers`
+  ADD INDEX `idx_grv_hcode_received_date` (`hcode`, `received_date`);
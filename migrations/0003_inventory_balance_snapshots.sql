@@ -0,0 +1,13 @@
+-- 0003: ยอดยกมารายเดือนต่อยา สำหรับคำนวณยอดยกมาของหน้าประวัติการเคลื่อนไหวโดยไม่ต้อง SUM ทั้งประวัติ
+-- snapshot ถูกสร้างอัตโนมัติเมื่อมีการเรียกดูประวัติ และถูกลบเมื่อมี transaction ย้อนหลังก่อนวันที่ของ snapshot
+
+CREATE TABLE IF NOT EXISTS `inventory_balance_snapshots` (
+  `hcode` VARCHAR(5) NOT NULL COMMENT 'รหัสหน่วยบริการ (อ้างอิง unitservice.hcode)',
+  `medicine_id` INT NOT NULL COMMENT 'รหัสยา (อ้างอิง medicines.id)',
+  `snapshot_date` DATE NOT NULL COMMENT 'ยอดคงเหลือ ณ ต้นวันนี้ (ต้นเดือน)',
+  `balance` INT NOT NULL COMMENT 'ผลรวม quantity_change ของ transaction ก่อน snapshot_date',
+  `created_at` TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`hcode`, `medicine_id`, `snapshot_date`),
+  FOREIGN KEY (`hcode`) REFERENCES `unitservice`(`hcode`) ON DELETE CASCADE ON UPDATE CASCADE,
+  FOREIGN KEY (`medicine_id`) REFERENCES `medicines`(`id`) ON DELETE CASCADE ON UPDATE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='ยอดยกมารายเดือนของยาแต่ละรายการ';
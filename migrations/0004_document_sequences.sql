@@ -0,0 +1,11 @@
+-- 0004: ตัวนับเลขที่เอกสาร (DSP, DSPEXC, GRN, REQ) ต่อประเภท/หน่วยบริการ/วัน แทนการค้นเลขล่าสุดด้วย LIKE ทุกครั้งที่สร้างเอกสาร
+-- แถวของวันถูกสร้างอัตโนมัติเมื่อออกเลขแรกของวัน โดยตั้งต้นจากเลขที่มีอยู่แล้วในตารางเอกสาร
+
+CREATE TABLE IF NOT EXISTS `document_sequences` (
+  `prefix` VARCHAR(10) NOT NULL COMMENT 'ประเภทเลขที่เอกสาร เช่น DSP, DSPEXC, GRN, REQ',
+  `scope` VARCHAR(10) NOT NULL DEFAULT '' COMMENT 'รหัสหน่วยบริการ (ว่าง = ใช้ร่วมกันทั้งระบบ เช่น REQ)',
+  `period` VARCHAR(8) NOT NULL COMMENT 'วันที่ในเลขที่เอกสาร (YYMMDD หรือ YYYYMMDD)',
+  `last_value` INT NOT NULL DEFAULT 0 COMMENT 'ลำดับล่าสุดที่ออกไปแล้ว',
+  `updated_at` TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  PRIMARY KEY (`prefix`, `scope`, `period`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='ตัวนับเลขที่เอกสารรายวัน';
@@ -0,0 +1,10 @@
+-- 0005: ตัวนับการเปลี่ยนแปลงข้อมูลต่อหน่วยบริการ ใช้สร้าง ETag ของ /api/medicines และ /api/inventory/
+-- medicines_version เพิ่มเมื่อข้อมูลหลักของยาเปลี่ยน / stock_version เพิ่มใน transaction เดียวกับที่ปรับ stock_balance
+
+CREATE TABLE IF NOT EXISTS `clinic_data_versions` (
+  `hcode` VARCHAR(5) NOT NULL COMMENT 'รหัสหน่วยบริการ (อ้างอิง unitservice.hcode)',
+  `medicines_version` BIGINT UNSIGNED NOT NULL DEFAULT 0 COMMENT 'ตัวนับการเปลี่ยนแปลงข้อมูลหลักของยา',
+  `stock_version` BIGINT UNSIGNED NOT NULL DEFAULT 0 COMMENT 'ตัวนับการเปลี่ยนแปลงยอดคงเหลือ',
+  `updated_at` TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  PRIMARY KEY (`hcode`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='ตัวนับการเปลี่ยนแปลงข้อมูลต่อหน่วยบริการ (ETag)';
@@ -0,0 +1,19 @@
+-- 0006: บันทึกการเปลี่ยนแปลงสำหรับ feed /api/changes (ยา, ยอดคงเหลือรายยา, สถานะใบเบิก)
+-- change_seq นับต่อหน่วยบริการใน transaction เดียวกับการเขียนข้อมูล / pruned_seq คือ seq สูงสุดที่ถูกลบออกจาก change_log แล้ว
+
+ALTER TABLE `clinic_data_versions`
+  ADD COLUMN `change_seq` BIGINT UNSIGNED NOT NULL DEFAULT 0 COMMENT 'ลำดับการเปลี่ยนแปลงล่าสุดใน change_log' AFTER `stock_version`;
+
+ALTER TABLE `clinic_data_versions`
+  ADD COLUMN `pruned_seq` BIGINT UNSIGNED NOT NULL DEFAULT 0 COMMENT 'token ที่เก่ากว่าค่านี้ต้องโหลดข้อมูลใหม่ทั้งหมด' AFTER `change_seq`;
+
+CREATE TABLE IF NOT EXISTS `change_log` (
+  `id` BIGINT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY,
+  `hcode` VARCHAR(5) NOT NULL COMMENT 'รหัสหน่วยบริการ (อ้างอิง unitservice.hcode)',
+  `seq` BIGINT UNSIGNED NOT NULL COMMENT 'ลำดับการเปลี่ยนแปลงของหน่วยบริการ (clinic_data_versions.change_seq)',
+  `entity` VARCHAR(20) NOT NULL COMMENT 'medicine, stock (entity_id = medicine_id) หรือ requisition',
+  `entity_id` INT NOT NULL,
+  `created_at` TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  INDEX `idx_change_log_hcode_seq` (`hcode`, `seq`),
+  INDEX `idx_change_log_created_at` (`created_at`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='บันทึกการเปลี่ยนแปลงสำหรับ feed /api/changes';
@@ -0,0 +1,10 @@
+-- 0007: จุดซิงค์ล่าสุดของข้อมูลการจ่ายยาจาก HOSxP ต่อหน่วยบริการ (ใช้ดึงเฉพาะรายการใหม่แทนการส่งซ้ำทั้งช่วงวันที่)
+-- (last_vstdate, last_hos_guid) เลื่อนใน transaction เดียวกับที่บันทึกรายการตัดจ่าย จึงไม่ล้ำหน้าข้อมูลที่ commit แล้ว
+
+CREATE TABLE IF NOT EXISTS `dispense_sync_watermarks` (
+  `hcode` VARCHAR(5) NOT NULL COMMENT 'รหัสหน่วยบริการ (อ้างอิง unitservice.hcode)',
+  `last_vstdate` DATE NOT NULL COMMENT 'วันที่รับบริการของรายการล่าสุดที่บันทึกแล้ว',
+  `last_hos_guid` VARCHAR(100) NOT NULL COMMENT 'hos_guid ของรายการล่าสุดที่บันทึกแล้ว (เรียงตาม vstdate, hos_guid)',
+  `updated_at` TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  PRIMARY KEY (`hcode`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='จุดซิงค์ล่าสุดของข้อมูลการจ่ายยาจาก HOSxP';
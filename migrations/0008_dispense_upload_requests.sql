@@ -0,0 +1,17 @@
+-- 0008: สถานะของคำขอตัดจ่ายแบบ bulk ต่อ idempotency_key (หนึ่งชุดข้อมูลจากโปรแกรมนำเข้า)
+-- คำขอที่ส่งซ้ำหลัง timeout ทำต่อจากสถานะที่ commit แล้วแทนการตัดจ่ายซ้ำ และคำขอที่ซ้อนกันทำ chunk เดียวกันไม่ได้
+
+CREATE TABLE IF NOT EXISTS `dispense_upload_requests` (
+  `hcode` VARCHAR(5) NOT NULL COMMENT 'รหัสหน่วยบริการ (อ้างอิง unitservice.hcode)',
+  `idempotency_key` VARCHAR(64) NOT NULL COMMENT 'รหัสของคำขอจาก client (คำขอที่ส่งซ้ำใช้รหัสเดิม)',
+  `fingerprint` CHAR(16) NOT NULL COMMENT 'ลายนิ้วมือของรายการในคำขอ',
+  `dispense_record_id` INT NULL COMMENT 'เอกสารตัดจ่ายที่คำขอนี้บันทึกรายการลง',
+  `next_index` INT NOT NULL DEFAULT 0 COMMENT 'ตำแหน่งรายการถัดไปที่ยังไม่ได้บันทึก',
+  `processed_total` INT NOT NULL DEFAULT 0 COMMENT 'จำนวนรายการที่บันทึกสำเร็จแล้ว',
+  `failed_total` INT NOT NULL DEFAULT 0 COMMENT 'จำนวนรายการที่ผิดพลาด',
+  `completed` TINYINT(1) NOT NULL DEFAULT 0 COMMENT 'ประมวลผลครบทุกรายการแล้ว',
+  `created_at` TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  `updated_at` TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  PRIMARY KEY (`hcode`, `idempotency_key`),
+  INDEX `idx_dispense_upload_requests_created_at` (`created_at`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='สถานะคำขอตัดจ่ายแบบ bulk ต่อ idempotency key';
@@ -0,0 +1,15 @@
+-- 0009: รายการจาก HOSxP ที่ตัดจ่ายไม่สำเร็จ (เช่น สต็อกไม่พอ) ระหว่างการซิงค์ต่อจากจุดล่าสุด
+-- บันทึกใน transaction เดียวกับการเลื่อนจุดซิงค์ จุดซิงค์จึงเลื่อนผ่านรายการเหล่านี้ได้ และโปรแกรมนำเข้าส่งใหม่จากตารางนี้
+
+CREATE TABLE IF NOT EXISTS `dispense_sync_failures` (
+  `hcode` VARCHAR(5) NOT NULL COMMENT 'รหัสหน่วยบริการ (อ้างอิง unitservice.hcode)',
+  `hos_guid` VARCHAR(100) NOT NULL COMMENT 'รหัสอ้างอิงของรายการยาใน HOSxP',
+  `medicine_id` INT NULL COMMENT 'รหัสยา (อ้างอิง medicines.id)',
+  `quantity_dispensed` DECIMAL(12,2) NULL COMMENT 'จำนวนที่จ่ายตาม HOSxP',
+  `dispense_date` DATE NULL COMMENT 'วันที่รับบริการ',
+  `error` TEXT COMMENT 'สาเหตุที่ตัดจ่ายไม่สำเร็จครั้งล่าสุด',
+  `attempts` INT NOT NULL DEFAULT 1 COMMENT 'จำนวนครั้งที่ตัดจ่ายไม่สำเร็จ',
+  `created_at` TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  `updated_at` TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  PRIMARY KEY (`hcode`, `hos_guid`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='รายการซิงค์จาก HOSxP ที่ตัดจ่ายไม่สำเร็จ รอส่งใหม่';
@@ -0,0 +1,18 @@
+-- 0010: สร้างข้อมูล stock_balance จาก inventory ให้ฐานข้อมูลเดิมที่ migrate 0001 แล้วแต่ยังไม่ได้รัน flask stock-balance rebuild
+-- ระหว่างที่ตารางว่าง สรุปคลังยาและการค้นหายาจะเห็นยอดคงเหลือเป็น 0 ทุกรายการ
+-- ใช้ ON DUPLICATE KEY UPDATE จึงรันบนฐานข้อมูลที่ rebuild แล้ว (หรือฐานข้อมูลใหม่ที่ยังไม่มีข้อมูล) ได้โดยผลเหมือนเดิม
+
+INSERT INTO stock_balance (hcode, medicine_id, total_on_hand, nearest_expiry)
+SELECT hcode, medicine_id,
+       COALESCE(SUM(quantity_on_hand), 0) AS total_on_hand,
+       MIN(CASE WHEN quantity_on_hand > 0 THEN expiry_date END) AS nearest_expiry
+FROM inventory
+GROUP BY hcode, medicine_id
+ON DUPLICATE KEY UPDATE
+    total_on_hand = VALUES(total_on_hand),
+    nearest_expiry = VALUES(nearest_expiry),
+    updated_at = CURRENT_TIMESTAMP;
+
+-- ETag และ change feed ที่ client ถือไว้สร้างจากตารางที่ว่าง: เพิ่มตัวนับให้ client โหลดยอดคงเหลือใหม่ทั้งหมด
+UPDATE clinic_data_versions SET stock_version = stock_version + 1;
+UPDATE clinic_data_versions SET change_seq = change_seq + 1, pruned_seq = change_seq;
@@ -11,16 +11,11 @@ async function loadAndDisplayUsers() {
         return;
     }
     tableBody.innerHTML = '<tr><td colspan="8" class="text-center text-gray-400 py-4">กำลังโหลดข้อมูลผู้ใช้งาน...</td></tr>';
+    const showEmpty = () => {
+        tableBody.innerHTML = '<tr><td colspan="8" class="text-center text-gray-500 py-4">ไม่พบข้อมูลผู้ใช้งาน</td></tr>';
+    };
     try {
-        const users = await fetchData('/users'); // Assumes fetchData is globally available from utils.js
-        tableBody.innerHTML = ''; 
-
-        if (!users || users.length === 0) {
-            tableBody.innerHTML = '<tr><td colspan="8" class="text-center text-gray-500 py-4">ไม่พบข้อมูลผู้ใช้งาน</td></tr>';
-            return;
-        }
-
-        users.forEach(user => {
+        await loadPagedTable('/users', tableBody, 8, users => users.forEach(user => {
             const row = tableBody.insertRow();
             const statusText = user.is_active ? 'ใช้งาน' : 'ไม่ใช้งาน';
             const statusClass = user.is_active ? 'bg-green-100 text-green-800' : 'bg-red-100 text-red-800';
@@ -42,7 +37,7 @@ async function loadAndDisplayUsers() {
                     </button>
                 </td>
             `;
-        });
+        }), showEmpty);
     } catch (error) {
         tableBody.innerHTML = '<tr><td colspan="8" class="text-center text-red-500 py-4">เกิดข้อผิดพลาดในการโหลดข้อมูลผู้ใช้งาน</td></tr>';
     }
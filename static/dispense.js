@@ -1,6 +1,6 @@
 // dispense.js
-// Global variable to store previewed items for confirmation
-let excelDispensePreviewData = null;
+// Global variable to store the uploaded Excel file until the preview is confirmed
+let excelDispenseUploadFile = null;
 /**
  * Loads and displays the history of dispensed medicine records for the current user's hcode.
  */
@@ -34,16 +34,12 @@ async function loadAndDisplayDispenseHistory() {
     
     let endpoint = `/dispense_records?${params.toString()}`;
 
-    try {
-        const dispenseHistory = await fetchData(endpoint); 
-        tableBody.innerHTML = ''; 
+    const showEmpty = () => {
+        tableBody.innerHTML = `<tr><td colspan="5" class="text-center text-gray-500 py-4">ไม่พบประวัติการตัดจ่ายยา${currentUser.hcode ? 'สำหรับหน่วยบริการ ' + currentUser.hcode : ''} ในช่วงวันที่ที่เลือก</td></tr>`;
+    };
 
-        if (!dispenseHistory || dispenseHistory.length === 0) {
-            tableBody.innerHTML = `<tr><td colspan="5" class="text-center text-gray-500 py-4">ไม่พบประวัติการตัดจ่ายยา${currentUser.hcode ? 'สำหรับหน่วยบริการ ' + currentUser.hcode : ''} ในช่วงวันที่ที่เลือก</td></tr>`;
-            return;
-        }
-
-        dispenseHistory.forEach(record => {
+    try {
+        await loadPagedTable(endpoint, tableBody, 5, dispenseHistory => dispenseHistory.forEach(record => {
             const row = tableBody.insertRow();
             // Ensure record object is correctly stringified for onclick event
             const recordJsonString = JSON.stringify(record).replace(/"/g, "&quot;").replace(/'/g, "&apos;");
@@ -69,7 +65,7 @@ async function loadAndDisplayDispenseHistory() {
                     </button>
                 </td>
             `;
-        });
+        }), showEmpty);
     } catch (error) {
         tableBody.innerHTML = '<tr><td colspan="5" class="text-center text-red-500 py-4">เกิดข้อผิดพลาดในการโหลดประวัติการตัดจ่ายยา</td></tr>';
     }
@@ -254,9 +250,9 @@ async function uploadDispenseExcel() {
         return;
     }
 
-    const file = fileInput.files[0];
+    excelDispenseUploadFile = fileInput.files[0];
     const formData = new FormData();
-    formData.append('file', file);
+    formData.append('file', excelDispenseUploadFile);
     formData.append('hcode', currentUser.hcode); 
 
     Swal.fire({
@@ -278,34 +274,34 @@ async function uploadDispenseExcel() {
         if (!response.ok) {
             Swal.fire('เกิดข้อผิดพลาด', result.error || 'ไม่สามารถอ่านข้อมูลจากไฟล์ Excel ได้', 'error');
             fileInput.value = ''; 
+            excelDispenseUploadFile = null;
             return;
         }
 
-        if (result.preview_items && result.preview_items.length > 0) {
-            excelDispensePreviewData = result.preview_items; 
-            showDispenseExcelPreviewModal(result.preview_items);
-        } else {
-            Swal.fire('ไม่พบข้อมูล', 'ไม่พบรายการยาที่สามารถประมวลผลได้ในไฟล์ Excel', 'info');
-            fileInput.value = ''; 
-        }
+        showDispenseExcelPreviewModal(result);
 
     } catch (error) {
         Swal.close();
         console.error('Error previewing Excel file:', error);
         Swal.fire('เกิดข้อผิดพลาด', 'ไม่สามารถเชื่อมต่อกับเซิร์ฟเวอร์หรือประมวลผลไฟล์ตัวอย่างได้', 'error');
         fileInput.value = ''; 
+        excelDispenseUploadFile = null;
     }
 }
 
-function showDispenseExcelPreviewModal(previewItems) {
+function showDispenseExcelPreviewModal(result) {
     const modalTitle = document.getElementById('modalTitle');
     const modalBody = document.getElementById('modalBody');
     if (!modalTitle || !modalBody) return;
 
+    const summary = result.summary;
     modalTitle.textContent = 'ตรวจสอบรายการตัดจ่ายยาจาก Excel (FEFO)';
-    let itemsHtml = `
+    // ยืนยันแล้วระบบจะอ่านไฟล์เดิมอีกครั้งฝั่งเซิร์ฟเวอร์ การแก้ไขจึงต้องทำในไฟล์แล้วอัปโหลดใหม่
+    modalBody.innerHTML = `
         <div class="text-sm mb-4">
-            <p>กรุณาตรวจสอบรายการด้านล่าง และแก้ไขวันที่/จำนวน หากจำเป็น ระบบจะจ่ายยาตามหลัก FEFO</p>
+            <p>ทั้งหมด <b>${summary.total_rows}</b> แถว: พร้อมจ่าย <b class="text-green-600">${summary.ready_rows}</b>, ข้ามรายการซ้ำ <b>${summary.skipped_rows}</b>, มีข้อผิดพลาด <b class="text-red-600">${summary.error_rows}</b></p>
+            ${result.preview_truncated ? `<p class="text-orange-600 text-xs">แสดงเพียง ${result.preview_items.length} รายการ (รายการที่มีข้อผิดพลาดแสดงก่อน)</p>` : ''}
+            <p>ระบบจะจ่ายยาตามหลัก FEFO หากต้องการแก้ไขวันที่/จำนวน กรุณาแก้ไขในไฟล์แล้วอัปโหลดใหม่</p>
             <p class="text-orange-600"><b>หมายเหตุสถานะการนำเข้า:</b></p>
             <ul class="list-disc list-inside ml-4 text-xs">
                 <li><span class="text-green-600 font-semibold">พร้อมจ่าย (FEFO) / รายการใหม่ (hos_guid):</span> ระบบจะพยายามจ่ายยาตามจำนวนนี้</li>
@@ -314,234 +310,167 @@ function showDispenseExcelPreviewModal(previewItems) {
                 <li><span class="text-red-600 font-semibold">มีข้อผิดพลาด / สต็อกไม่เพียงพอ:</span> ไม่สามารถดำเนินการได้</li>
             </ul>
         </div>
-        <table class="custom-table text-xs sm:text-sm w-full">
-            <thead>
-                <tr>
-                    <th>แถวที่</th>
-                    <th>HOS GUID</th>
-                    <th>วันที่จ่าย</th>
-                    <th>รหัสยา</th>
-                    <th>ชื่อยา</th>
-                    <th>จำนวน</th>
-                    <th>Lot ที่จะใช้ (FEFO)</th> 
-                    <th>สถานะการนำเข้า</th>
-                </tr>
-            </thead>
-            <tbody>`;
-
-    previewItems.forEach((item, index) => {
-        let rowClass = '';
-        let inputsDisabled = false;
-        let lotInfoDisplay = '<span class="text-gray-400">-</span>';
-
-        if (item.status === "พร้อมจ่าย (FEFO)" || item.status === "รายการใหม่ (hos_guid)" || item.status.includes("จำนวนแตกต่าง")) {
-            rowClass = item.status.includes("จำนวนแตกต่าง") ? 'bg-blue-50' : 'bg-green-50';
-            if (item.available_lots_info_for_preview && item.available_lots_info_for_preview.length > 0) {
-                lotInfoDisplay = item.available_lots_info_for_preview.join('<br>');
-            } else if (item.status === "พร้อมจ่าย (FEFO)") { // Should have lot info if ready
-                lotInfoDisplay = '<span class="text-orange-500">รอระบบเลือก Lot</span>';
-            }
-        } else if (item.status === "รายการซ้ำ (hos_guid) และจำนวนเท่าเดิม") {
-            rowClass = 'bg-gray-200 opacity-70'; 
-            inputsDisabled = true;
-            lotInfoDisplay = '<span class="text-gray-400">จะถูกข้าม</span>';
-        } else if (item.errors.length > 0 || item.status === "มีข้อผิดพลาด" || item.status.includes("สต็อกไม่เพียงพอ")) {
-            rowClass = 'bg-red-100'; 
-            inputsDisabled = true;
-            lotInfoDisplay = '<span class="text-red-500">ไม่สามารถจ่ายได้</span>';
-             if (item.available_lots_info_for_preview && item.available_lots_info_for_preview.length > 0) {
-                lotInfoDisplay = `<span class="text-red-500">${item.available_lots_info_for_preview.join('<br>')}</span>`;
-            }
-        }
-
-        let statusDisplayClass = '';
-        if (item.errors.length > 0 || item.status === "มีข้อผิดพลาด" || item.status.includes("สต็อกไม่เพียงพอ")) statusDisplayClass = 'text-red-600 font-semibold';
-        else if (item.status.includes("จำนวนแตกต่าง")) statusDisplayClass = 'text-blue-600 font-semibold';
-        else if (item.status.includes("จำนวนเท่าเดิม")) statusDisplayClass = 'text-gray-600';
-        else if (item.status === "พร้อมจ่าย (FEFO)" || item.status === "รายการใหม่ (hos_guid)") statusDisplayClass = 'text-green-600 font-semibold';
-        else statusDisplayClass = 'text-gray-500';
-
-
-        itemsHtml += `
-            <tr data-item-index="${index}" class="${rowClass}">
-                <td class="text-center">${item.row_num-1}</td>
-                <td>${item.hos_guid || '-'}</td>
-                <td><input type="text" id="excel-dispense-date-${index}" class="input-field !p-1 !text-xs !mb-0 thai-date-formatter" value="${item.dispense_date_str}" ${inputsDisabled ? 'disabled' : ''}></td>
-                <td>${item.medicine_code}</td>
-                <td>${item.medicine_name}</td>
-                <td><input type="number" id="excel-quantity-${index}" class="input-field !p-1 !text-xs w-16 !mb-0" value="${item.quantity_requested_str}" min="1" ${inputsDisabled ? 'disabled' : ''}></td>
-                <td class="text-xs">${lotInfoDisplay}</td> 
-                <td class="${statusDisplayClass}">${item.errors.length > 0 ? item.errors.join('<br>') : item.status}</td>
-            </tr>`;
-    });
-
-    itemsHtml += `</tbody></table>`;
-    modalBody.innerHTML = `
         <form id="confirmDispenseExcelForm">
-            ${itemsHtml}
+            <div class="overflow-x-auto max-h-96">
+                <table class="custom-table text-xs sm:text-sm w-full">
+                    <thead>
+                        <tr>
+                            <th>แถวที่</th>
+                            <th>HOS GUID</th>
+                            <th>วันที่จ่าย</th>
+                            <th>รหัสยา</th>
+                            <th>ชื่อยา</th>
+                            <th>จำนวน</th>
+                            <th>Lot ที่จะใช้ (FEFO)</th> 
+                            <th>สถานะการนำเข้า</th>
+                        </tr>
+                    </thead>
+                    <tbody id="dispenseExcelPreviewRows"></tbody>
+                </table>
+            </div>
             <div class="flex justify-end space-x-3 mt-6">
-                <button type="button" class="btn btn-secondary" onclick="closeModal('formModal'); document.getElementById('excelUploadDispense').value = ''; excelDispensePreviewData = null;">ยกเลิก</button>
-                <button type="submit" class="btn btn-primary">ยืนยันการตัดจ่าย</button>
+                <button type="button" class="btn btn-secondary" onclick="closeModal('formModal'); document.getElementById('excelUploadDispense').value = ''; excelDispenseUploadFile = null;">ยกเลิก</button>
+                <button type="submit" class="btn btn-primary" ${summary.ready_rows > 0 ? '' : 'disabled'}>ยืนยันการตัดจ่าย</button>
             </div>
         </form>
     `;
-    openModal('formModal');
 
-    document.querySelectorAll(`#formModal .thai-date-formatter`).forEach(el => {
-        if (typeof autoFormatThaiDateInput === 'function') {
-            el.addEventListener('input', autoFormatThaiDateInput);
+    // ค่าจากไฟล์ (hos_guid, รหัสยา, ข้อความผิดพลาด) ใส่ด้วย textContent เพื่อไม่ให้ถูกตีความเป็น HTML
+    const rowsBody = document.getElementById('dispenseExcelPreviewRows');
+    result.preview_items.forEach(item => {
+        let rowClass = 'bg-green-50';
+        let statusClass = 'text-green-600 font-semibold';
+        let lotInfo = item.available_lots_info_for_preview.length > 0 ? item.available_lots_info_for_preview.join('\n') : '-';
+        if (item.errors.length > 0) {
+            rowClass = 'bg-red-100';
+            statusClass = 'text-red-600 font-semibold';
+            if (item.available_lots_info_for_preview.length === 0) lotInfo = 'ไม่สามารถจ่ายได้';
+        } else if (item.status.includes("จำนวนเท่าเดิม")) {
+            rowClass = 'bg-gray-200 opacity-70';
+            statusClass = 'text-gray-600';
+            lotInfo = 'จะถูกข้าม';
+        } else if (item.status.includes("จำนวนแตกต่าง")) {
+            rowClass = 'bg-blue-50';
+            statusClass = 'text-blue-600 font-semibold';
         }
+        const row = rowsBody.insertRow();
+        row.className = rowClass;
+        [
+            [item.row_num - 1, 'text-center'],
+            [item.hos_guid || '-', ''],
+            [item.dispense_date_str, ''],
+            [item.medicine_code, ''],
+            [item.medicine_name, ''],
+            [item.quantity_requested_str, 'text-center'],
+            [lotInfo, 'text-xs'],
+            [item.errors.length > 0 ? item.errors.join('\n') : item.status, statusClass],
+        ].forEach(([value, cellClass]) => {
+            const cell = row.insertCell();
+            cell.className = cellClass;
+            cell.style.whiteSpace = 'pre-line';
+            cell.textContent = value ?? '';
+        });
     });
+    openModal('formModal');
 
     document.getElementById('confirmDispenseExcelForm').addEventListener('submit', async function(e) {
         e.preventDefault();
-        confirmAndProcessExcelDispense();
+        confirmAndProcessExcelDispense(summary);
     });
 }
 
-// updateLotExpiryForExcelPreview is no longer needed as user doesn't select lot for FEFO
-
-async function confirmAndProcessExcelDispense() {
-    if (!excelDispensePreviewData || !currentUser) {
-        Swal.fire('ข้อผิดพลาด', 'ไม่มีข้อมูลตัวอย่างสำหรับการยืนยัน หรือไม่พบข้อมูลผู้ใช้', 'error');
+async function confirmAndProcessExcelDispense(summary) {
+    if (!excelDispenseUploadFile || !currentUser) {
+        Swal.fire('ข้อผิดพลาด', 'ไม่พบไฟล์สำหรับการยืนยัน หรือไม่พบข้อมูลผู้ใช้', 'error');
         return;
     }
 
-    const itemsToSubmit = [];
-    let hasValidationError = false;
-
-    excelDispensePreviewData.forEach((originalItem, index) => {
-        // Skip items that are informational (skipped) or have errors from preview
-        if (originalItem.status === "รายการซ้ำ (hos_guid) และจำนวนเท่าเดิม" || originalItem.status === "มีข้อผิดพลาด" || originalItem.errors.length > 0 || originalItem.status.includes("สต็อกไม่เพียงพอ")) {
-            return; 
-        }
-        
-        const quantityInput = document.getElementById(`excel-quantity-${index}`);
-        const dateInput = document.getElementById(`excel-dispense-date-${index}`);
-        const rowElement = document.querySelector(`tr[data-item-index="${index}"]`);
-        if(rowElement) rowElement.classList.remove('border-2', 'border-red-500'); 
-
+    const result = await Swal.fire({
+        title: 'ยืนยันการตัดจ่ายยา',
+        text: `คุณต้องการยืนยันการตัดจ่ายยาทั้งหมด ${summary.ready_rows} รายการใช่หรือไม่? (ระบบจะจ่ายตาม FEFO)`,
+        icon: 'question',
+        showCancelButton: true,
+        confirmButtonText: 'ยืนยัน',
+        cancelButtonText: 'ยกเลิก',
+    });
+    if (!result.isConfirmed) return;
 
-        if (quantityInput && dateInput) {
-            const finalQuantityStr = quantityInput.value;
-            const finalDateStr = dateInput.value;
-            const finalDateIso = (typeof thai_to_iso_date_frontend === 'function') ? thai_to_iso_date_frontend(finalDateStr) : null;
+    Swal.fire({
+        title: 'กำลังบันทึกการตัดจ่าย...',
+        allowOutsideClick: false,
+        didOpen: () => { Swal.showLoading(); }
+    });
 
-            if (!finalDateIso) {
-                Swal.fire('ข้อผิดพลาด', `รูปแบบวันที่ไม่ถูกต้องสำหรับรายการยา ${originalItem.medicine_code} (แถว Excel ${originalItem.row_num})`, 'error');
-                if(rowElement) rowElement.classList.add('border-2', 'border-red-500');
-                hasValidationError = true; return;
+    // ส่งไฟล์เดิมให้ /dispense/upload_excel/process อ่านเอง ถ้าได้ 202 ให้ส่งไฟล์เดิมซ้ำพร้อม resume_cursor จนครบ
+    // idempotency_key เดียวกันทุกรอบ ทำให้การส่งซ้ำหลังการเชื่อมต่อหลุดไม่ตัดจ่ายซ้ำ
+    const idempotencyKey = (window.crypto && crypto.randomUUID) ? crypto.randomUUID() : `${Date.now()}-${Math.random().toString(36).slice(2)}`;
+    const failedDetails = [];
+    const updatedHosGuids = [];
+    const skippedHosGuids = [];
+    let resumeCursor = null;
+    let response, responseData;
+    try {
+        do {
+            const formData = new FormData();
+            formData.append('file', excelDispenseUploadFile);
+            formData.append('hcode', currentUser.hcode);
+            formData.append('dispenser_id', currentUser.id);
+            formData.append('idempotency_key', idempotencyKey);
+            if (resumeCursor) formData.append('resume_cursor', resumeCursor);
+            response = await fetch(`${API_BASE_URL}/dispense/upload_excel/process`, { method: 'POST', body: formData });
+            responseData = await response.json();
+            failedDetails.push(...(responseData.failed_details || responseData.details || []));
+            updatedHosGuids.push(...(responseData.updated_hos_guids || []));
+            skippedHosGuids.push(...(responseData.skipped_hos_guids_same_qty || []));
+            resumeCursor = responseData.next_cursor;
+        } while (response.status === 202 && resumeCursor);
+
+        let swalIcon, swalTitle, swalHtml;
+
+        if (response.ok || response.status === 207) { 
+            const totalProcessed = responseData.total_processed_count ?? responseData.processed_count ?? 0;
+            swalIcon = 'success';
+            swalTitle = 'การตัดจ่ายยาจาก Excel สำเร็จ';
+            swalHtml = `ประมวลผลสำเร็จ: ${totalProcessed} รายการ.<br>เอกสารตัดจ่ายเลขที่: <b>${escapeHtml(responseData.dispense_record_number || 'N/A')}</b>`;
+
+            if (updatedHosGuids.length > 0) {
+                swalHtml += `<br>อัปเดต (hos_guid): ${updatedHosGuids.length} รายการ.`;
             }
-            let finalQuantity;
-            try {
-                finalQuantity = parseInt(finalQuantityStr);
-                if (isNaN(finalQuantity) || finalQuantity <= 0) throw new Error("จำนวนไม่ถูกต้อง");
-            } catch (e) {
-                Swal.fire('ข้อผิดพลาด', `จำนวนจ่ายไม่ถูกต้องสำหรับรายการยา ${originalItem.medicine_code} (แถว Excel ${originalItem.row_num})`, 'error');
-                if(rowElement) rowElement.classList.add('border-2', 'border-red-500');
-                hasValidationError = true; return;
+            if (skippedHosGuids.length > 0) {
+                swalHtml += `<br>ข้ามรายการซ้ำ (hos_guid, จำนวนเท่าเดิม): ${skippedHosGuids.length} รายการ.`;
             }
-
-            // No lot selection by user, backend handles FEFO
-            itemsToSubmit.push({
-                row_num: originalItem.row_num,
-                hos_guid: originalItem.hos_guid, 
-                medicine_id: originalItem.medicine_id,
-                medicine_code: originalItem.medicine_code, 
-                // Lot and expiry will be determined by backend FEFO logic
-                quantity_dispensed: finalQuantity,
-                dispense_date_iso: finalDateIso 
+            if (responseData.peak_memory_mb !== undefined) {
+                console.info(`Excel dispense upload peak memory: ${responseData.peak_memory_mb} MB`);
+            }
+            if (responseData.total_failed_count > 0) {
+                swalIcon = totalProcessed > 0 ? 'warning' : 'error';
+                swalTitle = totalProcessed > 0 ? 'การตัดจ่ายสำเร็จบางส่วน!' : 'การตัดจ่ายล้มเหลว!';
+                swalHtml += `<br><br><b>พบข้อผิดพลาด ${responseData.total_failed_count} รายการที่ไม่ถูกบันทึก</b>`;
+            }
+        } else { 
+            swalIcon = 'error';
+            swalTitle = 'เกิดข้อผิดพลาด';
+            swalHtml = escapeHtml(responseData.error || responseData.message || 'ไม่สามารถบันทึกการตัดจ่ายยาจาก Excel ได้');
+        }
+        if (failedDetails.length > 0) {
+            swalHtml += `<br><b>รายละเอียด:</b><br><div style="max-height: 150px; overflow-y: auto; text-align: left; font-size: 0.9em; margin-top: 10px; padding: 5px; border: 1px solid #ddd; background-color: #f9f9f9;">`;
+            failedDetails.forEach(fail => {
+                const rowLabel = fail.row_num ? `แถว ${fail.row_num - 1}: ` : '';
+                swalHtml += `${rowLabel}ยา ${escapeHtml(fail.medicine_code || fail.hos_guid || 'N/A')}: ${escapeHtml(fail.error)}<br>`;
             });
+            swalHtml += `</div>`;
         }
-    });
-
-    if (hasValidationError) return; 
-
-    if (itemsToSubmit.length === 0) {
-        Swal.fire('ไม่มีรายการ', 'ไม่มีรายการยาที่พร้อมสำหรับการตัดจ่าย (อาจมีข้อผิดพลาด หรือเป็นรายการซ้ำที่จำนวนเท่าเดิมทั้งหมด)', 'info');
+        Swal.fire({icon: swalIcon, title: swalTitle, html: swalHtml});
+        if (typeof loadAndDisplayDispenseHistory === 'function') loadAndDisplayDispenseHistory();
+        if (typeof loadAndDisplayInventorySummary === 'function') loadAndDisplayInventorySummary();
+    } catch (error) {
+        console.error('Error confirming excel dispense:', error);
+        Swal.fire('เกิดข้อผิดพลาด', 'การเชื่อมต่อล้มเหลว หรือเกิดข้อผิดพลาดในการยืนยัน', 'error');
+    } finally {
         closeModal('formModal');
         document.getElementById('excelUploadDispense').value = '';
-        excelDispensePreviewData = null;
-        return;
+        excelDispenseUploadFile = null;
     }
-
-    Swal.fire({
-        title: 'ยืนยันการตัดจ่ายยา',
-        text: `คุณต้องการยืนยันการตัดจ่ายยาทั้งหมด ${itemsToSubmit.length} รายการที่เลือกใช่หรือไม่? (ระบบจะจ่ายตาม FEFO)`,
-        icon: 'question',
-        showCancelButton: true,
-        confirmButtonText: 'ยืนยัน',
-        cancelButtonText: 'ยกเลิก',
-        allowOutsideClick: () => !Swal.isLoading(),
-    }).then(async (result) => {
-        if (result.isConfirmed) {
-            Swal.fire({
-                title: 'กำลังบันทึกการตัดจ่าย...',
-                allowOutsideClick: false,
-                didOpen: () => { Swal.showLoading(); }
-            });
-
-            try {
-                const payload = {
-                    dispenser_id: currentUser.id,
-                    hcode: currentUser.hcode,
-                    dispense_items: itemsToSubmit // Backend will handle FEFO based on this
-                };
-                const response = await fetch(`${API_BASE_URL}/dispense/process_excel_dispense`, {
-                    method: 'POST',
-                    headers: {'Content-Type': 'application/json'},
-                    body: JSON.stringify(payload)
-                });
-                const responseData = await response.json();
-
-                let swalIcon, swalTitle, swalHtml;
-
-                if (response.ok || response.status === 207) { 
-                    swalIcon = 'success';
-                    swalTitle = responseData.message || 'การตัดจ่ายยาจาก Excel สำเร็จ';
-                    swalHtml = `ประมวลผลสำเร็จ: ${responseData.processed_count || 0} รายการ.<br>เอกสารตัดจ่ายเลขที่: <b>${responseData.dispense_record_number || 'N/A'}</b>`;
-
-                    if (responseData.updated_hos_guids && responseData.updated_hos_guids.length > 0) {
-                        swalHtml += `<br>อัปเดต (hos_guid): ${responseData.updated_hos_guids.length} รายการ.`;
-                    }
-                    if (responseData.skipped_hos_guids_same_qty && responseData.skipped_hos_guids_same_qty.length > 0) {
-                        swalHtml += `<br>ข้ามรายการซ้ำ (hos_guid, จำนวนเท่าเดิม): ${responseData.skipped_hos_guids_same_qty.length} รายการ.`;
-                    }
-
-                    if (responseData.failed_details && responseData.failed_details.length > 0) {
-                        swalIcon = responseData.processed_count > 0 ? 'warning' : 'error';
-                        swalTitle = responseData.processed_count > 0 ? 'การตัดจ่ายสำเร็จบางส่วน!' : 'การตัดจ่ายล้มเหลว!';
-                        swalHtml += `<br><br><b>พบข้อผิดพลาด ${responseData.failed_details.length} รายการที่ไม่ถูกบันทึก:</b><br><div style="max-height: 150px; overflow-y: auto; text-align: left; font-size: 0.9em; margin-top: 10px; padding: 5px; border: 1px solid #ddd; background-color: #f9f9f9;">`;
-                        responseData.failed_details.forEach(fail => {
-                            swalHtml += `ยา ${fail.medicine_code || (fail.hos_guid || 'N/A')} (Lot: ${fail.lot || 'N/A'}): ${fail.error}<br>`;
-                        });
-                        swalHtml += `</div>`;
-                    }
-                } else { 
-                    swalIcon = 'error';
-                    swalTitle = 'เกิดข้อผิดพลาด';
-                    swalHtml = responseData.error || 'ไม่สามารถบันทึกการตัดจ่ายยาจาก Excel ได้';
-                    if (responseData.details) { 
-                        swalHtml += `<br><br><b>รายละเอียด:</b><br><div style="max-height: 150px; overflow-y: auto; text-align: left; font-size: 0.9em; margin-top: 10px; padding: 5px; border: 1px solid #ddd; background-color: #f9f9f9;">`;
-                        responseData.details.forEach(fail => {
-                             swalHtml += `ยา ${fail.medicine_code || (fail.hos_guid || 'N/A')} (Lot: ${fail.lot || 'N/A'}): ${fail.error}<br>`;
-                        });
-                        swalHtml += `</div>`;
-                    }
-                }
-                Swal.fire({icon: swalIcon, title: swalTitle, html: swalHtml});
-                if (typeof loadAndDisplayDispenseHistory === 'function') loadAndDisplayDispenseHistory();
-                if (typeof loadAndDisplayInventorySummary === 'function') loadAndDisplayInventorySummary();
-            } catch (error) {
-                console.error('Error confirming excel dispense:', error);
-                Swal.fire('เกิดข้อผิดพลาด', 'การเชื่อมต่อล้มเหลว หรือเกิดข้อผิดพลาดในการยืนยัน', 'error');
-            } finally {
-                closeModal('formModal');
-                document.getElementById('excelUploadDispense').value = '';
-                excelDispensePreviewData = null;
-            }
-        }
-    });
 }
 
 async function viewDispenseDetails(recordId, recordHeaderDetails) { 
@@ -28,49 +28,41 @@ async function loadAndDisplayApprovedRequisitionsForReceiving() {
     if (endDate) params.append('endDate', endDate);
     params.append('_cb', new Date().getTime()); // Cache-busting parameter
 
+    const showEmpty = () => {
+        tableBody.innerHTML = '<tr><td colspan="5" class="text-center text-gray-500 py-4">ไม่พบใบเบิกที่อนุมัติแล้วและรอรับยา</td></tr>';
+    };
+
     try {
         const endpoint = `/requisitions?${params.toString()}`;
-        const requisitions = await fetchData(endpoint); 
-        
-        tableBody.innerHTML = ''; 
-
-        if (!Array.isArray(requisitions)) { 
-            console.error("Received non-array data for requisitions:", requisitions);
-            tableBody.innerHTML = '<tr><td colspan="5" class="text-center text-red-500 py-4">ข้อมูลใบเบิกที่ได้รับไม่ถูกต้อง</td></tr>';
-            return;
-        }
-
-        const filteredRequisitions = requisitions.filter(
-            req => req.requester_hcode === currentUser.hcode && (req.status === 'อนุมัติแล้ว' || req.status === 'อนุมัติบางส่วน')
-        );
-
-        if (!filteredRequisitions || filteredRequisitions.length === 0) {
-            tableBody.innerHTML = '<tr><td colspan="5" class="text-center text-gray-500 py-4">ไม่พบใบเบิกที่อนุมัติแล้วและรอรับยา</td></tr>';
-            return;
-        }
-
-        filteredRequisitions.forEach(req => {
-            const row = tableBody.insertRow();
-            let statusClass = req.status === 'อนุมัติแล้ว' ? 'bg-blue-100 text-blue-800' : 'bg-indigo-100 text-indigo-800';
-            
-            // Backend should send 'approval_date' pre-formatted as dd/mm/yyyy (Thai) or null
-            const displayApprovalDate = req.approval_date || 'N/A'; 
-            const approverNameDisplay = req.approved_by_name || 'N/A';
-
-            row.innerHTML = `
-                <td>${req.requisition_number}</td>
-                <td>${displayApprovalDate}</td>
-                <td>${approverNameDisplay}</td>
-                <td><span class="px-2 py-1 text-xs font-semibold rounded-full ${statusClass}">${req.status}</span></td>
-                <td>
-                    <button onclick='openReceiveGoodsModal(${req.id}, "${req.requisition_number}", "${displayApprovalDate}", "${approverNameDisplay}")' 
-                            class="btn btn-success btn-sm text-xs px-2 py-1">
-                        <svg xmlns="http://www.w3.org/2000/svg" width="12" height="12" fill="currentColor" class="bi bi-box-arrow-in-down mr-1" viewBox="0 0 16 16"><path fill-rule="evenodd" d="M3.5 10a.5.5 0 0 1-.5-.5v-8a.5.5 0 0 1 .5-.5h9a.5.5 0 0 1 .5.5v8a.5.5 0 0 1-.5-.5h-2a.5.5 0 0 0 0 1h2A1.5 1.5 0 0 0 14 9.5v-8A1.5 1.5 0 0 0 12.5 0h-9A1.5 1.5 0 0 0 2 1.5v8A1.5 1.5 0 0 0 3.5 11h2a.5.5 0 0 0 0-1z"/><path fill-rule="evenodd" d="M7.646 15.854a.5.5 0 0 0 .708 0l3-3a.5.5 0 0 0-.708-.708L8.5 14.293V5.5a.5.5 0 0 0-1 0v8.793l-2.146-2.147a.5.5 0 0 0-.708.708z"/></svg>
-                        ยืนยันการรับยา
-                    </button>
-                </td>
-            `;
-        });
+        await loadPagedTable(endpoint, tableBody, 5, requisitions => {
+            const filteredRequisitions = requisitions.filter(
+                req => req.requester_hcode === currentUser.hcode && (req.status === 'อนุมัติแล้ว' || req.status === 'อนุมัติบางส่วน')
+            );
+
+            filteredRequisitions.forEach(req => {
+                const row = tableBody.insertRow();
+                let statusClass = req.status === 'อนุมัติแล้ว' ? 'bg-blue-100 text-blue-800' : 'bg-indigo-100 text-indigo-800';
+                
+                // Backend should send 'approval_date' pre-formatted as dd/mm/yyyy (Thai) or null
+                const displayApprovalDate = req.approval_date || 'N/A'; 
+                const approverNameDisplay = req.approved_by_name || 'N/A';
+
+                row.innerHTML = `
+                    <td>${req.requisition_number}</td>
+                    <td>${displayApprovalDate}</td>
+                    <td>${approverNameDisplay}</td>
+                    <td><span class="px-2 py-1 text-xs font-semibold rounded-full ${statusClass}">${req.status}</span></td>
+                    <td>
+                        <button onclick='openReceiveGoodsModal(${req.id}, "${req.requisition_number}", "${displayApprovalDate}", "${approverNameDisplay}")' 
+                                class="btn btn-success btn-sm text-xs px-2 py-1">
+                            <svg xmlns="http://www.w3.org/2000/svg" width="12" height="12" fill="currentColor" class="bi bi-box-arrow-in-down mr-1" viewBox="0 0 16 16"><path fill-rule="evenodd" d="M3.5 10a.5.5 0 0 1-.5-.5v-8a.5.5 0 0 1 .5-.5h9a.5.5 0 0 1 .5.5v8a.5.5 0 0 1-.5-.5h-2a.5.5 0 0 0 0 1h2A1.5 1.5 0 0 0 14 9.5v-8A1.5 1.5 0 0 0 12.5 0h-9A1.5 1.5 0 0 0 2 1.5v8A1.5 1.5 0 0 0 3.5 11h2a.5.5 0 0 0 0-1z"/><path fill-rule="evenodd" d="M7.646 15.854a.5.5 0 0 0 .708 0l3-3a.5.5 0 0 0-.708-.708L8.5 14.293V5.5a.5.5 0 0 0-1 0v8.793l-2.146-2.147a.5.5 0 0 0-.708.708z"/></svg>
+                            ยืนยันการรับยา
+                        </button>
+                    </td>
+                `;
+            });
+            return filteredRequisitions.length;
+        }, showEmpty);
     } catch (error) {
         console.error("Error in loadAndDisplayApprovedRequisitionsForReceiving:", error); 
         tableBody.innerHTML = `<tr><td colspan="5" class="text-center text-red-500 py-4">เกิดข้อผิดพลาดในการโหลดข้อมูลใบเบิกที่รอรับยา: ${error.message}</td></tr>`;
@@ -382,15 +374,12 @@ async function loadAndDisplayManualGoodsReceivedList() {
     if (endDate) params.append('endDate', endDate);
 
 
-    try {
-        const manualReceives = await fetchData(`/goods_received_vouchers?${params.toString()}`); 
+    const showEmpty = () => {
+        tableBody.innerHTML = `<tr><td colspan="6" class="text-center text-gray-500 py-4">ไม่พบรายการรับยา (กรอกเอง) สำหรับหน่วยบริการ ${currentUser.hcode}</td></tr>`;
+    };
 
-        tableBody.innerHTML = '';
-        if (!manualReceives || manualReceives.length === 0) {
-            tableBody.innerHTML = `<tr><td colspan="6" class="text-center text-gray-500 py-4">ไม่พบรายการรับยา (กรอกเอง) สำหรับหน่วยบริการ ${currentUser.hcode}</td></tr>`;
-            return;
-        }
-        manualReceives.forEach(rec => {
+    try {
+        await loadPagedTable(`/goods_received_vouchers?${params.toString()}`, tableBody, 6, manualReceives => manualReceives.forEach(rec => {
             const row = tableBody.insertRow();
             const detailsJson = JSON.stringify(rec).replace(/"/g, "&quot;").replace(/'/g, "&apos;");
             row.innerHTML = `
@@ -403,7 +392,7 @@ async function loadAndDisplayManualGoodsReceivedList() {
                     <button onclick='viewManualGoodsReceivedDetails(${rec.id}, ${detailsJson})' class="btn btn-secondary btn-sm text-xs px-2 py-1 mr-1">ดูรายละเอียด</button>
                     </td>
             `;
-        });
+        }), showEmpty);
     } catch (error) {
         tableBody.innerHTML = '<tr><td colspan="6" class="text-center text-red-500 py-4">เกิดข้อผิดพลาดในการโหลดรายการรับยา (กรอกเอง)</td></tr>';
     }
@@ -606,3 +595,178 @@ async function confirmDeleteManualGoodsReceive(voucherId, voucherNumber) {
     });
 }
 
+
+// --- Goods Receiving from Supplier File (Excel/CSV) ---
+
+let goodsReceivedUploadFile = null;
+
+async function uploadGoodsReceivedFile() {
+    const fileInput = document.getElementById('goodsReceivedUploadFile');
+    if (!fileInput || fileInput.files.length === 0) {
+        Swal.fire('ข้อผิดพลาด', 'กรุณาเลือกไฟล์ที่ต้องการอัปโหลด', 'error');
+        return;
+    }
+    if (!currentUser || !currentUser.hcode || !currentUser.id) {
+        Swal.fire('ข้อผิดพลาด', 'ไม่สามารถอัปโหลดได้: ไม่พบข้อมูลผู้ใช้หรือรหัสหน่วยบริการ', 'error');
+        return;
+    }
+
+    goodsReceivedUploadFile = fileInput.files[0];
+    const formData = new FormData();
+    formData.append('file', goodsReceivedUploadFile);
+    formData.append('hcode', currentUser.hcode);
+
+    Swal.fire({
+        title: 'กำลังอ่านไฟล์...',
+        text: 'กรุณารอสักครู่ ระบบกำลังตรวจสอบรายการรับยา',
+        allowOutsideClick: false,
+        didOpen: () => { Swal.showLoading(); }
+    });
+
+    try {
+        const response = await fetch(`${API_BASE_URL}/goods_received/upload/preview`, { method: 'POST', body: formData });
+        const result = await response.json();
+        Swal.close();
+        if (!response.ok) {
+            Swal.fire('เกิดข้อผิดพลาด', result.error || 'ไม่สามารถอ่านข้อมูลจากไฟล์ได้', 'error');
+            fileInput.value = '';
+            return;
+        }
+        showGoodsReceivedUploadPreviewModal(result);
+    } catch (error) {
+        Swal.close();
+        console.error('Error previewing goods received file:', error);
+        Swal.fire('เกิดข้อผิดพลาด', 'ไม่สามารถเชื่อมต่อกับเซิร์ฟเวอร์หรือประมวลผลไฟล์ได้', 'error');
+        fileInput.value = '';
+    }
+}
+
+function showGoodsReceivedUploadPreviewModal(result) {
+    const modalTitle = document.getElementById('modalTitle');
+    const modalBody = document.getElementById('modalBody');
+    if (!modalTitle || !modalBody) return;
+
+    const summary = result.summary;
+    const hasErrors = summary.error_rows > 0;
+    modalTitle.textContent = 'ตรวจสอบรายการรับยาจากไฟล์';
+
+    modalBody.innerHTML = `
+        <div class="text-sm mb-4">
+            <p>ทั้งหมด <b>${summary.total_rows}</b> แถว: Lot ใหม่ <b>${summary.new_lots}</b>, รวมกับ Lot เดิม <b>${summary.merged_lots}</b>, มีข้อผิดพลาด <b class="text-red-600">${summary.error_rows}</b> (จำนวนรับรวม ${summary.total_quantity})</p>
+            ${result.preview_truncated ? '<p class="text-orange-600 text-xs">แสดงเพียงบางรายการ (รายการที่มีข้อผิดพลาดแสดงก่อน)</p>' : ''}
+            ${hasErrors ? '<p class="text-red-600">กรุณาแก้ไขแถวที่มีข้อผิดพลาดในไฟล์แล้วอัปโหลดใหม่ ระบบจะบันทึกเมื่อทุกแถวถูกต้องเท่านั้น</p>' : ''}
+        </div>
+        <form id="confirmGoodsReceivedUploadForm">
+            <div class="grid grid-cols-1 md:grid-cols-2 gap-x-4">
+                <div class="mb-4">
+                    <label for="uploadReceiveDate" class="label">วันที่รับยา:</label>
+                    <input type="text" id="uploadReceiveDate" name="received_date" class="input-field thai-date-formatter" placeholder="dd/mm/yyyy" value="${getCurrentThaiDateString()}" required>
+                </div>
+                <div class="mb-4">
+                    <label for="uploadSupplierName" class="label">ผู้ส่ง/แหล่งที่มา:</label>
+                    <input type="text" id="uploadSupplierName" name="supplier_name" class="input-field" placeholder="เช่น ชื่อบริษัท, รพ.แม่ข่าย" required>
+                </div>
+            </div>
+            <div class="mb-4">
+                <label for="uploadInvoiceNumber" class="label">เลขที่ใบส่งของ/ใบกำกับ (ถ้ามี):</label>
+                <input type="text" id="uploadInvoiceNumber" name="invoice_number" class="input-field" placeholder="INV-XXXXX">
+            </div>
+            <div class="mb-4">
+                <label for="uploadReceiveRemarks" class="label">หมายเหตุการรับยา:</label>
+                <textarea id="uploadReceiveRemarks" name="remarks" class="input-field" rows="2"></textarea>
+            </div>
+            <div class="overflow-x-auto max-h-96">
+                <table class="custom-table text-xs sm:text-sm w-full">
+                    <thead>
+                        <tr>
+                            <th>แถวที่</th>
+                            <th>รหัสยา</th>
+                            <th>ชื่อยา</th>
+                            <th>เลขที่ล็อต</th>
+                            <th>วันหมดอายุ</th>
+                            <th>จำนวน</th>
+                            <th>สถานะ</th>
+                        </tr>
+                    </thead>
+                    <tbody id="goodsReceivedUploadPreviewRows"></tbody>
+                </table>
+            </div>
+            <div class="flex justify-end space-x-3 mt-6">
+                <button type="button" class="btn btn-secondary" onclick="closeModal('formModal'); document.getElementById('goodsReceivedUploadFile').value = ''; goodsReceivedUploadFile = null;">ยกเลิก</button>
+                <button type="submit" class="btn btn-primary" ${hasErrors ? 'disabled' : ''}>ยืนยันการรับยา</button>
+            </div>
+        </form>
+    `;
+    // ค่าจากไฟล์ (รหัสยา, ล็อต, ข้อความผิดพลาด) ใส่ด้วย textContent เพื่อไม่ให้ถูกตีความเป็น HTML
+    const rowsBody = document.getElementById('goodsReceivedUploadPreviewRows');
+    result.preview_items.forEach(item => {
+        let rowClass = 'bg-green-50';
+        let statusClass = 'text-green-600 font-semibold';
+        if (item.errors.length > 0) {
+            rowClass = 'bg-red-100';
+            statusClass = 'text-red-600 font-semibold';
+        } else if (item.existing_quantity !== undefined) {
+            rowClass = 'bg-blue-50';
+            statusClass = 'text-blue-600 font-semibold';
+        }
+        const row = rowsBody.insertRow();
+        row.className = rowClass;
+        [
+            [item.row_num, 'text-center'],
+            [item.medicine_code, ''],
+            [item.medicine_name, ''],
+            [item.lot_number, ''],
+            [item.expiry_date_str, ''],
+            [item.quantity_received_str, 'text-center'],
+        ].forEach(([value, cellClass]) => {
+            const cell = row.insertCell();
+            cell.className = cellClass;
+            cell.textContent = value ?? '';
+        });
+        const statusCell = row.insertCell();
+        statusCell.className = statusClass;
+        statusCell.style.whiteSpace = 'pre-line';
+        statusCell.textContent = item.errors.length > 0 ? item.errors.join('\n') : item.status;
+    });
+    openModal('formModal');
+
+    document.querySelectorAll('#formModal .thai-date-formatter').forEach(el => {
+        if (typeof autoFormatThaiDateInput === 'function') {
+            el.addEventListener('input', autoFormatThaiDateInput);
+        }
+    });
+
+    document.getElementById('confirmGoodsReceivedUploadForm').addEventListener('submit', async function(e) {
+        e.preventDefault();
+        confirmGoodsReceivedUpload(new FormData(this));
+    });
+}
+
+async function confirmGoodsReceivedUpload(headerFormData) {
+    if (!goodsReceivedUploadFile || !currentUser) {
+        Swal.fire('ข้อผิดพลาด', 'ไม่พบไฟล์สำหรับการยืนยัน หรือไม่พบข้อมูลผู้ใช้', 'error');
+        return;
+    }
+    const formData = new FormData();
+    formData.append('file', goodsReceivedUploadFile);
+    formData.append('hcode', currentUser.hcode);
+    formData.append('receiver_id', currentUser.id);
+    ['received_date', 'supplier_name', 'invoice_number', 'remarks'].forEach(key => formData.append(key, headerFormData.get(key) || ''));
+
+    Swal.fire({
+        title: 'กำลังบันทึกการรับยา...',
+        allowOutsideClick: false,
+        didOpen: () => { Swal.showLoading(); }
+    });
+    try {
+        const responseData = await fetchData('/goods_received/upload/process', { method: 'POST', body: formData });
+        Swal.fire('บันทึกสำเร็จ!', `${responseData.message} (เลขที่ ${responseData.voucher_number})`, 'success');
+        closeModal('formModal');
+        document.getElementById('goodsReceivedUploadFile').value = '';
+        goodsReceivedUploadFile = null;
+        if (typeof loadAndDisplayInventorySummary === 'function') loadAndDisplayInventorySummary();
+        if (typeof loadAndDisplayManualGoodsReceivedList === 'function') loadAndDisplayManualGoodsReceivedList();
+    } catch (error) {
+        // Error handled by fetchData
+    }
+}
@@ -158,52 +158,49 @@ async function fetchAndDisplayInventoryHistory(medicineId) {
     if (startDate) endpoint += `&startDate=${encodeURIComponent(startDate)}`;
     if (endDate) endpoint += `&endDate=${encodeURIComponent(endDate)}`;
 
-    try {
-        const history = await fetchData(endpoint); 
-        let historyHtml = `
-            <div class="overflow-x-auto">
-                <table class="custom-table text-sm">
-                    <thead>
-                        <tr>
-                            <th>วันที่</th>
-                            <th>รายการ</th>
-                            <th>Lot No.</th>
-                            <th>Exp. Date</th>
-                            <th class="text-center">รับ</th> 
-                            <th class="text-center">จ่าย</th> 
-                            <th class="text-center">ยอดคงเหลือ</th>
-                            <th>ผู้ทำรายการ</th>
-                            <th>หมายเหตุ/อ้างอิง</th>
-                        </tr>
-                    </thead>
-                    <tbody>`;
-
-        if (!history || history.length === 0) {
-            historyHtml += `<tr><td colspan="9" class="text-center text-gray-500 py-4">ไม่พบประวัติการเคลื่อนไหวสำหรับยานี้ในหน่วยบริการ ${currentUser.hcode} ${startDate || endDate ? 'ในช่วงวันที่ที่เลือก' : ''}</td></tr>`;
-        } else {
-            history.forEach(item => {
-                const receivedQty = item.quantity_change > 0 ? item.quantity_change : '-';
-                const dispensedQty = item.quantity_change < 0 ? Math.abs(item.quantity_change) : '-';
-                historyHtml += `
+    historyTableContainer.innerHTML = `
+        <div class="overflow-x-auto">
+            <table class="custom-table text-sm">
+                <thead>
                     <tr>
-                        <td>${item.transaction_date}</td> 
-                        <td>${item.transaction_type || '-'}</td>
-                        <td>${item.lot_number || '-'}</td>
-                        <td>${item.expiry_date || '-'}</td> 
-                        <td class="text-center text-green-600">${receivedQty}</td> 
-                        <td class="text-center text-red-600">${dispensedQty}</td>  
-                        <td class="text-center">${item.quantity_after_transaction}</td> 
-                        <td>${item.user_full_name || '-'}</td>
-                        <td>${item.remarks || item.reference_document_id || '-'}</td>
+                        <th>วันที่</th>
+                        <th>รายการ</th>
+                        <th>Lot No.</th>
+                        <th>Exp. Date</th>
+                        <th class="text-center">รับ</th> 
+                        <th class="text-center">จ่าย</th> 
+                        <th class="text-center">ยอดคงเหลือ</th>
+                        <th>ผู้ทำรายการ</th>
+                        <th>หมายเหตุ/อ้างอิง</th>
                     </tr>
-                `;
-            });
-        }
-        historyHtml += `
-                    </tbody>
-                </table>
-            </div>`;
-        historyTableContainer.innerHTML = historyHtml;
+                </thead>
+                <tbody id="inventoryHistoryTableBody">
+                    <tr><td colspan="9" class="text-center text-gray-400 py-4">กำลังโหลดประวัติยา...</td></tr>
+                </tbody>
+            </table>
+        </div>`;
+    const tableBody = document.getElementById('inventoryHistoryTableBody');
+    const showEmpty = () => {
+        tableBody.innerHTML = `<tr><td colspan="9" class="text-center text-gray-500 py-4">ไม่พบประวัติการเคลื่อนไหวสำหรับยานี้ในหน่วยบริการ ${currentUser.hcode} ${startDate || endDate ? 'ในช่วงวันที่ที่เลือก' : ''}</td></tr>`;
+    };
+
+    try {
+        await loadPagedTable(endpoint, tableBody, 9, history => history.forEach(item => {
+            const receivedQty = item.quantity_change > 0 ? item.quantity_change : '-';
+            const dispensedQty = item.quantity_change < 0 ? Math.abs(item.quantity_change) : '-';
+            const row = tableBody.insertRow();
+            row.innerHTML = `
+                <td>${item.transaction_date}</td> 
+                <td>${item.transaction_type || '-'}</td>
+                <td>${item.lot_number || '-'}</td>
+                <td>${item.expiry_date || '-'}</td> 
+                <td class="text-center text-green-600">${receivedQty}</td> 
+                <td class="text-center text-red-600">${dispensedQty}</td>  
+                <td class="text-center">${item.quantity_after_transaction}</td> 
+                <td>${item.user_full_name || '-'}</td>
+                <td>${item.remarks || item.reference_document_id || '-'}</td>
+            `;
+        }), showEmpty);
     } catch (error) {
         historyTableContainer.innerHTML = `<p class="text-center text-red-500 py-4">เกิดข้อผิดพลาดในการโหลดประวัติยา: ${error.message}</p>`;
     }
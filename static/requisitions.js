@@ -33,17 +33,13 @@ async function loadAndDisplayRequisitions() {
         params.append('role', currentUser.role);
     }
 
+    const showEmpty = () => {
+        tableBody.innerHTML = '<tr><td colspan="5" class="text-center text-gray-500 py-4">ไม่พบข้อมูลใบเบิกในช่วงวันที่ที่เลือก หรือสำหรับหน่วยงานของคุณ</td></tr>';
+    };
+
     try {
         const endpoint = `/requisitions?${params.toString()}`;
-        const requisitions = await fetchData(endpoint); // fetchData is in utils.js
-        tableBody.innerHTML = '';
-
-        if (!requisitions || requisitions.length === 0) {
-            tableBody.innerHTML = '<tr><td colspan="5" class="text-center text-gray-500 py-4">ไม่พบข้อมูลใบเบิกในช่วงวันที่ที่เลือก หรือสำหรับหน่วยงานของคุณ</td></tr>';
-            return;
-        }
-
-        requisitions.forEach(req => {
+        await loadPagedTable(endpoint, tableBody, 5, requisitions => requisitions.forEach(req => {
             const row = tableBody.insertRow();
             let statusClass = '';
             switch(req.status) {
@@ -67,7 +63,7 @@ async function loadAndDisplayRequisitions() {
                     ${req.status === 'รออนุมัติ' && currentUser.role === 'เจ้าหน้าที่ รพสต.' && currentUser.hcode === req.requester_hcode ? `<button onclick="cancelRequisition(${req.id}, '${req.requisition_number}')" class="btn btn-danger btn-sm text-xs px-2 py-1 ml-1">ยกเลิก</button>` : ''}
                 </td>
             `;
-        });
+        }), showEmpty);
     } catch (error) {
          tableBody.innerHTML = '<tr><td colspan="5" class="text-center text-red-500 py-4">เกิดข้อผิดพลาดในการโหลดข้อมูลใบเบิก</td></tr>';
     }
@@ -83,10 +79,10 @@ async function loadAndDisplayPendingApprovals() {
         console.error("Table body for pending approvals not found.");
         return;
     }
-    tableBody.innerHTML = '<tr><td colspan="5" class="text-center text-gray-400 py-4">กำลังโหลดข้อมูลใบเบิกรออนุมัติ...</td></tr>';
+    tableBody.innerHTML = '<tr><td colspan="6" class="text-center text-gray-400 py-4">กำลังโหลดข้อมูลใบเบิกรออนุมัติ...</td></tr>';
     
     if (!currentUser) {
-        tableBody.innerHTML = '<tr><td colspan="5" class="text-center text-red-500 py-4">ไม่พบข้อมูลผู้ใช้งาน กรุณาเข้าสู่ระบบใหม่</td></tr>';
+        tableBody.innerHTML = '<tr><td colspan="6" class="text-center text-red-500 py-4">ไม่พบข้อมูลผู้ใช้งาน กรุณาเข้าสู่ระบบใหม่</td></tr>';
         return;
     }
     
@@ -100,15 +96,18 @@ async function loadAndDisplayPendingApprovals() {
         const endpoint = `/requisitions/pending_approval?${params.toString()}`;
         const requisitions = await fetchData(endpoint);
         tableBody.innerHTML = '';
+        const selectAll = document.getElementById('selectAllPendingRequisitions');
+        if (selectAll) selectAll.checked = false;
 
         if (!requisitions || requisitions.length === 0) {
-            tableBody.innerHTML = '<tr><td colspan="5" class="text-center text-gray-500 py-4">ไม่พบใบเบิกที่รออนุมัติในช่วงวันที่ที่เลือก</td></tr>';
+            tableBody.innerHTML = '<tr><td colspan="6" class="text-center text-gray-500 py-4">ไม่พบใบเบิกที่รออนุมัติในช่วงวันที่ที่เลือก</td></tr>';
             return;
         }
 
         requisitions.forEach(req => {
             const row = tableBody.insertRow();
             row.innerHTML = `
+                <td class="text-center"><input type="checkbox" class="pending-requisition-checkbox" value="${req.id}"></td>
                 <td>${req.requisition_number}</td>
                 <td>${req.requester_hospital_name || req.requester_name} (${req.requester_hcode || ''})</td> 
                 <td>${req.requisition_date}</td>
@@ -119,7 +118,49 @@ async function loadAndDisplayPendingApprovals() {
             `;
         });
     } catch (error) {
-        tableBody.innerHTML = '<tr><td colspan="5" class="text-center text-red-500 py-4">เกิดข้อผิดพลาดในการโหลดข้อมูลใบเบิกรออนุมัติ</td></tr>';
+        tableBody.innerHTML = '<tr><td colspan="6" class="text-center text-red-500 py-4">เกิดข้อผิดพลาดในการโหลดข้อมูลใบเบิกรออนุมัติ</td></tr>';
+    }
+}
+
+/**
+ * Approves all checked pending requisitions as requested, in one batch call.
+ */
+async function approveSelectedRequisitions() {
+    const requisitionIds = Array.from(document.querySelectorAll('.pending-requisition-checkbox:checked')).map(cb => parseInt(cb.value));
+    if (requisitionIds.length === 0) {
+        Swal.fire('ข้อผิดพลาด', 'กรุณาเลือกใบเบิกที่ต้องการอนุมัติอย่างน้อย 1 ใบ', 'error');
+        return;
+    }
+    if (!currentUser || !currentUser.id) {
+        Swal.fire('ข้อผิดพลาด', 'ไม่พบข้อมูลผู้ใช้งาน กรุณาเข้าสู่ระบบใหม่', 'error');
+        return;
+    }
+    const confirmation = await Swal.fire({
+        title: 'ยืนยันการอนุมัติ',
+        html: `อนุมัติใบเบิกที่เลือก <b>${requisitionIds.length}</b> ใบ ตามจำนวนที่ขอทุกรายการ ใช่หรือไม่?`,
+        icon: 'question',
+        showCancelButton: true,
+        confirmButtonText: 'อนุมัติ',
+        cancelButtonText: 'ยกเลิก'
+    });
+    if (!confirmation.isConfirmed) return;
+
+    try {
+        const responseData = await fetchData('/requisitions/batch_approval', {
+            method: 'PUT',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({
+                approved_by_id: currentUser.id,
+                approver_hcode: currentUser.hcode,
+                requisition_ids: requisitionIds
+            })
+        });
+        const failedHtml = (responseData.failed || []).map(f => `ID ${f.requisition_id}: ${f.error}`).join('<br>');
+        Swal.fire(responseData.failed && responseData.failed.length > 0 ? 'ดำเนินการบางส่วน' : 'สำเร็จ', `${responseData.message}${failedHtml ? '<br><small>' + failedHtml + '</small>' : ''}`, responseData.failed && responseData.failed.length > 0 ? 'warning' : 'success');
+        loadAndDisplayPendingApprovals();
+        if (typeof loadAndDisplayRequisitions === 'function') loadAndDisplayRequisitions();
+    } catch (error) {
+        // Error handled by fetchData
     }
 }
 
@@ -166,17 +166,45 @@ function getFiscalYearRange() {
     };
 }
 
+/**
+ * Escapes text (e.g. values read from an uploaded file) for use inside an HTML string.
+ * @param {*} value - The value to escape.
+ * @returns {string} HTML-safe text.
+ */
+function escapeHtml(value) {
+    const div = document.createElement('div');
+    div.textContent = value ?? '';
+    return div.innerHTML;
+}
+
 // --- API Interaction Helper ---
+// ผลลัพธ์ GET ที่ server ส่ง ETag มา (url -> { etag, data }) ใช้ส่ง If-None-Match และใช้ข้อมูลเดิมเมื่อได้ 304
+const etagResponseCache = new Map();
+const ETAG_CACHE_MAX_ENTRIES = 50;
+
 /**
  * Generic function to fetch data from the API.
  * Uses the globally defined API_BASE_URL.
+ * GET requests send If-None-Match when an ETag is known and reuse the cached data on 304 Not Modified.
  * @param {string} endpoint - The API endpoint (e.g., '/medicines').
  * @param {object} options - Fetch options (method, headers, body).
  * @returns {Promise<any>} The JSON response from the API.
  */
 async function fetchData(endpoint, options = {}) {
+    const url = `${API_BASE_URL}${endpoint}`;
+    const isGet = !options.method || options.method.toUpperCase() === 'GET';
+    const cached = isGet ? etagResponseCache.get(url) : null;
+    if (cached) {
+        // ไม่ใช้ HTTP cache ของ browser ซ้อน เพื่อให้ 304 ถูกส่งกลับมาที่นี่
+        options = { ...options, cache: 'no-store', headers: { ...(options.headers || {}), 'If-None-Match': cached.etag } };
+    }
     try {
-        const response = await fetch(`${API_BASE_URL}${endpoint}`, options); // ใช้ API_BASE_URL ที่กำหนดไว้ด้านบน
+        const response = await fetch(url, options); // ใช้ API_BASE_URL ที่กำหนดไว้ด้านบน
+        if (response.status === 304 && cached) {
+            etagResponseCache.delete(url);
+            etagResponseCache.set(url, cached); // ย้ายไปท้ายสุด (ใช้ล่าสุด)
+            return structuredClone(cached.data);
+        }
         if (!response.ok) {
             let errorData = { message: `HTTP error! Status: ${response.status}` };
             try {
@@ -189,14 +217,75 @@ async function fetchData(endpoint, options = {}) {
         if (response.status === 204) { // No Content
             return null;
         }
-        return await response.json();
+        const data = await response.json();
+        const etag = response.headers.get('ETag');
+        if (isGet && etag) {
+            etagResponseCache.delete(url);
+            etagResponseCache.set(url, { etag, data: structuredClone(data) });
+            if (etagResponseCache.size > ETAG_CACHE_MAX_ENTRIES) {
+                etagResponseCache.delete(etagResponseCache.keys().next().value);
+            }
+        } else if (isGet) {
+            etagResponseCache.delete(url);
+        }
+        return data;
     } catch (error) {
-        console.error(`Error fetching ${API_BASE_URL}${endpoint}:`, error);
+        console.error(`Error fetching ${url}:`, error);
         Swal.fire('เกิดข้อผิดพลาด!', `ไม่สามารถดำเนินการได้: ${error.message}`, 'error');
         throw error; // Re-throw so calling function can also handle if needed
     }
 }
 
+// --- Paged List Helper ---
+// จำนวนแถวต่อหน้าของรายการยาว ๆ (server จำกัดไม่เกิน MAX_PAGE_SIZE)
+const LIST_PAGE_SIZE = 100;
+
+/**
+ * โหลดรายการจาก endpoint ที่แบ่งหน้าแบบ keyset (ส่ง limit และ cursor) ทีละหน้าลงในตาราง
+ * เมื่อยังมีหน้าถัดไปจะแสดงปุ่ม "โหลดเพิ่ม" ท้ายตาราง แทนการดึงรายการทั้งหมดในครั้งเดียว
+ * @param {string} endpoint - endpoint พร้อม query string เดิม (เช่น '/dispense_records?hcode=...')
+ * @param {HTMLTableSectionElement} tableBody - tbody ที่จะเพิ่มแถว (ล้างเมื่อได้หน้าแรก)
+ * @param {number} colspan - จำนวนคอลัมน์ของตาราง (ใช้กับแถวปุ่มโหลดเพิ่ม)
+ * @param {function} renderItems - เพิ่มแถวของรายการในหน้าลงใน tableBody คืนค่าจำนวนแถวที่แสดง (ไม่คืนค่า = ทุกรายการ)
+ * @param {function} onEmpty - เรียกเมื่อไม่มีรายการให้แสดงเลย
+ */
+async function loadPagedTable(endpoint, tableBody, colspan, renderItems, onEmpty) {
+    let shown = 0;
+    async function loadPage(cursor) {
+        const params = new URLSearchParams({ limit: LIST_PAGE_SIZE });
+        if (cursor) params.append('cursor', cursor);
+        const page = await fetchData(`${endpoint}${endpoint.includes('?') ? '&' : '?'}${params.toString()}`);
+        if (!cursor) tableBody.innerHTML = '';
+        const items = (page && page.items) || [];
+        const rendered = renderItems(items);
+        shown += rendered === undefined ? items.length : rendered;
+        if (page && page.next_cursor) {
+            const row = tableBody.insertRow();
+            const cell = row.insertCell();
+            cell.colSpan = colspan;
+            cell.className = 'text-center py-2';
+            const button = document.createElement('button');
+            button.type = 'button';
+            button.className = 'btn btn-secondary btn-sm text-xs px-2 py-1';
+            button.textContent = `โหลดเพิ่ม (แสดงแล้ว ${shown} รายการ)`;
+            button.addEventListener('click', async () => {
+                button.disabled = true;
+                row.remove();
+                try {
+                    await loadPage(page.next_cursor);
+                } catch (error) {
+                    tableBody.appendChild(row);
+                    button.disabled = false;
+                }
+            });
+            cell.appendChild(button);
+        } else if (shown === 0) {
+            onEmpty();
+        }
+    }
+    await loadPage(null);
+}
+
 // --- Dynamic Form Row and Medicine Search Helpers ---
 
 /**
@@ -0,0 +1,122 @@
+# /tests/test_bulk_dispense_cursor.py
+# ทดสอบ resume_cursor ของโหมด bulk: เก็บยอดสะสมของรอบก่อน ๆ และผูกกับ payload ที่สร้าง
+# และคำขอที่ส่งซ้ำด้วย idempotency_key เดิม (คืนผลเดิมโดยไม่ตัดจ่ายซ้ำ)
+import pytest
+from flask import Flask
+
+import blueprints.dispense as dispense
+
+
+def _items(quantity=5):
+    return [
+        {"hos_guid": "G1", "medicine_id": 7, "quantity_dispensed": quantity, "dispense_date_iso": "2026-10-01"},
+        {"hos_guid": "G2", "medicine_id": 7, "quantity_dispensed": 2, "dispense_date_iso": "2026-10-02"},
+    ]
+
+
+class FakeCursor:
+    """ตอบเฉพาะ query ที่การส่งซ้ำของคำขอที่ทำครบแล้วต้องใช้ และจำคำสั่งที่รันไว้"""
+
+    def __init__(self, upload_state):
+        self.upload_state = upload_state
+        self.executed = []
+        self.rows = []
+
+    def execute(self, query, params=()):
+        sql = " ".join(query.split())
+        self.executed.append(sql)
+        if "FROM dispense_upload_requests" in sql:
+            self.rows = [self.upload_state] if self.upload_state else []
+        elif sql.startswith("SELECT dispense_record_number FROM dispense_records"):
+            self.rows = [{"dispense_record_number": "DSPEXC-12345-261001-001"}]
+        else:
+            self.rows = []
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def fetchall(self):
+        return self.rows
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def cursor(self, dictionary=False):
+        return self._cursor
+
+    def start_transaction(self):
+        raise AssertionError("คำขอที่ทำครบแล้วต้องไม่เริ่ม transaction ใหม่")
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def _post_with_upload_state(monkeypatch, upload_state):
+    cursor = FakeCursor(upload_state)
+    monkeypatch.setattr(dispense, 'get_db_connection', lambda: FakeConnection(cursor))
+    app = Flask(__name__)
+    app.register_blueprint(dispense.dispense_bp)
+    response = app.test_client().post('/api/dispense/process_excel_dispense', json={
+        "bulk_mode": True, "hcode": "12345", "dispenser_id": 3, "dispense_items": _items(), "idempotency_key": "run-1|chunk-1",
+    })
+    return response, cursor
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(dispense, 'get_db_connection', lambda: pytest.fail("ไม่ควรเชื่อมต่อฐานข้อมูลเมื่อ resume_cursor ไม่ถูกต้อง"))
+    app = Flask(__name__)
+    app.register_blueprint(dispense.dispense_bp)
+    return app.test_client()
+
+
+def test_cursor_round_trip_keeps_running_totals():
+    fingerprint = dispense._bulk_payload_fingerprint(_items())
+    cursor = dispense._encode_bulk_dispense_cursor(41, 500, 480, 20, fingerprint)
+    assert dispense._decode_bulk_dispense_cursor(cursor) == {
+        "dispense_record_id": 41, "next_index": 500, "processed_total": 480, "failed_total": 20, "fingerprint": fingerprint,
+    }
+
+
+def test_legacy_or_malformed_cursor_is_rejected():
+    assert dispense._decode_bulk_dispense_cursor("41:500") is None
+    assert dispense._decode_bulk_dispense_cursor(dispense.encode_page_cursor([41, -1, 0, 0, "x"])) is None
+
+
+def test_resume_with_cursor_from_another_payload_returns_409(client):
+    other_cursor = dispense._encode_bulk_dispense_cursor(41, 1, 1, 0, dispense._bulk_payload_fingerprint(_items(quantity=9)))
+    response = client.post('/api/dispense/process_excel_dispense', json={
+        "bulk_mode": True, "hcode": "12345", "dispenser_id": 3,
+        "dispense_items": _items(), "resume_cursor": other_cursor,
+    })
+    assert response.status_code == 409
+
+
+def test_retry_of_completed_request_returns_stored_totals_without_writing(monkeypatch):
+    upload_state = {"fingerprint": dispense._bulk_payload_fingerprint(_items()), "dispense_record_id": 41, "next_index": 2,
+                    "processed_total": 1, "failed_total": 1, "completed": 1}
+    response, cursor = _post_with_upload_state(monkeypatch, upload_state)
+    assert response.status_code == 207
+    body = response.get_json()
+    assert body["duplicate_request"] is True
+    assert (body["total_processed_count"], body["total_failed_count"], body["dispense_record_id"]) == (1, 1, 41)
+    assert not any(sql.startswith(("INSERT", "UPDATE", "DELETE")) for sql in cursor.executed)
+
+
+def test_idempotency_key_reused_for_another_payload_returns_409(monkeypatch):
+    upload_state = {"fingerprint": "0" * 16, "dispense_record_id": 41, "next_index": 2, "processed_total": 2, "failed_total": 0, "completed": 1}
+    response, _ = _post_with_upload_state(monkeypatch, upload_state)
+    assert response.status_code == 409
+
+
+def test_non_numeric_medicine_id_is_a_row_failure():
+    item = {"hos_guid": "G1", "medicine_id": "abc", "quantity_dispensed": 5, "dispense_date_iso": "2026-10-01"}
+    assert dispense._validate_excel_dispense_item(item, "2026-10-01") == (None, None, "รหัสยาไม่ถูกต้อง")
@@ -0,0 +1,54 @@
+# /tests/test_compression.py
+# ทดสอบว่า request ที่บีบอัดแล้วใหญ่เกิน max_bytes ได้ 413 โดยไม่อ่าน body ทั้งก้อน
+import gzip
+import io
+
+from helpers.compression import RequestDecompressionMiddleware
+
+
+class LimitedInput(io.BytesIO):
+    """บันทึกจำนวน byte สูงสุดที่ถูกขออ่าน (read() ไม่ระบุขนาดถือว่าอ่านทั้งหมด)"""
+
+    def __init__(self, data):
+        super().__init__(data)
+        self.requested = []
+
+    def read(self, size=-1):
+        self.requested.append(size)
+        return super().read(size)
+
+
+def call_middleware(environ, max_bytes=64):
+    calls = {}
+
+    def app(environ, start_response):
+        calls['body'] = environ['wsgi.input'].read()
+        start_response('200 OK', [])
+        return [b'ok']
+
+    def start_response(status, headers):
+        calls['status'] = status
+
+    RequestDecompressionMiddleware(app, max_bytes)(environ, start_response)
+    return calls
+
+
+def test_oversized_content_length_is_rejected_before_reading():
+    body = LimitedInput(gzip.compress(b'x' * 10))
+    calls = call_middleware({'HTTP_CONTENT_ENCODING': 'gzip', 'CONTENT_LENGTH': '1000', 'wsgi.input': body})
+    assert calls['status'].startswith('413')
+    assert body.requested == []
+
+
+def test_chunked_input_is_read_at_most_max_bytes_plus_one():
+    body = LimitedInput(b'\x00' * 500)
+    calls = call_middleware({'HTTP_CONTENT_ENCODING': 'gzip', 'wsgi.input_terminated': True, 'wsgi.input': body})
+    assert calls['status'].startswith('413')
+    assert body.requested == [65]
+
+
+def test_chunked_gzip_body_within_limit_is_decompressed():
+    body = LimitedInput(gzip.compress(b'{"a": 1}'))
+    calls = call_middleware({'HTTP_CONTENT_ENCODING': 'gzip', 'wsgi.input_terminated': True, 'wsgi.input': body})
+    assert calls['status'].startswith('200')
+    assert calls['body'] == b'{"a": 1}'
@@ -0,0 +1,51 @@
+# /tests/test_connection_pool.py
+# ทดสอบว่า process ลูกทิ้ง connection ที่สืบทอดจาก process แม่โดยไม่ปิด (การปิดจะตัด connection ของ process แม่)
+import pytest
+
+import helpers.database as database
+
+
+class FakeRawConnection:
+    def __init__(self):
+        self.closed = False
+        self.rolled_back = False
+
+    def close(self):
+        self.closed = True
+
+    def rollback(self):
+        self.rolled_back = True
+
+
+@pytest.fixture
+def inherited_pool(monkeypatch):
+    pool = database.ConnectionPool({}, pool_size=2, max_overflow=0, timeout=1, recycle=0)
+    pool.pid = -1  # จำลอง pool ที่สร้างใน process แม่
+    monkeypatch.setattr(database, '_pool', pool)
+    monkeypatch.setattr(database, '_inherited_connections', [])
+    return pool
+
+
+def test_pid_change_abandons_idle_connections_without_closing(inherited_pool):
+    raw_conn = FakeRawConnection()
+    inherited_pool._idle.append((raw_conn, 0))
+
+    pool = database.get_connection_pool()
+
+    assert pool is not inherited_pool
+    assert not raw_conn.closed
+    assert raw_conn in database._inherited_connections
+    assert not inherited_pool._idle
+
+
+def test_releasing_inherited_connection_keeps_it_open(inherited_pool):
+    raw_conn = FakeRawConnection()
+    inherited_pool.release(raw_conn, 0)
+
+    assert not raw_conn.closed and not raw_conn.rolled_back
+    assert raw_conn in database._inherited_connections
+
+
+def test_inherited_pool_refuses_checkout(inherited_pool):
+    with pytest.raises(database.Error):
+        inherited_pool.acquire()
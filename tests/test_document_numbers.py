@@ -0,0 +1,56 @@
+# /tests/test_document_numbers.py
+# ทดสอบการออกเลขที่เอกสาร: สร้างแถวตัวนับด้วย INSERT ... ON DUPLICATE KEY UPDATE คำสั่งเดียว (ไม่มี UPDATE แถวที่ยังไม่มี)
+# และการจองเลขเป็นช่วงสำหรับงานนำเข้าแบบ bulk
+from datetime import datetime
+
+from helpers.document_numbers import reserve_document_numbers, next_document_number
+
+ON_DATE = datetime(2024, 1, 31)
+
+
+class FakeCursor:
+    """จำลองตาราง document_sequences และ LAST_INSERT_ID() ของ MySQL"""
+
+    def __init__(self, legacy_numbers=()):
+        self.sequences = {}
+        self.legacy_numbers = list(legacy_numbers)
+        self.last_insert_id = 0
+        self.executed = []
+        self.rows = []
+
+    def execute(self, query, params=()):
+        self.executed.append(query)
+        self.rows = []
+        if query.startswith("SELECT 1 AS found FROM document_sequences"):
+            self.rows = [{"found": 1}] if tuple(params) in self.sequences else []
+        elif query.startswith("SELECT dispense_record_number AS number"):
+            self.rows = [{"number": number} for number in self.legacy_numbers]
+        elif query.startswith("INSERT INTO document_sequences"):
+            prefix, scope, period, seed_value, count = params
+            key = (prefix, scope, period)
+            self.sequences[key] = self.sequences[key] + count if key in self.sequences else seed_value
+            self.last_insert_id = self.sequences[key]
+        elif query.startswith("SELECT LAST_INSERT_ID()"):
+            self.rows = [{"last_value": self.last_insert_id}]
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def fetchall(self):
+        return self.rows
+
+
+def test_first_number_of_day_continues_from_legacy_numbers():
+    cursor = FakeCursor(legacy_numbers=["DSP-12345-240131-004"])
+    assert next_document_number('DSP', cursor, '12345', ON_DATE) == "DSP-12345-240131-005"
+    assert next_document_number('DSP', cursor, '12345', ON_DATE) == "DSP-12345-240131-006"
+    assert not any(query.startswith("UPDATE") for query in cursor.executed)
+
+
+def test_reserve_returns_a_contiguous_range():
+    cursor = FakeCursor()
+    assert reserve_document_numbers('DSP', cursor, '12345', 3, ON_DATE) == [
+        "DSP-12345-240131-001", "DSP-12345-240131-002", "DSP-12345-240131-003",
+    ]
+    assert reserve_document_numbers('DSP', cursor, '12345', 2, ON_DATE) == ["DSP-12345-240131-004", "DSP-12345-240131-005"]
+    assert reserve_document_numbers('DSP', cursor, '12345', 0, ON_DATE) == []
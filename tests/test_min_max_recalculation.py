@@ -0,0 +1,42 @@
+# /tests/test_min_max_recalculation.py
+# ทดสอบว่า updated_successfully มาจากค่าที่บันทึกจริง (อ่านกลับหลัง UPDATE) ไม่ใช่ True เสมอ
+import blueprints.inventory as inventory
+
+
+class FakeCursor:
+    """ตอบ query ยอดจ่ายและการอ่าน min/max กลับ ส่วน UPDATE ของยา id 2 ถูกข้าม (จำลองแถวที่ไม่ถูกบันทึก)"""
+
+    def __init__(self):
+        self.rows = []
+        self.rowcount = 0
+        self.stored = {1: (0, 0), 2: (0, 0)}
+
+    def execute(self, query, params=()):
+        sql = " ".join(query.split())
+        self.rows = []
+        if sql.startswith("SELECT m.id, m.generic_name"):
+            self.rows = [
+                {"id": 1, "generic_name": "A", "lead_time_days": 10, "review_period_days": 20, "total_dispensed": 90},
+                {"id": 2, "generic_name": "B", "lead_time_days": 10, "review_period_days": 20, "total_dispensed": 180},
+            ]
+        elif sql.startswith("UPDATE medicines SET"):
+            self.stored[1] = (10, 30)
+        elif sql.startswith("SELECT id, min_stock, max_stock FROM medicines"):
+            self.rows = [{"id": medicine_id, "min_stock": values[0], "max_stock": values[1]} for medicine_id, values in self.stored.items()]
+        elif sql.startswith("SELECT LAST_INSERT_ID()"):
+            self.rows = [{"seq": 1, "last_value": 1}]
+
+    def executemany(self, query, rows):
+        pass
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def fetchall(self):
+        return self.rows
+
+
+def test_updated_successfully_reflects_stored_values():
+    details = inventory.recalculate_min_max_for_hcode('12345', 90, FakeCursor())
+    outcome = {detail['medicine_id']: (detail['final_min_stock'], detail['final_max_stock'], detail['updated_successfully']) for detail in details}
+    assert outcome == {1: (10, 30, True), 2: (20, 60, False)}
@@ -0,0 +1,134 @@
+# /tests/test_receive_upload.py
+# ทดสอบการบันทึกการรับยาจากไฟล์ผ่าน endpoint จริง โดยใช้ connection จำลองที่ทำงานแบบ mysql-connector
+# (autocommit ปิด: query แรกเปิด transaction โดยนัย และ start_transaction ซ้อนจะ error)
+import io
+from datetime import datetime
+
+import pytest
+from flask import Flask
+from mysql.connector import ProgrammingError
+
+import blueprints.receive as receive
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.rows = []
+        self.rowcount = 0
+        self.lastrowid = None
+
+    def execute(self, query, params=()):
+        self.conn.in_transaction = True
+        self.conn.executed.append(query)
+        sql = " ".join(query.split())
+        self.rows, self.rowcount = [], 0
+        if sql.startswith("SELECT id, medicine_code, generic_name"):
+            self.rows = [med for med in self.conn.medicines if med['medicine_code'] in params[1:]]
+        elif sql.startswith("SELECT LAST_INSERT_ID() AS "):
+            self.rows = [{sql.rsplit(" ", 1)[-1]: 1}]
+        elif sql.startswith("INSERT INTO goods_received_vouchers"):
+            self.lastrowid = 501
+            self.rowcount = 1
+
+    def executemany(self, query, seq_params):
+        self.conn.in_transaction = True
+        self.conn.executed.append(query)
+
+    def fetchall(self):
+        return self.rows
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, medicines):
+        self.medicines = medicines
+        self.in_transaction = False
+        self.executed = []
+        self.commits = 0
+
+    def cursor(self, dictionary=False):
+        return FakeCursor(self)
+
+    def start_transaction(self):
+        if self.in_transaction:
+            raise ProgrammingError(msg="Transaction already in progress")
+        self.in_transaction = True
+
+    def commit(self):
+        self.in_transaction = False
+        self.commits += 1
+
+    def rollback(self):
+        self.in_transaction = False
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def fake_conn(monkeypatch):
+    conn = FakeConnection([{"id": 7, "medicine_code": "PARA500", "generic_name": "Paracetamol", "strength": "500 mg", "unit": "เม็ด"}])
+    monkeypatch.setattr(receive, 'get_db_connection', lambda: conn)
+    monkeypatch.setattr(receive, 'invalidate_clinic_stock_caches', lambda hcode: None)
+    return conn
+
+
+@pytest.fixture
+def client():
+    app = Flask(__name__)
+    app.register_blueprint(receive.receive_bp)
+    return app.test_client()
+
+
+def test_upload_process_saves_valid_file(client, fake_conn):
+    csv_data = "รหัสยา,เลขที่ล็อต,วันหมดอายุ,จำนวน\nPARA500,L001,2027-12-31,100\nPARA500,L002,2028-06-30,50\n".encode('utf-8')
+    response = client.post('/api/goods_received/upload/process', data={
+        "file": (io.BytesIO(csv_data), "receive.csv"),
+        "hcode": "12345",
+        "receiver_id": "3",
+        "received_date": "01/10/2569",
+        "voucher_number": "GRN-TEST-1",
+    }, content_type='multipart/form-data')
+
+    assert response.status_code == 201, response.get_json()
+    body = response.get_json()
+    assert body["voucher_id"] == 501
+    assert body["voucher_number"] == "GRN-TEST-1"
+    assert body["summary"]["total_rows"] == 2
+    assert body["summary"]["total_quantity"] == 150
+    assert fake_conn.commits == 1
+    assert any("INSERT INTO inventory_transactions" in query for query in fake_conn.executed)
+
+
+def test_upload_process_numbers_voucher_in_same_transaction(client, fake_conn):
+    csv_data = "รหัสยา,เลขที่ล็อต,วันหมดอายุ,จำนวน\nPARA500,L001,2027-12-31,100\n".encode('utf-8')
+    response = client.post('/api/goods_received/upload/process', data={
+        "file": (io.BytesIO(csv_data), "receive.csv"),
+        "hcode": "12345",
+        "receiver_id": "3",
+        "received_date": "01/10/2569",
+    }, content_type='multipart/form-data')
+
+    assert response.status_code == 201, response.get_json()
+    assert response.get_json()["voucher_number"] == f"GRN-12345-{datetime.now().strftime('%y%m%d')}-001"
+    assert any("INSERT INTO document_sequences" in query for query in fake_conn.executed)
+
+
+def test_upload_process_rejects_unknown_medicine(client, fake_conn):
+    csv_data = "รหัสยา,เลขที่ล็อต,วันหมดอายุ,จำนวน\nUNKNOWN,L001,2027-12-31,10\n".encode('utf-8')
+    response = client.post('/api/goods_received/upload/process', data={
+        "file": (io.BytesIO(csv_data), "receive.csv"),
+        "hcode": "12345",
+        "receiver_id": "3",
+        "received_date": "01/10/2569",
+    }, content_type='multipart/form-data')
+
+    assert response.status_code == 400
+    assert response.get_json()["failed_rows"][0]["medicine_code"] == "UNKNOWN"
+    assert fake_conn.commits == 0
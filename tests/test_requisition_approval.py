@@ -0,0 +1,30 @@
+# /tests/test_requisition_approval.py
+# ทดสอบการตรวจข้อมูลการอนุมัติใบเบิก: ค่าที่ไม่ใช่ตัวเลขต้องได้ RequisitionApprovalError (400) ไม่ใช่ 500
+import pytest
+
+from blueprints.requisitions import _plan_requisition_approval, RequisitionApprovalError
+
+REQUISITION = {"status": 'รออนุมัติ', "items": {11: 5, 12: 3}}
+
+
+def test_plan_approves_all_items_as_requested():
+    item_updates, final_status = _plan_requisition_approval(1, REQUISITION, None)
+    assert final_status == 'อนุมัติแล้ว'
+    assert [(update[0], update[1]) for update in item_updates] == [(11, 5), (12, 3)]
+
+
+def test_plan_accepts_numeric_strings():
+    item_updates, final_status = _plan_requisition_approval(1, REQUISITION, [
+        {"requisition_item_id": "11", "quantity_approved": "2", "item_approval_status": 'แก้ไขจำนวน'},
+    ])
+    assert final_status == 'อนุมัติบางส่วน'
+    assert item_updates[0][:2] == (11, 2)
+
+
+@pytest.mark.parametrize("item_id, quantity", [("abc", 5), (11, "five"), (11, [5])])
+def test_plan_rejects_non_numeric_values(item_id, quantity):
+    with pytest.raises(RequisitionApprovalError) as excinfo:
+        _plan_requisition_approval(1, REQUISITION, [
+            {"requisition_item_id": item_id, "quantity_approved": quantity, "item_approval_status": 'อนุมัติ'},
+        ])
+    assert excinfo.value.status_code == 400
@@ -0,0 +1,23 @@
+# /tests/test_spreadsheet.py
+# ทดสอบการตัดรายการ preview ตามค่าเริ่มต้น และการวัดหน่วยความจำแบบ ru_maxrss ที่เปิดไว้เป็นค่าเริ่มต้น
+from helpers.spreadsheet import limit_preview_items, track_upload_memory, MaxRssMemoryTracker
+
+
+def test_limit_preview_items_keeps_error_rows_first():
+    preview_items = [{"row_num": row_num, "errors": ["ผิด"] if row_num == 4 else []} for row_num in range(2, 6)]
+    limited, truncated = limit_preview_items(preview_items, 2)
+    assert truncated is True
+    assert [item["row_num"] for item in limited] == [4, 2]
+
+
+def test_limit_preview_items_returns_short_list_unchanged():
+    preview_items = [{"row_num": 2, "errors": []}]
+    assert limit_preview_items(preview_items, 200) == (preview_items, False)
+
+
+def test_default_tracker_reports_max_rss_growth():
+    with track_upload_memory() as memory_tracker:
+        buffer = b'\x01' * (32 * 1024 * 1024)
+    assert isinstance(memory_tracker, MaxRssMemoryTracker)
+    assert memory_tracker.peak_memory_mb >= 0
+    del buffer